@@ -0,0 +1,489 @@
+import copy
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+from calrissian.cache import cache_key
+from calrissian.concurrency import ConcurrencyLimits, concurrency_of
+from calrissian.executor import Resources
+from calrissian.iobudget import IOBudget
+from calrissian.job import CalrissianCommandLineJob, k8s_safe_name, random_tag
+from calrissian.k8s import KubernetesClient, CompletionResult
+from calrissian.pool import command_lines
+
+log = logging.getLogger('calrissian.batch')
+
+# Each job of a batch pod writes its exit code and start and finish times in a status file, in a directory bound here
+BATCH_STATUS_ROOT = '/var/run/calrissian-batch'
+BATCH_STATUS_FILENAME = 'status'
+
+# Batch size used until the runtime of a kind of job has been observed
+DEFAULT_TARGET_SECONDS = 300
+
+# Backends running the jobs of a batch: sequentially or in parallel in one pod, or in the pods of an Indexed Job
+POD_BACKEND = 'pod'
+INDEXED_JOB_BACKEND = 'indexed-job'
+BACKENDS = [POD_BACKEND, INDEXED_JOB_BACKEND]
+
+# Annotation of Indexed Job pods holding their completion index
+COMPLETION_INDEX_ANNOTATION = 'batch.kubernetes.io/job-completion-index'
+
+# How many times the job controller retries the pod of an index that failed, e.g. evicted. Retried per index with
+# backoffLimitPerIndex from Kubernetes 1.28, see indexed_job_body
+INDEXED_JOB_RETRIES = 2
+
+
+def scale_resources(container_resources, factor):
+    """
+    Multiply the cpu and memory requests and limits of a container, as built by KubernetesPodBuilder
+    :param container_resources: dict of requests and limits
+    :param factor: int
+    :return: dict
+    """
+    scaled = copy.deepcopy(container_resources)
+    for bound in scaled.values():
+        if 'cpu' in bound:
+            cpu = float(bound['cpu']) * factor
+            bound['cpu'] = '{}'.format(int(cpu) if cpu.is_integer() else cpu)
+        if 'memory' in bound:
+            memory = float(bound['memory'][:-len('Mi')]) * factor
+            bound['memory'] = '{}Mi'.format(int(memory) if memory.is_integer() else memory)
+    return scaled
+
+
+def job_script(pod, status_path):
+    """
+    Build the shell lines running the command line of a job pod in a subshell, with its environment and working
+    directory, and writing its exit code and start and finish times to status_path
+    :param pod: dict, job pod spec built by KubernetesPodBuilder
+    :param status_path: str, path of the status file in the batch pod
+    :return: str
+    """
+    lines = ['set -e'] + command_lines(pod)
+    # The exit code is the command line's, a failure before it leaves no status
+    lines[-1:-1] = ['set +e', 'start=$(date +%s)']
+    lines.append('echo "$? $start $(date +%s)" > {}'.format(status_path))
+    return '(\n{}\n)'.format('\n'.join(lines))
+
+
+def batch_pod_body(pods, parallelism):
+    """
+    Combine the pod specs of compatible jobs into the spec of a single pod running their command lines,
+    parallelism at a time
+    :param pods: list of (dict, str) tuples, the pod spec built for each job and the path of its status file
+    :param parallelism: int, how many command lines run at once. The resources of the pod are scaled by it.
+    :return: dict
+    """
+    first = pods[0][0]
+    body = copy.deepcopy(first)
+    body['metadata']['name'] = k8s_safe_name('{}-batch-{}'.format(first['metadata']['name'], random_tag()))
+    spec = body['spec']
+    # Directories of redirected stdout/stderr are created in each job's script
+    spec.pop('initContainers', None)
+    volumes, volume_mounts = [], []
+    for pod, _ in pods:
+        for volume in pod['spec']['volumes']:
+            if volume['name'] not in [v['name'] for v in volumes]:
+                volumes.append(volume)
+        for volume_mount in pod['spec']['containers'][0]['volumeMounts']:
+            if volume_mount not in volume_mounts:
+                volume_mounts.append(volume_mount)
+    spec['volumes'] = volumes
+    container = spec['containers'][0]
+    container.pop('env', None)
+    container['volumeMounts'] = volume_mounts
+    container['resources'] = scale_resources(container['resources'], parallelism)
+    scripts = []
+    for index, (pod, status_path) in enumerate(pods):
+        if parallelism > 1:
+            scripts.append(job_script(pod, status_path) + ' &')
+            if (index + 1) % parallelism == 0 or index + 1 == len(pods):
+                scripts.append('wait')
+        else:
+            scripts.append(job_script(pod, status_path))
+    container['args'] = ['\n'.join(scripts)]
+    return body
+
+
+def indexed_job_body(pods, parallelism, retries_per_index=True):
+    """
+    Combine the pod specs of compatible jobs into the spec of an Indexed Job, whose pod of each completion index
+    runs the command line of the job at that index
+    :param pods: list of (dict, str) tuples, the pod spec built for each job and the path of its status file
+    :param parallelism: int, how many pods run at once
+    :param retries_per_index: bool, retry the pod of each index INDEXED_JOB_RETRIES times with backoffLimitPerIndex,
+    which needs Kubernetes 1.28 or later. Otherwise the pods of all indexes share a backoffLimit of that many retries
+    per index.
+    :return: dict
+    """
+    pod = batch_pod_body(pods, 1)
+    # Job names are also label values, so must be short
+    pod['metadata']['name'] = 'calrissian-batch-{}'.format(random_tag())
+    branches = ['{})\n{}\n;;'.format(index, job_script(job_pod, status_path))
+                for index, (job_pod, status_path) in enumerate(pods)]
+    pod['spec']['containers'][0]['args'] = ['case "$JOB_COMPLETION_INDEX" in\n{}\nesac'.format('\n'.join(branches))]
+    body = {
+        'apiVersion': 'batch/v1',
+        'kind': 'Job',
+        'metadata': pod['metadata'],
+        'spec': {
+            'completionMode': 'Indexed',
+            'completions': len(pods),
+            'parallelism': parallelism,
+            'template': {
+                'metadata': {'labels': pod['metadata']['labels']},
+                'spec': pod['spec'],
+            },
+        },
+    }
+    # A failing command line writes its status and exits 0, so only failures of the pods are retried
+    if retries_per_index:
+        body['spec']['backoffLimitPerIndex'] = INDEXED_JOB_RETRIES
+    else:
+        body['spec']['backoffLimit'] = INDEXED_JOB_RETRIES * len(pods)
+    return body
+
+
+def status_paths(batched):
+    """
+    :param batched: list of (job, pod, status_dir, status_target) tuples
+    :return: list of (pod, status path in the pod) tuples
+    """
+    return [(pod, '{}/{}'.format(status_target, BATCH_STATUS_FILENAME)) for _, pod, _, status_target in batched]
+
+
+def mount_conflicts(pod, volume_mounts):
+    """
+    :param pod: dict, job pod spec
+    :param volume_mounts: list of volume mounts already in a batch pod
+    :return: True if the pod mounts something else at a path mounted in the batch pod
+    """
+    mounted = {m['mountPath']: m for m in volume_mounts}
+    return any(m['mountPath'] in mounted and mounted[m['mountPath']] != m
+               for m in pod['spec']['containers'][0]['volumeMounts'])
+
+
+def read_status(status_path):
+    """
+    :param status_path: str, path of the status file written by job_script()
+    :return: (exit_code, start_time, finish_time) tuple. Missing values are None.
+    """
+    try:
+        with open(status_path) as f:
+            fields = f.read().split()
+    except OSError:
+        return None, None, None
+    values = []
+    for field in fields[:3]:
+        try:
+            values.append(int(field))
+        except ValueError:
+            values.append(None)
+    values.extend([None] * (3 - len(values)))
+    exit_code, start, finish = values
+    start_time = datetime.fromtimestamp(start, timezone.utc) if start is not None else None
+    finish_time = datetime.fromtimestamp(finish, timezone.utc) if finish is not None else None
+    return exit_code, start_time, finish_time
+
+
+class JobBatch(object):
+    """
+    A group of compatible CalrissianCommandLineJobs run in a single pod, queued and run by the executor as one job.
+
+    Each job stages its inputs and builds its pod spec as usual. The pod specs are then combined into one pod, whose
+    command runs each job's command line in a subshell with the job's environment and working directory. The exit
+    code of each command line is written to a status file in the job's tmpdir, and handed to the job's finish()
+    with the job's own resources and times, so that its outputs are collected and its output callback called as if
+    it had run in its own pod. Jobs of a batch share the pod's /tmp.
+    """
+
+    def __init__(self, jobs, key, parallelism, batcher):
+        self.jobs = jobs
+        self.key = key
+        self.parallelism = parallelism
+        self.batcher = batcher
+        self.outdir = None
+        self.name = '{}-batch'.format(jobs[0].name)
+
+    def __str__(self):
+        return 'JobBatch {} of {} jobs'.format(self.name, len(self.jobs))
+
+    def prepare(self, runtime_context, tmpdir_lock=None):
+        """
+        Stage the inputs of the jobs and build their pod specs
+        :return: list of (job, pod, status_dir, status_target) tuples, for the jobs that must run
+        """
+        prepared = []
+        for job in self.jobs:
+            job.check_requirements(runtime_context)
+            if job.resume_from_journal(runtime_context):
+                continue
+            job.prepare_run(runtime_context, tmpdir_lock)
+            if job.restore_from_step_cache(runtime_context):
+                continue
+            status_dir = tempfile.mkdtemp(dir=job.tmpdir)
+            status_target = '{}/{}'.format(BATCH_STATUS_ROOT, len(prepared))
+            job.volume_builder.add_volume_binding(status_dir, status_target, writable=True)
+            prepared.append((job, job.create_kubernetes_runtime(runtime_context), status_dir, status_target))
+        return prepared
+
+    def run(self, runtime_context, tmpdir_lock=None):
+        batched, volume_mounts = [], []
+        for job, pod, status_dir, status_target in self.prepare(runtime_context, tmpdir_lock):
+            if mount_conflicts(pod, volume_mounts):
+                # e.g. jobs with the same outdir in the container
+                log.info('Job {} mounts conflict with its batch, running it in its own pod'.format(job.name))
+                job.finish(job.run_kubernetes_pod(pod, runtime_context), runtime_context)
+            elif job.reference_cache_entries:
+                # The batch pod has no init container filling the reference cache
+                log.info('Job {} reads inputs from the reference cache, running it in its own pod'.format(job.name))
+                job.finish(job.run_kubernetes_pod(pod, runtime_context), runtime_context)
+            else:
+                batched.append((job, pod, status_dir, status_target))
+                volume_mounts.extend(pod['spec']['containers'][0]['volumeMounts'])
+        if not batched:
+            return
+        batch_result, tool_logs = self.execute(batched)
+        for (job, pod, status_dir, _), tool_log in zip(batched, tool_logs):
+            exit_code, start_time, finish_time = read_status(os.path.join(status_dir, BATCH_STATUS_FILENAME))
+            if exit_code is None:
+                # The batch was killed before the job finished
+                exit_code = batch_result.exit_code or 1
+            if exit_code != 0:
+                log.error('ERROR the command of job {} failed in batch {}:'.format(job.name, self.name))
+                log.error('\t' + pod['spec']['containers'][0]['args'][0])
+            requests = pod['spec']['containers'][0]['resources'].get('requests', {})
+            completion_result = CompletionResult(
+                exit_code,
+                requests.get('cpu'),
+                requests.get('memory'),
+                start_time or batch_result.start_time,
+                finish_time or batch_result.finish_time,
+                tool_log,
+                batch_result.node_selectors,
+            )
+            if start_time and finish_time:
+                self.batcher.record(self.key, (finish_time - start_time).total_seconds())
+            job.finish(completion_result, runtime_context)
+
+    def execute(self, batched):
+        """
+        Run the command lines of the batched jobs in a single pod
+        :param batched: list of (job, pod, status_dir, status_target) tuples
+        :return: (CompletionResult of the batch, list of the tool log of each job) tuple
+        """
+        parallelism = min(self.parallelism, len(batched))
+        body = batch_pod_body(status_paths(batched), parallelism)
+        log.info('Running {} jobs in batch pod {}'.format(len(batched), body['metadata']['name']))
+        client = KubernetesClient()
+        client.submit_pod(body)
+        batch_result = client.wait_for_completion()
+        return batch_result, [batch_result.tool_log] * len(batched)
+
+
+class IndexedJobBatch(JobBatch):
+    """
+    A JobBatch run as a Kubernetes Indexed Job instead of a single pod: each job of the batch runs in the pod of its
+    completion index, parallelism pods at a time. Submitting a batch takes a single API request, and pods that fail
+    for other reasons than their command line, e.g. evicted, are retried by the job controller. The batch is queued
+    with the resources of a single pod, and its parallelism raised when dequeued to as many pods as the resources
+    left in its pool fit, see JobBatcher.widen.
+
+    Jobs still running on termination are deleted by the static cleanup() method.
+    """
+    job_names = []
+    lock = threading.Lock()
+
+    def execute(self, batched):
+        body = indexed_job_body(status_paths(batched), min(self.parallelism, len(batched)),
+                                self.batcher.retries_per_index)
+        name = body['metadata']['name']
+        log.info('Running {} jobs in indexed job {}'.format(len(batched), name))
+        client = KubernetesClient()
+        with IndexedJobBatch.lock:
+            client.create_job(body)
+            IndexedJobBatch.job_names.append(name)
+        tool_logs = [[] for _ in batched]
+        try:
+            k8s_job = client.wait_for_job(name)
+            for pod in client.list_pods_for_selector('job-name={}'.format(name)):
+                index = (pod.metadata.annotations or {}).get(COMPLETION_INDEX_ANNOTATION)
+                try:
+                    tool_logs[int(index)].extend(client.read_pod_log(pod.metadata.name))
+                except Exception:
+                    log.error('Unable to read the log of pod {}, ignoring'.format(pod.metadata.name))
+        finally:
+            with IndexedJobBatch.lock:
+                client.delete_job_name(name)
+                if name in IndexedJobBatch.job_names:
+                    IndexedJobBatch.job_names.remove(name)
+        pod_spec = body['spec']['template']['spec']
+        requests = pod_spec['containers'][0]['resources'].get('requests', {})
+        batch_result = CompletionResult(
+            0 if k8s_job.status.succeeded == len(batched) else 1,
+            requests.get('cpu'),
+            requests.get('memory'),
+            k8s_job.status.start_time,
+            k8s_job.status.completion_time or datetime.now(timezone.utc),
+            [],
+            pod_spec['nodeSelector'],
+        )
+        return batch_result, tool_logs
+
+    @staticmethod
+    def cleanup():
+        with IndexedJobBatch.lock:
+            if not IndexedJobBatch.job_names:
+                return
+            k8s_client = KubernetesClient()
+            for job_name in IndexedJobBatch.job_names:
+                log.info('IndexedJobBatch deleting job {}'.format(job_name))
+                try:
+                    k8s_client.delete_job_name(job_name)
+                except Exception:
+                    log.error('Error deleting job named {}, ignoring'.format(job_name))
+            IndexedJobBatch.job_names = []
+
+
+class JobBatcher(object):
+    """
+    Coalesces queued jobs that can share a pod into JobBatches, so that scatters of many short jobs do not pay the
+    scheduling and startup cost of a pod per job.
+
+    Jobs can share a pod when they run the same tool in the same image with the same resources. A batch holds as
+    many jobs as expected to run for about target_seconds, from the runtimes observed for the same kind of job,
+    up to max_size. Its command lines run parallelism at a time, and its pod requests the resources of that many jobs.
+    With the indexed-job backend, batches run as Indexed Jobs instead, of as many pods at a time as the resources of
+    their pool fit when they are dequeued.
+    """
+
+    def __init__(self, max_size, target_seconds=DEFAULT_TARGET_SECONDS, parallelism=1, backend=POD_BACKEND,
+                 retries_per_index=True):
+        """
+        :param retries_per_index: bool, retry the pods of Indexed Jobs per index, see indexed_job_body
+        """
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.parallelism = parallelism
+        self.batch_class = IndexedJobBatch if backend == INDEXED_JOB_BACKEND else JobBatch
+        self.retries_per_index = retries_per_index
+        self.runtimes = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def batch_key(job):
+        """
+        :param job: a queued job
+        :return: str, equal for jobs that can share a pod, or None if the job must run on its own
+        """
+        if not isinstance(job, CalrissianCommandLineJob) or not job.batchable:
+            return None
+        if job.fuse_downstream or job.fused_upstream:
+            # Fused steps run in the runner pod of their chain
+            return None
+        if job.timelimit:
+            # activeDeadlineSeconds would bound the whole batch, not each job
+            return None
+        if job.get_requirement('http://commonwl.org/cwltool#CUDARequirement')[0]:
+            return None
+        try:
+            image = job._get_container_image()
+        except Exception:
+            return None
+        return cache_key({
+            'tool': job.tool_document,
+            'image': image,
+            'resources': job.builder.resources,
+        })
+
+    def record(self, key, seconds):
+        """
+        Record the runtime of a batched job
+        """
+        with self.lock:
+            count, total = self.runtimes.get(key, (0, 0))
+            self.runtimes[key] = (count + 1, total + seconds)
+
+    def batch_size(self, key):
+        """
+        :param key: batch key of the jobs
+        :return: int, how many of these jobs to run in a pod
+        """
+        with self.lock:
+            count, total = self.runtimes.get(key, (0, 0))
+        if not count:
+            return self.max_size
+        mean_seconds = max(total / count, 1)
+        size = int(self.target_seconds * self.parallelism / mean_seconds)
+        return max(1, min(size, self.max_size))
+
+    def batch(self, jrq, total_resources):
+        """
+        Replace groups of compatible jobs in a JobResourceQueue with JobBatches
+        :param jrq: JobResourceQueue
+        :param total_resources: Resources, a batch must fit in them
+        """
+        groups = {}
+        for job, rsc in list(jrq.jobs.items()):
+            key = self.batch_key(job)
+            if key is not None:
+                groups.setdefault(key, []).append((job, rsc))
+        for key, group in groups.items():
+            size = self.batch_size(key)
+            for start in range(0, len(group), size):
+                chunk = group[start:start + size]
+                if len(chunk) < 2:
+                    continue
+                rsc = chunk[0][1]
+                # Indexed Jobs are widened when dequeued, see widen
+                parallelism = 1 if self.batch_class is IndexedJobBatch else min(self.parallelism, len(chunk))
+                _, limit = concurrency_of(chunk[0][0])
+                if limit:
+                    # A batch running more commands at once than its Concurrency limit would never be admitted
+                    parallelism = min(parallelism, limit)
+                while parallelism > 1 and self.scale(rsc, parallelism).exceeds(total_resources):
+                    parallelism -= 1
+                jobs = [job for job, _ in chunk]
+                for job in jobs:
+                    jrq.jobs.pop(job)
+                jrq.jobs[self.batch_class(jobs, key, parallelism, self)] = self.scale(rsc, parallelism)
+                log.info('Batched {} jobs of {}, {} at a time'.format(len(jobs), jobs[0].name, parallelism))
+
+    @staticmethod
+    def widen(job, rsc, spare, admitted):
+        """
+        Raise the parallelism of a dequeued IndexedJobBatch to as many pods as the spare resources of its pool fit,
+        within the Concurrency limit of its jobs and the I/O budget
+        :param job: a dequeued job or JobBatch
+        :param rsc: Resources the job was dequeued with, those of a single pod for an IndexedJobBatch
+        :param spare: Resources of the pool left by the jobs dequeued with it
+        :param admitted: the other jobs dequeued with it
+        :return: (Resources to allocate to the job, spare Resources left) tuple
+        """
+        if not isinstance(job, IndexedJobBatch):
+            return rsc, spare
+        while job.parallelism < len(job.jobs) and spare - rsc >= Resources.EMPTY:
+            job.parallelism += 1
+            if not ConcurrencyLimits.can_admit(job, admitted) or not IOBudget.has_room(job, admitted):
+                job.parallelism -= 1
+                break
+            spare -= rsc
+        if job.parallelism > 1:
+            log.info('Running {} pods of {} at a time'.format(job.parallelism, job.name))
+        return rsc.scale(job.parallelism), spare
+
+    @staticmethod
+    def scale(rsc, factor):
+        return rsc.scale(factor)
+
+    @staticmethod
+    def members(job):
+        """
+        :param job: a dequeued job or JobBatch
+        :return: list of the jobs it runs
+        """
+        if isinstance(job, JobBatch):
+            return job.jobs
+        return [job]
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import uuid
+
+from calrissian.report import Reporter
+
+log = logging.getLogger("calrissian.cache")
+
+# cwltool stages each input in a directory named stg<uuid4> under the stagedir, so these names differ on every run
+STAGING_DIR_REGEX = re.compile('stg[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+
+def normalize(value, placeholders):
+    """
+    Replace the run-specific paths in a string, list or dict of strings with stable placeholders
+    :param value: str, list or dict
+    :param placeholders: dict of {path: placeholder}
+    :return: normalized copy of value
+    """
+    if isinstance(value, dict):
+        return {k: normalize(v, placeholders) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [normalize(v, placeholders) for v in value]
+    elif isinstance(value, str):
+        for path, placeholder in placeholders.items():
+            if path:
+                value = value.replace(path, placeholder)
+        return STAGING_DIR_REGEX.sub('stg', value)
+    else:
+        return value
+
+
+def file_fingerprint(path, checksum=None):
+    """
+    Identify the content of a file by its size and, when known, its checksum, falling back on its modification time.
+    Files restored from the cache keep their modification time (copies preserve it), so steps downstream of a cache
+    hit can hit the cache as well.
+    :param path: local path of the file
+    :param checksum: CWL checksum of the file, if computed
+    :return: list
+    """
+    stat = os.stat(path)
+    if checksum:
+        return [stat.st_size, checksum]
+    return [stat.st_size, int(stat.st_mtime * 1000)]
+
+
+def directory_fingerprint(path):
+    """
+    Identify the content of a directory by the fingerprints of the files it contains
+    :param path: local path of the directory
+    :return: sorted list of [relative path, size, modification time]
+    """
+    fingerprint = []
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            fingerprint.append([os.path.relpath(file_path, path)] + file_fingerprint(file_path))
+    return sorted(fingerprint)
+
+
+def cache_key(key_dict):
+    key_str = json.dumps(key_dict, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+
+def copy_tree(src, dst):
+    """
+    Copy src to dst, preserving modification times. Entries are not hardlinked to outdirs, so that a step rewriting
+    its inputs in place cannot change the entry it was restored from, nor the entry its upstream step stored.
+    """
+    shutil.copytree(src, dst, copy_function=shutil.copy2, symlinks=True, dirs_exist_ok=True)
+
+
+def tree_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+
+class StepCache(object):
+    """
+    Singleton thread-safe, content-addressed cache of step outputs, kept in a directory on the shared volume.
+
+    Each entry is a directory named after its key, holding the outdir of the step that produced it, and a
+    metadata file named <key>.json. The metadata file is written last and marks the entry as complete. Its
+    modification time is updated on each hit, and entries are evicted least recently used first when their
+    total size exceeds max_bytes. Entries being restored are pinned, and not evicted until they are copied.
+    """
+    HITS = 'hits'
+    MISSES = 'misses'
+    STORES = 'stores'
+    EVICTIONS = 'evictions'
+
+    directory = None
+    max_bytes = None
+    # Key to number of restores copying the entry
+    pinned = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def initialize(directory, max_bytes=None):
+        with StepCache.lock:
+            os.makedirs(directory, exist_ok=True)
+            StepCache.directory = directory
+            StepCache.max_bytes = max_bytes
+            StepCache.pinned = {}
+
+    @staticmethod
+    def is_enabled():
+        return StepCache.directory is not None
+
+    @staticmethod
+    def _entry_path(key):
+        return os.path.join(StepCache.directory, key)
+
+    @staticmethod
+    def _metadata_path(key):
+        return os.path.join(StepCache.directory, '{}.json'.format(key))
+
+    @staticmethod
+    def restore(key, outdir):
+        """
+        Look up a cache entry and copy its contents into outdir, marking the entry as recently used.
+        Holds the lock only to look up and pin the entry, so that it cannot be evicted while it is copied, and
+        other steps can use the cache meanwhile.
+        :param key: cache key
+        :param outdir: directory to restore the entry into
+        :return: True on a hit, False on a miss
+        """
+        with StepCache.lock:
+            metadata_path = StepCache._metadata_path(key)
+            if not os.path.exists(metadata_path):
+                Reporter.add_cache_event(StepCache.MISSES)
+                return False
+            os.utime(metadata_path)
+            StepCache.pinned[key] = StepCache.pinned.get(key, 0) + 1
+        try:
+            copy_tree(StepCache._entry_path(key), outdir)
+        finally:
+            with StepCache.lock:
+                StepCache.pinned[key] -= 1
+                if not StepCache.pinned[key]:
+                    del StepCache.pinned[key]
+        Reporter.add_cache_event(StepCache.HITS)
+        return True
+
+    @staticmethod
+    def store(key, outdir, **metadata):
+        """
+        Store the contents of outdir under key, then evict entries if the cache is over its size limit.
+        The entry is built in a temporary directory and renamed, so a partial entry is never visible.
+        :param key: cache key
+        :param outdir: directory to store
+        :param metadata: additional fields to save in the metadata file
+        """
+        if os.path.exists(StepCache._metadata_path(key)):
+            return
+        staging = os.path.join(StepCache.directory, '.{}-{}'.format(key, uuid.uuid4().hex))
+        copy_tree(outdir, staging)
+        size = tree_size(staging)
+        with StepCache.lock:
+            entry_path = StepCache._entry_path(key)
+            if os.path.exists(entry_path):
+                # Stored concurrently by an identical job
+                shutil.rmtree(staging, True)
+                return
+            os.rename(staging, entry_path)
+            with open(StepCache._metadata_path(key), 'w') as f:
+                json.dump(dict(metadata, size=size), f)
+            Reporter.add_cache_event(StepCache.STORES)
+            log.info('Stored {} bytes in step cache entry {}'.format(size, key))
+            StepCache._evict()
+
+    @staticmethod
+    def _evict():
+        # Called with the lock acquired
+        if not StepCache.max_bytes:
+            return
+        entries = []
+        for filename in os.listdir(StepCache.directory):
+            if filename.endswith('.json'):
+                metadata_path = os.path.join(StepCache.directory, filename)
+                with open(metadata_path) as f:
+                    size = json.load(f).get('size', 0)
+                entries.append((os.path.getmtime(metadata_path), filename[:-len('.json')], size))
+        total = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total <= StepCache.max_bytes:
+                break
+            if key in StepCache.pinned:
+                # Evicted by a later store once restored
+                continue
+            log.info('Evicting step cache entry {} ({} bytes)'.format(key, size))
+            # Remove the metadata first, so the entry stops being a hit before its files go away
+            os.remove(StepCache._metadata_path(key))
+            shutil.rmtree(StepCache._entry_path(key), True)
+            Reporter.add_cache_event(StepCache.EVICTIONS)
+            total -= size
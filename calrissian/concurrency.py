@@ -0,0 +1,77 @@
+import threading
+
+# Requirement or hint capping how many pods of a tool run at once, e.g. for steps calling a rate-limited service
+#   calrissian:Concurrency:
+#     maxConcurrency: 4
+#     group: geocoding-api
+# Jobs share a cap by group, by default the id of their tool.
+CONCURRENCY_REQUIREMENT = 'https://calrissian-cwl.github.io/schema#Concurrency'
+
+
+def concurrency_of(job):
+    """
+    :param job: a queued job, or a JobBatch of jobs of the same tool
+    :return: (group, limit) of the Concurrency requirement of the job, or (None, None) if it has none
+    """
+    members = getattr(job, 'jobs', None)
+    if isinstance(members, list) and members:
+        job = members[0]
+    group, limit = getattr(job, 'concurrency_group', None), getattr(job, 'concurrency_limit', None)
+    if not isinstance(group, str) or not isinstance(limit, int):
+        return None, None
+    return group, limit
+
+
+def concurrency_slots(job):
+    """
+    :param job: a queued job, or a JobBatch
+    :return: int: the number of commands the job runs at once, the parallelism of a JobBatch
+    """
+    if isinstance(getattr(job, 'jobs', None), list):
+        return job.parallelism
+    return 1
+
+
+class ConcurrencyLimits(object):
+    """
+    Singleton count of the running jobs of each Concurrency group, across the ResourcePools of the executor.
+    JobResourceQueue.dequeue skips the jobs of groups at their limit, so other queued jobs start in their place.
+    """
+    running = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def reset():
+        with ConcurrencyLimits.lock:
+            ConcurrencyLimits.running = {}
+
+    @staticmethod
+    def can_admit(job, admitted):
+        """
+        :param job: a queued job
+        :param admitted: the jobs admitted by the same dequeue, not started yet
+        :return: True if the job fits within the limit of its group
+        """
+        group, limit = concurrency_of(job)
+        if group is None:
+            return True
+        with ConcurrencyLimits.lock:
+            running = ConcurrencyLimits.running.get(group, 0)
+        running += sum(concurrency_slots(other) for other in admitted if concurrency_of(other)[0] == group)
+        return running + concurrency_slots(job) <= limit
+
+    @staticmethod
+    def started(job):
+        group, _ = concurrency_of(job)
+        if group is None:
+            return
+        with ConcurrencyLimits.lock:
+            ConcurrencyLimits.running[group] = ConcurrencyLimits.running.get(group, 0) + concurrency_slots(job)
+
+    @staticmethod
+    def finished(job):
+        group, _ = concurrency_of(job)
+        if group is None:
+            return
+        with ConcurrencyLimits.lock:
+            ConcurrencyLimits.running[group] = max(0, ConcurrencyLimits.running.get(group, 0) - concurrency_slots(job))
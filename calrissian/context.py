@@ -23,7 +23,13 @@ class CalrissianRuntimeContext(RuntimeContext):
         self.pod_gpu_nodeselectors = None
         self.pod_serviceaccount = None
         self.tool_logs_basepath = None
+        self.max_ram = None
         self.max_gpus = None
+        # NAME=QUANTITY values of --max-resource, and the --resource-pools file setting the limits of each pool instead
+        self.max_resource = None
+        self.resource_pools = None
+        # Replicas of each time-sliced GPU, that GPUShare hints are requested in
+        self.gpu_slices = 1
         self.no_network_access_pod_labels = None
         self.network_access_pod_labels = None
 
@@ -33,4 +39,39 @@ class CalrissianRuntimeContext(RuntimeContext):
 
         self.dask_gateway_url = None
         self.dask_script_configmap = None
+
+        # Resubmit pods evicted, preempted or lost with their node up to this many times
+        self.max_pod_resubmissions = 0
+        # Retry OOMKilled jobs with their RAM request scaled by this factor
+        self.oom_retry_factor = None
+        self.oom_max_retries = 0
+        # Set to ThreadPoolJobExecutor methods, like select_resources
+        self.reserve_resources = None
+        self.release_resources = None
+        # Write outdirs on a scratch volume of the node and copy them back, see CalrissianCommandLineJob.uses_scratch_outdir
+        self.scratch_outdir = False
+        self.scratch_storage_class = None
+        # Mount /tmp as a tmpfs the size of tmpdirMin, added to the RAM of jobs, see CalrissianCommandLineTool.memory_tmpdir
+        self.memory_tmpdir = False
+        # Set to a calrissian.stripe.OutdirStriper to create outdirs on several volumes
+        self.outdir_striper = None
+        # Names of the workflow steps the context was copied for, outermost first, see name
+        self.step_path = ()
         return super(CalrissianRuntimeContext, self).__init__(kwargs)
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        # WorkflowJobStep.job names a copy of the context of its workflow after the step, so the steps of a
+        # sub-workflow are named in a copy of the context of the step running it, and step_path keeps the nesting.
+        self._name = name
+        if name:
+            self.step_path = getattr(self, 'step_path', ()) + (name,)
+
+    def create_outdir(self):
+        if self.outdir_striper is not None:
+            return self.outdir_striper.create_outdir()
+        return super(CalrissianRuntimeContext, self).create_outdir()
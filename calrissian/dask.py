@@ -206,6 +206,9 @@ class KubernetesDaskPodBuilder(KubernetesPodBuilder):
 class CalrissianCommandLineDaskJob(CalrissianCommandLineJob):
 
     container_shared_dir = '/shared'
+
+    # Dask clusters are created per pod
+    batchable = False
     
     dask_gateway_controller_dir = '/controller'
 
@@ -334,6 +337,9 @@ class CalrissianCommandLineDaskJob(CalrissianCommandLineJob):
             return pod['spec']['containers'][0]['name']
 
         self.check_requirements(runtimeContext)
+
+        if self.resume_from_journal(runtimeContext):
+            return
         
         if tmpdir_lock:
             with tmpdir_lock:
@@ -1,5 +1,6 @@
 import functools
 import threading
+import time
 from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 from queue import Queue
 
@@ -7,8 +8,17 @@ from cwltool.errors import WorkflowException
 from cwltool.executors import JobExecutor
 from schema_salad.validate import ValidationException
 import logging
+
+from calrissian.concurrency import ConcurrencyLimits
+from calrissian.iobudget import IOBudget
+from calrissian.overcommit import MemoryOvercommit
+from calrissian.report import EPHEMERAL_STORAGE, DEFAULT_POOL
+
 log = logging.getLogger("calrissian.executor")
 
+# Interval between checks for the resources a running job waits to reserve
+RESERVE_POLL_SECONDS = 5
+
 class DuplicateJobException(Exception):
     pass
 
@@ -28,63 +38,90 @@ class IncompleteStatusException(Exception):
 class Resources(object):
     """
     Class to encapsulate compute resources and provide arithmetic operations and comparisons
+
+    Besides ram, cores and gpus, extended maps other Kubernetes resource names, e.g. ephemeral-storage, hugepages-2Mi
+    or vendor resources, to their amounts. Resources missing from extended amount to 0.
     """
+    __slots__ = ('ram', 'cores', 'gpus', 'extended')
+
     RAM = 'ram'
     CORES = 'cores'
     GPUS = 'gpus'
+    EXTENDED = 'extended'
 
-    def __init__(self, ram=0, cores=0, gpus=0):
+    def __init__(self, ram=0, cores=0, gpus=0, extended=None):
         self.ram = ram
         self.cores = cores
         self.gpus = gpus
+        self.extended = dict(extended) if extended else {}
+
+    def _extended_names(self, other):
+        return set(self.extended) | set(other.extended)
+
+    def _pairs(self, other):
+        """
+        :return: list of (amount in self, amount in other) of every resource
+        """
+        pairs = [(self.ram, other.ram), (self.cores, other.cores), (self.gpus, other.gpus)]
+        for name in sorted(self._extended_names(other)):
+            pairs.append((self.extended.get(name, 0), other.extended.get(name, 0)))
+        return pairs
+
+    def _combine(self, other, operation):
+        extended = {name: operation(self.extended.get(name, 0), other.extended.get(name, 0))
+                    for name in self._extended_names(other)}
+        return Resources(operation(self.ram, other.ram), operation(self.cores, other.cores),
+                         operation(self.gpus, other.gpus), extended)
 
     def __sub__(self, other):
-        ram = self.ram - other.ram
-        cores = self.cores - other.cores
-        gpus = self.gpus - other.gpus
-        return Resources(ram, cores, gpus)
+        return self._combine(other, lambda a, b: a - b)
 
     def __add__(self, other):
-        ram = self.ram + other.ram
-        cores = self.cores + other.cores
-        gpus = self.gpus + other.gpus
-        return Resources(ram, cores, gpus)
+        return self._combine(other, lambda a, b: a + b)
 
     def __neg__(self):
-        return Resources(-self.ram, -self.cores, -self.gpus)
+        return Resources.EMPTY - self
 
     def __lt__(self, other):
-        return self.ram < other.ram and self.cores < other.cores and self.gpus < other.gpus
+        return all(a < b for a, b in self._pairs(other))
 
     def __gt__(self, other):
-        return self.ram > other.ram and self.cores > other.cores and self.gpus > other.gpus
+        return all(a > b for a, b in self._pairs(other))
 
     def __eq__(self, other):
-        return self.ram == other.ram and self.cores == other.cores and self.gpus == other.gpus
+        return all(a == b for a, b in self._pairs(other))
 
     def __ge__(self, other):
-        return self.ram >= other.ram and self.cores >= other.cores and self.gpus >= other.gpus
+        return all(a >= b for a, b in self._pairs(other))
 
     def __le__(self, other):
-        return self.ram <= other.ram and self.cores <= other.cores and self.gpus <= other.gpus
+        return all(a <= b for a, b in self._pairs(other))
 
     def __str__(self):
-        return '[ram: {}, cores: {}, gpus {}]'.format(self.ram, self.cores, self.gpus)
+        extended = ''.join(', {}: {}'.format(name, amount) for name, amount in sorted(self.extended.items()))
+        return '[ram: {}, cores: {}, gpus {}{}]'.format(self.ram, self.cores, self.gpus, extended)
 
     def is_negative(self):
-        return self.ram < 0 or self.cores < 0 or self.gpus < 0
+        return self.ram < 0 or self.cores < 0 or self.gpus < 0 or any(a < 0 for a in self.extended.values())
 
     def exceeds(self, other):
-        return self.ram > other.ram or self.cores > other.cores or self.gpus > other.gpus
+        return any(a > b for a, b in self._pairs(other))
+
+    def scale(self, factor):
+        return Resources(self.ram * factor, self.cores * factor, self.gpus * factor,
+                         {name: amount * factor for name, amount in self.extended.items()})
 
     def to_dict(self):
-        return { Resources.CORES: self.cores,
-                 Resources.RAM: self.ram,
-                 Resources.GPUS: self.gpus }
+        result = { Resources.CORES: self.cores,
+                   Resources.RAM: self.ram,
+                   Resources.GPUS: self.gpus }
+        if self.extended:
+            result[Resources.EXTENDED] = dict(self.extended)
+        return result
 
     @classmethod
     def from_dict(cls, d):
-        return cls(d.get(cls.RAM, 0), d.get(cls.CORES, 0), d.get(cls.GPUS, 0))
+        return cls(d.get(cls.RAM, 0), d.get(cls.CORES, 0), d.get(cls.GPUS, 0), d.get(cls.EXTENDED))
 
     @classmethod
     def from_job(cls, job):
@@ -95,12 +132,22 @@ class Resources(object):
 
     @classmethod
     def min(cls, rsc1, rsc2):
-        return Resources(min(rsc1.ram, rsc2.ram), min(rsc1.cores, rsc2.cores), min(rsc1.gpus, rsc2.gpus))
+        return rsc1._combine(rsc2, min)
 
 
 Resources.EMPTY = Resources(0, 0, 0)
 
 
+def expected_runtime(job):
+    """
+    The ToolTimeLimit of a job bounds its runtime, as its pod is killed once it is exceeded
+    :param job: a queued or running job
+    :return: int: the maximum runtime of the job in seconds, or None if it is unbounded
+    """
+    timelimit = getattr(job, 'timelimit', None)
+    return timelimit if isinstance(timelimit, int) and timelimit > 0 else None
+
+
 class JobResourceQueue(object):
     """
     Contains a dictionary of jobs, mapped to their resources.
@@ -127,6 +174,33 @@ class JobResourceQueue(object):
         if job:
             self.jobs[job] = Resources.from_job(job)
 
+    def can_admit(self, job, admitted):
+        """
+        Whether a job may start besides the running jobs and those admitted by the same dequeue
+        :param job: a queued job
+        :param admitted: dict of the jobs admitted so far, to their Resources
+        :return: True unless its Concurrency group is at its limit or it exceeds the I/O budget, see
+        calrissian.concurrency and calrissian.iobudget
+        """
+        return ConcurrencyLimits.can_admit(job, admitted) and IOBudget.can_admit(job, admitted)
+
+    def release(self, job, rsc):
+        """
+        Called when a job dequeued from this queue finished
+        :param job: the job
+        :param rsc: Resources of the job
+        """
+        pass
+
+    def resize(self, job, rsc, resized):
+        """
+        Called when the resources of a job dequeued from this queue change before it starts, e.g. a widened JobBatch
+        :param job: the job
+        :param rsc: Resources the job was dequeued with
+        :param resized: Resources the job starts with
+        """
+        pass
+
     def is_empty(self):
         """
         Is the queue empty
@@ -141,24 +215,89 @@ class JobResourceQueue(object):
         """
         return sorted(self.jobs.items(), key=lambda item: getattr(item[1], self.priority), reverse=self.descending)
 
-    def dequeue(self, resource_limit):
+    @staticmethod
+    def reservation(resource, resource_limit, releases):
+        """
+        Find when a job that does not fit now will fit, as running jobs release their resources
+        :param resource: Resources of the job
+        :param resource_limit: Resources available now
+        :param releases: list of (time, Resources) released by running jobs at the latest at that time
+        :return: (time, Resources left over beside the job at that time), or (None, None) if it never fits
+        """
+        for release_time, released in sorted(releases, key=lambda release: release[0]):
+            resource_limit = resource_limit + released
+            if resource_limit - resource >= Resources.EMPTY:
+                return release_time, resource_limit - resource
+        return None, None
+
+    def dequeue(self, resource_limit, releases=None, now=None):
         """
         Collects jobs from the sorted list that fit together within the specified resource limit.
         Removes (pop) collected jobs from the queue (pop).
         May return an empty dictionary if queue is empty or no jobs fit.imit
+
+        When releases are provided, jobs are backfilled: the first job that does not fit is reserved the time at
+        which enough resources are released for it, and later jobs are only collected if they are expected to
+        finish before that time or fit beside it.
         :param resource_limit: A Resource object
+        :param releases: list of (time, Resources) released by running jobs at the latest at that time, or None
+        :param now: current time, on the clock of releases
         :return: Dictionary of {Job:Resources}
         """
         jobs = {}
+        reserved_time, spare = None, None
         for job, resource in self.sorted_jobs():
+            if not self.can_admit(job, jobs):
+                continue
             if resource_limit - resource >= Resources.EMPTY:
+                if reserved_time is not None:
+                    runtime = expected_runtime(job)
+                    if runtime is None or now + runtime > reserved_time:
+                        # Still running when the reserved job starts, so it must fit beside it
+                        if not (spare - resource >= Resources.EMPTY):
+                            continue
+                        spare = spare - resource
                 jobs[job] = resource
                 resource_limit = resource_limit - resource
+            elif releases is not None and reserved_time is None:
+                reserved_time, spare = self.reservation(resource, resource_limit, releases)
         for job in jobs:
             self.jobs.pop(job)
         return jobs
 
 
+class ResourcePool(object):
+    """
+    Share of the cluster that jobs are admitted to: the nodes matching its node selector, with their own capacity and
+    JobResourceQueue
+    """
+
+    def __init__(self, name, node_selector, total_resources):
+        """
+        :param name: str, identifies the pool in the usage report
+        :param node_selector: dict of node labels, empty for the default pool that runs on any node
+        :param total_resources: Resources limit for the concurrent jobs of the pool
+        """
+        self.name = name
+        self.node_selector = node_selector
+        self.total_resources = total_resources
+        self.available_resources = total_resources + Resources.EMPTY  # start with entire pool available
+        # Resources that running jobs wait to reserve, held back from queued jobs
+        self.pending_resources = Resources.EMPTY
+        self.jrq = JobResourceQueue()
+
+    def matches(self, node_selector):
+        """
+        :param node_selector: dict of the node labels a job selects
+        :return: True if the job selects the nodes of this named pool
+        """
+        return bool(self.node_selector) and all(node_selector.get(key) == value
+                                                for key, value in self.node_selector.items())
+
+    def fits(self, rsc):
+        return not rsc.exceeds(self.total_resources)
+
+
 class ThreadPoolJobExecutor(JobExecutor):
     """
     A cwltool JobExecutor subclass that uses concurrent.futures.ThreadPoolExecutor
@@ -170,11 +309,13 @@ class ThreadPoolJobExecutor(JobExecutor):
     Relevant: https://github.com/common-workflow-language/cwltool/issues/888
     """
 
-    def __init__(self, total_ram, total_cores, total_gpus=0, max_workers=None):
+    def __init__(self, total_ram, total_cores, total_gpus=0, max_workers=None, total_extended=None):
         """
         Initialize a ThreadPoolJobExecutor
         :param total_ram: RAM limit in megabytes for concurrent jobs
         :param total_cores: cpu core count limit for concurrent jobs
+        :param total_extended: dict of other Kubernetes resource names to their limits for concurrent jobs, in the
+        units of calrissian.report.parse_resource_quantity. Jobs requesting resources missing from it cannot run.
         :param max_workers: Number of worker threads to create. Set to None to use Python's default of 5xcpu count, which
         should be sufficient. Setting max_workers too low can cause deadlocks.
 
@@ -182,32 +323,161 @@ class ThreadPoolJobExecutor(JobExecutor):
         """
         super(ThreadPoolJobExecutor, self).__init__()
         self.max_workers = max_workers
-        self.jrq = JobResourceQueue()
+        self.default_pool = ResourcePool(DEFAULT_POOL, {}, Resources(total_ram, total_cores, total_gpus,
+                                                                     total_extended))
+        # Named ResourcePools, e.g. of GPU or high-memory nodes, see route
+        self.pools = []
         self.exceptions = Queue()
-        self.total_resources = Resources(total_ram, total_cores, total_gpus)
-        self.available_resources = Resources(total_ram, total_cores, total_gpus) # start with entire pool available
         self.resources_lock = threading.Lock()
+        self.start_hooks = []
+        # Set to a calrissian.batch.JobBatcher to run compatible jobs in shared pods
+        self.batcher = None
+        # When True, queued jobs are backfilled around the first job that does not fit, see JobResourceQueue.dequeue
+        self.backfill = False
+        # Futures of running jobs, mapped to the job, its Resources, the time by which it is expected to finish and
+        # its ResourcePool
+        self.running = {}
+
+    # The queue and resources of the default pool
+
+    @property
+    def jrq(self):
+        return self.default_pool.jrq
+
+    @jrq.setter
+    def jrq(self, jrq):
+        self.default_pool.jrq = jrq
+
+    @property
+    def total_resources(self):
+        return self.default_pool.total_resources
+
+    @total_resources.setter
+    def total_resources(self, total_resources):
+        self.default_pool.total_resources = total_resources
+
+    @property
+    def available_resources(self):
+        return self.default_pool.available_resources
+
+    @available_resources.setter
+    def available_resources(self, available_resources):
+        self.default_pool.available_resources = available_resources
+
+    @property
+    def pending_resources(self):
+        return self.default_pool.pending_resources
+
+    @pending_resources.setter
+    def pending_resources(self, pending_resources):
+        self.default_pool.pending_resources = pending_resources
+
+    def all_pools(self):
+        return [self.default_pool] + self.pools
+
+    def capacity_for(self, rsc):
+        """
+        :param rsc: Resources requested by a job
+        :return: Resources: the largest totals of the pools a job requesting rsc can run in, or None if it fits in no
+        pool. The job is routed to one of them when it is queued, see clamp_to_pool.
+        """
+        capacity = None
+        for pool in self.all_pools():
+            if pool.fits(rsc):
+                capacity = pool.total_resources if capacity is None else \
+                    capacity._combine(pool.total_resources, max)
+        return capacity
+
+    def clamp_to_pool(self, job, pool):
+        """
+        Lower the limits of a job to the totals of the pool it was routed to, from the capacity select_resources
+        clamped them to
+        :param job: a job about to be queued
+        :param pool: ResourcePool of the job
+        """
+        if not hasattr(job, 'builder'):
+            return
+        totals = pool.total_resources.to_dict()
+        resources = dict(job.builder.resources)
+        for limit, total in (('ramMax', Resources.RAM), ('coresMax', Resources.CORES),
+                             ('cudaDeviceCountMax', Resources.GPUS)):
+            if resources.get(limit) is not None:
+                resources[limit] = min(resources[limit], totals[total])
+        job.builder.resources = resources
+
+    def route(self, job, runtime_context):
+        """
+        Choose the pool of a job: the named pool whose node selector the job selects, else the default pool, else
+        the first named pool the job fits in when it is larger than the default pool. Jobs routed to a named pool run
+        on its nodes, see CalrissianCommandLineJob.resource_pool.
+        :param job: a job about to be queued
+        :param runtime_context: cwltool RuntimeContext, to find the node selectors of the job
+        :return: ResourcePool
+        """
+        if not self.pools:
+            return self.default_pool
+        node_selector = job.node_selector(runtime_context) if hasattr(job, 'node_selector') else {}
+        for pool in self.pools:
+            if pool.matches(node_selector):
+                return pool
+        rsc = Resources.from_job(job)
+        for pool in self.all_pools():
+            if pool.fits(rsc):
+                return pool
+        return self.default_pool
+
+    def enqueue(self, job, runtime_context):
+        """
+        Queue a job in the queue of its pool. Raises OversizedJobException if it does not fit in the pool.
+        """
+        pool = self.route(job, runtime_context)
+        if pool is not self.default_pool:
+            job.resource_pool = pool
+        self.raise_if_oversized(job, pool)
+        self.clamp_to_pool(job, pool)
+        pool.jrq.enqueue(job)
+
+    def pool_of(self, pool):
+        return pool if pool is not None else self.default_pool
+
+    def add_start_hook(self, hook):
+        """
+        Register a callable to run when run_jobs starts, before the first job is created
+        :param hook: callable taking the process and the runtime context
+        """
+        self.start_hooks.append(hook)
 
     def select_resources(self, request, runtime_context):
         """
         Naïve check for available cores cores and memory
         Checks if requested resources fit within the total allocation, raises WorkflowException if not.
-        If fits, returns a dictionary of resources that satisfy the requested min/max
+        If fits, returns a dictionary of resources that satisfy the requested min/max. The job is not routed to a pool
+        yet, so the maxima are clamped to the largest pools it fits in, and to the totals of its pool by enqueue.
+
+        When ephemeral-storage is limited, the tmpdirMin and outdirMin of the request are selected as ephemeral-storage.
+        The outdirMin is also selected as outdirSize, e.g. to size a scratch outdir, and the tmpdirMin as tmpdirSize,
+        e.g. to size a memory tmpdir.
 
         :param request: dict of ramMin, coresMin, ramMax, coresMax
         :param runtime_context: RuntimeContext, unused
         :return: dict of selected resources
         """
-        requested_min = Resources(request.get('ramMin'), request.get('coresMin'), request.get('cudaDeviceCountMin', 0))
-        requested_max = Resources(request.get('ramMax'), request.get('coresMax'), request.get('cudaDeviceCountMax', 0))
+        extended = {}
+        if EPHEMERAL_STORAGE in self.total_resources.extended:
+            extended[EPHEMERAL_STORAGE] = request.get('tmpdirMin', 0) + request.get('outdirMin', 0)
+        requested_min = Resources(request.get('ramMin'), request.get('coresMin'), request.get('cudaDeviceCountMin', 0),
+                                  extended)
+        requested_max = Resources(request.get('ramMax'), request.get('coresMax'), request.get('cudaDeviceCountMax', 0),
+                                  extended)
 
-        if requested_min.exceeds(self.total_resources):
+        capacity = self.capacity_for(requested_min)
+        if capacity is None:
             raise WorkflowException('Requested minimum resources {} exceed total available {}'.format(
-                requested_min, self.total_resources
+                requested_min, ', '.join(str(pool.total_resources) for pool in self.all_pools())
             ))
 
-        rsc_requested = Resources.min(requested_min, self.total_resources)
-        rsc_limit = Resources.min(requested_max, self.total_resources)
+        rsc_requested = Resources.min(requested_min, capacity)
+        rsc_limit = Resources.min(requested_max, capacity)
 
         result = rsc_requested.to_dict()
         result.update({
@@ -215,10 +485,14 @@ class ThreadPoolJobExecutor(JobExecutor):
             "coresMax": rsc_limit.to_dict().get('cores'),
             "cudaDeviceCountMax": rsc_limit.to_dict().get('gpus')
         })
+        if 'outdirMin' in request:
+            result['outdirSize'] = request['outdirMin']
+        if 'tmpdirMin' in request:
+            result['tmpdirSize'] = request['tmpdirMin']
 
         return result
 
-    def job_done_callback(self, rsc, logger, future):
+    def job_done_callback(self, rsc, logger, future, pool=None):
         """
         Callback to run after a job is finished to restore reserved resources and check for exceptions.
         Expected to be called as part of the Future.add_done_callback(). The callback is invoked on a background
@@ -228,13 +502,21 @@ class ThreadPoolJobExecutor(JobExecutor):
         :param rsc: Resources used by the job to return to our available resources.
         :param logger: logger where messages shall be logged
         :param future: A concurrent.futures.Future representing the finished task. May be in cancelled or done states
+        :param pool: ResourcePool of the job, None for the default pool
         """
 
+        with self.resources_lock:
+            entry = self.running.pop(future, None)
+
         # Always restore the resources.
         try:
-            self.restore(rsc, logger)
+            self.restore(rsc, logger, pool)
         except Exception as ex:
             self.exceptions.put(ex)
+        if entry is not None:
+            ConcurrencyLimits.finished(entry[0])
+            IOBudget.finished(entry[0])
+            self.pool_of(pool).jrq.release(entry[0], rsc)
 
         # if the future was cancelled, there is no more work to do. Bail out now because calling result() or
         # exception() on a cancelled future would raise a CancelledError in this scope.
@@ -281,65 +563,194 @@ class ThreadPoolJobExecutor(JobExecutor):
             else: # multiple exceptions were queued, raise multiple
                 raise WorkflowException(str(exceptions)) from exceptions[0]
 
-    def raise_if_oversized(self, job):
+    def raise_if_oversized(self, job, pool=None):
         """
         Raise an exception if a job does not fit within total_resources
         :param job: Job to check resources
+        :param pool: ResourcePool of the job, None for the default pool
         """
+        pool = self.pool_of(pool)
         rsc = Resources.from_job(job)
-        if rsc.exceeds(self.total_resources):
+        if rsc.exceeds(pool.total_resources):
             raise OversizedJobException('Job {} resources {} exceed total resources {}'.
-                                        format(job, rsc, self.total_resources))
+                                        format(job, rsc, pool.total_resources))
 
-    def _account(self, rsc):
+    def overcommit_floor(self, pool=None):
+        """
+        :return: Resources: the lowest available resources, negative in RAM when it is overcommitted
+        """
+        if not MemoryOvercommit.is_enabled():
+            return Resources.EMPTY
+        return Resources(ram=-(MemoryOvercommit.max_ratio - 1.0) * self.pool_of(pool).total_resources.ram)
+
+    def _account(self, rsc, pool=None):
+        pool = self.pool_of(pool)
         with self.resources_lock:
-            self.available_resources += rsc
+            pool.available_resources += rsc
             # Check if overallocated
-            if self.available_resources.is_negative():
+            if (pool.available_resources - self.overcommit_floor(pool)).is_negative():
                 raise InconsistentResourcesException('Available resources are negative: {}'.
-                                                     format(self.available_resources))
-            elif self.available_resources.exceeds(self.total_resources):
+                                                     format(pool.available_resources))
+            elif pool.available_resources.exceeds(pool.total_resources):
                 raise InconsistentResourcesException('Available resources exceeds total. Available: {}, Total: {}'.
-                                                     format(self.available_resources, self.total_resources))
+                                                     format(pool.available_resources, pool.total_resources))
 
-    def allocate(self, rsc, logger):
+    def allocate(self, rsc, logger, pool=None):
         """
         Reserve resources from the total. Raises InconsistentResourcesException if available becomes negative
         :param rsc: A Resources object to reserve from the total.
         :param logger: logger where messages shall be logged
+        :param pool: ResourcePool to reserve from, None for the default pool
         """
-        logger.debug('allocate {} from available {}'.format(rsc, self.available_resources))
-        self._account(-rsc)
+        logger.debug('allocate {} from available {}'.format(rsc, self.pool_of(pool).available_resources))
+        self._account(-rsc, pool)
 
-    def restore(self, rsc, logger):
+    def restore(self, rsc, logger, pool=None):
         """
         Restore resources to the total. Raises InconsistentResourcesException if available becomes negative
         :param rsc: A Resources object to restore to the total
         :param logger: logger where messages shall be logged
+        :param pool: ResourcePool to restore to, None for the default pool
+        """
+        logger.debug('restore {} to available {}'.format(rsc, self.pool_of(pool).available_resources))
+        self._account(rsc, pool)
+
+    def reserve_resources(self, rsc, runtime_context, block=True, pool=None, held=Resources.EMPTY):
+        """
+        Reserve additional resources for a job that is already running, e.g. to retry it with a larger request.
+        Waits until running jobs restore enough resources, which are held back from queued jobs meanwhile.
+        The resources the job already holds are returned while it waits and reserved again together with the
+        additional ones, so that jobs waiting for more at the same time cannot deadlock each holding part of the pool.
+        The job must return them with release_resources when it finishes.
+        Raises OversizedJobException if the resources exceed the total.
+
+        :param rsc: A Resources object to reserve
+        :param runtime_context: cwltool RuntimeContext, its workflow_eval_lock guards the queue
+        :param block: When False, do not wait for the resources to be available, nor take the pending resources held
+        back for jobs waiting for theirs
+        :param pool: ResourcePool of the job, None for the default pool
+        :param held: A Resources object the job already holds and does not use while it waits
+        :return: True if the resources were reserved, False if they are not available and block is False
+        """
+        pool = self.pool_of(pool)
+        total = rsc + held
+        if total.exceeds(pool.total_resources):
+            raise OversizedJobException('Additional resources {} exceed total resources {}'.
+                                        format(rsc, pool.total_resources))
+        if not block:
+            return self._reserve_if_available(rsc, runtime_context, pool, pending=True)
+        with runtime_context.workflow_eval_lock:
+            # Queued jobs cannot take the held resources, pending until reserved again
+            self.restore(held, log, pool)
+            pool.pending_resources += total
+        try:
+            while not self._reserve_if_available(total, runtime_context, pool):
+                time.sleep(RESERVE_POLL_SECONDS)
+            return True
+        finally:
+            with runtime_context.workflow_eval_lock:
+                pool.pending_resources -= total
+
+    def _reserve_if_available(self, rsc, runtime_context, pool=None, pending=False):
+        """
+        :param pending: True to leave the pending resources of the pool to the jobs waiting for them
+        """
+        pool = self.pool_of(pool)
+        with runtime_context.workflow_eval_lock:
+            available = pool.available_resources - pool.pending_resources if pending else pool.available_resources
+            if available - rsc >= Resources.EMPTY:
+                self.allocate(rsc, log, pool)
+                return True
+            return False
+
+    def release_resources(self, rsc, runtime_context, pool=None):
+        """
+        Return resources reserved with reserve_resources
+        :param rsc: A Resources object to restore
+        :param runtime_context: cwltool RuntimeContext, unused
+        :param pool: ResourcePool the resources were reserved from, None for the default pool
+        """
+        self.restore(rsc, log, pool)
+
+    def expected_releases(self, pool=None):
+        """
+        :param pool: ResourcePool, None for the default pool
+        :return: list of (time, Resources) that running jobs of the pool with a time limit release at the latest at
+        that time, on the time.monotonic() clock
+        """
+        pool = self.pool_of(pool)
+        with self.resources_lock:
+            return [(finish, rsc) for _, rsc, finish, job_pool in self.running.values()
+                    if finish is not None and job_pool is pool]
+
+    def overcommit_allowance(self, pool=None):
+        """
+        :param pool: ResourcePool, None for the default pool
+        :return: Resources that may be admitted beyond the available resources of the pool, see MemoryOvercommit
         """
-        logger.debug('restore {} to available {}'.format(rsc, self.available_resources))
-        self._account(rsc)
+        if not MemoryOvercommit.is_enabled():
+            return Resources.EMPTY
+        pool = self.pool_of(pool)
+        with self.resources_lock:
+            running = [(job, rsc) for job, rsc, _, job_pool in self.running.values() if job_pool is pool]
+        return Resources(ram=MemoryOvercommit.allowance(pool.total_resources.ram, running))
 
     def start_queued_jobs(self, pool_executor, logger, runtime_context):
         """
-        Pulls jobs off the queue in groups that fit in currently available resources, allocates resources, and submits
-        jobs to the pool_executor as Futures. Attaches a callback to each future to clean up (e.g. check
+        Pulls jobs off the queues in groups that fit in currently available resources, allocates resources, and
+        submits jobs to the pool_executor as Futures. Attaches a callback to each future to clean up (e.g. check
         for execptions, restore allocated resources)
         :param pool_executor: concurrent.futures.Executor: where job callables shall be submitted
         :param logger: logger where messages shall be logged
         :param runtime_context: cwltool RuntimeContext: to provide to the job
         :return: set: futures that were submitted on this invocation
         """
-        runnable_jobs = self.jrq.dequeue(self.available_resources)  # Removes jobs from the queue
         submitted_futures = set()
+        for pool in self.all_pools():
+            submitted_futures.update(self.start_queued_jobs_of(pool, pool_executor, logger, runtime_context))
+        return submitted_futures
+
+    def start_queued_jobs_of(self, pool, pool_executor, logger, runtime_context):
+        """
+        Start the queued jobs of a ResourcePool that fit in its available resources, see start_queued_jobs
+        :return: set: futures that were submitted on this invocation
+        """
+        if self.batcher is not None:
+            self.batcher.batch(pool.jrq, pool.total_resources)
+        # Removes jobs from the queue
+        resource_limit = pool.available_resources - pool.pending_resources + self.overcommit_allowance(pool)
+        if self.backfill:
+            runnable_jobs = pool.jrq.dequeue(resource_limit, self.expected_releases(pool), time.monotonic())
+        else:
+            runnable_jobs = pool.jrq.dequeue(resource_limit)
+        submitted_futures = set()
+        spare = resource_limit
+        for rsc in runnable_jobs.values():
+            spare -= rsc
         for job, rsc in runnable_jobs.items():
-            if runtime_context.builder is not None:
-                job.builder = runtime_context.builder
-            if job.outdir is not None:
-                self.output_dirs.add(job.outdir)
-            self.allocate(rsc, logger)
+            if self.batcher is not None:
+                admitted = [other for other in runnable_jobs if other is not job]
+                widened, spare = self.batcher.widen(job, rsc, spare, admitted)
+                if widened != rsc:
+                    pool.jrq.resize(job, rsc, widened)
+                    rsc = widened
+            members = self.batcher.members(job) if self.batcher is not None else [job]
+            for member in members:
+                if runtime_context.builder is not None:
+                    member.builder = runtime_context.builder
+                if member.outdir is not None:
+                    self.output_dirs.add(member.outdir)
+            self.allocate(rsc, logger, pool)
+            ConcurrencyLimits.started(job)
+            IOBudget.started(job)
             future = pool_executor.submit(job.run, runtime_context)
-            callback = functools.partial(self.job_done_callback, rsc, logger)
+            runtime = expected_runtime(job)
+            with self.resources_lock:
+                self.running[future] = (job, rsc, time.monotonic() + runtime if runtime else None, pool)
+            if MemoryOvercommit.is_enabled():
+                MemoryOvercommit.record_admission(pool.total_resources.ram - pool.available_resources.ram,
+                                                  pool.total_resources.ram)
+            callback = functools.partial(self.job_done_callback, rsc, logger, pool=pool)
             # Callback will be invoked in a thread on the submitting process (but not the thread that submitted, this
             # clarification is mostly for process pool executors)
             future.add_done_callback(callback)
@@ -380,8 +791,7 @@ class ThreadPoolJobExecutor(JobExecutor):
                 try:
                     job = next(job_iterator)
                     if job:
-                        self.raise_if_oversized(job)
-                        self.jrq.enqueue(job)
+                        self.enqueue(job, runtime_context)
                     else:
                         # job is None. More to come, but depend on queued jobs completing, so start what we can
                         submitted = self.start_queued_jobs(pool_executor, logger, runtime_context)
@@ -415,7 +825,7 @@ class ThreadPoolJobExecutor(JobExecutor):
             self.raise_if_exception_queued(futures, logger)
             with runtime_context.workflow_eval_lock:
                 # Check if we're done with pending jobs and submitted jobs
-                if not futures and self.jrq.is_empty():
+                if not futures and all(pool.jrq.is_empty() for pool in self.all_pools()):
                     finished = True
 
     def run_jobs(self, process, job_order_object, logger, runtime_context):
@@ -431,6 +841,8 @@ class ThreadPoolJobExecutor(JobExecutor):
             self.total_resources, self.max_workers))
         if runtime_context.workflow_eval_lock is None:
             raise WorkflowException("runtimeContext.workflow_eval_lock must not be None")
+        for hook in self.start_hooks:
+            hook(process, runtime_context)
         # Wrap in an Executor context. This ensures that the executor waits for tasks to finish before shutting down
         job_iterator = process.job(job_order_object, self.output_callback, runtime_context)
         with ThreadPoolExecutor(max_workers=self.max_workers) as pool_executor:
@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from calrissian.concurrency import ConcurrencyLimits, concurrency_of, concurrency_slots
+from calrissian.executor import JobResourceQueue, Resources
+from calrissian.report import Reporter
+from calrissian.speculation import sibling_group
+
+log = logging.getLogger('calrissian.fairshare')
+
+# Hint weighting the share of the resources the jobs of a step get when competing with other steps, e.g.
+#   calrissian:FairShare:
+#     weight: 2
+# How many of them run at once is capped by the Concurrency requirement, see calrissian.concurrency
+FAIR_SHARE_REQUIREMENT = 'https://calrissian-cwl.github.io/schema#FairShare'
+
+
+def fair_share_path(job):
+    """
+    The path of a job in the fair-share hierarchy, the names of the steps running the sub-workflows it is part of
+    and of its own step, see CalrissianRuntimeContext.step_path. Jobs of tools run outside a workflow get the name of
+    their step, see sibling_group. The jobs of a scatter share the path.
+    :param job: a queued job, or a JobBatch of jobs of the same step
+    :return: tuple of str
+    """
+    members = getattr(job, 'jobs', None)
+    if members:
+        job = members[0]
+    step_path = getattr(job, 'step_path', None)
+    if isinstance(step_path, tuple) and step_path:
+        return step_path
+    return (sibling_group(job) or '',)
+
+
+def members_of(job):
+    return getattr(job, 'jobs', None) or [job]
+
+
+class FairShareQueue(JobResourceQueue):
+    """
+    A JobResourceQueue that shares the resources fairly between the steps and sub-workflows whose jobs are queued,
+    instead of admitting the smallest jobs first, so that a wide scatter does not starve the other branches of a
+    workflow.
+
+    Jobs are grouped by their fair_share_path. Each prefix of a path is charged with the dominant share of the total
+    resources requested by its running jobs, and jobs are dequeued from the prefix with the lowest charge over its
+    weight, level by level, like hierarchical weighted fair queueing. The weight of a step comes from the FairShare
+    hint of its jobs; prefixes above the steps weigh 1. Jobs of a Concurrency group at its limit are skipped by
+    JobResourceQueue.can_admit, and other jobs dequeued in their place.
+    """
+
+    def __init__(self, total_resources, priority=Resources.RAM, descending=False):
+        """
+        :param total_resources: Resources the shares are relative to, the total of the ResourcePool
+        """
+        super(FairShareQueue, self).__init__(priority, descending)
+        self.total_resources = total_resources
+        self.lock = threading.Lock()
+        # Dominant share charged to each prefix of the paths of the running jobs
+        self.usage = {}
+        self.weights = {}
+        self.enqueued_at = {}
+
+    def cost(self, rsc):
+        """
+        :param rsc: Resources of a job
+        :return: float: the largest fraction of any of the total resources the job requests
+        """
+        pairs = [(rsc.ram, self.total_resources.ram), (rsc.cores, self.total_resources.cores),
+                 (rsc.gpus, self.total_resources.gpus)]
+        pairs.extend((amount, self.total_resources.extended.get(name, 0)) for name, amount in rsc.extended.items())
+        return float(max([amount / total for amount, total in pairs if total], default=0))
+
+    def weight(self, prefix):
+        return self.weights.get(prefix, 1.0)
+
+    def enqueue(self, job):
+        super(FairShareQueue, self).enqueue(job)
+        path = fair_share_path(job)
+        self.weights[path] = float(getattr(job, 'fair_share_weight', 1.0) or 1.0)
+        self.enqueued_at[job] = time.monotonic()
+
+    def pick(self, paths, usage):
+        """
+        :param paths: the paths with jobs to dequeue
+        :param usage: dict of the dominant share charged to each prefix
+        :return: the path to dequeue a job from, descending from the root to the least charged prefix over its weight
+        """
+        prefix = ()
+        while prefix not in paths:
+            depth = len(prefix) + 1
+            children = sorted({path[:depth] for path in paths if len(path) >= depth and path[:depth - 1] == prefix})
+            prefix = min(children, key=lambda child: usage.get(child, 0.0) / self.weight(child))
+        return prefix
+
+    def sorted_jobs(self):
+        """
+        Produces a list of the jobs in the queue in fair-share order: the jobs of each path keep the order of
+        JobResourceQueue.sorted_jobs, and are interleaved as if each job was admitted in turn. Once the Concurrency
+        group of a path would be at its limit, the remaining jobs of the path come last.
+        """
+        queues = {}
+        for job, rsc in super(FairShareQueue, self).sorted_jobs():
+            queues.setdefault(fair_share_path(job), deque()).append((job, rsc))
+        with self.lock:
+            usage = dict(self.usage)
+        with ConcurrencyLimits.lock:
+            running = dict(ConcurrencyLimits.running)
+        ordered, capped = [], []
+        while queues:
+            path = self.pick(queues, usage)
+            job, rsc = queues[path].popleft()
+            ordered.append((job, rsc))
+            group, limit = concurrency_of(job)
+            if group is not None:
+                running[group] = running.get(group, 0) + concurrency_slots(job)
+            if not queues[path] or (group is not None and running[group] >= limit):
+                capped.extend(queues.pop(path))
+            for depth in range(1, len(path) + 1):
+                usage[path[:depth]] = usage.get(path[:depth], 0.0) + self.cost(rsc)
+        return ordered + capped
+
+    def dequeue(self, resource_limit, releases=None, now=None):
+        jobs = super(FairShareQueue, self).dequeue(resource_limit, releases, now)
+        dequeued_at = time.monotonic()
+        with self.lock:
+            for job, rsc in jobs.items():
+                path = fair_share_path(job)
+                for depth in range(1, len(path) + 1):
+                    self.usage[path[:depth]] = self.usage.get(path[:depth], 0.0) + self.cost(rsc)
+        for job in jobs:
+            branch = '/'.join(fair_share_path(job))
+            for member in members_of(job):
+                Reporter.add_queue_wait(branch, dequeued_at - self.enqueued_at.pop(member, dequeued_at))
+        return jobs
+
+    def release(self, job, rsc):
+        path = fair_share_path(job)
+        with self.lock:
+            for depth in range(1, len(path) + 1):
+                self.usage[path[:depth]] = max(0.0, self.usage.get(path[:depth], 0.0) - self.cost(rsc))
+
+    def resize(self, job, rsc, resized):
+        path = fair_share_path(job)
+        with self.lock:
+            for depth in range(1, len(path) + 1):
+                self.usage[path[:depth]] = self.usage.get(path[:depth], 0.0) + self.cost(resized) - self.cost(rsc)
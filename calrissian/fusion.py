@@ -0,0 +1,80 @@
+import logging
+
+from cwltool.command_line_tool import CommandLineTool
+from cwltool.utils import aslist
+from cwltool.workflow import Workflow
+
+log = logging.getLogger('calrissian.fusion')
+
+# Fused steps run in runner pods. Unless the warm pool is enabled with its own TTL, runners are kept this long
+FUSION_TTL_SECONDS = 30
+
+
+def upstream_steps(step, step_ids):
+    """
+    :param step: cwltool WorkflowStep
+    :param step_ids: ids of the steps of its workflow
+    :return: set of the ids of the steps whose outputs are sources of the step's inputs
+    """
+    upstream = set()
+    for step_input in step.tool['inputs']:
+        for source in aslist(step_input.get('source', [])):
+            source_step = source.rsplit('/', 1)[0]
+            if source_step in step_ids:
+                upstream.add(source_step)
+    return upstream
+
+
+def compatible_tools(tool, other_tool):
+    """
+    :return: True if both tools are CommandLineTools that declare the same image and resources, so that their
+    jobs can run in the same runner pod
+    """
+    if not isinstance(tool, CommandLineTool) or not isinstance(other_tool, CommandLineTool):
+        return False
+    return all(tool.get_requirement(requirement)[0] == other_tool.get_requirement(requirement)[0]
+               for requirement in ['DockerRequirement', 'ResourceRequirement'])
+
+
+def fuse_linear_chains(process):
+    """
+    Find the steps of a workflow, and of its nested workflows, that form linear chains: a step whose outputs are only
+    consumed by a single step, which only consumes outputs of that step, and neither is scattered.
+    When both steps run compatible tools, they are marked to run one after the other in the same runner pod.
+    :param process: cwltool Process
+    :return: list of (step id, step id) tuples, the fused pairs
+    """
+    fused = []
+    if not isinstance(process, Workflow):
+        return fused
+    steps = {step.id: step for step in process.steps}
+    upstream = {step_id: upstream_steps(step, steps) for step_id, step in steps.items()}
+    downstream = {step_id: {s for s in steps if step_id in upstream[s]} for step_id in steps}
+    for step_id, step in steps.items():
+        fused.extend(fuse_linear_chains(step.embedded_tool))
+        if len(upstream[step_id]) != 1:
+            continue
+        upstream_id = next(iter(upstream[step_id]))
+        upstream_step = steps[upstream_id]
+        if downstream[upstream_id] != {step_id}:
+            # Fan-out
+            continue
+        if 'scatter' in step.tool or 'scatter' in upstream_step.tool:
+            continue
+        if not compatible_tools(upstream_step.embedded_tool, step.embedded_tool):
+            continue
+        upstream_step.embedded_tool.fuse_downstream = True
+        step.embedded_tool.fused_upstream = True
+        fused.append((upstream_id, step_id))
+    return fused
+
+
+def start_step_fusion(process, runtime_context):
+    """
+    Mark the linear chains of a process for fusion.
+    Registered as a ThreadPoolJobExecutor start hook, so it runs before the first job is created
+    :param process: cwltool Process about to be run
+    :param runtime_context: CalrissianRuntimeContext, unused
+    """
+    for upstream_id, step_id in fuse_linear_chains(process):
+        log.info('Fusing step {} into step {}'.format(step_id, upstream_id))
@@ -0,0 +1,99 @@
+import math
+import logging
+from fractions import Fraction
+
+from cwltool.errors import WorkflowException
+
+log = logging.getLogger("calrissian.gpu")
+
+# Hint requesting a share of a time-sliced GPU, or partitions of a MIG GPU, instead of whole GPUs, e.g.
+#   calrissian:GPUShare:
+#     share: 0.25
+# or
+#   calrissian:GPUShare:
+#     migProfile: 1g.5gb
+#     migCount: 1
+GPU_SHARE_REQUIREMENT = 'https://calrissian-cwl.github.io/schema#GPUShare'
+
+# Kubernetes resource of the NVIDIA device plugin, a replica of a GPU when GPUs are time-sliced
+NVIDIA_GPU = 'nvidia.com/gpu'
+
+# Prefix of the Kubernetes resources of the MIG partitions advertised with the mixed strategy of the device plugin
+MIG_RESOURCE_PREFIX = 'nvidia.com/mig-'
+
+# Key of the resources of a job with a GPUShare: the number of nvidia.com/gpu its pod requests
+GPU_REPLICAS = 'gpuReplicas'
+
+
+def mig_resource(profile):
+    """
+    :param profile: str, MIG profile, e.g. 1g.5gb or nvidia.com/mig-1g.5gb
+    :return: str: the Kubernetes resource of the profile
+    """
+    if profile.startswith(MIG_RESOURCE_PREFIX):
+        return profile
+    return MIG_RESOURCE_PREFIX + profile
+
+
+def slice_replicas(share, slices):
+    """
+    Time-sliced GPUs are advertised as slices replicas of nvidia.com/gpu each, so a share of a GPU is requested as
+    the replicas that cover it
+    :param share: float, fraction of a GPU, more than 0
+    :param slices: int, replicas of each GPU
+    :return: int: the number of replicas
+    """
+    # Tolerate the rounding of shares like 0.1 * 10
+    return max(1, math.ceil(share * slices - 1e-9))
+
+
+def check_gpu_share(requirement, runtime_context):
+    """
+    Fail before queueing the jobs of a GPUShare hint the executor has no GPUs or MIG partitions to account for
+    :param requirement: dict of the GPUShare hint
+    :param runtime_context: CalrissianRuntimeContext
+    :raises WorkflowException: naming the option to set
+    """
+    if runtime_context.resource_pools:
+        # Each pool sets its own limits
+        return
+    profile = requirement.get('migProfile')
+    if profile:
+        resource = mig_resource(profile)
+        limited = [value.partition('=')[0].strip() for value in runtime_context.max_resource or []]
+        if resource not in limited:
+            raise WorkflowException('Error: set --max-resource {}=COUNT to run CWL files with the GPUShare hint '
+                                    'of MIG profile {}'.format(resource, profile))
+    elif not runtime_context.max_gpus:
+        raise WorkflowException('Error: set --max-gpus to run CWL files with the GPUShare hint')
+
+
+def gpu_share_resources(resources, requirement, slices):
+    """
+    Account a job for the GPUShare hint. A share counts as the fraction of a GPU its replicas amount to, and MIG
+    partitions count as extended resources rather than GPUs.
+    :param resources: dict of the job's resources, as selected by ThreadPoolJobExecutor.select_resources
+    :param requirement: dict of the GPUShare hint
+    :param slices: int, replicas of each GPU, see --gpu-slices
+    :return: dict: a copy of resources with gpus, GPU_REPLICAS and the extended MIG resources
+    """
+    shared = dict(resources)
+    profile = requirement.get('migProfile')
+    if profile:
+        extended = dict(shared.get('extended') or {})
+        extended[mig_resource(profile)] = int(requirement.get('migCount', 1))
+        shared['extended'] = extended
+        shared['gpus'] = 0
+        shared[GPU_REPLICAS] = 0
+        return shared
+    share = float(requirement.get('share', 1))
+    if share <= 0:
+        raise WorkflowException('GPUShare share must be more than 0, got {}'.format(share))
+    replicas = slice_replicas(share, slices)
+    if replicas != share * slices:
+        log.debug('GPU share {} rounded up to {} of {} slices'.format(share, replicas, slices))
+    # Exact, so that the shares restored to the executor add up to its total again
+    shared['gpus'] = Fraction(replicas, slices)
+    shared['cudaDeviceCountMax'] = shared['gpus']
+    shared[GPU_REPLICAS] = replicas
+    return shared
@@ -0,0 +1,141 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger("calrissian.history")
+
+# Number of most recent runs of a tool its requests are sized from
+HISTORY_WINDOW = 50
+
+# Tools with fewer recorded runs keep the requests of their ResourceRequirement
+MIN_OBSERVATIONS = 3
+
+# Percentile of the observed peaks a right-sized request covers
+DEFAULT_PERCENTILE = 95
+
+# Margin added to the observed peaks, for runs on larger inputs
+RIGHT_SIZE_HEADROOM = 1.2
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile
+    :param values: non-empty list of numbers
+    :param pct: percentile, between 0 and 100
+    :return: the smallest value that at least pct percent of the values are lower than or equal to
+    """
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def clamp(value, lowest, highest):
+    return max(lowest, min(value, highest))
+
+
+class UsageHistory(object):
+    """
+    Singleton thread-safe store of the peak CPU and memory used by each run of a tool, kept in a SQLite database
+    that persists across runs, e.g. next to the usage report.
+
+    With right_sizing, the requests of a tool's jobs are set from the given percentile of its recorded peaks plus
+    RIGHT_SIZE_HEADROOM, instead of the ResourceRequirement its author wrote. Requests stay within coresMax and
+    ramMax, which remain the limits of the pod.
+    """
+    path = None
+    right_sizing = False
+    percentile = DEFAULT_PERCENTILE
+    lock = threading.Lock()
+
+    @staticmethod
+    def initialize(path, right_sizing=False, percentile=DEFAULT_PERCENTILE):
+        with UsageHistory.lock:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = UsageHistory.connect(path)
+            try:
+                with connection:
+                    connection.execute('CREATE TABLE IF NOT EXISTS usage (tool TEXT NOT NULL, name TEXT, '
+                                       'recorded_at REAL NOT NULL, peak_cpus REAL, peak_ram_megabytes REAL)')
+                    connection.execute('CREATE INDEX IF NOT EXISTS usage_tool ON usage (tool, recorded_at)')
+            finally:
+                connection.close()
+            UsageHistory.path = path
+            UsageHistory.right_sizing = right_sizing
+            UsageHistory.percentile = percentile
+
+    @staticmethod
+    def connect(path):
+        # A connection per operation, as jobs record from their own threads
+        return sqlite3.connect(path, timeout=30)
+
+    @staticmethod
+    def is_enabled():
+        return UsageHistory.path is not None
+
+    @staticmethod
+    def is_right_sizing():
+        return UsageHistory.is_enabled() and UsageHistory.right_sizing
+
+    @staticmethod
+    def record(tool, name, peak_cpus, peak_ram_megabytes):
+        """
+        Record the peak usage of a successful run of a tool
+        :param tool: str, identifies the tool across runs, see CalrissianCommandLineJob.usage_history_key()
+        :param name: name of the job
+        :param peak_cpus: float, cores
+        :param peak_ram_megabytes: float
+        """
+        with UsageHistory.lock:
+            connection = UsageHistory.connect(UsageHistory.path)
+            try:
+                with connection:
+                    connection.execute('INSERT INTO usage VALUES (?, ?, ?, ?, ?)',
+                                       (tool, name, time.time(), peak_cpus, peak_ram_megabytes))
+            finally:
+                connection.close()
+
+    @staticmethod
+    def observations(tool):
+        """
+        :param tool: str, identifies the tool across runs
+        :return: list of (peak_cpus, peak_ram_megabytes) of the most recent runs of the tool, at most HISTORY_WINDOW
+        """
+        with UsageHistory.lock:
+            connection = UsageHistory.connect(UsageHistory.path)
+            try:
+                return connection.execute('SELECT peak_cpus, peak_ram_megabytes FROM usage WHERE tool = ? '
+                                          'ORDER BY recorded_at DESC LIMIT ?', (tool, HISTORY_WINDOW)).fetchall()
+            finally:
+                connection.close()
+
+    @staticmethod
+    def right_size(tool, resources):
+        """
+        Size the requests of a job of a tool from its recorded peaks, within the coresMin and coresMax, and ramMin and
+        ramMax of its ResourceRequirement
+        :param tool: str, identifies the tool across runs
+        :param resources: dict of the job's resources, as selected by ThreadPoolJobExecutor.select_resources, with the
+        minimums as cores and ram
+        :return: dict: a copy of resources with right-sized cores and ram, or resources if the tool has too few
+        recorded runs
+        """
+        observations = UsageHistory.observations(tool)
+        if len(observations) < MIN_OBSERVATIONS:
+            return resources
+        right_sized = dict(resources)
+        cpus = [peak_cpus for peak_cpus, _ in observations if peak_cpus is not None]
+        if cpus:
+            cores = math.ceil(percentile(cpus, UsageHistory.percentile) * RIGHT_SIZE_HEADROOM * 10) / 10.0
+            right_sized['cores'] = clamp(cores, resources['cores'], resources.get('coresMax', resources['cores']))
+        rams = [peak_ram for _, peak_ram in observations if peak_ram is not None]
+        if rams:
+            ram = math.ceil(percentile(rams, UsageHistory.percentile) * RIGHT_SIZE_HEADROOM)
+            right_sized['ram'] = clamp(ram, resources['ram'], resources.get('ramMax', resources['ram']))
+        log.info('Right-sized {} from {} to {} cores and {} to {} MB of RAM, from {} runs'.format(
+            tool, resources['cores'], right_sized['cores'], resources['ram'], right_sized['ram'], len(observations)))
+        return right_sized
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+
+from calrissian.concurrency import concurrency_slots
+
+log = logging.getLogger('calrissian.iobudget')
+
+# Requirement or hint declaring how heavily a tool reads and writes the shared volume, by class or weight, e.g.
+#   calrissian:IOClass:
+#     ioClass: heavy
+# or
+#   calrissian:IOClass:
+#     weight: 3
+IO_CLASS_REQUIREMENT = 'https://calrissian-cwl.github.io/schema#IOClass'
+
+# Weights of the I/O classes, in units of the --io-budget
+IO_CLASS_WEIGHTS = {
+    'light': 1,
+    'medium': 2,
+    'heavy': 4,
+}
+
+DEFAULT_IO_CLASS = 'medium'
+
+
+def io_weight_of(job):
+    """
+    :param job: a queued job, or a JobBatch of jobs of the same tool
+    :return: the I/O weight the job puts on the shared volume, that of each job times the parallelism of a JobBatch
+    """
+    members = getattr(job, 'jobs', None)
+    member = members[0] if isinstance(members, list) and members else job
+    weight = getattr(member, 'io_weight', 0)
+    if not isinstance(weight, (int, float)):
+        return 0
+    return weight * concurrency_slots(job)
+
+
+def members_of(job):
+    members = getattr(job, 'jobs', None)
+    return members if isinstance(members, list) else [job]
+
+
+class IOBudget(object):
+    """
+    Singleton budget of the I/O weight of the jobs running at once on the shared volume, across the ResourcePools of
+    the executor. JobResourceQueue.dequeue skips jobs that would exceed it, so other queued jobs start in their place.
+    A job heavier than the whole budget starts when no other weighted job runs.
+
+    The time jobs wait from the first dequeue that held them back for I/O until they start is reported as I/O wait.
+    """
+    budget = None
+    in_use = 0
+    peak_in_use = 0
+    # Jobs held back for I/O, mapped to the time they were first held back
+    held = {}
+    held_tasks = 0
+    total_wait_seconds = 0.0
+    max_wait_seconds = 0.0
+    lock = threading.Lock()
+
+    @staticmethod
+    def initialize(budget):
+        with IOBudget.lock:
+            IOBudget.budget = budget
+            IOBudget.in_use = 0
+            IOBudget.peak_in_use = 0
+            IOBudget.held = {}
+            IOBudget.held_tasks = 0
+            IOBudget.total_wait_seconds = 0.0
+            IOBudget.max_wait_seconds = 0.0
+
+    @staticmethod
+    def is_enabled():
+        return IOBudget.budget is not None
+
+    @staticmethod
+    def can_admit(job, admitted):
+        """
+        :param job: a queued job
+        :param admitted: the jobs admitted by the same dequeue, not started yet
+        :return: True if the job fits in the budget beside the running and admitted jobs
+        """
+        weight = io_weight_of(job)
+        if not IOBudget.is_enabled() or not weight:
+            return True
+        admitted_weight = sum(io_weight_of(other) for other in admitted)
+        with IOBudget.lock:
+            in_use = IOBudget.in_use + admitted_weight
+            if in_use + weight <= IOBudget.budget or not in_use:
+                return True
+            if job not in IOBudget.held:
+                log.debug('Holding back {} for I/O, {} of {} in use'.format(job, in_use, IOBudget.budget))
+                IOBudget.held[job] = time.monotonic()
+            return False
+
+    @staticmethod
+    def has_room(job, admitted):
+        """
+        :param job: a job admitted by a dequeue
+        :param admitted: the other jobs admitted by the same dequeue, not started yet
+        :return: True if the job fits in the budget beside the running and admitted jobs, without holding it back
+        """
+        weight = io_weight_of(job)
+        if not IOBudget.is_enabled() or not weight:
+            return True
+        admitted_weight = sum(io_weight_of(other) for other in admitted)
+        with IOBudget.lock:
+            return IOBudget.in_use + admitted_weight + weight <= IOBudget.budget
+
+    @staticmethod
+    def started(job):
+        weight = io_weight_of(job)
+        if not IOBudget.is_enabled() or not weight:
+            return
+        now = time.monotonic()
+        with IOBudget.lock:
+            IOBudget.in_use += weight
+            IOBudget.peak_in_use = max(IOBudget.peak_in_use, IOBudget.in_use)
+            # Jobs held back before being batched count with the batch
+            for held in [job] + members_of(job):
+                held_since = IOBudget.held.pop(held, None)
+                if held_since is None:
+                    continue
+                wait_seconds = now - held_since
+                IOBudget.held_tasks += 1
+                IOBudget.total_wait_seconds += wait_seconds
+                IOBudget.max_wait_seconds = max(IOBudget.max_wait_seconds, wait_seconds)
+
+    @staticmethod
+    def finished(job):
+        weight = io_weight_of(job)
+        if not IOBudget.is_enabled() or not weight:
+            return
+        with IOBudget.lock:
+            IOBudget.in_use = max(0, IOBudget.in_use - weight)
+
+    @staticmethod
+    def to_dict():
+        with IOBudget.lock:
+            return {
+                'budget': IOBudget.budget,
+                'peak_weight': IOBudget.peak_in_use,
+                'held_tasks': IOBudget.held_tasks,
+                'total_io_wait_seconds': IOBudget.total_wait_seconds,
+                'max_io_wait_seconds': IOBudget.max_wait_seconds,
+            }
@@ -10,10 +10,22 @@ cwltool.job.cuda_check = _cuda_check
 
 from cwltool.utils import DEFAULT_TMP_PREFIX
 from cwltool.errors import WorkflowException, UnsupportedRequirement
-from calrissian.k8s import KubernetesClient, CompletionResult
-from calrissian.report import Reporter, TimedResourceReport
+from calrissian.k8s import KubernetesClient, CompletionResult, PodDisruptedException, RUN_ID_LABEL, OOM_KILLED_REASON, \
+    DEADLINE_EXCEEDED_REASON, UsageMonitor
+from calrissian.report import Reporter, TimedResourceReport, MemoryParser, EPHEMERAL_STORAGE, format_resource_quantity
+from calrissian.executor import Resources
+from calrissian.gpu import GPU_REPLICAS, NVIDIA_GPU
+from calrissian.journal import Journal, job_identity
+from calrissian.cache import StepCache, cache_key, normalize, file_fingerprint, directory_fingerprint
+from calrissian.pool import RunnerPool, RUNNER_ROOT, exports_environment
+from calrissian.retry import retrying_exponential_if_exception_type
+from calrissian.speculation import Speculator
+from calrissian.history import UsageHistory
+from calrissian.refcache import ReferenceCache, fill_script, REFERENCE_CACHE_VOLUME_NAME, REFERENCE_CACHE_MOUNT, \
+    REFERENCE_SOURCES_ROOT, REFERENCE_STATS_DIR, REFERENCE_ENTRY_FILENAME
 from cwltool.builder import Builder
 import logging
+import math
 import os
 import yaml
 import shutil
@@ -23,17 +35,33 @@ import string
 import shellescape
 import re
 from cwltool.utils import visit_class, ensure_writable
+from schema_salad.ref_resolver import uri_file_path
 
 log = logging.getLogger("calrissian.job")
 log_main = logging.getLogger("calrissian.main")
 
 
 K8S_UNSAFE_REGEX = re.compile('[^-a-z0-9]')
+# Digest of an image reference, e.g. @sha256:<64 hex digits>
+IMAGE_DIGEST_REGEX = re.compile('@[a-z0-9]+([+._-][a-z0-9]+)*:[0-9a-fA-F]{32,}$')
 
 # Environment variable used to override image name used for initContainers
 INIT_IMAGE_ENV_VARIABLE = 'CALRISSIAN_INIT_IMAGE'
 DEFAULT_INIT_IMAGE = 'alpine:3.10'
 
+# With --scratch-outdir, the outdir of a job is a volume on its node, and its outdir on the shared volume is mounted
+# here to copy the results back to, see CalrissianCommandLineJob.uses_scratch_outdir
+SCRATCH_OUTDIR_VOLUME_NAME = 'scratch-outdir'
+SCRATCH_COPY_BACK_DIR = '/calrissian/copy-back'
+# The copy back runs tar in the container of the tool, which fails without it
+COPY_BACK_TAR_MISSING_MESSAGE = 'calrissian: --scratch-outdir requires tar in the image of the step'
+COPY_BACK_TAR_MISSING_EXIT_CODE = 127
+# outdirMin of jobs without a ResourceRequirement, in MiB
+DEFAULT_OUTDIR_MEGABYTES = 1024
+
+# emptyDir medium of the /tmp of jobs with a memory tmpdir, see calrissian.tool.memory_tmpdir_resources
+TMPDIR_MEMORY_MEDIUM = 'Memory'
+
 
 class VolumeBuilderException(WorkflowException):
     pass
@@ -71,6 +99,14 @@ def quoted_arg_list(arg_list):
     return [shellescape.quote(arg) if shouldquote(arg) else arg for arg in arg_list]
 
 
+def is_pinned_by_digest(image):
+    """
+    :param image: image reference, e.g. debian:stable or debian@sha256:...
+    :return: bool: whether the reference always resolves to the same image
+    """
+    return bool(IMAGE_DIGEST_REGEX.search(image))
+
+
 def total_size(outputs):
     """
     Recursively walk through an output dictionary object, totaling
@@ -85,6 +121,17 @@ def total_size(outputs):
     return sum([f.get('size', 0) for f in files])
 
 
+def outputs_exist(outputs):
+    """
+    Check that every local File and Directory in an output dictionary still exists
+    :param outputs: output dictionary from a CWL job
+    :return: True if all files and directories exist
+    """
+    locations = []
+    visit_class(outputs, ("File", "Directory",), lambda f: locations.append(f.get('location', '')))
+    return all(os.path.exists(uri_file_path(l)) for l in locations if l.startswith('file://'))
+
+
 class KubernetesPodVolumeInspector(object):
     def __init__(self, pod):
         self.pod = pod
@@ -118,9 +165,13 @@ class KubernetesVolumeBuilder(object):
     def __init__(self):
         self.persistent_volume_entries = {}
         self.emptydir_volume_names = []
+        self.ephemeral_volume_names = []
+        self.hostpath_volume_names = []
         self.configmap_volume_names = []
         self.volume_mounts = []
         self.volumes = []
+        # (source, target) of each persistent volume binding
+        self.volume_bindings = []
 
     def add_persistent_volume_entries_from_pod(self, pod):
         """
@@ -146,14 +197,57 @@ class KubernetesVolumeBuilder(object):
         self.persistent_volume_entries[prefix] = entry
         self.volumes.append(entry['volume'])
 
-    def add_emptydir_volume(self, name):
+    def add_emptydir_volume(self, name, medium=None, size_megabytes=None):
+        """
+        :param medium: 'Memory' for a tmpfs counted in the memory of the pod, or None for the disk of the node
+        :param size_megabytes: sizeLimit of the volume in MiB, or None
+        """
+        empty_dir = {}
+        if medium:
+            empty_dir['medium'] = medium
+        if size_megabytes:
+            empty_dir['sizeLimit'] = '{}Mi'.format(size_megabytes)
         volume = {
             'name': name,
-            'emptyDir': {},
+            'emptyDir': empty_dir,
         }
         self.emptydir_volume_names.append(name)
         self.volumes.append(volume)
 
+    def add_ephemeral_volume(self, name, storage_class_name, size_megabytes):
+        """
+        Add a generic ephemeral volume, provisioned with the pod from a storage class, e.g. of local disks
+        :param size_megabytes: size of the volume in MiB
+        """
+        volume = {
+            'name': name,
+            'ephemeral': {
+                'volumeClaimTemplate': {
+                    'spec': {
+                        'accessModes': ['ReadWriteOnce'],
+                        'storageClassName': storage_class_name,
+                        'resources': {'requests': {'storage': '{}Mi'.format(size_megabytes)}},
+                    }
+                }
+            }
+        }
+        self.ephemeral_volume_names.append(name)
+        self.volumes.append(volume)
+
+    def add_hostpath_volume(self, name, path):
+        """
+        Add a directory of the node, created if missing
+        """
+        volume = {
+            'name': name,
+            'hostPath': {
+                'path': path,
+                'type': 'DirectoryOrCreate',
+            }
+        }
+        self.hostpath_volume_names.append(name)
+        self.volumes.append(volume)
+
     def add_configmap_volume(self, name, cm_name):
         volume = {
             'name': name,
@@ -164,12 +258,13 @@ class KubernetesVolumeBuilder(object):
 
     def find_persistent_volume(self, source):
         """
-        For a given source path, return the volume entry that contains it
+        For a given source path, return the volume entry that contains it. When volumes are mounted at prefixes of
+        each other, e.g. /data/out1 and /data/out10, the longest prefix contains it.
         """
-        for prefix, entry in self.persistent_volume_entries.items():
-            if source.startswith(prefix):
-                return entry
-        return None
+        prefixes = [prefix for prefix in self.persistent_volume_entries if source.startswith(prefix)]
+        if not prefixes:
+            return None
+        return self.persistent_volume_entries[max(prefixes, key=len)]
 
     @staticmethod
     def calculate_subpath(source, prefix, parent_sub_path):
@@ -180,22 +275,25 @@ class KubernetesVolumeBuilder(object):
         else:
             return source_without_prefix
 
-    def add_volume_binding(self, source, target, writable):
+    def persistent_volume_mount(self, source, target, writable):
         # Find the persistent volume claim where this goes
         pv = self.find_persistent_volume(source)
         if not pv:
             raise VolumeBuilderException('Could not find a persistent volume mounted for {}'.format(source))
         # Now build up the volumeMount entry for this container
-        volume_mount = {
+        return {
             'name': pv['volume']['name'],
             'mountPath': target,
             'subPath': self.calculate_subpath(source, pv['prefix'], pv['subPath']),
             'readOnly': not writable
         }
-        self.volume_mounts.append(volume_mount)
+
+    def add_volume_binding(self, source, target, writable):
+        self.volume_mounts.append(self.persistent_volume_mount(source, target, writable))
+        self.volume_bindings.append((source, target))
 
     def add_emptydir_volume_binding(self, name, target):
-        if name not in self.emptydir_volume_names:
+        if name not in self.emptydir_volume_names + self.ephemeral_volume_names:
             # fail if the name is not registered
             raise VolumeBuilderException('Could not find an emptyDir volume named {}'.format(name))
         volume_mount = {
@@ -204,6 +302,17 @@ class KubernetesVolumeBuilder(object):
         }
         self.volume_mounts.append(volume_mount)
 
+    def add_hostpath_volume_binding(self, name, target, sub_path):
+        if name not in self.hostpath_volume_names:
+            raise VolumeBuilderException('Could not find a hostPath volume named {}'.format(name))
+        volume_mount = {
+            'name': name,
+            'mountPath': target,
+            'subPath': sub_path,
+            'readOnly': True
+        }
+        self.volume_mounts.append(volume_mount)
+
     def add_configmap_volume_binding(self, name, target):
         if name not in self.configmap_volume_names:
             raise VolumeBuilderException('Could not find a configMap volume named {}'.format(name))
@@ -215,7 +324,7 @@ class KubernetesVolumeBuilder(object):
 
 class KubernetesPodBuilder(object):
 
-    def __init__(self, name, builder, container_image, environment, volume_mounts, volumes, command_line, stdout, stderr, stdin, labels, nodeselectors, gpu_nodeselectors, security_context, serviceaccount, pod_additional_spec=None, no_network_access_pod_labels=None, network_access_pod_labels=None):
+    def __init__(self, name, builder, container_image, environment, volume_mounts, volumes, command_line, stdout, stderr, stdin, labels, nodeselectors, gpu_nodeselectors, security_context, serviceaccount, pod_additional_spec=None, no_network_access_pod_labels=None, network_access_pod_labels=None, copy_back_dir=None, reference_cache=None):
         self.name = name
         self.builder = builder
         self.cwl_version = self.builder.cwlVersion
@@ -235,9 +344,14 @@ class KubernetesPodBuilder(object):
         self.serviceaccount = serviceaccount
         self.no_network_access_pod_labels = no_network_access_pod_labels
         self.network_access_pod_labels = network_access_pod_labels
+        # Where the outdir is copied back to after the command line ran, when it is a scratch volume
+        self.copy_back_dir = copy_back_dir
+        # (script, volume mounts) of the init container filling the reference cache of the node, see calrissian.refcache
+        self.reference_cache = reference_cache
         self.priority_class = pod_additional_spec.get("pod_priority_class")
         self.env_from_secret = pod_additional_spec.get("env_from_secret")
         self.env_from_configmap = pod_additional_spec.get("env_from_configmap")
+        self.active_deadline_seconds = pod_additional_spec.get("active_deadline_seconds")
         self.requirements = {} if self.builder.requirements is None else self.builder.requirements
         self.hints = [] if self.builder.hints is None else self.builder.hints
 
@@ -251,6 +365,9 @@ class KubernetesPodBuilder(object):
     def init_container_name(self):
         return k8s_safe_name('{}-init'.format(self.name))
 
+    def reference_cache_container_name(self):
+        return k8s_safe_name('{}-cache'.format(self.name))
+
     # To provide the CWL command-line to kubernetes, we must wrap it in 'sh -c <command string>'
     # Otherwise we can't do things like redirecting stdout.
 
@@ -268,7 +385,22 @@ class KubernetesPodBuilder(object):
         # pod_command is a list of strings. Needs to be turned into a single string
         # and passed as an argument to sh -c. Otherwise we cannot redirect STDIN/OUT/ERR inside a kubernetes container
         # Join everything into a single string and then return a single args list
-        return [' '.join(pod_command)]
+        command = ' '.join(pod_command)
+        if self.copy_back_dir:
+            command = self.with_copy_back(command)
+        return [command]
+
+    def with_copy_back(self, command):
+        """
+        Run the command, then stream the scratch outdir to the copy-back dir in one tar pipe. The exit code is that of
+        the command, or 1 if it succeeded but its results could not be copied back. The pipe runs in the container of
+        the tool, so images without tar fail with COPY_BACK_TAR_MISSING_EXIT_CODE before the command runs.
+        """
+        outdir, copy_back_dir = quoted_arg_list([self.builder.outdir, self.copy_back_dir])
+        return 'command -v tar > /dev/null || {{ echo {} >&2; exit {}; }}; ' \
+               '( {} ); status=$?; tar -C {} -cf - . | tar -C {} -xf - || [ $status -ne 0 ] || status=1; ' \
+               'exit $status'.format(shellescape.quote(COPY_BACK_TAR_MISSING_MESSAGE), COPY_BACK_TAR_MISSING_EXIT_CODE,
+                                     command, outdir, copy_back_dir)
 
     # If redirecting to stdout or stderr, we may need to make intermediate directories first
     # This can only happen inside the pod, so we use an initContainer to `mkdir -p` for any directories
@@ -290,6 +422,14 @@ class KubernetesPodBuilder(object):
                 'workingDir': self.container_workingdir(),
                 'volumeMounts': self.volume_mounts,
             })
+        if self.reference_cache:
+            script, volume_mounts = self.reference_cache
+            containers.append({
+                'name': self.reference_cache_container_name(),
+                'image':  os.environ.get(INIT_IMAGE_ENV_VARIABLE, DEFAULT_INIT_IMAGE),
+                'command': ['/bin/sh', '-c', script],
+                'volumeMounts': volume_mounts,
+            })
         return containers
 
     def container_environment(self):
@@ -356,6 +496,22 @@ class KubernetesPodBuilder(object):
                         container_resources[resource_bound] = {}
                     container_resources[resource_bound][resource_type] = resource_value
 
+            elif cwl_field == Resources.EXTENDED:
+                for name, amount in cwl_value.items():
+                    quantity = format_resource_quantity(name, amount)
+                    container_resources.setdefault('requests', {})[name] = quantity
+                    if name != EPHEMERAL_STORAGE:
+                        # Hugepages and extended resources cannot be overcommitted, so need limits equal to requests
+                        container_resources.setdefault('limits', {})[name] = quantity
+
+        if GPU_REPLICAS in self.resources:
+            # A share of a time-sliced GPU, or MIG partitions requested above as extended resources
+            replicas = self.resources[GPU_REPLICAS]
+            if replicas:
+                container_resources.setdefault('requests', {})[NVIDIA_GPU] = str(replicas)
+                container_resources.setdefault('limits', {})[NVIDIA_GPU] = str(replicas)
+            return container_resources
+
         # Add CUDA requirements from CWL
         for requirement in self.requirements:
             if requirement["class"] in ['cwltool:CUDARequirement', 'http://commonwl.org/cwltool#CUDARequirement']:
@@ -414,7 +570,7 @@ class KubernetesPodBuilder(object):
                 'class' in req
                 and req['class'] in ['cwltool:CUDARequirement', 'http://commonwl.org/cwltool#CUDARequirement']
                 for req in self.requirements
-            )
+            ) or GPU_REPLICAS in self.resources
             else _tostring(self.nodeselectors)
         )
 
@@ -460,6 +616,10 @@ class KubernetesPodBuilder(object):
         if ( self.priority_class ):
             spec['spec']['priorityClassName'] = self.priority_class
 
+        if self.active_deadline_seconds:
+            # ToolTimeLimit, enforced by the kubelet
+            spec['spec']['activeDeadlineSeconds'] = self.active_deadline_seconds
+
         if self.env_from_secret or self.env_from_configmap:
             envfrom = []
 
@@ -480,12 +640,50 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
 
     container_tmpdir = '/tmp'
 
+    # Set by CalrissianCommandLineTool.job(), part of the step cache key
+    tool_document = None
+
+    # Whether the job can share a pod with compatible jobs, see calrissian.batch
+    batchable = True
+
+    # Set by CalrissianCommandLineTool.job() for steps of a fused chain, see calrissian.fusion
+    fuse_downstream = False
+    fused_upstream = False
+
+    # Set by ThreadPoolJobExecutor.enqueue() when the job is admitted to a named ResourcePool
+    resource_pool = None
+
+    # Set by CalrissianCommandLineTool.job() to the name cwltool made the name of the job unique from, shared by the
+    # jobs of a scatter, see calrissian.speculation.sibling_group
+    step_name = None
+
+    # Set by CalrissianCommandLineTool.job() from the FairShare hint, see calrissian.fairshare
+    fair_share_weight = 1.0
+
+    # Set by CalrissianCommandLineTool.job() from the Concurrency requirement, see calrissian.concurrency
+    concurrency_group = None
+    concurrency_limit = None
+
+    # Set by CalrissianCommandLineTool.job() from the IOClass requirement, see calrissian.iobudget
+    io_weight = 0
+
+    # Set by CalrissianCommandLineTool.job() when /tmp is a tmpfs, its size in MiB, added to the RAM of the job
+    memory_tmpdir_megabytes = None
+
     def __init__(self, *args, **kwargs):
         super(CalrissianCommandLineJob, self).__init__(*args, **kwargs)
         self.client = KubernetesClient()
         volume_builder = KubernetesVolumeBuilder()
         volume_builder.add_persistent_volume_entries_from_pod(self.client.get_current_pod())
         self.volume_builder = volume_builder
+        self.step_cache_key = None
+        self.copy_back_dir = None
+        # (key, source) of the inputs read from the reference cache of the node, see calrissian.refcache
+        self.reference_cache_entries = []
+        self.reference_cache = None
+        self.reference_cache_stats_dir = None
+        # Reserved from the executor when the job is retried with more memory, released when it finishes
+        self.escalated_resources = Resources.EMPTY
             
     def make_tmpdir(self):
         # Doing this because cwltool.job does it
@@ -505,7 +703,34 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
             self.environment[str(k)] = str(v)
 
     def wait_for_kubernetes_pod(self):
-        return self.client.wait_for_completion()
+        return self.client.wait_for_completion(sample_usage=UsageMonitor.is_enabled())
+
+    def observed_ram_megabytes(self):
+        """
+        :return: the peak RAM sampled from the running pod of the job in megabytes, or None if it was not sampled
+        """
+        pod = self.client.pod
+        if pod is None:
+            return None
+        return UsageMonitor.peak_ram_megabytes(pod.metadata.name)
+
+    def usage_history_key(self):
+        """
+        Identify the tool of the job in the usage history by the last part of its id and its image, which are
+        stable across runs unlike the location of the document
+        :return: str
+        """
+        tool_id = self.tool_document.get('id', self.name) if self.tool_document else self.name
+        return '{}@{}'.format(os.path.basename(tool_id), self._get_container_image())
+
+    def record_usage(self, completion_result: CompletionResult):
+        """
+        Record the peak usage sampled while a successful pod ran in the usage history
+        """
+        if completion_result.peak_cpus is None and completion_result.peak_ram_megabytes is None:
+            return
+        UsageHistory.record(self.usage_history_key(), self.name, completion_result.peak_cpus,
+                            completion_result.peak_ram_megabytes)
 
     def report(self, completion_result: CompletionResult, disk_bytes):
         """
@@ -513,6 +738,10 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
         :param completion_result: calrissian.k8s.CompletionResult
         """
         report = TimedResourceReport.create(self.name, completion_result, disk_bytes)
+        if self.resource_pool is not None:
+            report.resource_pool = self.resource_pool.name
+        if self.builder.resources.get(Resources.GPUS):
+            report.gpus = float(self.builder.resources[Resources.GPUS])
         Reporter.add_report(report)
 
     def dump_tool_logs(self, name, completion_result: CompletionResult, runtime_context):
@@ -553,11 +782,21 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
 
         disk_bytes = total_size(outputs)
         self.report(completion_result, disk_bytes)
+        if self.reference_cache_stats_dir:
+            ReferenceCache.record(self.name, self.reference_cache_stats_dir)
+        self.record_completion(outputs, status, exit_code)
+        if status == "success" and self.step_cache_key:
+            StepCache.store(self.step_cache_key, self.outdir, name=self.name, image=self._get_container_image())
+        if status == "success" and UsageHistory.is_enabled():
+            self.record_usage(completion_result)
 
         # Invoke the callback with a lock
         with runtimeContext.workflow_eval_lock:
             self.output_callback(outputs, status)
 
+        self.cleanup(runtimeContext)
+
+    def cleanup(self, runtimeContext):
         # Cleanup our stagedir and tmp
         if self.stagedir is not None and os.path.exists(self.stagedir):
             log.debug('shutil.rmtree({}, {})'.format(self.stagedir, True))
@@ -602,9 +841,12 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
 
     def get_pod_labels(self, runtimeContext):
         if runtimeContext.pod_labels:
-            return read_yaml(runtimeContext.pod_labels)
+            labels = read_yaml(runtimeContext.pod_labels)
         else:
-            return {}
+            labels = {}
+        if Journal.is_enabled():
+            labels[RUN_ID_LABEL] = Journal.run_id
+        return labels
 
     def get_network_access_pod_labels(self, runtimeContext):
         if runtimeContext.network_access_pod_labels:
@@ -630,6 +872,29 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
         else:
             return {}
 
+    def is_gpu_job(self):
+        cuda_req, _ = self.get_requirement('http://commonwl.org/cwltool#CUDARequirement')
+        return cuda_req is not None or GPU_REPLICAS in self.builder.resources
+
+    def node_selector(self, runtimeContext):
+        """
+        The node selector the pod of the job is scheduled with, which routes the job to a ResourcePool
+        :return: dict
+        """
+        if self.is_gpu_job():
+            return self.get_pod_gpu_nodeselectors(runtimeContext)
+        return self.get_pod_nodeselectors(runtimeContext)
+
+    def get_resource_pool_nodeselectors(self, nodeselectors):
+        """
+        Constrain the pod to the nodes of the ResourcePool the job was admitted to
+        :param nodeselectors: dict of the node selector from the runtime context
+        :return: dict
+        """
+        if self.resource_pool is None:
+            return nodeselectors
+        return dict(nodeselectors, **self.resource_pool.node_selector)
+
     def get_pod_serviceaccount(self, runtimeContext):
         return runtimeContext.pod_serviceaccount
 
@@ -674,6 +939,9 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
         
         if self.get_pod_env_from_configmap(runtimeContext):
             spec["env_from_configmap"] = self.get_pod_env_from_configmap(runtimeContext)
+
+        if self.timelimit:
+            spec["active_deadline_seconds"] = self.timelimit
         
         return spec
 
@@ -684,12 +952,20 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
         runtime = []
 
         # Append volume for outdir
-        self._add_volume_binding(os.path.realpath(self.outdir), self.builder.outdir, writable=True)
-        # Use a kubernetes emptyDir: {} volume for /tmp
+        if self.uses_scratch_outdir(runtimeContext):
+            self.add_scratch_outdir_volume(runtimeContext)
+        else:
+            self._add_volume_binding(os.path.realpath(self.outdir), self.builder.outdir, writable=True)
+        # Use a kubernetes emptyDir: {} volume for /tmp, or a memory-backed one for jobs with a memory tmpdir
         # Note that below add_volumes() may result in other temporary files being mounted
         # from the calrissian host's tmpdir prefix into an absolute container path, but this will
         # not conflict with '/tmp' as an emptyDir
-        self._add_emptydir_volume_and_binding('tmpdir', self.container_tmpdir)
+        if self.memory_tmpdir_megabytes:
+            self.volume_builder.add_emptydir_volume('tmpdir', medium=TMPDIR_MEMORY_MEDIUM,
+                                                    size_megabytes=self.memory_tmpdir_megabytes)
+            self.volume_builder.add_emptydir_volume_binding('tmpdir', self.container_tmpdir)
+        else:
+            self._add_emptydir_volume_and_binding('tmpdir', self.container_tmpdir)
 
         # Call the ContainerCommandLineJob add_volumes method
         self.add_volumes(self.pathmapper,
@@ -710,6 +986,94 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
                 secret_store=runtimeContext.secret_store,
                 any_path_okay=any_path_okay)
 
+        if self.reference_cache_entries:
+            self.add_reference_cache_init()
+
+        # Report an error if anything was added to the runtime list
+        if runtime:
+            log.error('Runtime list is not empty. k8s does not use that, so you should see who put something there:\n{}'.format(' '.join(runtime)))
+        return self.build_kubernetes_pod(runtimeContext)
+
+    def uses_scratch_outdir(self, runtimeContext):
+        """
+        With --scratch-outdir, the job writes its outdir on a volume of its node rather than the shared volume, and
+        copies it back in bulk once its command line exits. Jobs staging inputs into their outdir, e.g. with an
+        InitialWorkDirRequirement, keep their outdir on the shared volume, where the inputs are staged.
+        :return: bool
+        """
+        if not runtimeContext.scratch_outdir:
+            return False
+        outdir = os.path.join(self.builder.outdir, '')
+        for mapper in [self.pathmapper, self.generatemapper]:
+            if mapper is None:
+                continue
+            if any(entry.target.startswith(outdir) for _, entry in mapper.items()):
+                return False
+        return True
+
+    def add_scratch_outdir_volume(self, runtimeContext):
+        """
+        Mount a scratch volume at the outdir: an emptyDir on the disk of the node, or a generic ephemeral volume of
+        --scratch-storage-class the size of outdirMin. The outdir on the shared volume is mounted to copy back to, so
+        outputs are collected at the same paths.
+        """
+        if runtimeContext.scratch_storage_class:
+            size_megabytes = int(math.ceil(self.builder.resources.get('outdirSize') or DEFAULT_OUTDIR_MEGABYTES))
+            self.volume_builder.add_ephemeral_volume(SCRATCH_OUTDIR_VOLUME_NAME, runtimeContext.scratch_storage_class,
+                                                     size_megabytes)
+        else:
+            self.volume_builder.add_emptydir_volume(SCRATCH_OUTDIR_VOLUME_NAME)
+        self.volume_builder.add_emptydir_volume_binding(SCRATCH_OUTDIR_VOLUME_NAME, self.builder.outdir)
+        self._add_volume_binding(os.path.realpath(self.outdir), SCRATCH_COPY_BACK_DIR, writable=True)
+        self.copy_back_dir = SCRATCH_COPY_BACK_DIR
+
+    def input_checksums(self):
+        """
+        :return: dict of the paths of the input files with a checksum to their checksum
+        """
+        checksums = {}
+
+        def add_checksum(file_object):
+            location = file_object.get('location', '')
+            if file_object.get('checksum') and location.startswith('file://'):
+                checksums[uri_file_path(location)] = file_object['checksum']
+
+        visit_class(self.builder.job, ('File',), add_checksum)
+        return checksums
+
+    def add_reference_cache_binding(self, source, target):
+        """
+        Mount a read-only input file from the reference cache of the node instead of the shared volume
+        """
+        if REFERENCE_CACHE_VOLUME_NAME not in self.volume_builder.hostpath_volume_names:
+            self.volume_builder.add_hostpath_volume(REFERENCE_CACHE_VOLUME_NAME, ReferenceCache.directory)
+        key = ReferenceCache.entry_key(source, self.input_checksums().get(source))
+        self.volume_builder.add_hostpath_volume_binding(REFERENCE_CACHE_VOLUME_NAME, target,
+                                                        '{}/{}'.format(key, REFERENCE_ENTRY_FILENAME))
+        self.reference_cache_entries.append((key, source))
+
+    def add_reference_cache_init(self):
+        """
+        Set up the init container filling the reference cache of the node with the inputs of the job, mounting the
+        cache directory, each input on the shared volume and a directory of the tmpdir to write its stats to
+        """
+        self.reference_cache_stats_dir = tempfile.mkdtemp(dir=self.tmpdir)
+        volume_mounts = [
+            {'name': REFERENCE_CACHE_VOLUME_NAME, 'mountPath': REFERENCE_CACHE_MOUNT},
+            self.volume_builder.persistent_volume_mount(self.reference_cache_stats_dir, REFERENCE_STATS_DIR, True),
+        ]
+        entries = []
+        for key, source in dict(self.reference_cache_entries).items():
+            target = '{}/{}'.format(REFERENCE_SOURCES_ROOT, len(entries))
+            volume_mounts.append(self.volume_builder.persistent_volume_mount(source, target, False))
+            entries.append((key, target, os.path.getsize(source)))
+        self.reference_cache = (fill_script(entries, ReferenceCache.max_bytes), volume_mounts)
+
+    def build_kubernetes_pod(self, runtimeContext):
+        """
+        Build the pod spec of the job from its volume bindings and its current resources
+        :return: dict
+        """
         k8s_builder = KubernetesPodBuilder(
             self.name,
             self.builder,
@@ -722,24 +1086,276 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
             self.stderr,
             self.stdin,
             self.get_pod_labels(runtimeContext),
-            self.get_pod_nodeselectors(runtimeContext),
-            self.get_pod_gpu_nodeselectors(runtimeContext),
+            self.get_resource_pool_nodeselectors(self.get_pod_nodeselectors(runtimeContext)),
+            self.get_resource_pool_nodeselectors(self.get_pod_gpu_nodeselectors(runtimeContext)),
             self.get_security_context(runtimeContext),
             self.get_pod_serviceaccount(runtimeContext),
             self.get_pod_additional_spec(runtimeContext),
             self.get_no_network_access_pod_labels(runtimeContext),
             self.get_network_access_pod_labels(runtimeContext),
+            copy_back_dir=self.copy_back_dir,
+            reference_cache=self.reference_cache,
         )
         built = k8s_builder.build()
         log.debug('{}\n{}{}\n'.format('-' * 80, yaml.dump(built), '-' * 80))
-        # Report an error if anything was added to the runtime list
-        if runtime:
-            log.error('Runtime list is not empty. k8s does not use that, so you should see who put something there:\n{}'.format(' '.join(runtime)))
         return built
 
     def execute_kubernetes_pod(self, pod):
         self.client.submit_pod(pod)
 
+    def record_submission(self, pod):
+        """
+        Record the submitted pod in the journal, so a restarted controller can reattach to it
+        :param pod: the submitted pod spec
+        """
+        if Journal.is_enabled():
+            Journal.record(Journal.SUBMITTED, job_identity(self), name=self.name, pod=pod['metadata']['name'],
+                           outdir=self.outdir, builder_outdir=self.builder.outdir)
+
+    def record_completion(self, outputs, status, exit_code):
+        """
+        Record the outputs of the finished job in the journal, so a resumed run can skip it
+        """
+        if Journal.is_enabled():
+            Journal.record(Journal.COMPLETED, job_identity(self), name=self.name, outputs=outputs, status=status,
+                           exit_code=exit_code)
+
+    def resume_from_journal(self, runtimeContext):
+        """
+        When resuming a run, skip the job if the journal records it as successfully completed and its outputs are
+        still in place. The recorded outputs are then handed to the output callback as if the job had just run.
+        :return: True if the job was resumed from the journal, False if it must run
+        """
+        if not Journal.is_enabled():
+            return False
+        completed = Journal.claim(Journal.COMPLETED, job_identity(self))
+        if completed is None or completed['status'] != 'success':
+            return False
+        if not outputs_exist(completed['outputs']):
+            log.info('Job {} completed before, but its outputs are missing. Running it again'.format(self.name))
+            return False
+        log.info('Job {} completed before, resuming with its recorded outputs'.format(self.name))
+        # Keep the journal complete for a further resume
+        Journal.record(Journal.COMPLETED, completed['key'], name=self.name, outputs=completed['outputs'],
+                       status=completed['status'], exit_code=completed['exit_code'])
+        with runtimeContext.workflow_eval_lock:
+            self.output_callback(completed['outputs'], completed['status'])
+        return True
+
+    def compute_step_cache_key(self):
+        """
+        Key the step cache on everything that determines the outputs of the job: the tool document, the image,
+        the command line and environment, and the content of the input files. The outdir in the container is random,
+        and so are the staging directories, so they are normalized first.
+        Images are keyed by reference as written in the DockerRequirement, so only jobs of images pinned by digest
+        are cached, see is_pinned_by_digest.
+        :return: str
+        """
+        placeholders = {self.builder.outdir: '$(runtime.outdir)'}
+        checksums = {}
+        visit_class(self.builder.files, ("File",), lambda f: checksums.update({f.get('location'): f.get('checksum')}))
+        inputs = []
+        for mapper in [self.pathmapper, self.generatemapper]:
+            if mapper is None:
+                continue
+            for location, entry in mapper.items():
+                target = normalize(entry.target, placeholders)
+                if entry.type in ['File', 'WritableFile'] and os.path.isfile(entry.resolved):
+                    inputs.append([target, file_fingerprint(entry.resolved, checksums.get(location))])
+                elif entry.type in ['Directory', 'WritableDirectory'] and os.path.isdir(entry.resolved):
+                    inputs.append([target, directory_fingerprint(entry.resolved)])
+                else:
+                    # File literals and synthetic directories
+                    inputs.append([target, normalize(entry.resolved, placeholders)])
+        return cache_key({
+            'tool': self.tool_document,
+            'image': self._get_container_image(),
+            'command_line': normalize(self.command_line, placeholders),
+            'stdin': normalize(self.stdin, placeholders),
+            'stdout': normalize(self.stdout, placeholders),
+            'stderr': normalize(self.stderr, placeholders),
+            'environment': normalize(self.environment, placeholders),
+            'inputs': sorted(inputs),
+        })
+
+    def restore_from_step_cache(self, runtimeContext):
+        """
+        Look up the outputs of an identical job in the step cache. On a hit, they are linked into the outdir
+        and collected without creating a pod.
+        :return: True on a cache hit, False if the job must run
+        """
+        if not StepCache.is_enabled():
+            return False
+        work_reuse, _ = self.get_requirement('WorkReuse')
+        if work_reuse and not work_reuse.get('enableReuse', True):
+            return False
+        image = self._get_container_image()
+        if not is_pinned_by_digest(image):
+            # A tag can move to another image, whose outputs would differ from the cached ones
+            log.debug('Job {} is not cached, its image {} is not pinned by digest'.format(self.name, image))
+            return False
+        self.step_cache_key = self.compute_step_cache_key()
+        if not StepCache.restore(self.step_cache_key, self.outdir):
+            return False
+        log.info('Job {} restored from step cache entry {}'.format(self.name, self.step_cache_key))
+        outputs = self.collect_outputs(self.outdir, 0)
+        self.record_completion(outputs, "success", 0)
+        with runtimeContext.workflow_eval_lock:
+            self.output_callback(outputs, "success")
+        self.cleanup(runtimeContext)
+        return True
+
+    def can_run_in_runner_pool(self, pod=None):
+        """
+        A runner pod reproduces the job's bindings with links under RUNNER_ROOT, so only jobs whose outdir and
+        inputs are all bound there can run in one. Other jobs, e.g. with an absolute dockerOutputDirectory,
+        run in their own pod, as do jobs whose environment cannot be exported in the runner pod.
+        :param pod: the pod spec built for the job, if built
+        :return: bool
+        """
+        if not RunnerPool.is_enabled():
+            return False
+        if pod is not None and not exports_environment(pod):
+            # e.g. variables from secrets or config maps
+            return False
+        if self.timelimit:
+            # The runner pod has no deadline per command line
+            return False
+        if self.volume_builder.configmap_volume_names or set(self.volume_builder.emptydir_volume_names) - {'tmpdir'}:
+            return False
+        if self.volume_builder.ephemeral_volume_names or self.memory_tmpdir_megabytes:
+            return False
+        if self.reference_cache_entries:
+            # The runner pod has no init container filling the cache
+            return False
+        return all(target.startswith(RUNNER_ROOT + '/') for _, target in self.volume_builder.volume_bindings)
+
+    def execute_in_runner_pool(self, pod):
+        """
+        Run the command line of the job's pod in a runner pod from the pool, instead of submitting the pod
+        :param pod: the pod spec built for the job
+        :return: CompletionResult, or None if the pod must be submitted
+        """
+        if not self.can_run_in_runner_pool(pod):
+            return None
+        input_paths = [entry.resolved for _, entry in self.pathmapper.items()] if self.fused_upstream else None
+        hold_outdir = self.outdir if self.fuse_downstream else None
+        return RunnerPool.execute(pod, self.volume_builder.volume_bindings,
+                                  self.volume_builder.persistent_volume_entries.values(),
+                                  input_paths=input_paths, hold_outdir=hold_outdir)
+
+    def run_kubernetes_pod(self, pod, runtimeContext):
+        """
+        Run the job's pod in a runner pod from the pool, or submit it and wait for it to finish
+        :param pod: the pod spec built for the job
+        :return: CompletionResult
+        """
+        completion_result = self.execute_in_runner_pool(pod)
+        if completion_result is None:
+            completion_result = self.submit_kubernetes_pod(pod, runtimeContext)
+        return completion_result
+
+    def submit_kubernetes_pod(self, pod, runtimeContext):
+        """
+        Submit the job's pod and wait for it to finish. When the pod is evicted, preempted or lost with its node,
+        the job is resubmitted in a new pod with exponential backoff, up to --max-pod-resubmissions times.
+        With --speculation-factor, a straggler is raced against a duplicate pod, see calrissian.speculation.
+        :param pod: the pod spec built for the job
+        :return: CompletionResult
+        """
+        attempts = runtimeContext.max_pod_resubmissions + 1
+        for attempt in retrying_exponential_if_exception_type(PodDisruptedException, attempts, log):
+            with attempt:
+                if attempt.retry_state.attempt_number > 1:
+                    log.info('Resubmitting job {} after its pod was disrupted'.format(self.name))
+                    # With a new name, the disrupted pod may still be terminating
+                    pod = self.build_kubernetes_pod(runtimeContext)
+                self.execute_kubernetes_pod(pod) # analogous to _execute()
+                self.record_submission(pod)
+                if Speculator.is_enabled():
+                    return Speculator.wait(self, pod, runtimeContext)
+                return self.wait_for_kubernetes_pod()
+
+    def escalated_ram(self, runtimeContext):
+        """
+        The RAM request to retry the job with after it was OOMKilled: its request scaled by --oom-retry-factor,
+        up to the ramMax of its ResourceRequirement, or up to --max-ram when it does not declare a larger ramMax.
+        :return: RAM in megabytes, or None if the request cannot be raised
+        """
+        ram = self.builder.resources['ram']
+        ram_max = self.builder.resources.get('ramMax', ram)
+        if ram_max > ram or runtimeContext.max_ram is None:
+            ceiling = ram_max
+        else:
+            ceiling = MemoryParser.parse_to_megabytes(runtimeContext.max_ram)
+        escalated = min(math.ceil(ram * runtimeContext.oom_retry_factor), math.floor(ceiling))
+        return escalated if escalated > ram else None
+
+    def retry_oom_killed(self, pod, completion_result, runtimeContext):
+        """
+        While the container of the job is OOMKilled, resubmit it with an escalated RAM request, up to
+        --oom-max-retries times. The escalated RAM is reserved from the executor before each retry, and the
+        escalation is recorded in the usage report. Reattached jobs are not retried, their pod was built by
+        another controller.
+        :param pod: the pod spec of the failed attempt, None for a reattached job
+        :param completion_result: CompletionResult of the failed attempt
+        :return: (pod spec, CompletionResult) of the last attempt
+        """
+        if not runtimeContext.oom_retry_factor or pod is None:
+            return pod, completion_result
+        attempt = 0
+        while completion_result.reason == OOM_KILLED_REASON and attempt < runtimeContext.oom_max_retries:
+            ram = self.builder.resources['ram']
+            escalated = self.escalated_ram(runtimeContext)
+            if escalated is None:
+                log.info('Job {} was OOMKilled with {}Mi, which cannot be raised further'.format(self.name, ram))
+                break
+            attempt += 1
+            log.info('Job {} was OOMKilled with {}Mi, retrying with {}Mi'.format(self.name, ram, escalated))
+            # The failed attempt used resources too
+            self.report(completion_result, 0)
+            Reporter.add_memory_escalation({'name': self.name, 'attempt': attempt, 'from_ram_megabytes': ram,
+                                            'to_ram_megabytes': escalated})
+            extra = Resources(ram=escalated - ram)
+            # The killed container no longer uses its RAM, returned while waiting for the escalated request
+            runtimeContext.reserve_resources(extra, runtimeContext, pool=self.resource_pool,
+                                             held=Resources(ram=ram))
+            self.escalated_resources += extra
+            self.builder.resources['ram'] = escalated
+            # Kubernetes rejects requests above the limit
+            self.builder.resources['ramMax'] = max(self.builder.resources.get('ramMax', ram), escalated)
+            pod = self.build_kubernetes_pod(runtimeContext)
+            completion_result = self.run_kubernetes_pod(pod, runtimeContext)
+        return pod, completion_result
+
+    def release_escalated_resources(self, runtimeContext):
+        """
+        Return the resources reserved by retry_oom_killed to the executor
+        """
+        if self.escalated_resources != Resources.EMPTY:
+            runtimeContext.release_resources(self.escalated_resources, runtimeContext, pool=self.resource_pool)
+            self.escalated_resources = Resources.EMPTY
+
+    def reattach_kubernetes_pod(self):
+        """
+        When replaying the journal after a controller restart, reattach to the pod the previous controller submitted
+        for this job if it still exists, whether it is still running or has finished in the meantime.
+        The job then adopts the output directory of that pod.
+        :return: True if reattached, False if a pod must be submitted
+        """
+        if not Journal.is_enabled():
+            return False
+        submission = Journal.claim(Journal.SUBMITTED, job_identity(self))
+        if submission is None or not self.client.reattach_pod(submission['pod']):
+            return False
+        log.info('Job {} reattached to pod {}, adopting outdir {}'.format(self.name, submission['pod'], submission['outdir']))
+        self.outdir = submission['outdir']
+        self.builder.outdir = submission['builder_outdir']
+        # Keep the journal complete for a further restart
+        Journal.record(Journal.SUBMITTED, submission['key'], name=self.name, pod=submission['pod'],
+                       outdir=self.outdir, builder_outdir=self.builder.outdir)
+        return True
+
     def _add_emptydir_volume_and_binding(self, name, target):
         self.volume_builder.add_emptydir_volume(name)
         self.volume_builder.add_emptydir_volume_binding(name, target)
@@ -758,7 +1374,11 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
                                      host_outdir_tgt  # type: Optional[Text]
                                      ):
         """Append volume a file/dir mapping to the runtime option list."""
-        if not volume.resolved.startswith("_:"):
+        if volume.resolved.startswith("_:"):
+            return
+        if volume.type == 'File' and ReferenceCache.caches(volume.resolved):
+            self.add_reference_cache_binding(volume.resolved, volume.target)
+        else:
             self._add_volume_binding(volume.resolved, volume.target) # this one defaults to read_only
 
     def add_writable_file_volume(self,
@@ -830,16 +1450,10 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
             "HOME": self.builder.outdir,
         }
 
-    def run(self, runtimeContext, tmpdir_lock=None):
-        
-        def get_pod_command(pod):
-            return pod['spec']['containers'][0]['args']
-            
-        def get_pod_name(pod):
-            return pod['spec']['containers'][0]['name']
-
-        self.check_requirements(runtimeContext)
-        
+    def prepare_run(self, runtimeContext, tmpdir_lock=None):
+        """
+        Create the job's tmpdir, populate its environment and stage its inputs, before its pod spec is built
+        """
         if tmpdir_lock:
             with tmpdir_lock:
                 self.make_tmpdir()
@@ -851,14 +1465,43 @@ class CalrissianCommandLineJob(ContainerCommandLineJob):
         self.setup_kubernetes(runtimeContext)
 
         self._setup(runtimeContext)
-        
-        pod = self.create_kubernetes_runtime(runtimeContext) # analogous to create_runtime()
-        self.execute_kubernetes_pod(pod) # analogous to _execute()
-        completion_result = self.wait_for_kubernetes_pod()
-        if completion_result.exit_code != 0:
-            log_main.error(f"ERROR the command below failed in pod {get_pod_name(pod)}:")
-            log_main.error("\t" + " ".join(get_pod_command(pod)))
-        self.finish(completion_result, runtimeContext)
+
+    def run(self, runtimeContext, tmpdir_lock=None):
+
+        def get_pod_command(pod):
+            return pod['spec']['containers'][0]['args']
+            
+        def get_pod_name(pod):
+            return pod['spec']['containers'][0]['name']
+
+        self.check_requirements(runtimeContext)
+
+        if self.resume_from_journal(runtimeContext):
+            return
+
+        self.prepare_run(runtimeContext, tmpdir_lock)
+
+        if self.reattach_kubernetes_pod():
+            pod = None
+            completion_result = self.wait_for_kubernetes_pod()
+        elif self.restore_from_step_cache(runtimeContext):
+            return
+        else:
+            pod = self.create_kubernetes_runtime(runtimeContext) # analogous to create_runtime()
+            completion_result = self.run_kubernetes_pod(pod, runtimeContext)
+        try:
+            pod, completion_result = self.retry_oom_killed(pod, completion_result, runtimeContext)
+            if completion_result.exit_code != 0 and pod is not None:
+                log_main.error(f"ERROR the command below failed in pod {get_pod_name(pod)}:")
+                log_main.error("\t" + " ".join(get_pod_command(pod)))
+            elif completion_result.exit_code != 0:
+                log_main.error(f"ERROR the command of reattached job {self.name} failed:")
+                log_main.error("\t" + " ".join(self.quoted_command_line()))
+            if completion_result.reason == DEADLINE_EXCEEDED_REASON:
+                log_main.error(f"ERROR job {self.name} exceeded its time limit of {self.timelimit} seconds")
+            self.finish(completion_result, runtimeContext)
+        finally:
+            self.release_escalated_resources(runtimeContext)
     
     def setup_kubernetes(self, runtime_context):
         cuda_req, _ = self.get_requirement("http://commonwl.org/cwltool#CUDARequirement")
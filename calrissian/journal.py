@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+
+log = logging.getLogger("calrissian.journal")
+
+# Keys of File and Directory objects that depend on where a job stages its inputs. They differ between
+# runs of the same workflow, so they are left out of a job's identity
+STAGING_KEYS = ['path', 'dirname']
+
+
+def _canonical(value):
+    """
+    Recursively strip staging-dependent keys from a CWL input object
+    :param value: CWL input object (dict, list or scalar)
+    :return: a copy of value without STAGING_KEYS
+    """
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in value.items() if k not in STAGING_KEYS}
+    elif isinstance(value, list):
+        return [_canonical(v) for v in value]
+    else:
+        return value
+
+
+def job_identity(job):
+    """
+    Compute a key that identifies a job across controller restarts.
+    cwltool names jobs deterministically (step name, plus scatter index), so the key is that name
+    and a digest of the job's inputs.
+    :param job: a CalrissianCommandLineJob
+    :return: str
+    """
+    inputs = json.dumps(_canonical(job.builder.job), sort_keys=True, default=str)
+    digest = hashlib.sha256(inputs.encode('utf-8')).hexdigest()
+    return '{}:{}'.format(job.name, digest)
+
+
+def read_journal(path):
+    """
+    Read the entries of a journal file, skipping a truncated last line left by an interrupted write
+    :param path: path of the journal file
+    :return: list of dicts
+    """
+    entries = []
+    with open(path) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                log.warning('Ignoring malformed journal entry: {}'.format(line.rstrip()))
+    return entries
+
+
+class Journal(object):
+    """
+    Singleton thread-safe, append-only journal of a workflow run, stored as JSON lines.
+
+    Each entry has an 'event' and a 'key'. The first entry of a journal records the run id, which is added as a
+    label to every pod submitted so the pods of a run can be found again. When replayed, the entries of a previous
+    controller are loaded so that jobs can look up what was done for them before a restart.
+
+    Events:
+    - SUBMITTED: a pod was submitted for a job, with the pod name and output directories
+    - COMPLETED: a job finished, with its output object, status and exit code
+    """
+    RUN = 'run'
+    SUBMITTED = 'submitted'
+    COMPLETED = 'completed'
+
+    path = None
+    run_id = None
+    replayed = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def initialize(path, replay=()):
+        """
+        Start journaling to path
+        :param path: path of the journal file
+        :param replay: events of the latest run in the journal to load. If empty, a new run is started
+        """
+        with Journal.lock:
+            Journal.path = path
+            Journal.run_id = None
+            Journal.replayed = {}
+            if replay and os.path.exists(path):
+                for entry in read_journal(path):
+                    if entry['event'] == Journal.RUN:
+                        # Only the latest run in the journal is replayed
+                        Journal.run_id = entry['key']
+                        Journal.replayed = {}
+                    elif entry['event'] in replay:
+                        # Later entries supersede earlier ones
+                        Journal.replayed.setdefault(entry['event'], {})[entry['key']] = entry
+            if Journal.run_id is None:
+                Journal.run_id = uuid.uuid4().hex
+                Journal._write({'event': Journal.RUN, 'key': Journal.run_id})
+            log.info('Journal {} for run {}, replayed {} entries'.format(
+                path, Journal.run_id, sum(len(e) for e in Journal.replayed.values())))
+
+    @staticmethod
+    def is_enabled():
+        return Journal.path is not None
+
+    @staticmethod
+    def _write(entry):
+        # Called with the lock acquired. Flushed to disk so that entries survive the controller pod being killed
+        with open(Journal.path, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def record(event, key, **fields):
+        with Journal.lock:
+            if Journal.path is None:
+                return
+            entry = dict(fields, event=event, key=key)
+            Journal._write(entry)
+
+    @staticmethod
+    def replayed_entries(event):
+        with Journal.lock:
+            return list(Journal.replayed.get(event, {}).values())
+
+    @staticmethod
+    def claim(event, key):
+        """
+        Remove and return the replayed entry for event and key, so that it is only acted upon once
+        :return: the entry dict, or None if there is none
+        """
+        with Journal.lock:
+            return Journal.replayed.get(event, {}).pop(key, None)
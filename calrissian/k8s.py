@@ -1,15 +1,19 @@
 import threading
 import logging
 import os
+import time
 from typing import List, Union
 from kubernetes import client, config, watch
+from kubernetes.stream import stream
 from kubernetes.client.models import V1ContainerState, V1Container, V1ContainerStatus
 from kubernetes.client.rest import ApiException
 from kubernetes.config.config_exception import ConfigException
 from calrissian.executor import IncompleteStatusException
+from calrissian.overcommit import MemoryOvercommit, MEMORY_SHORTAGE_REASONS
 from calrissian.retry import retry_exponential_if_exception_type
+from calrissian.report import CPUParser, MemoryParser
 from urllib3.exceptions import HTTPError
-from datetime import datetime
+from datetime import datetime, timezone
 
 log = logging.getLogger('calrissian.k8s')
 
@@ -25,6 +29,30 @@ POD_NAME_ENV_VARIABLE = 'CALRISSIAN_POD_NAME'
 # Namespace to use if not running in cluster
 K8S_FALLBACK_NAMESPACE = 'default'
 
+# Label identifying the pods submitted during a run, used to find them again after a controller restart
+RUN_ID_LABEL = 'calrissian-run-id'
+
+# Interval between samples of the resources used by running pods. metrics-server scrapes every 15s by default
+USAGE_SAMPLE_SECONDS = 15
+MIN_USAGE_SAMPLE_SECONDS = 5
+
+# Reason of a container terminated for exceeding its memory limit
+OOM_KILLED_REASON = 'OOMKilled'
+
+# Reason of a pod killed for running longer than its activeDeadlineSeconds
+DEADLINE_EXCEEDED_REASON = 'DeadlineExceeded'
+
+# Exit code reported for a pod killed by its deadline before its container terminated, as for SIGKILL
+DEADLINE_EXCEEDED_EXIT_CODE = 137
+
+# Reasons of pods that failed without running to completion: evicted under node pressure, preempted,
+# or lost with their node (e.g. a reclaimed spot instance)
+DISRUPTION_REASONS = ['Evicted', 'Preempting', 'NodeLost', 'NodeShutdown', 'UnexpectedAdmissionError']
+
+# Pod condition set when the pod is about to be deleted by a disruption, see
+# https://kubernetes.io/docs/concepts/workloads/pods/disruptions/#pod-disruption-conditions
+DISRUPTION_TARGET_CONDITION = 'DisruptionTarget'
+
 
 def read_file(path):
     with open(path) as f:
@@ -45,13 +73,22 @@ class CalrissianJobException(Exception):
     pass
 
 
+class PodDisruptedException(CalrissianJobException):
+    """
+    Raised when the observed pod is evicted, preempted or lost with its node, so it can be resubmitted
+    """
+    pass
+
+
 class CompletionResult(object):
     """
     Simple structure to hold information about pod execution duration and resources.
     The CPU and memory values should be in kubernetes units (strings).
     """
 
-    def __init__(self, exit_code, cpus, memory, start_time, finish_time, tool_log, node_selectors):
+    def __init__(self, exit_code, cpus, memory, start_time, finish_time, tool_log, node_selectors, reason=None,
+                 peak_cpus=None, peak_ram_megabytes=None, mean_cpus=None, mean_ram_megabytes=None,
+                 extended_resources=None):
         self.exit_code = exit_code
         self.cpus = cpus
         self.memory = memory
@@ -59,6 +96,63 @@ class CompletionResult(object):
         self.finish_time = finish_time
         self.tool_log = tool_log
         self.node_selectors = node_selectors
+        # Reason the container terminated, e.g. OOMKilled
+        self.reason = reason
+        # Highest and mean usage sampled while the pod ran, as numbers, or None if it was not sampled
+        self.peak_cpus = peak_cpus
+        self.peak_ram_megabytes = peak_ram_megabytes
+        self.mean_cpus = mean_cpus
+        self.mean_ram_megabytes = mean_ram_megabytes
+        # Requests other than cpu and memory, e.g. ephemeral-storage, in kubernetes units
+        self.extended_resources = extended_resources if extended_resources is not None else {}
+
+
+class PodUsage(object):
+    """
+    CPU and memory used by a running pod, sampled from the metrics API. Values are numbers: cores and megabytes.
+    """
+
+    def __init__(self):
+        self.peak_cpus = None
+        self.peak_ram_megabytes = None
+        self.samples = 0
+        self.total_cpus = 0
+        self.total_ram_megabytes = 0
+        self.last_timestamp = None
+
+    @staticmethod
+    def parse(pod_metrics):
+        """
+        :param pod_metrics: PodMetrics dict, as listed by the metrics API
+        :return: (cpus, ram_megabytes) summed over the containers of the pod
+        """
+        containers = pod_metrics.get('containers') or []
+        cpus = sum(CPUParser.parse(container['usage']['cpu']) for container in containers)
+        ram_megabytes = sum(MemoryParser.parse_to_megabytes(container['usage']['memory']) for container in containers)
+        return cpus, ram_megabytes
+
+    def add(self, pod_metrics):
+        """
+        Add a sample. metrics-server scrapes pods at its own resolution, the same sample is only counted once.
+        :param pod_metrics: PodMetrics dict, as listed by the metrics API
+        """
+        timestamp = pod_metrics.get('timestamp')
+        if not pod_metrics.get('containers') or (timestamp is not None and timestamp == self.last_timestamp):
+            return
+        self.last_timestamp = timestamp
+        cpus, ram_megabytes = self.parse(pod_metrics)
+        self.peak_cpus = cpus if self.peak_cpus is None else max(self.peak_cpus, cpus)
+        self.peak_ram_megabytes = ram_megabytes if self.peak_ram_megabytes is None \
+            else max(self.peak_ram_megabytes, ram_megabytes)
+        self.samples += 1
+        self.total_cpus += cpus
+        self.total_ram_megabytes += ram_megabytes
+
+    def mean_cpus(self):
+        return self.total_cpus / self.samples if self.samples else None
+
+    def mean_ram_megabytes(self):
+        return self.total_ram_megabytes / self.samples if self.samples else None
 
 
 class KubernetesClient(object):
@@ -77,6 +171,8 @@ class KubernetesClient(object):
         self.completion_result = None
         self.namespace = load_config_get_namespace()
         self.core_api_instance = client.CoreV1Api()
+        self.apps_api_instance = client.AppsV1Api()
+        self.batch_api_instance = client.BatchV1Api()
         self.tool_log = []
 
     @retry_exponential_if_exception_type((ApiException, HTTPError,), log)
@@ -87,6 +183,121 @@ class KubernetesClient(object):
             monitor.add(pod)
             self._set_pod(pod)
 
+    def reattach_pod(self, pod_name):
+        """
+        Observe a pod submitted by a previous controller instead of submitting a new one.
+        The pod is expected to be tracked by PodMonitor already, see PodMonitor.recover()
+        :param pod_name: name of the pod to reattach to
+        :return: True if the pod still exists and is now observed, False if it is gone
+        """
+        try:
+            pod = self.get_pod_for_name(pod_name)
+        except CalrissianJobException:
+            log.info('k8s pod \'{}\' no longer exists, cannot reattach'.format(pod_name))
+            return False
+        log.info('Reattached to k8s pod name {} with id {}'.format(pod.metadata.name, pod.metadata.uid))
+        self._set_pod(pod)
+        return True
+
+    @retry_exponential_if_exception_type((ApiException, HTTPError,), log)
+    def list_pods_for_run(self, run_id):
+        """
+        List the pods labelled with a run id
+        :param run_id: str
+        :return: list of V1Pod
+        """
+        label_selector = '{}={}'.format(RUN_ID_LABEL, run_id)
+        return self.core_api_instance.list_namespaced_pod(self.namespace, label_selector=label_selector).items
+
+    @retry_exponential_if_exception_type((ApiException, HTTPError,), log)
+    def list_pods_for_selector(self, label_selector):
+        """
+        List the pods matching a label selector
+        :param label_selector: str, e.g. 'key=value'
+        :return: list of V1Pod
+        """
+        return self.core_api_instance.list_namespaced_pod(self.namespace, label_selector=label_selector).items
+
+    @retry_exponential_if_exception_type((ApiException, HTTPError,), log)
+    def create_daemonset(self, daemonset_body):
+        daemonset = self.apps_api_instance.create_namespaced_daemon_set(self.namespace, daemonset_body)
+        log.info('Created k8s daemonset name {} with id {}'.format(daemonset.metadata.name, daemonset.metadata.uid))
+        return daemonset
+
+    @retry_exponential_if_exception_type((ApiException, HTTPError,), log)
+    def read_daemonset(self, daemonset_name):
+        return self.apps_api_instance.read_namespaced_daemon_set(daemonset_name, self.namespace)
+
+    @retry_exponential_if_exception_type((ApiException, HTTPError,), log)
+    def delete_daemonset_name(self, daemonset_name):
+        try:
+            # Foreground propagation deletes the daemonset pods along with it
+            self.apps_api_instance.delete_namespaced_daemon_set(daemonset_name, self.namespace,
+                                                                propagation_policy='Foreground')
+        except ApiException as e:
+            if e.status == 404:
+                # daemonset was not found - already deleted, so do not retry
+                pass
+            else:
+                # Re-raise
+                raise
+
+    @retry_exponential_if_exception_type((ApiException, HTTPError,), log)
+    def create_job(self, job_body):
+        job = self.batch_api_instance.create_namespaced_job(self.namespace, job_body)
+        log.info('Created k8s job name {} with id {}'.format(job.metadata.name, job.metadata.uid))
+        return job
+
+    @staticmethod
+    def job_is_finished(job):
+        """
+        :param job: V1Job
+        :return: True if the job has a Complete or Failed condition
+        """
+        conditions = (job.status and job.status.conditions) or []
+        return any(c.type in ['Complete', 'Failed'] and c.status == 'True' for c in conditions)
+
+    @retry_exponential_if_exception_type((ApiException, HTTPError,), log)
+    def wait_for_job(self, job_name):
+        """
+        Wait for a job to complete or fail
+        :param job_name: str
+        :return: the finished V1Job
+        """
+        while True:
+            w = watch.Watch()
+            for event in w.stream(self.batch_api_instance.list_namespaced_job, self.namespace,
+                                  field_selector='metadata.name={}'.format(job_name)):
+                job = event['object']
+                log.info('job name {} has {} succeeded and {} failed pods'.format(
+                    job_name, job.status.succeeded, job.status.failed))
+                if self.job_is_finished(job):
+                    w.stop()
+                    return job
+            # The watch timed out before the job finished, watch again
+
+    @retry_exponential_if_exception_type((ApiException, HTTPError,), log)
+    def read_pod_log(self, pod_name):
+        """
+        :param pod_name: str
+        :return: list of log entries of the pod, see format_log_entry()
+        """
+        content = self.core_api_instance.read_namespaced_pod_log(pod_name, self.namespace)
+        return [self.format_log_entry(pod_name, line) for line in content.splitlines()]
+
+    @retry_exponential_if_exception_type((ApiException, HTTPError,), log)
+    def delete_job_name(self, job_name):
+        try:
+            # Foreground propagation deletes the job pods along with it
+            self.batch_api_instance.delete_namespaced_job(job_name, self.namespace, propagation_policy='Foreground')
+        except ApiException as e:
+            if e.status == 404:
+                # job was not found - already deleted, so do not retry
+                pass
+            else:
+                # Re-raise
+                raise
+
     def should_delete_pod(self):
         """
         Decide whether or not to delete a pod. Defaults to True if unset.
@@ -111,13 +322,17 @@ class KubernetesClient(object):
                 # Re-raise
                 raise
 
-    def _handle_completion(self, state: V1ContainerState, container: V1Container, node_selectors):
+    def _handle_completion(self, state: V1ContainerState, container: V1Container, node_selectors, reason=None,
+                           usage=None):
         """
         Sets self.completion_result to an object containing exit_code, resources, and timingused
         :param state: V1ContainerState
         :param container: V1Container
+        :param reason: str: reason of the pod's termination, overriding the reason of the container's
+        :param usage: PodUsage sampled while the pod ran, or None
         :return: None
         """
+        usage = usage or PodUsage()
         
         exit_code = state.terminated.exit_code
         # We extract resource requests here since requests are used for scheduling. Limits are
@@ -132,10 +347,87 @@ class KubernetesClient(object):
             start_time,
             finish_time, 
             self.tool_log,
-            node_selectors=node_selectors
+            node_selectors=node_selectors,
+            reason=reason or state.terminated.reason,
+            peak_cpus=usage.peak_cpus,
+            peak_ram_megabytes=usage.peak_ram_megabytes,
+            mean_cpus=usage.mean_cpus(),
+            mean_ram_megabytes=usage.mean_ram_megabytes(),
+            extended_resources=self._extract_extended_requests(container)
         )
+        MemoryOvercommit.observe(self.completion_result.reason)
         log.info('handling completion with {}'.format(exit_code))
 
+    def _handle_deadline_exceeded(self, pod, container, node_selectors):
+        """
+        Sets self.completion_result for a pod killed by its activeDeadlineSeconds before its container
+        terminated, e.g. while its image was being pulled
+        :param pod: V1Pod
+        :param container: V1Container
+        :return: None
+        """
+        cpus, memory = self._extract_cpu_memory_requests(container)
+        finish_time = datetime.now(timezone.utc)
+        self.completion_result = CompletionResult(
+            DEADLINE_EXCEEDED_EXIT_CODE,
+            cpus,
+            memory,
+            pod.status.start_time or finish_time,
+            finish_time,
+            self.tool_log,
+            node_selectors=node_selectors,
+            reason=DEADLINE_EXCEEDED_REASON,
+            extended_resources=self._extract_extended_requests(container)
+        )
+        log.info('handling deadline exceeded before the container of pod {} terminated'.format(pod.metadata.name))
+
+    def _finish_pod(self, pod):
+        """
+        Stop observing a completed pod, deleting it unless disabled
+        """
+        if self.should_delete_pod():
+            with PodMonitor() as monitor:
+                self.delete_pod_name(pod.metadata.name)
+                monitor.remove(pod)
+        self._clear_pod()
+
+    @staticmethod
+    def pod_disruption_reason(event):
+        """
+        Detect pods that will not run to completion: deleted by another party than the controller, failed with
+        an eviction or node loss reason, or targeted by a disruption
+        :param event: watch event of the observed pod
+        :return: str: the reason of the disruption, or None if the pod was not disrupted
+        """
+        pod = event['object']
+        if event.get('type') == 'DELETED':
+            if PodMonitor.deletion_requested(pod.metadata.name):
+                # Deleted by the controller itself, e.g. on termination
+                return None
+            return 'Deleted'
+        if pod.status.reason == DEADLINE_EXCEEDED_REASON:
+            # Killed by its time limit, running it again would not help
+            return None
+        if pod.status.reason in DISRUPTION_REASONS:
+            return pod.status.reason
+        for condition in pod.status.conditions or []:
+            if condition.type == DISRUPTION_TARGET_CONDITION and condition.status == 'True':
+                return condition.reason or DISRUPTION_TARGET_CONDITION
+        return None
+
+    def _handle_disruption(self, pod, reason, deleted):
+        """
+        Stop observing a disrupted pod, deleting it unless it is already gone
+        """
+        log.warning('pod name {} with id {} was disrupted: {}'.format(pod.metadata.name, pod.metadata.uid, reason))
+        if reason in MEMORY_SHORTAGE_REASONS:
+            MemoryOvercommit.observe(reason)
+        with PodMonitor() as monitor:
+            if not deleted:
+                self.delete_pod_name(pod.metadata.name)
+            monitor.remove(pod)
+        self._clear_pod()
+
     @staticmethod
     def format_log_entry(pod_name, log_entry):
         return {"timestamp": f"{datetime.utcnow().isoformat()}Z", "pod": pod_name, "entry": log_entry}
@@ -160,29 +452,47 @@ class KubernetesClient(object):
 
         
     @retry_exponential_if_exception_type((ApiException, HTTPError, IncompleteStatusException), log)
-    def wait_for_completion(self) -> CompletionResult:
+    def wait_for_completion(self, sample_usage=False) -> CompletionResult:
+        """
+        Wait for the observed pod to complete, and stop observing it
+        :param sample_usage: sample the resources the pod uses while it runs, see UsageMonitor
+        :return: CompletionResult
+        """
         w = watch.Watch()
         for event in w.stream(self.core_api_instance.list_namespaced_pod, self.namespace, field_selector=self._get_pod_field_selector()):
             pod = event['object']
+            if event.get('type') == 'DELETED' and PodMonitor.deletion_requested(pod.metadata.name):
+                self._clear_pod()
+                w.stop()
+                raise CalrissianJobException('Pod {} was deleted by the controller'.format(pod.metadata.name))
+            disruption = self.pod_disruption_reason(event)
+            if disruption is not None:
+                self._handle_disruption(pod, disruption, deleted=event.get('type') == 'DELETED')
+                w.stop()
+                raise PodDisruptedException('Pod {} was disrupted: {}'.format(pod.metadata.name, disruption))
             status = self.get_first_or_none(pod.status.container_statuses)
             log.info('pod name {} with id {} has status {}'.format(pod.metadata.name, pod.metadata.uid, status))
-            if status is None:
-                continue
-            if self.state_is_waiting(status.state):
+            deadline_exceeded = pod.status.reason == DEADLINE_EXCEEDED_REASON
+            if status is None or self.state_is_waiting(status.state):
+                if deadline_exceeded:
+                    self._handle_deadline_exceeded(pod, self.get_first_or_none(pod.spec.containers),
+                                                   self._get_pod_node_selector())
+                    self._finish_pod(pod)
+                    w.stop()
                 continue
             elif self.state_is_running(status.state):
                 # Can only get logs once container is running
+                if sample_usage:
+                    UsageMonitor.add(pod.metadata.name, self.namespace)
                 self.follow_logs() # This will not return until pod completes
             elif self.state_is_terminated(status.state):
                 log.info('Handling terminated pod name {} with id {}'.format(pod.metadata.name, pod.metadata.uid))
                 container = self.get_first_or_none(pod.spec.containers)
                 node_selectors = self._get_pod_node_selector()
-                self._handle_completion(status.state, container, node_selectors)
-                if self.should_delete_pod():
-                    with PodMonitor() as monitor:
-                        self.delete_pod_name(pod.metadata.name)
-                        monitor.remove(pod)
-                self._clear_pod()
+                self._handle_completion(status.state, container, node_selectors,
+                                        reason=DEADLINE_EXCEEDED_REASON if deadline_exceeded else None,
+                                        usage=UsageMonitor.remove(pod.metadata.name))
+                self._finish_pod(pod)
                 # stop watching for events, our pod is done. Causes wait loop to exit
                 w.stop()
             else:
@@ -195,6 +505,58 @@ class KubernetesClient(object):
 
         return self.completion_result
 
+    @retry_exponential_if_exception_type((ApiException, HTTPError,), log)
+    def wait_for_running(self):
+        """
+        Wait for the container of the observed pod to be running, e.g. before executing commands in it
+        """
+        w = watch.Watch()
+        for event in w.stream(self.core_api_instance.list_namespaced_pod, self.namespace, field_selector=self._get_pod_field_selector()):
+            pod = event['object']
+            status = self.get_first_or_none(pod.status.container_statuses)
+            if status is None or self.state_is_waiting(status.state):
+                continue
+            w.stop()
+            if self.state_is_running(status.state):
+                log.info('pod name {} with id {} is running'.format(pod.metadata.name, pod.metadata.uid))
+                return
+            raise CalrissianJobException('Pod {} is not running'.format(pod.metadata.name), status)
+
+    def exec_in_pod(self, command) -> CompletionResult:
+        """
+        Execute a command in the container of the observed pod and wait for it to exit
+        :param command: list of str
+        :return: CompletionResult of the command, with the resources requested by the pod
+        """
+        pod_name = self.pod.metadata.name
+        start_time = datetime.now(timezone.utc)
+        resp = stream(self.core_api_instance.connect_get_namespaced_pod_exec, pod_name, self.namespace,
+                      command=command, stderr=True, stdin=False, stdout=True, tty=False, _preload_content=False)
+        tool_log = []
+        while resp.is_open():
+            resp.update(timeout=1)
+            outputs = []
+            if resp.peek_stdout():
+                outputs.append(resp.read_stdout())
+            if resp.peek_stderr():
+                outputs.append(resp.read_stderr())
+            for output in outputs:
+                for line in output.splitlines():
+                    log.debug('[{}] {}'.format(pod_name, line))
+                    tool_log.append(self.format_log_entry(pod_name, line))
+        resp.close()
+        container = self.get_first_or_none(self.pod.spec.containers)
+        cpus, memory = self._extract_cpu_memory_requests(container)
+        return CompletionResult(
+            resp.returncode,
+            cpus,
+            memory,
+            start_time,
+            datetime.now(timezone.utc),
+            tool_log,
+            node_selectors=self._get_pod_node_selector()
+        )
+
     def _set_pod(self, pod):
         log.info('k8s pod \'{}\' started'.format(pod.metadata.name))
         if self.pod is not None:
@@ -202,6 +564,8 @@ class KubernetesClient(object):
         self.pod = pod
 
     def _clear_pod(self):
+        if self.pod is not None:
+            UsageMonitor.remove(self.pod.metadata.name)
         self.pod = None
 
     def _get_pod_field_selector(self):
@@ -244,6 +608,13 @@ class KubernetesClient(object):
         else:
             raise CalrissianJobException('Unable to extract CPU/memory requests, not present')
 
+    def _extract_extended_requests(self, container):
+        """
+        :return: dict of the requests of the container other than cpu and memory, e.g. ephemeral-storage
+        """
+        requests = container.resources.requests or {}
+        return {name: quantity for name, quantity in requests.items() if name not in ['cpu', 'memory']}
+
     def _extract_start_finish_times(self, state):
         """
         Extracts the started_at and finished_at timestamps from state.terminated
@@ -279,6 +650,85 @@ class KubernetesClient(object):
         return self.get_pod_for_name(pod_name)
 
 
+class UsageMonitor(object):
+    """
+    Singleton sampling the CPU and memory used by the running pods observed by KubernetesClient, from the metrics
+    API (metrics.k8s.io, served by metrics-server). A single background thread lists the metrics of the pods of the
+    namespace once per interval, so the load on the API server does not grow with the number of running pods.
+    The thread stops when no pod is observed.
+    """
+    interval = None
+    # Pod name to PodUsage
+    usages = {}
+    thread = None
+    lock = threading.Lock()
+
+    @staticmethod
+    def initialize(interval=USAGE_SAMPLE_SECONDS):
+        with UsageMonitor.lock:
+            UsageMonitor.interval = max(interval, MIN_USAGE_SAMPLE_SECONDS)
+            UsageMonitor.usages = {}
+
+    @staticmethod
+    def is_enabled():
+        return UsageMonitor.interval is not None
+
+    @staticmethod
+    def add(pod_name, namespace):
+        """
+        Start sampling a running pod
+        :return: PodUsage of the pod
+        """
+        with UsageMonitor.lock:
+            usage = UsageMonitor.usages.setdefault(pod_name, PodUsage())
+            if UsageMonitor.thread is None:
+                UsageMonitor.thread = threading.Thread(target=UsageMonitor.run, args=(namespace,), daemon=True)
+                UsageMonitor.thread.start()
+            return usage
+
+    @staticmethod
+    def peak_ram_megabytes(pod_name):
+        """
+        :return: the peak RAM sampled from a running pod in megabytes, or None if it was not sampled yet
+        """
+        with UsageMonitor.lock:
+            usage = UsageMonitor.usages.get(pod_name)
+            return usage.peak_ram_megabytes if usage is not None else None
+
+    @staticmethod
+    def remove(pod_name):
+        """
+        Stop sampling a pod
+        :return: PodUsage of the pod, or None if it was not sampled
+        """
+        with UsageMonitor.lock:
+            return UsageMonitor.usages.pop(pod_name, None)
+
+    @staticmethod
+    def sample(custom_objects_api, namespace):
+        try:
+            metrics = custom_objects_api.list_namespaced_custom_object('metrics.k8s.io', 'v1beta1', namespace, 'pods')
+        except (ApiException, HTTPError) as e:
+            log.debug('Unable to list pod metrics: {}'.format(e))
+            return
+        with UsageMonitor.lock:
+            for pod_metrics in metrics.get('items') or []:
+                usage = UsageMonitor.usages.get(pod_metrics['metadata']['name'])
+                if usage is not None:
+                    usage.add(pod_metrics)
+
+    @staticmethod
+    def run(namespace):
+        custom_objects_api = client.CustomObjectsApi()
+        while True:
+            time.sleep(UsageMonitor.interval)
+            with UsageMonitor.lock:
+                if not UsageMonitor.usages:
+                    UsageMonitor.thread = None
+                    return
+            UsageMonitor.sample(custom_objects_api, namespace)
+
+
 class PodMonitor(object):
     """
     This class is designed to track pods submitted by KubernetesClient across different background threads,
@@ -287,10 +737,12 @@ class PodMonitor(object):
     Instances of this class are used as context manager, and acquire the shared lock.
     The add and remove methods should only be called from inside the context block while the lock is acquired.
 
-    The static cleanup() method also acquires the lock and attempts to delete all outstanding pods.
+    The static cleanup() method also acquires the lock and attempts to delete all outstanding pods. Their names are
+    kept in deleted_names, so that their deletion is not taken for a disruption and the pods are not resubmitted.
 
     """
     pod_names = []
+    deleted_names = set()
     lock = threading.Lock()
 
     def __enter__(self):
@@ -313,6 +765,33 @@ class PodMonitor(object):
         else:
             log.warning('PodMonitor {} has already been removed'.format(pod.metadata.name))
 
+    @staticmethod
+    def recover(run_id, pod_names):
+        """
+        After a controller restart, find the pods left over from the run. Pods that were recorded
+        as submitted are tracked again, so they are either reattached by their job or deleted by cleanup().
+        Other pods of the run were never recorded, their results cannot be adopted and they are deleted.
+        :param run_id: str: the run id label value
+        :param pod_names: collection of recorded pod names
+        """
+        log.info('Recovering pods for run {}'.format(run_id))
+        with PodMonitor() as monitor:
+            k8s_client = KubernetesClient()
+            for pod in k8s_client.list_pods_for_run(run_id):
+                if pod.metadata.name in pod_names:
+                    monitor.add(pod)
+                else:
+                    log.info('PodMonitor deleting unrecorded pod {}'.format(pod.metadata.name))
+                    k8s_client.delete_pod_name(pod.metadata.name)
+
+    @staticmethod
+    def deletion_requested(pod_name):
+        """
+        :param pod_name: str: name of a pod
+        :return: bool: whether cleanup() deleted the pod
+        """
+        return pod_name in PodMonitor.deleted_names
+
     @staticmethod
     def cleanup():
         log.info('Starting Cleanup')
@@ -320,6 +799,7 @@ class PodMonitor(object):
             k8s_client = KubernetesClient()
             for pod_name in PodMonitor.pod_names:
                 log.info('PodMonitor deleting pod {}'.format(pod_name))
+                PodMonitor.deleted_names.add(pod_name)
                 try:
                     k8s_client.delete_pod_name(pod_name)
                 except Exception:
@@ -3,12 +3,30 @@ import re
 
 import cwltool
 from cwltool.process import use_custom_schema, get_schema
-from calrissian.executor import ThreadPoolJobExecutor
+from calrissian.executor import ThreadPoolJobExecutor, ResourcePool, Resources
 from calrissian.context import CalrissianLoadingContext, CalrissianRuntimeContext
 from calrissian.version import version
-from calrissian.k8s import PodMonitor
-from calrissian.report import initialize_reporter, write_report, CPUParser, MemoryParser
+from calrissian.k8s import PodMonitor, UsageMonitor, USAGE_SAMPLE_SECONDS
+from calrissian.report import initialize_reporter, write_report, CPUParser, MemoryParser, Reporter, \
+    parse_resource_quantity, DEFAULT_POOL
 from calrissian.dask import DaskPodMonitor
+from calrissian.journal import Journal
+from calrissian.cache import StepCache
+from calrissian.prepull import ImagePrePuller, start_image_prepull
+from calrissian.pool import RunnerPool, RUNNER_OUTDIR, RUNNER_STAGEDIR
+from calrissian.batch import JobBatcher, IndexedJobBatch, DEFAULT_TARGET_SECONDS, BACKENDS, POD_BACKEND
+from calrissian.fusion import start_step_fusion, FUSION_TTL_SECONDS
+from calrissian.speculation import Speculator, DEFAULT_QUANTILE
+from calrissian.history import UsageHistory, DEFAULT_PERCENTILE
+from calrissian.overcommit import MemoryOvercommit
+from calrissian.fairshare import FairShareQueue, FAIR_SHARE_REQUIREMENT
+from calrissian.concurrency import CONCURRENCY_REQUIREMENT
+from calrissian.iobudget import IOBudget, IO_CLASS_REQUIREMENT
+from calrissian.stripe import OutdirStriper, PLACEMENTS, ROUND_ROBIN
+from calrissian.tool import MEMORY_TMPDIR_REQUIREMENT, EXTENDED_RESOURCES_REQUIREMENT
+from calrissian.gpu import GPU_SHARE_REQUIREMENT
+from calrissian.refcache import ReferenceCache, DEFAULT_REFERENCE_CACHE_SIZE
+from calrissian.job import read_yaml
 from cwltool.main import main as cwlmain
 from cwltool.argparser import arg_parser
 from typing_extensions import Text
@@ -34,8 +52,45 @@ def get_log_level(parsed_args):
     return level
 
 
+def parse_max_resources(values):
+    """
+    :param values: list of NAME=QUANTITY strings from --max-resource, or None
+    :return: dict of Kubernetes resource names to their amounts, see calrissian.report.parse_resource_quantity
+    """
+    max_resources = {}
+    for value in values or []:
+        name, separator, quantity = value.partition('=')
+        if not separator:
+            raise ValueError('Unable to parse \'{}\' as a resource, expected NAME=QUANTITY'.format(value))
+        max_resources[name.strip()] = parse_resource_quantity(name.strip(), quantity.strip())
+    return max_resources
+
+
+def parse_resource_pools(filename):
+    """
+    :param filename: YAML file from --resource-pools, mapping the name of each pool to its nodeSelector and its
+    maxRam, maxCores, maxGpus and maxResources limits, which follow the conventions of --max-ram, --max-cores,
+    --max-gpus and --max-resource
+    :return: list of ResourcePool
+    """
+    pools = []
+    for name, spec in (read_yaml(filename) or {}).items():
+        if name == DEFAULT_POOL:
+            raise ValueError('Resource pool name \'{}\' is reserved for the --max-ram and --max-cores limits'.format(name))
+        if not spec.get('nodeSelector'):
+            raise ValueError('Resource pool \'{}\' has no nodeSelector'.format(name))
+        max_resources = ['{}={}'.format(key, value) for key, value in spec.get('maxResources', {}).items()]
+        total_resources = Resources(MemoryParser.parse_to_megabytes(str(spec.get('maxRam', 0))),
+                                    CPUParser.parse(str(spec.get('maxCores', 0))),
+                                    int(spec.get('maxGpus', 0)),
+                                    parse_max_resources(max_resources))
+        node_selector = {str(key): str(value) for key, value in spec['nodeSelector'].items()}
+        pools.append(ResourcePool(name, node_selector, total_resources))
+    return pools
+
+
 def activate_logging(level):
-    loggers = ['executor','context','tool','job', 'k8s','main', 'dask']
+    loggers = ['executor','context','tool','job', 'k8s','main', 'dask', 'journal', 'cache', 'prepull', 'pool', 'batch', 'fusion', 'speculation', 'history', 'overcommit', 'gpu', 'fairshare', 'iobudget', 'stripe', 'refcache']
     for logger in loggers:
         logging.getLogger('calrissian.{}'.format(logger)).setLevel(level)
         logging.getLogger('calrissian.{}'.format(logger)).addHandler(logging.StreamHandler())
@@ -45,12 +100,23 @@ def add_arguments(parser):
     parser.add_argument('--max-ram', type=str, help='Maximum amount of RAM to use, e.g 1048576, 512Mi or 2G. Follows k8s resource conventions')
     parser.add_argument('--max-cores', type=str, help='Maximum number of CPU cores to use')
     parser.add_argument('--max-gpus', type=str, nargs='?', help='Maximum number of GPU cores to use')
+    parser.add_argument('--gpu-slices', type=int, nargs='?', default=1, help='Number of replicas of nvidia.com/gpu the device plugin advertises for each time-sliced GPU. Steps with a calrissian:GPUShare hint request the replicas covering their share of a GPU, and are accounted for that fraction of --max-gpus')
+    parser.add_argument('--max-resource', type=str, action='append', metavar='NAME=QUANTITY', help='Maximum amount of another Kubernetes resource to use, e.g. ephemeral-storage=100Gi, hugepages-2Mi=1Gi or example.com/fpga=2. Repeatable. Steps request ephemeral-storage for their tmpdirMin and outdirMin once it is limited, and other resources with the calrissian:ExtendedResources hint')
+    parser.add_argument('--resource-pools', type=Text, nargs='?', help='YAML file of node pools, e.g. of GPU or high-memory nodes, mapping each name to its nodeSelector and its maxRam, maxCores, maxGpus and maxResources. Steps selecting the nodes of a pool, or too large for --max-ram and --max-cores, are admitted against its limits and run on its nodes')
     parser.add_argument('--pod-labels', type=Text, nargs='?', help='YAML file of labels to add to Pods submitted')
     parser.add_argument('--pod-env-vars', type=Text, nargs='?', help='YAML file of environment variables to add at runtime to Pods submitted')
     parser.add_argument('--pod-nodeselectors', type=Text, nargs='?', help='YAML file of node selectors to add to Pods submitted')
     parser.add_argument('--pod-gpu-nodeselectors', type=Text, nargs='?', help='YAML file of node selectors to add to Pods submitted that require GPUs')
     parser.add_argument('--pod-serviceaccount', type=str, help='Service Account to use for pods management')
     parser.add_argument('--usage-report', type=Text, nargs='?', help='Output JSON file name to record resource usage')
+    parser.add_argument('--stripe-outdir-prefix', type=Text, action='append', metavar='PREFIX', help='Prefix like --tmp-outdir-prefix of the output directories of steps on another persistent volume mounted in this pod. Repeatable, to spread the output of steps over several volumes instead of --tmp-outdir-prefix')
+    parser.add_argument('--stripe-placement', type=Text, choices=PLACEMENTS, default=ROUND_ROBIN, help='How output directories are placed on the --stripe-outdir-prefix volumes: in turn, or on the least used volume')
+    parser.add_argument('--scratch-outdir', action='store_true', help='Write the output directory of steps on a volume of their node, and copy it to the shared volume in one tar stream once their command exits. Speeds up tools writing many small files. The images of the steps must provide tar, steps fail with exit code 127 otherwise. Steps staging inputs into their output directory keep it on the shared volume')
+    parser.add_argument('--scratch-storage-class', type=Text, nargs='?', help='With --scratch-outdir, provision the scratch volumes as generic ephemeral volumes of this storage class, e.g. of local disks, the size of outdirMin, instead of emptyDir volumes')
+    parser.add_argument('--reference-cache-dir', type=Text, nargs='?', help='Directory on each node, mounted as a hostPath, where read-only input files under a --reference-cache-prefix are cached, so that the pods of a node read them once from the shared volume')
+    parser.add_argument('--reference-cache-prefix', type=Text, action='append', help='With --reference-cache-dir, cache the read-only input files under this path, e.g. of reference genomes. May be repeated')
+    parser.add_argument('--reference-cache-size', type=str, default=DEFAULT_REFERENCE_CACHE_SIZE, help='Maximum size of the --reference-cache-dir of each node, e.g 200Gi. Least recently used entries are evicted. Follows k8s resource conventions. Default {}'.format(DEFAULT_REFERENCE_CACHE_SIZE))
+    parser.add_argument('--memory-tmpdir', action='store_true', help='Mount /tmp of steps as a tmpfs the size of their tmpdirMin, added to their memory request and limit, for temp-heavy tools such as sorters and indexers. Tools opt in or out with the MemoryTmpdir hint')
     parser.add_argument('--stdout', type=Text, nargs='?', help='Output file name to tee standard output (CWL output object)')
     parser.add_argument('--stderr', type=Text, nargs='?', help='Output file name to tee standard error to (includes tool logs)')
     parser.add_argument('--tool-logs-basepath', type=Text, nargs='?', help='Base path for saving the tool logs')
@@ -63,6 +129,32 @@ def add_arguments(parser):
     parser.add_argument('--pod-priority-class', type=Text, nargs='?', help='Priority Class Name assigned to the pod')
     parser.add_argument('--env-from-secret', type=Text, action='append', help='Secret Id to set the pod environment')
     parser.add_argument('--env-from-configmap', type=Text, action='append', help='ConfigMap Id to set the pod environment')
+    parser.add_argument('--journal', type=Text, nargs='?', help='Append-only JSON lines file recording the pods submitted during the run')
+    parser.add_argument('--reattach', action='store_true', help='Replay the --journal of a previous controller: reattach to its pods that still exist instead of resubmitting them')
+    parser.add_argument('--resume', action='store_true', help='Replay the --journal of a previous run: skip the steps it completed successfully')
+    parser.add_argument('--step-cache', type=Text, nargs='?', help='Directory on the shared volume where step outputs are cached and reused by identical steps. Only steps whose image is pinned by digest are cached')
+    parser.add_argument('--step-cache-size', type=str, nargs='?', help='Maximum size of the --step-cache, e.g 100Gi. Least recently used entries are evicted. Follows k8s resource conventions')
+    parser.add_argument('--prepull-images', action='store_true', help='Pull the container images of the workflow on the nodes of --pod-nodeselectors, and those of GPU steps on the nodes of --pod-gpu-nodeselectors, while the first steps are staged')
+    parser.add_argument('--warm-pool-ttl', type=int, nargs='?', help='Run steps in reusable runner pods, deleted after being idle for this many seconds')
+    parser.add_argument('--fuse-steps', action='store_true', help='Run linear chains of steps with the same image and resources in the same runner pod. Enables the runner pool of --warm-pool-ttl')
+    parser.add_argument('--batch-max-size', type=int, nargs='?', help='Run up to this many compatible steps (same tool, image and resources) in a single pod')
+    parser.add_argument('--batch-target-seconds', type=int, nargs='?', default=DEFAULT_TARGET_SECONDS, help='Size batches of steps to run for about this many seconds, from their observed runtimes. Used with --batch-max-size')
+    parser.add_argument('--batch-parallelism', type=int, nargs='?', default=1, help='Number of steps of a batch run at once, the batch pod requests the resources of that many steps. Used with --batch-max-size and the pod backend, Indexed Jobs run as many pods at once as the available resources fit')
+    parser.add_argument('--batch-backend', choices=BACKENDS, default=POD_BACKEND, help='Run batches of steps in a single pod, or as a Kubernetes Indexed Job with a pod per step. Used with --batch-max-size. Indexed Jobs retry the pod of each step with backoffLimitPerIndex, which needs Kubernetes 1.28 or later, see --batch-shared-backoff-limit')
+    parser.add_argument('--batch-shared-backoff-limit', action='store_true', help='Retry the pods of Indexed Jobs with a backoffLimit shared by all their steps instead of backoffLimitPerIndex, for Kubernetes before 1.28. Used with --batch-backend indexed-job')
+    parser.add_argument('--max-pod-resubmissions', type=int, nargs='?', default=0, help='Resubmit the pods of steps evicted, preempted or lost with their node up to this many times, with exponential backoff. Disabled by default')
+    parser.add_argument('--speculation-factor', type=float, nargs='?', help='Run a duplicate pod of the scattered steps still running after this many times the median runtime of their finished siblings. The first to complete wins')
+    parser.add_argument('--speculation-quantile', type=float, nargs='?', default=DEFAULT_QUANTILE, help='Fraction of the siblings of a scattered step that must have finished before it is duplicated. Used with --speculation-factor')
+    parser.add_argument('--oom-retry-factor', type=float, nargs='?', help='Retry steps whose container is OOMKilled with their RAM request scaled by this factor, up to their ramMax or --max-ram')
+    parser.add_argument('--oom-max-retries', type=int, nargs='?', default=2, help='Maximum number of times a step is retried with more RAM. Used with --oom-retry-factor')
+    parser.add_argument('--usage-sample-seconds', type=float, nargs='?', help='Sample the CPU and memory used by running steps from the metrics API at this interval, reporting their peak and mean usage')
+    parser.add_argument('--usage-history', type=Text, nargs='?', help='SQLite file recording the peak CPU and memory used by each run of each tool, sampled from the metrics API. Kept across runs')
+    parser.add_argument('--right-size', action='store_true', help='Set the requests of steps from the peaks recorded in --usage-history for their tool, within their coresMin and coresMax, and ramMin and ramMax')
+    parser.add_argument('--right-size-percentile', type=float, nargs='?', default=DEFAULT_PERCENTILE, help='Percentile of the recorded peaks of a tool its requests cover. Used with --right-size')
+    parser.add_argument('--memory-overcommit', type=float, nargs='?', help='Admit steps requesting up to this ratio of --max-ram, e.g. 1.5, lowered after containers are OOMKilled or pods evicted. With --usage-sample-seconds, steps are admitted against the RAM running steps use rather than request')
+    parser.add_argument('--io-budget', type=float, nargs='?', help='Total I/O weight of the steps reading and writing the shared volume at once, e.g. 16. Steps weigh 1, 2 or 4 with a light, medium or heavy calrissian:IOClass, or its weight, and nothing without it. Steps exceeding the budget wait while other steps start, and the time they waited is reported')
+    parser.add_argument('--fair-share', action='store_true', help='Share the resources fairly between the steps and sub-workflows with queued jobs, weighted by their calrissian:FairShare hint, instead of starting the smallest jobs first. Reports the time the jobs of each step waited in the queue')
+    parser.add_argument('--backfill', action='store_true', help='Reserve resources for the first queued step that does not fit, and only start smaller steps ahead of it if their ToolTimeLimit ends before it can start')
 
 def print_version():
     print(version())
@@ -97,6 +189,8 @@ def parse_arguments(parser):
 def handle_sigterm(signum, frame):
     log.error('Received signal {}, deleting pods'.format(signum))
     PodMonitor.cleanup()
+    IndexedJobBatch.cleanup()
+    ImagePrePuller.cleanup()
     sys.exit(signum)
 
 
@@ -136,8 +230,6 @@ def flush_tees():
 
 
 def add_custom_schema():
-    cwltool.command_line_tool.ACCEPTLIST_EN_RELAXED_RE = re.compile(r".*")
-    cwltool.command_line_tool.ACCEPTLIST_RE = cwltool.command_line_tool.ACCEPTLIST_EN_RELAXED_RE
     supported_versions = ["v1.0", "v1.1", "v1.2"]
 
     with open(os.path.join(os.path.dirname(__file__), "dask/custom_schema/schema.yaml")) as f:
@@ -148,10 +240,41 @@ def add_custom_schema():
         get_schema(s)
 
     cwltool.process.supportedProcessRequirements.extend([
-        "https://calrissian-cwl.github.io/schema#DaskGatewayRequirement"
+        "https://calrissian-cwl.github.io/schema#DaskGatewayRequirement",
+        CONCURRENCY_REQUIREMENT,
+        IO_CLASS_REQUIREMENT,
+        MEMORY_TMPDIR_REQUIREMENT,
+        EXTENDED_RESOURCES_REQUIREMENT,
+        GPU_SHARE_REQUIREMENT,
+        FAIR_SHARE_REQUIREMENT
     ])
 
 
+def add_dask_schema():
+    cwltool.command_line_tool.ACCEPTLIST_EN_RELAXED_RE = re.compile(r".*")
+    cwltool.command_line_tool.ACCEPTLIST_RE = cwltool.command_line_tool.ACCEPTLIST_EN_RELAXED_RE
+    add_custom_schema()
+
+
+def initialize_journal(path, reattach, resume):
+    """
+    Start the journal. When reattaching, pods left over from the previous controller are tracked again
+    so jobs can reattach to them
+    :param path: path of the journal file
+    :param reattach: replay the pods submitted by a previous controller
+    :param resume: replay the jobs completed by a previous run
+    """
+    replay = []
+    if reattach:
+        replay.append(Journal.SUBMITTED)
+    if reattach or resume:
+        replay.append(Journal.COMPLETED)
+    Journal.initialize(path, replay=replay)
+    if reattach:
+        pod_names = [entry['pod'] for entry in Journal.replayed_entries(Journal.SUBMITTED)]
+        PodMonitor.recover(Journal.run_id, pod_names)
+
+
 def main():
     parser = arg_parser()
     add_arguments(parser)
@@ -162,10 +285,56 @@ def main():
     max_ram_megabytes = MemoryParser.parse_to_megabytes(parsed_args.max_ram)
     max_cores = CPUParser.parse(parsed_args.max_cores)
     max_gpus = int(parsed_args.max_gpus) if parsed_args.max_gpus else 0
-    executor = ThreadPoolJobExecutor(max_ram_megabytes, max_cores, max_gpus)
+    executor = ThreadPoolJobExecutor(max_ram_megabytes, max_cores, max_gpus,
+                                     total_extended=parse_max_resources(parsed_args.max_resource))
     initialize_reporter(max_ram_megabytes, max_cores)
+    if parsed_args.resource_pools:
+        executor.pools = parse_resource_pools(parsed_args.resource_pools)
+        Reporter.set_resource_pools({pool.name: pool.total_resources.to_dict() for pool in executor.all_pools()})
+    if parsed_args.journal:
+        initialize_journal(parsed_args.journal, parsed_args.reattach, parsed_args.resume)
+    if parsed_args.step_cache:
+        max_cache_bytes = MemoryParser.parse(parsed_args.step_cache_size) if parsed_args.step_cache_size else None
+        StepCache.initialize(parsed_args.step_cache, max_cache_bytes)
+    if parsed_args.reference_cache_dir:
+        ReferenceCache.initialize(parsed_args.reference_cache_dir, parsed_args.reference_cache_prefix or [],
+                                  MemoryParser.parse(parsed_args.reference_cache_size))
     runtime_context = CalrissianRuntimeContext(vars(parsed_args))
     runtime_context.select_resources = executor.select_resources
+    runtime_context.reserve_resources = executor.reserve_resources
+    runtime_context.release_resources = executor.release_resources
+    if parsed_args.stripe_outdir_prefix:
+        runtime_context.outdir_striper = OutdirStriper(parsed_args.stripe_outdir_prefix, parsed_args.stripe_placement)
+    executor.backfill = parsed_args.backfill
+    if parsed_args.fair_share:
+        for pool in executor.all_pools():
+            pool.jrq = FairShareQueue(pool.total_resources)
+    warm_pool_ttl = parsed_args.warm_pool_ttl
+    if parsed_args.fuse_steps:
+        executor.add_start_hook(start_step_fusion)
+        if warm_pool_ttl is None:
+            warm_pool_ttl = FUSION_TTL_SECONDS
+    if warm_pool_ttl is not None:
+        RunnerPool.initialize(warm_pool_ttl)
+        # Runner pods can only reproduce bindings under their runner root
+        runtime_context.docker_outdir = RUNNER_OUTDIR
+        runtime_context.docker_stagedir = RUNNER_STAGEDIR
+    if parsed_args.batch_max_size:
+        executor.batcher = JobBatcher(parsed_args.batch_max_size, parsed_args.batch_target_seconds,
+                                      parsed_args.batch_parallelism, parsed_args.batch_backend,
+                                      not parsed_args.batch_shared_backoff_limit)
+    if parsed_args.prepull_images:
+        executor.add_start_hook(start_image_prepull)
+    if parsed_args.speculation_factor:
+        Speculator.initialize(parsed_args.speculation_factor, parsed_args.speculation_quantile)
+    if parsed_args.usage_sample_seconds or parsed_args.usage_history:
+        UsageMonitor.initialize(parsed_args.usage_sample_seconds or USAGE_SAMPLE_SECONDS)
+    if parsed_args.memory_overcommit:
+        MemoryOvercommit.initialize(max(1.0, parsed_args.memory_overcommit), UsageMonitor.is_enabled())
+    if parsed_args.io_budget:
+        IOBudget.initialize(parsed_args.io_budget)
+    if parsed_args.usage_history:
+        UsageHistory.initialize(parsed_args.usage_history, parsed_args.right_size, parsed_args.right_size_percentile)
     install_signal_handler()
 
     parsed_args.enable_ext = True
@@ -176,15 +345,23 @@ def main():
                          loadingContext=CalrissianLoadingContext(),
                          runtimeContext=runtime_context,
                          versionfunc=version,
-                         custom_schema_callback=(add_custom_schema if parsed_args.dask_gateway_url else None)
+                         custom_schema_callback=(add_dask_schema if parsed_args.dask_gateway_url else add_custom_schema)
                         )
     finally:
         # Always clean up after cwlmain
         if parsed_args.dask_gateway_url:
             DaskPodMonitor.cleanup()
         else:
+            RunnerPool.cleanup()
             PodMonitor.cleanup()
+            IndexedJobBatch.cleanup()
+        if parsed_args.prepull_images:
+            ImagePrePuller.cleanup()
         if parsed_args.usage_report:
+            if MemoryOvercommit.is_enabled():
+                Reporter.set_memory_overcommit(MemoryOvercommit.to_dict())
+            if IOBudget.is_enabled():
+                Reporter.set_io_budget(IOBudget.to_dict())
             write_report(parsed_args.usage_report)
         flush_tees()
 
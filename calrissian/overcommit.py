@@ -0,0 +1,122 @@
+import logging
+import threading
+
+log = logging.getLogger('calrissian.overcommit')
+
+# Margin over the peak RAM sampled from a running pod that is still considered in use by it
+OVERCOMMIT_HEADROOM = 1.25
+
+# Increase of the ratio with each job that completes without running short of memory
+RECOVERY_STEP = 0.05
+
+# Reasons a container or pod terminated that signal its node ran short of memory: killed by the kernel, or evicted
+# by the kubelet under node memory pressure
+MEMORY_SHORTAGE_REASONS = ['OOMKilled', 'Evicted', 'TerminationByKubelet']
+
+
+class MemoryOvercommit(object):
+    """
+    Singleton policy admitting jobs beyond the RAM limit of the executor, as pods often use a fraction of the RAM
+    they request.
+
+    At most (ratio - 1) times the limit is admitted beyond it. When measured, running jobs count at the peak RAM
+    sampled from their pods times OVERCOMMIT_HEADROOM, capped by their request, and jobs not sampled yet count at their
+    request, so that only RAM that is requested but unused is admitted again.
+    The ratio halves its overcommit each time a container is OOMKilled or a pod is evicted, and recovers by
+    RECOVERY_STEP with each job that completes, up to max_ratio.
+    """
+    max_ratio = None
+    ratio = None
+    measured = False
+    backoffs = 0
+    # RAM requested by the running jobs over the RAM limit, when the last job was admitted and at the highest
+    admission_ratio = 0.0
+    peak_admission_ratio = 0.0
+    lock = threading.Lock()
+
+    @staticmethod
+    def initialize(max_ratio, measured=False):
+        with MemoryOvercommit.lock:
+            MemoryOvercommit.max_ratio = max_ratio
+            MemoryOvercommit.ratio = max_ratio
+            MemoryOvercommit.measured = measured
+            MemoryOvercommit.backoffs = 0
+            MemoryOvercommit.admission_ratio = 0.0
+            MemoryOvercommit.peak_admission_ratio = 0.0
+
+    @staticmethod
+    def is_enabled():
+        return MemoryOvercommit.max_ratio is not None
+
+    @staticmethod
+    def backoff(reason):
+        """
+        Halve the overcommit after a container or pod ran short of memory
+        :param reason: str: reason of the termination or disruption
+        """
+        with MemoryOvercommit.lock:
+            MemoryOvercommit.ratio = 1.0 + (MemoryOvercommit.ratio - 1.0) / 2.0
+            MemoryOvercommit.backoffs += 1
+            log.warning('Memory overcommit backs off to {:.2f} after a pod was {}'.format(MemoryOvercommit.ratio,
+                                                                                        reason))
+
+    @staticmethod
+    def recover():
+        """
+        Raise the overcommit towards max_ratio after a job completed without running short of memory
+        """
+        with MemoryOvercommit.lock:
+            MemoryOvercommit.ratio = min(MemoryOvercommit.max_ratio, MemoryOvercommit.ratio + RECOVERY_STEP)
+
+    @staticmethod
+    def observe(reason):
+        """
+        Adjust the overcommit to the termination of a container or the disruption of a pod
+        :param reason: str: reason of the termination or disruption, or None
+        """
+        if not MemoryOvercommit.is_enabled():
+            return
+        if reason in MEMORY_SHORTAGE_REASONS:
+            MemoryOvercommit.backoff(reason)
+        else:
+            MemoryOvercommit.recover()
+
+    @staticmethod
+    def allowance(total_ram, running):
+        """
+        :param total_ram: RAM limit of the executor, in megabytes
+        :param running: list of (job, Resources) of the running jobs
+        :return: RAM in megabytes that may be admitted beyond the RAM available to queued jobs
+        """
+        with MemoryOvercommit.lock:
+            allowance = (MemoryOvercommit.ratio - 1.0) * total_ram
+        if not MemoryOvercommit.measured:
+            return allowance
+        unused = 0
+        for job, rsc in running:
+            observed = getattr(job, 'observed_ram_megabytes', lambda: None)()
+            if observed is not None:
+                unused += max(0, rsc.ram - observed * OVERCOMMIT_HEADROOM)
+        return min(allowance, unused)
+
+    @staticmethod
+    def record_admission(committed_ram, total_ram):
+        """
+        :param committed_ram: RAM requested by the running jobs, in megabytes
+        :param total_ram: RAM limit of the executor, in megabytes
+        """
+        with MemoryOvercommit.lock:
+            MemoryOvercommit.admission_ratio = committed_ram / total_ram if total_ram else 0.0
+            MemoryOvercommit.peak_admission_ratio = max(MemoryOvercommit.peak_admission_ratio,
+                                                        MemoryOvercommit.admission_ratio)
+
+    @staticmethod
+    def to_dict():
+        with MemoryOvercommit.lock:
+            return {
+                'max_ratio': MemoryOvercommit.max_ratio,
+                'ratio': MemoryOvercommit.ratio,
+                'admission_ratio': MemoryOvercommit.admission_ratio,
+                'peak_admission_ratio': MemoryOvercommit.peak_admission_ratio,
+                'backoffs': MemoryOvercommit.backoffs,
+            }
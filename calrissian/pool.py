@@ -0,0 +1,322 @@
+import copy
+import logging
+import threading
+import time
+import uuid
+
+import shellescape
+
+from calrissian.cache import cache_key
+from calrissian.k8s import KubernetesClient, PodMonitor
+
+log = logging.getLogger('calrissian.pool')
+
+# Runner pods mount a writable emptyDir here. Jobs run in a runner pod have their outdir and staged inputs
+# under it, so that they can be linked to their location on the shared volumes without mounting anything
+RUNNER_ROOT = '/var/run/calrissian'
+RUNNER_OUTDIR = RUNNER_ROOT + '/outdir'
+RUNNER_STAGEDIR = RUNNER_ROOT + '/stage'
+RUNNER_TMPDIR = '/tmp'
+RUNNER_VOLUME_NAME = 'calrissian-runner'
+TMPDIR_VOLUME_NAME = 'tmpdir'
+
+# Label identifying runner pods
+RUNNER_LABEL = 'calrissian-runner'
+
+# How often idle runners are checked for expiry
+REAP_INTERVAL_SECONDS = 5
+
+# Keeps the runner container alive, terminating promptly when the pod is deleted
+RUNNER_COMMAND = 'trap "exit 0" TERM; while true; do sleep 1 & wait $!; done'
+
+
+def runner_pod_body(pod, persistent_volume_entries):
+    """
+    Derive the spec of a runner pod from the spec of a job pod. The runner keeps the image, resources,
+    labels and scheduling of the job pod, but mounts the shared volumes at the paths they have in this pod
+    instead of the job's bindings, and idles until command lines are executed in it.
+    :param pod: dict, job pod spec built by KubernetesPodBuilder
+    :param persistent_volume_entries: the persistent volume entries of a KubernetesVolumeBuilder
+    :return: dict, runner pod spec without a name
+    """
+    body = copy.deepcopy(pod)
+    body['metadata'].pop('name', None)
+    body['metadata']['labels'][RUNNER_LABEL] = 'true'
+    spec = body['spec']
+    spec.pop('initContainers', None)
+    volumes = [
+        {'name': RUNNER_VOLUME_NAME, 'emptyDir': {}},
+        {'name': TMPDIR_VOLUME_NAME, 'emptyDir': {}},
+    ]
+    volume_mounts = [
+        {'name': RUNNER_VOLUME_NAME, 'mountPath': RUNNER_ROOT},
+        {'name': TMPDIR_VOLUME_NAME, 'mountPath': RUNNER_TMPDIR},
+    ]
+    for entry in persistent_volume_entries:
+        if entry['volume']['name'] not in [v['name'] for v in volumes]:
+            volumes.append(entry['volume'])
+        volume_mounts.append({
+            'name': entry['volume']['name'],
+            'mountPath': entry['prefix'],
+            'subPath': entry['subPath'],
+            'readOnly': entry['volume']['persistentVolumeClaim']['readOnly'],
+        })
+    spec['volumes'] = volumes
+    container = spec['containers'][0]
+    # The environment, working directory and command are those of each job, set when it is executed
+    container.pop('env', None)
+    container.pop('args', None)
+    container['name'] = 'runner'
+    container['command'] = ['/bin/sh', '-c', RUNNER_COMMAND]
+    container['workingDir'] = RUNNER_ROOT
+    container['volumeMounts'] = volume_mounts
+    spec['terminationGracePeriodSeconds'] = 0
+    return body
+
+
+def exports_environment(pod):
+    """
+    :param pod: dict, job pod spec built by KubernetesPodBuilder
+    :return: bool: whether command_lines can export the whole environment of the job, which it cannot for variables
+    taken from secrets or config maps, with valueFrom or envFrom
+    """
+    container = pod['spec']['containers'][0]
+    if container.get('envFrom'):
+        return False
+    return all('value' in env for env in container.get('env') or [])
+
+
+def command_lines(pod):
+    """
+    Shell lines running the command line of a job pod spec with its environment and working directory,
+    in a container that was not created for it
+    :param pod: dict, job pod spec built by KubernetesPodBuilder
+    :return: list of str, the command line last
+    """
+    container = pod['spec']['containers'][0]
+    lines = []
+    for env in container.get('env') or []:
+        lines.append('export {}={}'.format(env['name'], shellescape.quote(env['value'])))
+    lines.append('cd {}'.format(shellescape.quote(container['workingDir'])))
+    for init_container in pod['spec'].get('initContainers') or []:
+        # Creates the directories of redirected stdout/stderr
+        lines.append(init_container['command'][-1])
+    lines.append(container['args'][0])
+    return lines
+
+
+def runner_script(pod, volume_bindings):
+    """
+    Build the shell script that runs a job pod's command line in a runner pod.
+    It clears what the previous job left behind, links each bound path to its source on the shared volumes,
+    then runs the command line with the job's environment and working directory.
+    :param pod: dict, job pod spec built by KubernetesPodBuilder
+    :param volume_bindings: list of (source, target) tuples, targets under RUNNER_ROOT
+    :return: str
+    """
+    lines = ['set -e', 'rm -rf {}/* {}/* {}/.[!.]*'.format(RUNNER_ROOT, RUNNER_TMPDIR, RUNNER_TMPDIR)]
+    # Parents are linked before the paths inside them
+    for source, target in sorted(volume_bindings, key=lambda binding: binding[1]):
+        target_dir = target.rsplit('/', 1)[0]
+        lines.append('mkdir -p {} && ln -sfn {} {}'.format(
+            shellescape.quote(target_dir), shellescape.quote(source), shellescape.quote(target)))
+    lines.extend(command_lines(pod))
+    # The exit code is the command line's, which may be a list of commands when using ShellCommandRequirement
+    lines.insert(-1, 'set +e')
+    return '\n'.join(lines)
+
+
+class RunnerPod(object):
+    """
+    A long-lived pod that runs the command lines of successive jobs, one at a time
+    """
+
+    def __init__(self, key, body):
+        self.key = key
+        self.body = copy.deepcopy(body)
+        self.body['metadata']['name'] = 'calrissian-runner-{}'.format(uuid.uuid4().hex[:12])
+        self.client = KubernetesClient()
+        self.last_used = None
+
+    @property
+    def name(self):
+        return self.body['metadata']['name']
+
+    def start(self):
+        self.client.submit_pod(self.body)
+        self.client.wait_for_running()
+
+    def execute(self, script):
+        return self.client.exec_in_pod(['/bin/sh', '-c', script])
+
+    def delete(self):
+        if self.client.pod is None:
+            # Never submitted
+            return
+        log.info('Deleting runner pod {}'.format(self.name))
+        with PodMonitor() as monitor:
+            self.client.delete_pod_name(self.name)
+            monitor.remove(self.client.pod)
+
+
+class RunnerPool(object):
+    """
+    Singleton thread-safe pool of runner pods, keyed by the spec they were created from: pods with the same
+    image, resources, labels and scheduling are interchangeable.
+
+    A job takes an idle runner with its key, or starts a new one, runs its command line in it and returns it to
+    the pool. Runners idle for more than ttl seconds are deleted by a background thread.
+    Runners are tracked by PodMonitor like any other pod, so they are deleted on termination.
+
+    A job whose outputs are consumed by a single fused step (see calrissian.fusion) holds its runner for that step
+    instead, keyed by its outdir. The fused step claims the runner that produced its inputs, so the chain runs in one
+    pod. Runners held for more than ttl seconds are deleted too.
+    """
+    ttl = None
+    idle = {}
+    held = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def initialize(ttl):
+        with RunnerPool.lock:
+            RunnerPool.ttl = ttl
+            RunnerPool.idle = {}
+            RunnerPool.held = {}
+        reaper = threading.Thread(target=RunnerPool._reap, name='calrissian-runner-reaper', daemon=True)
+        reaper.start()
+
+    @staticmethod
+    def is_enabled():
+        return RunnerPool.ttl is not None
+
+    @staticmethod
+    def _reap():
+        while RunnerPool.is_enabled():
+            time.sleep(REAP_INTERVAL_SECONDS)
+            RunnerPool.evict_expired()
+
+    @staticmethod
+    def evict_expired(now=None):
+        """
+        Delete the runners idle for more than ttl seconds
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        with RunnerPool.lock:
+            if RunnerPool.ttl is None:
+                return
+            for key, runners in RunnerPool.idle.items():
+                expired.extend(r for r in runners if now - r.last_used > RunnerPool.ttl)
+                RunnerPool.idle[key] = [r for r in runners if now - r.last_used <= RunnerPool.ttl]
+            for outdir, runner in list(RunnerPool.held.items()):
+                if now - runner.last_used > RunnerPool.ttl:
+                    # The fused step failed or was never run
+                    expired.append(RunnerPool.held.pop(outdir))
+        for runner in expired:
+            RunnerPool.discard(runner)
+
+    @staticmethod
+    def acquire(body):
+        """
+        Take an idle runner pod matching body, or start a new one
+        :param body: dict, runner pod spec without a name, see runner_pod_body()
+        :return: RunnerPod
+        """
+        key = cache_key(body)
+        with RunnerPool.lock:
+            runners = RunnerPool.idle.get(key)
+            if runners:
+                runner = runners.pop()
+                log.info('Reusing runner pod {}'.format(runner.name))
+                return runner
+        runner = RunnerPod(key, body)
+        log.info('Starting runner pod {}'.format(runner.name))
+        try:
+            runner.start()
+        except Exception:
+            RunnerPool.discard(runner)
+            raise
+        return runner
+
+    @staticmethod
+    def release(runner):
+        runner.last_used = time.monotonic()
+        with RunnerPool.lock:
+            RunnerPool.idle.setdefault(runner.key, []).append(runner)
+
+    @staticmethod
+    def hold(outdir, runner):
+        """
+        Keep a runner for the fused step consuming the outputs in outdir
+        """
+        runner.last_used = time.monotonic()
+        with RunnerPool.lock:
+            RunnerPool.held[outdir] = runner
+
+    @staticmethod
+    def claim(input_paths, key):
+        """
+        Take the runner held by the job that produced one of input_paths
+        :param input_paths: paths of the inputs of a fused step
+        :param key: key of the runner the step needs
+        :return: RunnerPod, or None if no runner with that key was held for these inputs
+        """
+        with RunnerPool.lock:
+            outdir = next((o for o in RunnerPool.held for p in input_paths if p.startswith(o + '/')), None)
+            runner = RunnerPool.held.pop(outdir) if outdir is not None else None
+        if runner is None:
+            return None
+        if runner.key != key:
+            log.info('Runner pod {} does not match its fused step, deleting it'.format(runner.name))
+            RunnerPool.discard(runner)
+            return None
+        log.info('Continuing fused steps in runner pod {}'.format(runner.name))
+        return runner
+
+    @staticmethod
+    def discard(runner):
+        try:
+            runner.delete()
+        except Exception:
+            log.error('Error deleting runner pod {}, ignoring'.format(runner.name))
+
+    @staticmethod
+    def execute(pod, volume_bindings, persistent_volume_entries, input_paths=None, hold_outdir=None):
+        """
+        Run a job pod's command line in a runner pod
+        :param pod: dict, job pod spec built by KubernetesPodBuilder
+        :param volume_bindings: list of (source, target) tuples of the job
+        :param persistent_volume_entries: the persistent volume entries of the job's KubernetesVolumeBuilder
+        :param input_paths: for a fused step, the paths of its inputs, to run in the runner that produced them
+        :param hold_outdir: for a job consumed by a fused step, its outdir, to hold its runner for that step
+        :return: CompletionResult, or None if no runner could run the job
+        """
+        body = runner_pod_body(pod, persistent_volume_entries)
+        runner = RunnerPool.claim(input_paths, cache_key(body)) if input_paths else None
+        try:
+            runner = runner or RunnerPool.acquire(body)
+        except Exception:
+            log.exception('Unable to start a runner pod, submitting pod instead')
+            return None
+        try:
+            completion_result = runner.execute(runner_script(pod, volume_bindings))
+        except Exception:
+            log.exception('Error running in runner pod {}, submitting pod instead'.format(runner.name))
+            RunnerPool.discard(runner)
+            return None
+        if hold_outdir and completion_result.exit_code == 0:
+            RunnerPool.hold(hold_outdir, runner)
+        else:
+            RunnerPool.release(runner)
+        return completion_result
+
+    @staticmethod
+    def cleanup():
+        with RunnerPool.lock:
+            runners = [r for runners in RunnerPool.idle.values() for r in runners] + list(RunnerPool.held.values())
+            RunnerPool.idle = {}
+            RunnerPool.held = {}
+            RunnerPool.ttl = None
+        for runner in runners:
+            RunnerPool.discard(runner)
@@ -0,0 +1,274 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from cwltool.command_line_tool import CommandLineTool
+from cwltool.workflow import Workflow
+
+from calrissian.gpu import GPU_SHARE_REQUIREMENT
+from calrissian.job import random_tag, read_yaml
+from calrissian.k8s import KubernetesClient
+from calrissian.report import Reporter
+
+log = logging.getLogger('calrissian.prepull')
+
+# Label identifying the pods of a pre-pull daemonset
+PREPULL_LABEL = 'calrissian-prepull'
+
+# How long to wait for the images to be pulled on every node, and how often to check
+PREPULL_TIMEOUT_SECONDS = 600
+PREPULL_POLL_SECONDS = 2
+
+# Reasons of a waiting container whose image is still being pulled
+PULLING_REASONS = ['ContainerCreating', 'PodInitializing']
+
+# Reasons of a waiting container whose image could not be pulled
+PULL_FAILED_REASONS = ['ErrImagePull', 'ImagePullBackOff', 'InvalidImageName', 'ErrImageNeverPull']
+
+
+def is_gpu_tool(tool):
+    """
+    :param tool: cwltool CommandLineTool
+    :return: True if the pods of the tool are scheduled with the GPU node selectors, see
+    CalrissianCommandLineJob.node_selector
+    """
+    cuda_requirement, _ = tool.get_requirement('http://commonwl.org/cwltool#CUDARequirement')
+    gpu_share, _ = tool.get_requirement(GPU_SHARE_REQUIREMENT)
+    return bool(cuda_requirement or gpu_share)
+
+
+def collect_images(process, default_container=None, gpu=None):
+    """
+    Walk a loaded CWL process and collect the container images its CommandLineTools will run in
+    :param process: cwltool Process, e.g. a Workflow or a CommandLineTool
+    :param default_container: image used by tools without a DockerRequirement
+    :param gpu: True to only collect the images of GPU tools, False to only collect those of other tools, see
+    is_gpu_tool, None to collect all
+    :return: set of image names
+    """
+    images = set()
+    if isinstance(process, Workflow):
+        for step in process.steps:
+            images.update(collect_images(step.embedded_tool, default_container, gpu))
+    elif isinstance(process, CommandLineTool):
+        if gpu is not None and is_gpu_tool(process) != gpu:
+            return images
+        # Requirements inherited from the workflow and its steps have been merged into the tool's
+        docker_requirement, _ = process.get_requirement('DockerRequirement')
+        if docker_requirement and docker_requirement.get('dockerPull'):
+            images.add(docker_requirement['dockerPull'])
+        elif default_container:
+            images.add(default_container)
+    return images
+
+
+def started_at(status):
+    """
+    :param status: V1ContainerStatus
+    :return: datetime the container first started, once its image was on the node, or None if it has not started
+    """
+    times = []
+    for state in [status.state, status.last_state]:
+        if state is None:
+            continue
+        for started in [state.running, state.terminated]:
+            if started is not None and started.started_at is not None:
+                times.append(started.started_at)
+    return min(times, default=None)
+
+
+class ImagePrePuller(object):
+    """
+    Warms the image caches of the cluster nodes before the steps that need the images are scheduled.
+
+    A short-lived daemonset runs one container per image on every node. The containers only need to be created
+    for their image to be pulled, so they are given a command that may not even exist in the image, and their
+    state is watched until each image is available (or failed to pull) on each node. The kubelet pulls the images
+    of the containers one after the other, so each pull is timed from the start of the previous container, or of the
+    pod for the first one, to the start of its own container. The time each pull took is added to the usage report,
+    then the daemonset is deleted.
+
+    Daemonsets still running on termination are deleted by the static cleanup() method.
+    """
+    daemonset_names = []
+    lock = threading.Lock()
+
+    def __init__(self, images, nodeselectors=None, serviceaccount=None, timeout=PREPULL_TIMEOUT_SECONDS):
+        self.images = list(images)
+        self.nodeselectors = nodeselectors
+        self.serviceaccount = serviceaccount
+        self.timeout = timeout
+        self.name = 'calrissian-prepull-{}'.format(random_tag())
+        self.pulls = {}
+
+    @staticmethod
+    def container_name(index):
+        return 'prepull-{}'.format(index)
+
+    def labels(self):
+        return {PREPULL_LABEL: self.name}
+
+    def build(self):
+        containers = [
+            {
+                'name': self.container_name(index),
+                'image': image,
+                # Any command will do, the image is pulled before it runs
+                'command': ['true'],
+                'imagePullPolicy': 'IfNotPresent',
+                'resources': {'requests': {'cpu': '1m', 'memory': '4Mi'}},
+            } for index, image in enumerate(self.images)
+        ]
+        pod_spec = {
+            'containers': containers,
+            'terminationGracePeriodSeconds': 0,
+        }
+        if self.nodeselectors:
+            pod_spec['nodeSelector'] = {str(k): str(v) for k, v in self.nodeselectors.items()}
+        if self.serviceaccount:
+            # Image pull secrets are usually attached to the service account
+            pod_spec['serviceAccountName'] = self.serviceaccount
+        return {
+            'apiVersion': 'apps/v1',
+            'kind': 'DaemonSet',
+            'metadata': {
+                'name': self.name,
+                'labels': self.labels(),
+            },
+            'spec': {
+                'selector': {'matchLabels': self.labels()},
+                'template': {
+                    'metadata': {'labels': self.labels()},
+                    'spec': pod_spec,
+                },
+            },
+        }
+
+    def observe(self, pod):
+        """
+        Record the images of a daemonset pod that have been pulled, or failed to pull, each timed from the start of
+        the previous container of the pod, or of the pod for the first one
+        :param pod: V1Pod
+        """
+        if not pod.spec.node_name or not pod.status.start_time:
+            return
+        now = datetime.now(timezone.utc)
+        statuses = {status.name: status for status in pod.status.container_statuses or []}
+        pull_started = pod.status.start_time
+        for index, image in enumerate(self.images):
+            status = statuses.get(self.container_name(index))
+            if status is None:
+                break
+            waiting = status.state.waiting
+            if waiting and waiting.reason in PULLING_REASONS:
+                # The images of the next containers are pulled after this one
+                break
+            # Containers that do not start, e.g. failing to pull or to run, are timed when first observed
+            pulled_at = started_at(status) or now
+            key = (pod.spec.node_name, image)
+            elapsed_seconds = max((pulled_at - pull_started).total_seconds(), 0)
+            pull_started = max(pulled_at, pull_started)
+            if key in self.pulls:
+                continue
+            if waiting and waiting.reason in PULL_FAILED_REASONS:
+                log.warning('Failed to pull image {} on node {}: {}'.format(image, pod.spec.node_name, waiting.message))
+                result = 'failed'
+            else:
+                # Running, terminated or failing to run, the image is on the node
+                result = 'pulled'
+
+            log.info('Image {} {} on node {} after {} seconds'.format(image, result, pod.spec.node_name, elapsed_seconds))
+            self.pulls[key] = {
+                'image': image,
+                'node': pod.spec.node_name,
+                'status': result,
+                'elapsed_seconds': elapsed_seconds,
+            }
+
+    def is_done(self, daemonset):
+        """
+        :param daemonset: V1DaemonSet
+        :return: True when every image has been pulled, or failed to pull, on every node of the daemonset
+        """
+        if not daemonset.status or daemonset.status.observed_generation is None:
+            # The daemonset controller has not scheduled the pods yet
+            return False
+        return len(self.pulls) >= (daemonset.status.desired_number_scheduled or 0) * len(self.images)
+
+    def run(self):
+        k8s_client = KubernetesClient()
+        with ImagePrePuller.lock:
+            k8s_client.create_daemonset(self.build())
+            ImagePrePuller.daemonset_names.append(self.name)
+        started = time.monotonic()
+        try:
+            while True:
+                for pod in k8s_client.list_pods_for_selector('{}={}'.format(PREPULL_LABEL, self.name)):
+                    self.observe(pod)
+                if self.is_done(k8s_client.read_daemonset(self.name)):
+                    log.info('Pre-pulled {} images'.format(len(self.images)))
+                    break
+                if time.monotonic() - started > self.timeout:
+                    log.warning('Gave up pre-pulling images after {} seconds'.format(self.timeout))
+                    break
+                time.sleep(PREPULL_POLL_SECONDS)
+        finally:
+            with ImagePrePuller.lock:
+                k8s_client.delete_daemonset_name(self.name)
+                if self.name in ImagePrePuller.daemonset_names:
+                    ImagePrePuller.daemonset_names.remove(self.name)
+            for pull in self.pulls.values():
+                Reporter.add_image_pull(pull)
+
+    def _run_logging_errors(self):
+        try:
+            self.run()
+        except Exception:
+            # Pre-pulling is an optimization, steps pull their images anyway
+            log.exception('Error pre-pulling images, ignoring')
+
+    def start(self):
+        """
+        Pre-pull the images on a background thread, so the workflow does not wait for it
+        :return: the started threading.Thread
+        """
+        log.info('Pre-pulling images {}'.format(', '.join(self.images)))
+        thread = threading.Thread(target=self._run_logging_errors, name=self.name, daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def cleanup():
+        with ImagePrePuller.lock:
+            if not ImagePrePuller.daemonset_names:
+                return
+            k8s_client = KubernetesClient()
+            for daemonset_name in ImagePrePuller.daemonset_names:
+                log.info('ImagePrePuller deleting daemonset {}'.format(daemonset_name))
+                try:
+                    k8s_client.delete_daemonset_name(daemonset_name)
+                except Exception:
+                    log.error('Error deleting daemonset named {}, ignoring'.format(daemonset_name))
+            ImagePrePuller.daemonset_names = []
+
+
+def start_image_prepull(process, runtime_context):
+    """
+    Start pre-pulling the images of a process on the nodes its pods may run on, with a daemonset per node selector:
+    the images of GPU tools on the nodes of the GPU node selectors, the others on the nodes of the pod node selectors.
+    Registered as a ThreadPoolJobExecutor start hook, so it runs while the first steps are staged
+    :param process: cwltool Process about to be run
+    :param runtime_context: CalrissianRuntimeContext
+    """
+    nodeselectors = read_yaml(runtime_context.pod_nodeselectors) if runtime_context.pod_nodeselectors else None
+    gpu_nodeselectors = read_yaml(runtime_context.pod_gpu_nodeselectors) if runtime_context.pod_gpu_nodeselectors \
+        else None
+    groups = {}
+    for selectors, gpu in [(nodeselectors, False), (gpu_nodeselectors, True)]:
+        key = tuple(sorted((str(k), str(v)) for k, v in (selectors or {}).items()))
+        images = groups.setdefault(key, (selectors, set()))[1]
+        images.update(collect_images(process, runtime_context.default_container, gpu))
+    for selectors, images in groups.values():
+        if images:
+            ImagePrePuller(sorted(images), selectors, runtime_context.pod_serviceaccount).start()
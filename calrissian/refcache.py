@@ -0,0 +1,167 @@
+import logging
+import os
+import threading
+
+from calrissian.cache import cache_key, file_fingerprint
+from calrissian.report import Reporter
+
+log = logging.getLogger('calrissian.refcache')
+
+# The cache directory of the node, mounted in the pods with cached inputs
+REFERENCE_CACHE_VOLUME_NAME = 'reference-cache'
+# Where the init container filling the cache mounts the cache directory, the cached inputs on the shared volume and
+# a directory on the shared volume to write its stats to
+REFERENCE_CACHE_MOUNT = '/calrissian/reference-cache'
+REFERENCE_SOURCES_ROOT = '/calrissian/reference-sources'
+REFERENCE_STATS_DIR = '/calrissian/reference-stats'
+REFERENCE_STATS_FILENAME = 'stats'
+# Name of the file in each entry directory
+REFERENCE_ENTRY_FILENAME = 'data'
+# Entries used within this many minutes are not evicted, so that the inputs of pods starting on the node stay there
+EVICTION_GRACE_MINUTES = 10
+DEFAULT_REFERENCE_CACHE_SIZE = '100Gi'
+
+# Fills the cache directory of the node with the entries of a pod, formatted with the cache mount, the stats file,
+# the size limit and the space needed in KiB, the keys of the entries and the commands fetching each entry.
+# Least recently used entries are evicted first, under a lock of the whole cache. Each entry is then copied under a
+# lock of its own, so that pods starting together on a node copy it once, and renamed into place once complete.
+FILL_SCRIPT = '''set -e
+cache={cache}
+stats={stats}
+(
+  flock 9
+  used=$(du -sk "$cache" | cut -f1)
+  for entry in $(ls -1tr "$cache"); do
+    [ $((used + {needed})) -gt {limit} ] || break
+    [ -d "$cache/$entry" ] || continue
+    case " {keys} " in *" $entry "*) continue;; esac
+    [ -z "$(find "$cache/$entry" -maxdepth 0 -mmin -{grace})" ] || continue
+    size=$(du -sk "$cache/$entry" | cut -f1)
+    rm -rf "$cache/$entry"
+    used=$((used - size))
+    echo "evictions $((size * 1024))" >> "$stats"
+  done
+) 9>"$cache/.lock"
+{fetches}'''
+
+FETCH_SCRIPT = '''(
+  flock 9
+  if [ -e "$cache/{key}/{filename}" ]; then
+    touch "$cache/{key}"
+    echo "hits {size}" >> "$stats"
+  else
+    rm -rf "$cache/{key}.partial"
+    mkdir "$cache/{key}.partial"
+    cp {source} "$cache/{key}.partial/{filename}"
+    mv "$cache/{key}.partial" "$cache/{key}"
+    echo "misses {size}" >> "$stats"
+  fi
+) 9>"$cache/{key}.lock"
+'''
+
+
+def fill_script(entries, max_bytes):
+    """
+    :param entries: list of (key, source, size) of the entries of a pod, source being where the init container
+    mounts the input on the shared volume and size its size in bytes
+    :param max_bytes: size limit of the cache directory of each node in bytes
+    :return: str, shell script of the init container filling the cache
+    """
+    fetches = ''.join(FETCH_SCRIPT.format(key=key, source=source, size=size, filename=REFERENCE_ENTRY_FILENAME)
+                      for key, source, size in entries)
+    return FILL_SCRIPT.format(cache=REFERENCE_CACHE_MOUNT,
+                              stats='{}/{}'.format(REFERENCE_STATS_DIR, REFERENCE_STATS_FILENAME),
+                              needed=sum(size for _, _, size in entries) // 1024,
+                              limit=max_bytes // 1024,
+                              keys=' '.join(key for key, _, _ in entries),
+                              grace=EVICTION_GRACE_MINUTES,
+                              fetches=fetches)
+
+
+def read_stats(path):
+    """
+    :param path: the stats file written by the init container filling the cache
+    :return: dict of the count of each event and of the bytes hit, missed and evicted
+    """
+    stats = {}
+    with open(path) as f:
+        for line in f:
+            event, size = line.split()
+            stats[event] = stats.get(event, 0) + 1
+            stats['{}_bytes'.format(event)] = stats.get('{}_bytes'.format(event), 0) + int(size)
+    return stats
+
+
+class ReferenceCache(object):
+    """
+    Singleton read-through cache of large read-only inputs, e.g. reference genomes or elevation models read by every
+    job of a scatter, in a directory on each node instead of read from the shared volume by each pod.
+
+    Read-only files under the prefixes are mounted into the containers from a hostPath volume of the directory. An
+    init container fills it: each entry is a directory named after the key of the file, holding a copy of the file,
+    and its modification time is updated on each hit. Entries are evicted least recently used first when the
+    directory would exceed max_bytes. The init containers write their hits, misses and evictions to a file on the
+    shared volume, added to the report when the job finishes.
+    """
+    directory = None
+    prefixes = []
+    max_bytes = None
+    lock = threading.Lock()
+
+    @staticmethod
+    def initialize(directory, prefixes, max_bytes):
+        """
+        :param directory: path of the cache directory on the nodes
+        :param prefixes: list of str, paths of the inputs to cache
+        :param max_bytes: size limit of the cache directory of each node
+        """
+        with ReferenceCache.lock:
+            ReferenceCache.directory = directory
+            ReferenceCache.prefixes = [os.path.join(prefix, '') for prefix in prefixes]
+            ReferenceCache.max_bytes = int(max_bytes)
+        if not prefixes:
+            log.warning('No prefix of the inputs to cache in {}, no input will be cached'.format(directory))
+
+    @staticmethod
+    def is_enabled():
+        return ReferenceCache.directory is not None
+
+    @staticmethod
+    def caches(path):
+        """
+        :param path: path of an input on the shared volume
+        :return: bool: whether the input is read from the cache
+        """
+        if not ReferenceCache.is_enabled():
+            return False
+        return any(path.startswith(prefix) for prefix in ReferenceCache.prefixes) and os.path.isfile(path)
+
+    @staticmethod
+    def entry_key(path, checksum=None):
+        """
+        Identify the content of a file by its size and checksum, shared by the copies of a file, or by its path, size
+        and modification time when its checksum is not known, so that a file rewritten in place is fetched again.
+        :param path: path of the file on the shared volume
+        :param checksum: CWL checksum of the file, if computed
+        :return: str
+        """
+        fingerprint = file_fingerprint(path, checksum)
+        if checksum:
+            return cache_key({'fingerprint': fingerprint})
+        return cache_key({'path': os.path.realpath(path), 'fingerprint': fingerprint})
+
+    @staticmethod
+    def record(name, stats_dir):
+        """
+        Add the stats written by the init container of a job to the report
+        :param name: name of the job
+        :param stats_dir: directory the init container wrote its stats file to
+        """
+        path = os.path.join(stats_dir, REFERENCE_STATS_FILENAME)
+        if not os.path.exists(path):
+            # The pod did not get to fill the cache
+            return
+        stats = read_stats(path)
+        log.info('Job {} read {} cached inputs from its node, fetched {}'.format(
+            name, stats.get('hits', 0), stats.get('misses', 0)))
+        Reporter.add_reference_cache_stats(stats)
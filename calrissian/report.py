@@ -8,6 +8,12 @@ log = logging.getLogger("calrissian.report")
 
 SECONDS_PER_HOUR = 60.0 * 60.0
 
+# Kubernetes resource of the local storage of a pod
+EPHEMERAL_STORAGE = 'ephemeral-storage'
+
+# Name of the resource pool of the --max-ram, --max-cores and --max-gpus limits, see calrissian.executor.ResourcePool
+DEFAULT_POOL = 'default'
+
 
 class TimedReport(object):
     """
@@ -105,22 +111,66 @@ class CPUParser(ResourceParser):
     kind = 'cpu'
     url = 'https://kubernetes.io/docs/concepts/configuration/manage-compute-resources-container/#meaning-of-cpu'
     suffixes = {
-        'm': 0.001
+        'm': 0.001,
+        'u': 1e-6,
+        'n': 1e-9,
     }
 
 
+def is_storage_resource(name):
+    """
+    Storage and hugepages are accounted for in mebibytes, like the tmpdirMin and outdirMin of CWL
+    :param name: Kubernetes resource name
+    """
+    return name == EPHEMERAL_STORAGE or name.startswith('hugepages-')
+
+
+def parse_resource_quantity(name, quantity):
+    """
+    :param name: Kubernetes resource name, e.g. ephemeral-storage or example.com/fpga
+    :param quantity: Kubernetes quantity, e.g. 10Gi or 1
+    :return: float: the quantity in mebibytes for storage resources, otherwise the count
+    """
+    if is_storage_resource(name):
+        return MemoryParser.parse(str(quantity)) / MemoryParser.suffixes['Mi']
+    return float(quantity)
+
+
+def format_resource_quantity(name, amount):
+    """
+    Inverse of parse_resource_quantity
+    :return: str: Kubernetes quantity
+    """
+    if amount == int(amount):
+        amount = int(amount)
+    return '{}Mi'.format(amount) if is_storage_resource(name) else str(amount)
+
+
 class TimedResourceReport(TimedReport):
     """
     Adds CPU, memory, and disk values to TimedReport, in order to calculate resource usage over the
     duration of the timed report. These values, by convention, are the kubernetes **requested**
     resources (not limits or actual).
+    When usage is sampled, the peak and mean CPU and memory actually used are reported as well.
     """
-    def __init__(self, cpus=0, ram_megabytes=0, disk_megabytes=0, exit_code=0, node_selectors=None, *args, **kwargs):
+    def __init__(self, cpus=0, ram_megabytes=0, disk_megabytes=0, exit_code=0, node_selectors=None,
+                 peak_cpus=None, mean_cpus=None, peak_ram_megabytes=None, mean_ram_megabytes=None,
+                 extended_resources=None, resource_pool=None, gpus=None, *args, **kwargs):
         self.cpus = cpus
         self.ram_megabytes = ram_megabytes
         self.disk_megabytes = disk_megabytes
         self.exit_code = exit_code
         self.node_selectors = node_selectors if node_selectors is not None else {}
+        self.peak_cpus = peak_cpus
+        self.mean_cpus = mean_cpus
+        self.peak_ram_megabytes = peak_ram_megabytes
+        self.mean_ram_megabytes = mean_ram_megabytes
+        # Requests other than cpu and memory, see parse_resource_quantity, or None if there were none
+        self.extended_resources = extended_resources or None
+        # Name of the resource pool the job was admitted to, or None for the default pool
+        self.resource_pool = resource_pool
+        # GPUs accounted to the job, a fraction of a GPU for a share of a time-sliced GPU, or None without GPUs
+        self.gpus = gpus
         super(TimedResourceReport, self).__init__(*args, **kwargs)
 
     def ram_megabyte_hours(self):
@@ -137,6 +187,37 @@ class TimedResourceReport(TimedReport):
         else:
             return 0
 
+    def gpu_hours(self):
+        """
+        :return: the GPUs accounted to the job over the duration of the report, or None without GPUs
+        """
+        if self.gpus is None:
+            return None
+        return self.gpus * self.elapsed_hours()
+
+    def used_ram_megabyte_hours(self):
+        """
+        :return: the RAM actually used over the duration of the report, or None if it was not sampled
+        """
+        if self.mean_ram_megabytes is None:
+            return None
+        return self.mean_ram_megabytes * self.elapsed_hours()
+
+    def used_cpu_hours(self):
+        """
+        :return: the CPU actually used over the duration of the report, or None if it was not sampled
+        """
+        if self.mean_cpus is None:
+            return None
+        return self.mean_cpus * self.elapsed_hours()
+
+    def extended_resource_hours(self):
+        """
+        :return: dict of the requests other than cpu and memory to their amount over the duration of the report
+        """
+        elapsed_hours = self.elapsed_hours()
+        return {name: amount * elapsed_hours for name, amount in (self.extended_resources or {}).items()}
+
     def to_dict(self):
         result = super(TimedResourceReport, self).to_dict()
         result['ram_megabyte_hours'] = self.ram_megabyte_hours()
@@ -144,6 +225,14 @@ class TimedResourceReport(TimedReport):
         result['exit_code'] = self.exit_code
         if self.node_selectors:
             result['node_selectors'] = self.node_selectors
+        if self.mean_ram_megabytes is not None:
+            result['used_ram_megabyte_hours'] = self.used_ram_megabyte_hours()
+        if self.mean_cpus is not None:
+            result['used_cpu_hours'] = self.used_cpu_hours()
+        if self.extended_resources:
+            result['extended_resource_hours'] = self.extended_resource_hours()
+        if self.gpus is not None:
+            result['gpu_hours'] = self.gpu_hours()
         return result
 
     @classmethod
@@ -151,10 +240,17 @@ class TimedResourceReport(TimedReport):
         cpus = CPUParser.parse(completion_result.cpus)
         ram_megabytes = MemoryParser.parse_to_megabytes(completion_result.memory)
         disk_megabytes = MemoryParser.parse_to_megabytes(str(disk_bytes))
+        extended_resources = {name: parse_resource_quantity(name, quantity)
+                              for name, quantity in completion_result.extended_resources.items()}
 
         return cls(name=name, start_time=completion_result.start_time, finish_time=completion_result.finish_time, cpus=cpus,
                    ram_megabytes=ram_megabytes, disk_megabytes=disk_megabytes,
-                   exit_code=completion_result.exit_code, node_selectors=completion_result.node_selectors)
+                   exit_code=completion_result.exit_code, node_selectors=completion_result.node_selectors,
+                   peak_cpus=completion_result.peak_cpus,
+                   mean_cpus=completion_result.mean_cpus,
+                   peak_ram_megabytes=completion_result.peak_ram_megabytes,
+                   mean_ram_megabytes=completion_result.mean_ram_megabytes,
+                   extended_resources=extended_resources)
 
 
 class Event(object):
@@ -275,18 +371,91 @@ class TimelineReport(TimedReport):
         self.cores_allowed = cores_allowed
         self.ram_mb_allowed = ram_mb_allowed
         self.children = []
+        # Counts of step cache events (hits, misses...), only reported when the step cache is used
+        self.step_cache = None
+        # Image pulls on each node, only reported when images are pre-pulled
+        self.image_pulls = None
+        # RAM escalations of OOMKilled steps, only reported when steps were retried with more memory
+        self.memory_escalations = None
+        # Ratios of the memory overcommit policy, only reported when RAM is overcommitted
+        self.memory_overcommit = None
+        # Total resources of each resource pool by name, only reported when jobs are admitted to node pools
+        self.resource_pools = None
+        # Time the jobs of each step or sub-workflow waited in the queue, only reported with fair-share queueing
+        self.queue_waits = None
+        # Weight and waits of the I/O budget, only reported when the shared volume has an I/O budget
+        self.io_budget = None
+        # Hits, misses and evictions of the reference cache of the nodes, only reported when inputs are cached there
+        self.reference_cache = None
         super(TimelineReport, self).__init__(*args, **kwargs)
 
     def add_report(self, report):
         self.children.append(report)
         self._recalculate_times()
 
+    def add_cache_event(self, event):
+        if self.step_cache is None:
+            self.step_cache = {}
+        self.step_cache[event] = self.step_cache.get(event, 0) + 1
+
+    def add_reference_cache_stats(self, stats):
+        if self.reference_cache is None:
+            self.reference_cache = {}
+        for name, value in stats.items():
+            self.reference_cache[name] = self.reference_cache.get(name, 0) + value
+
+    def add_image_pull(self, image_pull):
+        if self.image_pulls is None:
+            self.image_pulls = []
+        self.image_pulls.append(image_pull)
+
+    def add_memory_escalation(self, escalation):
+        if self.memory_escalations is None:
+            self.memory_escalations = []
+        self.memory_escalations.append(escalation)
+
+    def set_memory_overcommit(self, memory_overcommit):
+        self.memory_overcommit = memory_overcommit
+
+    def set_io_budget(self, io_budget):
+        self.io_budget = io_budget
+
+    def set_resource_pools(self, resource_pools):
+        self.resource_pools = resource_pools
+
+    def add_queue_wait(self, branch, seconds):
+        if self.queue_waits is None:
+            self.queue_waits = {}
+        waits = self.queue_waits.setdefault(branch, {'tasks': 0, 'total_wait_seconds': 0.0, 'max_wait_seconds': 0.0})
+        waits['tasks'] += 1
+        waits['total_wait_seconds'] += seconds
+        waits['max_wait_seconds'] = max(waits['max_wait_seconds'], seconds)
+
     def total_cpu_hours(self):
         return sum_ignore_none([child.cpu_hours() for child in self.children])
 
     def total_ram_megabyte_hours(self):
         return sum_ignore_none([child.ram_megabyte_hours() for child in self.children])
 
+    def total_used_cpu_hours(self):
+        return sum_ignore_none([child.used_cpu_hours() for child in self.children])
+
+    def total_used_ram_megabyte_hours(self):
+        return sum_ignore_none([child.used_ram_megabyte_hours() for child in self.children])
+
+    def total_gpu_hours(self):
+        return sum_ignore_none([child.gpu_hours() for child in self.children])
+
+    def is_usage_sampled(self):
+        return any(child.mean_cpus is not None or child.mean_ram_megabytes is not None for child in self.children)
+
+    def total_extended_resource_hours(self):
+        totals = {}
+        for child in self.children:
+            for name, hours in child.extended_resource_hours().items():
+                totals[name] = totals.get(name, 0) + hours
+        return totals
+
     def total_disk_megabytes(self):
         return sum_ignore_none([child.disk_megabytes for child in self.children])
 
@@ -308,6 +477,35 @@ class TimelineReport(TimedReport):
         self._walk(processor)
         return processor.result()
 
+    def resource_pool_usage(self, name, total):
+        """
+        Usage of a resource pool by the jobs admitted to it
+        :param name: name of the resource pool
+        :param total: dict of the total resources of the pool, see calrissian.executor.Resources.to_dict
+        :return: dict
+        """
+        pool_report = TimelineReport(total.get('cores', 0), total.get('ram', 0))
+        for child in self.children:
+            if (child.resource_pool or DEFAULT_POOL) == name:
+                pool_report.add_report(child)
+        result = {
+            'cores_allowed': pool_report.cores_allowed,
+            'ram_mb_allowed': pool_report.ram_mb_allowed,
+            'total_tasks': pool_report.total_tasks(),
+            'total_cpu_hours': pool_report.total_cpu_hours(),
+            'total_ram_megabyte_hours': pool_report.total_ram_megabyte_hours(),
+            'max_parallel_cpus': pool_report.max_parallel_cpus(),
+            'max_parallel_ram_megabytes': pool_report.max_parallel_ram_megabytes(),
+        }
+        # Utilization over the whole run, as the capacity of every pool is reserved for all of it
+        elapsed_hours = self.elapsed_hours()
+        if elapsed_hours and pool_report.cores_allowed:
+            result['cpu_utilization'] = result['total_cpu_hours'] / (pool_report.cores_allowed * elapsed_hours)
+        if elapsed_hours and pool_report.ram_mb_allowed:
+            result['ram_utilization'] = result['total_ram_megabyte_hours'] / (pool_report.ram_mb_allowed *
+                                                                              elapsed_hours)
+        return result
+
     def _recalculate_times(self):
         start_times = [c.start_time for c in self.children if c.start_time]
         if start_times:
@@ -330,11 +528,22 @@ class TimelineReport(TimedReport):
         result = super(TimelineReport, self).to_dict()
         result['total_cpu_hours'] = self.total_cpu_hours()
         result['total_ram_megabyte_hours'] = self.total_ram_megabyte_hours()
+        if self.is_usage_sampled():
+            result['total_used_cpu_hours'] = self.total_used_cpu_hours()
+            result['total_used_ram_megabyte_hours'] = self.total_used_ram_megabyte_hours()
+        if any(child.gpus is not None for child in self.children):
+            result['total_gpu_hours'] = self.total_gpu_hours()
+        total_extended_resource_hours = self.total_extended_resource_hours()
+        if total_extended_resource_hours:
+            result['total_extended_resource_hours'] = total_extended_resource_hours
         result['total_disk_megabytes'] = self.total_disk_megabytes()
         result['total_tasks'] = self.total_tasks()
         result['max_parallel_cpus'] = self.max_parallel_cpus()
         result['max_parallel_ram_megabytes'] = self.max_parallel_ram_megabytes()
         result['max_parallel_tasks'] = self.max_parallel_tasks()
+        if self.resource_pools:
+            result['resource_pools'] = {name: self.resource_pool_usage(name, total)
+                                        for name, total in self.resource_pools.items()}
         result['children'] = [x.to_dict() for x in self.children]
         return result
 
@@ -357,6 +566,46 @@ class Reporter(object):
         with Reporter.lock:
             Reporter.timeline_report.add_report(report)
 
+    @staticmethod
+    def add_cache_event(event):
+        with Reporter.lock:
+            Reporter.timeline_report.add_cache_event(event)
+
+    @staticmethod
+    def add_reference_cache_stats(stats):
+        with Reporter.lock:
+            Reporter.timeline_report.add_reference_cache_stats(stats)
+
+    @staticmethod
+    def add_image_pull(image_pull):
+        with Reporter.lock:
+            Reporter.timeline_report.add_image_pull(image_pull)
+
+    @staticmethod
+    def add_memory_escalation(escalation):
+        with Reporter.lock:
+            Reporter.timeline_report.add_memory_escalation(escalation)
+
+    @staticmethod
+    def set_memory_overcommit(memory_overcommit):
+        with Reporter.lock:
+            Reporter.timeline_report.set_memory_overcommit(memory_overcommit)
+
+    @staticmethod
+    def set_io_budget(io_budget):
+        with Reporter.lock:
+            Reporter.timeline_report.set_io_budget(io_budget)
+
+    @staticmethod
+    def set_resource_pools(resource_pools):
+        with Reporter.lock:
+            Reporter.timeline_report.set_resource_pools(resource_pools)
+
+    @staticmethod
+    def add_queue_wait(branch, seconds):
+        with Reporter.lock:
+            Reporter.timeline_report.add_queue_wait(branch, seconds)
+
     @staticmethod
     def get_report():
         with Reporter.lock:
@@ -1,4 +1,4 @@
-from tenacity import retry, wait_exponential, retry_if_exception, retry_if_exception_type, stop_after_attempt, before_sleep_log
+from tenacity import retry, Retrying, wait_exponential, retry_if_exception, retry_if_exception_type, stop_after_attempt, before_sleep_log
 import logging
 import os
 
@@ -33,3 +33,19 @@ def retry_exponential_if_exception_type(exc_type, logger):
             stop=stop_after_attempt(RetryParameters.ATTEMPTS),
             before_sleep=before_sleep_log(logger, logging.DEBUG),
             reraise=True)
+
+
+def retrying_exponential_if_exception_type(exc_type, attempts, logger):
+    """
+    Iterable counterpart of retry_exponential_if_exception_type, for blocks of code that change between attempts.
+    Iterate over the result and run each attempt in a `with attempt:` block.
+    :param exc_type: Type of exception (or tuple of types) to retry if encountered
+    :param attempts: Max number of attempts before giving up
+    :param logger: A logger instance to send retry logs to
+    :return: tenacity.Retrying
+    """
+    return Retrying(retry=retry_if_exception_type(exc_type),
+            wait=wait_exponential(multiplier=RetryParameters.MULTIPLIER, min=RetryParameters.MIN, max=RetryParameters.MAX),
+            stop=stop_after_attempt(attempts),
+            before_sleep=before_sleep_log(logger, logging.INFO),
+            reraise=True)
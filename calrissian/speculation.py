@@ -0,0 +1,219 @@
+import copy
+import logging
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from calrissian.executor import Resources
+from calrissian.k8s import KubernetesClient
+
+log = logging.getLogger('calrissian.speculation')
+
+# Interval between checks of a running step against its finished siblings
+SPECULATION_CHECK_SECONDS = 30
+
+# Steps with fewer finished siblings are never speculated
+MIN_FINISHED_SIBLINGS = 5
+
+# Fraction of the siblings of a step that must have finished before it is speculated
+DEFAULT_QUANTILE = 0.9
+
+
+def sibling_group(job):
+    """
+    cwltool names the jobs of a scattered step after the step, with a _<n> suffix to make them unique. Steps may end
+    in _<n> themselves, so the name the suffix was added to is kept as the step_name of the job.
+    :param job: a job, or any object with a name
+    :return: the name shared by the job and its siblings
+    """
+    step_name = getattr(job, 'step_name', None)
+    if isinstance(step_name, str) and step_name:
+        return step_name
+    return getattr(job, 'name', None)
+
+
+def avoid_node(pod, node_name):
+    """
+    Require the pod to be scheduled on a node other than node_name
+    :param pod: pod spec dict, modified in place
+    :param node_name: name of the node to avoid
+    """
+    pod['spec']['affinity'] = {
+        'nodeAffinity': {
+            'requiredDuringSchedulingIgnoredDuringExecution': {
+                'nodeSelectorTerms': [
+                    {'matchFields': [{'key': 'metadata.name', 'operator': 'NotIn', 'values': [node_name]}]}
+                ]
+            }
+        }
+    }
+
+
+class Speculator(object):
+    """
+    Singleton tracking the runtimes of the jobs of scattered steps, to run a duplicate of the stragglers.
+    A job is a straggler once most of its siblings have finished and it has been running for longer than
+    factor times their median runtime. Its siblings are counted when CalrissianCommandLineTool.job makes them, which
+    cwltool does for the whole scatter once the step is ready, so that the siblings still queued count too.
+    """
+    factor = None
+    quantile = DEFAULT_QUANTILE
+    # Sibling group to number of jobs made
+    made = {}
+    # Sibling group to runtimes of the finished jobs, in seconds
+    runtimes = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def initialize(factor, quantile=DEFAULT_QUANTILE):
+        with Speculator.lock:
+            Speculator.factor = factor
+            Speculator.quantile = quantile
+            Speculator.made = {}
+            Speculator.runtimes = {}
+
+    @staticmethod
+    def is_enabled():
+        return Speculator.factor is not None
+
+    @staticmethod
+    def add(group):
+        with Speculator.lock:
+            Speculator.made[group] = Speculator.made.get(group, 0) + 1
+
+    @staticmethod
+    def finish(group, seconds):
+        with Speculator.lock:
+            Speculator.runtimes.setdefault(group, []).append(seconds)
+
+    @staticmethod
+    def is_straggler(group, elapsed_seconds):
+        """
+        :param group: sibling group of a running job
+        :param elapsed_seconds: time since the job was submitted
+        :return: True if the job should be duplicated
+        """
+        with Speculator.lock:
+            runtimes = Speculator.runtimes.get(group, [])
+            if len(runtimes) < max(MIN_FINISHED_SIBLINGS, Speculator.quantile * Speculator.made.get(group, 0)):
+                return False
+            return elapsed_seconds > Speculator.factor * statistics.median(runtimes)
+
+    @staticmethod
+    def can_speculate(job):
+        """
+        The duplicate runs in its own outdir, which starts empty. Jobs that stage files in their outdir are not
+        speculated.
+        """
+        return job.generatemapper is None
+
+    @staticmethod
+    def speculate(job, pod, rsc, runtime_context):
+        """
+        Submit a duplicate of the pod of a job, with its own outdir, away from the node of the original pod.
+        A job with a scratch outdir copies its results back to its own outdir too.
+        The resources of the duplicate are reserved from the executor, if it has them available.
+        :param job: CalrissianCommandLineJob
+        :param pod: pod spec of the original pod
+        :param rsc: Resources of the duplicate
+        :return: (KubernetesClient, outdir) of the duplicate, or None if the executor is short of resources
+        """
+        if not runtime_context.reserve_resources(rsc, runtime_context, block=False, pool=job.resource_pool):
+            return None
+        try:
+            node_name = job.client.get_pod_for_name(pod['metadata']['name']).spec.node_name
+            outdir = tempfile.mkdtemp(prefix='{}-'.format(os.path.basename(job.outdir)),
+                                      dir=os.path.dirname(os.path.realpath(job.outdir)))
+            volume = job.volume_builder.find_persistent_volume(outdir)
+            duplicate = copy.deepcopy(job.build_kubernetes_pod(runtime_context))
+            # With a scratch outdir, the outdir on the shared volume is mounted where the results are copied back to
+            outdir_mount_path = job.copy_back_dir or job.builder.outdir
+            for volume_mount in duplicate['spec']['containers'][0]['volumeMounts']:
+                if volume_mount['mountPath'] == outdir_mount_path:
+                    volume_mount['subPath'] = job.volume_builder.calculate_subpath(outdir, volume['prefix'],
+                                                                                   volume['subPath'])
+            if node_name:
+                avoid_node(duplicate, node_name)
+            client = KubernetesClient()
+            client.submit_pod(duplicate)
+        except Exception:
+            runtime_context.release_resources(rsc, runtime_context, pool=job.resource_pool)
+            raise
+        log.info('Job {} is a straggler on node {}, duplicated in pod {}'.format(job.name, node_name,
+                                                                                duplicate['metadata']['name']))
+        return client, outdir
+
+    @staticmethod
+    def stop(client):
+        """
+        Delete the pod of a losing client, so that its wait_for_completion returns
+        """
+        pod = client.pod
+        if pod is not None:
+            client.delete_pod_name(pod.metadata.name)
+
+    @staticmethod
+    def race(job, pod, rsc, runtime_context, group, started):
+        """
+        Wait for the first of the original pod and its duplicate to complete, submitting the duplicate once
+        the job is a straggler. The loser is deleted and the resources of the duplicate are released.
+        :return: (CompletionResult, outdir) of the winner, and the outdir of the duplicate or None
+        """
+        speculative_outdir = None
+        try:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                pending = {pool.submit(job.wait_for_kubernetes_pod): (job.client, job.outdir)}
+                try:
+                    while True:
+                        done, _ = wait(pending, timeout=SPECULATION_CHECK_SECONDS, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            _, outdir = pending.pop(future)
+                            if future.exception() is None:
+                                return (future.result(), outdir), speculative_outdir
+                            if not pending:
+                                raise future.exception()
+                        if (speculative_outdir is None and Speculator.can_speculate(job)
+                                and Speculator.is_straggler(group, time.monotonic() - started)):
+                            speculative = Speculator.speculate(job, pod, rsc, runtime_context)
+                            if speculative is not None:
+                                client, speculative_outdir = speculative
+                                pending[pool.submit(client.wait_for_completion)] = speculative
+                finally:
+                    # Delete the loser, the pool then waits for its wait_for_completion to return
+                    for client, _ in pending.values():
+                        Speculator.stop(client)
+        except Exception:
+            if speculative_outdir is not None:
+                shutil.rmtree(speculative_outdir, True)
+            raise
+        finally:
+            if speculative_outdir is not None:
+                runtime_context.release_resources(rsc, runtime_context, pool=job.resource_pool)
+
+    @staticmethod
+    def wait(job, pod, runtime_context):
+        """
+        Wait for the submitted pod of a job. Once it straggles behind its siblings, race it against a duplicate.
+        The first pod to complete wins, the other one is deleted. If the duplicate wins, the job adopts its outdir.
+        :param job: CalrissianCommandLineJob whose pod was submitted
+        :param pod: pod spec of the submitted pod
+        :param runtime_context: CalrissianRuntimeContext, to reserve the resources of the duplicate
+        :return: CompletionResult of the winner
+        """
+        group = sibling_group(job)
+        started = time.monotonic()
+        (completion_result, outdir), speculative_outdir = Speculator.race(job, pod, Resources.from_job(job),
+                                                                          runtime_context, group, started)
+        if speculative_outdir is not None:
+            if outdir == speculative_outdir:
+                log.info('Job {} adopts the outdir of its duplicate {}'.format(job.name, speculative_outdir))
+                shutil.rmtree(job.outdir, True)
+                job.outdir = speculative_outdir
+            else:
+                shutil.rmtree(speculative_outdir, True)
+        Speculator.finish(group, time.monotonic() - started)
+        return completion_result
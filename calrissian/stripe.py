@@ -0,0 +1,69 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+log = logging.getLogger('calrissian.stripe')
+
+ROUND_ROBIN = 'round-robin'
+LEAST_USED = 'least-used'
+PLACEMENTS = [ROUND_ROBIN, LEAST_USED]
+
+
+class OutdirStriper(object):
+    """
+    Creates the output directories of jobs on several volumes mounted in the controller, e.g. PVCs of different
+    storage backends, so that the I/O of a large scatter is spread over them instead of limited by one volume.
+
+    Each prefix is a path like --tmp-outdir-prefix, on its own persistent volume. Outdirs go to the prefixes in turn
+    with ROUND_ROBIN, or to the prefix on the least used volume with LEAST_USED. Volumes used within a percent of
+    each other, like those of outdirs created together, are then taken in turn.
+    """
+
+    def __init__(self, prefixes, placement=ROUND_ROBIN):
+        """
+        :param prefixes: list of str, prefixes of the outdirs on each volume
+        :param placement: ROUND_ROBIN or LEAST_USED
+        """
+        if placement not in PLACEMENTS:
+            raise ValueError('Unknown outdir placement {}, expected one of {}'.format(placement, ', '.join(PLACEMENTS)))
+        self.prefixes = list(prefixes)
+        self.placement = placement
+        # Number of outdirs created with each prefix
+        self.placed = {prefix: 0 for prefix in self.prefixes}
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def used_percent(prefix):
+        """
+        :param prefix: prefix of outdirs
+        :return: int: the percent of the volume of the prefix in use
+        """
+        usage = shutil.disk_usage(os.path.dirname(prefix) or '.')
+        return int(100 * usage.used / usage.total) if usage.total else 0
+
+    def next_prefix(self):
+        """
+        :return: str, the prefix of the next outdir
+        """
+        with self.lock:
+            if self.placement == LEAST_USED:
+                used = {prefix: self.used_percent(prefix) for prefix in self.prefixes}
+                prefix = min(self.prefixes, key=lambda prefix: (used[prefix], self.placed[prefix]))
+            else:
+                prefix = self.prefixes[self.next_index % len(self.prefixes)]
+                self.next_index += 1
+            self.placed[prefix] += 1
+        return prefix
+
+    def create_outdir(self):
+        """
+        Create an outdir like cwltool.context.RuntimeContext.create_outdir, with the next prefix
+        :return: str, path of the new directory
+        """
+        out_dir, out_prefix = os.path.split(self.next_prefix())
+        outdir = tempfile.mkdtemp(prefix=out_prefix, dir=out_dir)
+        log.debug('Created outdir {}'.format(outdir))
+        return outdir
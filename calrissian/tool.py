@@ -1,11 +1,51 @@
 from cwltool.command_line_tool import CommandLineTool
+from cwltool.errors import WorkflowException
+from cwltool.process import shortname
 from cwltool.workflow import default_make_tool
 from calrissian.dask import CalrissianCommandLineDaskJob, dask_req_validate
 from calrissian.job import CalrissianCommandLineJob
+from calrissian.history import UsageHistory
+from calrissian.executor import Resources
+from calrissian.report import parse_resource_quantity, EPHEMERAL_STORAGE
+from calrissian.gpu import GPU_SHARE_REQUIREMENT, check_gpu_share, gpu_share_resources
+from calrissian.fairshare import FAIR_SHARE_REQUIREMENT
+from calrissian.concurrency import CONCURRENCY_REQUIREMENT
+from calrissian.iobudget import IO_CLASS_REQUIREMENT, IO_CLASS_WEIGHTS, DEFAULT_IO_CLASS
+from calrissian.speculation import Speculator
 import logging
+import math
 
 log = logging.getLogger("calrissian.tool")
 
+# Hint requesting Kubernetes resources other than cpu, memory and GPUs, e.g.
+#   calrissian:ExtendedResources:
+#     resources: {hugepages-2Mi: 512Mi, example.com/fpga: 1}
+EXTENDED_RESOURCES_REQUIREMENT = 'https://calrissian-cwl.github.io/schema#ExtendedResources'
+
+# Hint mounting /tmp as a tmpfs the size of tmpdirMin, or not with enabled: false when --memory-tmpdir is set, e.g.
+#   calrissian:MemoryTmpdir:
+#     enabled: true
+MEMORY_TMPDIR_REQUIREMENT = 'https://calrissian-cwl.github.io/schema#MemoryTmpdir'
+
+
+def memory_tmpdir_resources(resources):
+    """
+    Move the tmpdirSize of a job from its disk to its memory: a tmpfs is counted in the memory of the pod, so it is
+    added to the request and limit of ram, and taken out of any ephemeral-storage request
+    :param resources: dict of the job's resources, as selected by ThreadPoolJobExecutor.select_resources
+    :return: (dict, int): a copy of resources, and the size of the tmpfs in MiB
+    """
+    size_megabytes = int(math.ceil(resources.get('tmpdirSize') or 0))
+    resources = dict(resources)
+    resources['ram'] = resources['ram'] + size_megabytes
+    if resources.get('ramMax') is not None:
+        resources['ramMax'] = resources['ramMax'] + size_megabytes
+    extended = resources.get(Resources.EXTENDED) or {}
+    if EPHEMERAL_STORAGE in extended:
+        resources[Resources.EXTENDED] = dict(extended, **{
+            EPHEMERAL_STORAGE: max(0, extended[EPHEMERAL_STORAGE] - size_megabytes)})
+    return resources, size_megabytes
+
 
 class CalrissianCommandLineToolException(BaseException):
     pass
@@ -13,6 +53,10 @@ class CalrissianCommandLineToolException(BaseException):
 
 class CalrissianCommandLineTool(CommandLineTool):
 
+    # Set by calrissian.fusion.fuse_linear_chains() on the tools of fused workflow steps
+    fuse_downstream = False
+    fused_upstream = False
+
     def make_job_runner(self, runtimeContext):
         """
         Construct a callable that can run a CommandLineTool
@@ -56,6 +100,120 @@ class CalrissianCommandLineTool(CommandLineTool):
         
         return CalrissianCommandLineJob
 
+    def extended_resources(self):
+        """
+        :return: dict of the Kubernetes resources requested by the ExtendedResources hint to their amounts, see
+        calrissian.report.parse_resource_quantity
+        """
+        requirement, _ = self.get_requirement(EXTENDED_RESOURCES_REQUIREMENT)
+        if not requirement:
+            return {}
+        return {name: parse_resource_quantity(name, quantity)
+                for name, quantity in (requirement.get('resources') or {}).items()}
+
+    def gpu_share(self):
+        """
+        :return: dict of the GPUShare hint, or None
+        """
+        requirement, _ = self.get_requirement(GPU_SHARE_REQUIREMENT)
+        return requirement
+
+    def concurrency(self):
+        """
+        :return: (group, limit) of the Concurrency requirement, the group defaulting to the id of the tool, or
+        (None, None) without it
+        """
+        requirement, _ = self.get_requirement(CONCURRENCY_REQUIREMENT)
+        if not requirement:
+            return None, None
+        limit = int(requirement['maxConcurrency'])
+        if limit < 1:
+            raise WorkflowException('Concurrency maxConcurrency must be at least 1, got {}'.format(limit))
+        return requirement.get('group') or self.tool.get('id'), limit
+
+    def io_weight(self):
+        """
+        :return: the weight of the IOClass requirement, from its weight or its ioClass, or 0 without it
+        """
+        requirement, _ = self.get_requirement(IO_CLASS_REQUIREMENT)
+        if not requirement:
+            return 0
+        if requirement.get('weight') is not None:
+            weight = requirement['weight']
+            if weight < 0:
+                raise WorkflowException('IOClass weight must not be negative, got {}'.format(weight))
+            return weight
+        io_class = requirement.get('ioClass', DEFAULT_IO_CLASS)
+        if io_class not in IO_CLASS_WEIGHTS:
+            raise WorkflowException('IOClass ioClass must be one of {}, got {}'.format(
+                ', '.join(IO_CLASS_WEIGHTS), io_class))
+        return IO_CLASS_WEIGHTS[io_class]
+
+    def memory_tmpdir(self, runtimeContext):
+        """
+        :return: bool: whether the /tmp of the jobs is a tmpfs, from the MemoryTmpdir hint, or --memory-tmpdir
+        without it
+        """
+        requirement, _ = self.get_requirement(MEMORY_TMPDIR_REQUIREMENT)
+        if requirement is not None:
+            return bool(requirement.get('enabled', True))
+        return bool(runtimeContext.memory_tmpdir)
+
+    def job(self, job_order, output_callbacks, runtimeContext):
+        """
+        Yield the jobs of the base CommandLineTool, providing them with the tool document they were made from.
+        When right-sizing, their requests are set from the usage history of the tool. The command line is built by
+        then, so $(runtime.cores) and $(runtime.ram) keep the values of the ResourceRequirement.
+        The resources of the ExtendedResources hint are added to their requests, and the GPUShare hint replaces
+        their whole GPUs with a share of a time-sliced GPU or MIG partitions. The FairShare hint sets their weight in
+        the fair-share queue, the Concurrency requirement the group they are capped with, and the IOClass requirement
+        their weight in the I/O budget. With a memory tmpdir, its size is added to their RAM before right-sizing,
+        whose recorded peaks include the tmpfs.
+        """
+        extended_resources = self.extended_resources()
+        gpu_share = self.gpu_share()
+        fair_share, _ = self.get_requirement(FAIR_SHARE_REQUIREMENT)
+        concurrency_group, concurrency_limit = self.concurrency()
+        io_weight = self.io_weight()
+        memory_tmpdir = self.memory_tmpdir(runtimeContext)
+        if gpu_share:
+            check_gpu_share(gpu_share, runtimeContext)
+        # As named by CommandLineTool.job
+        step_name = runtimeContext.name or shortname(self.tool.get('id', 'job'))
+        for job in super(CalrissianCommandLineTool, self).job(job_order, output_callbacks, runtimeContext):
+            if isinstance(job, CalrissianCommandLineJob):
+                if extended_resources:
+                    resources = dict(job.builder.resources)
+                    resources[Resources.EXTENDED] = dict(resources.get(Resources.EXTENDED) or {}, **extended_resources)
+                    job.builder.resources = resources
+                if gpu_share:
+                    job.builder.resources = gpu_share_resources(job.builder.resources, gpu_share,
+                                                                runtimeContext.gpu_slices)
+                if fair_share:
+                    job.fair_share_weight = float(fair_share.get('weight', 1.0))
+                if concurrency_group is not None:
+                    job.concurrency_group = concurrency_group
+                    job.concurrency_limit = concurrency_limit
+                if io_weight:
+                    job.io_weight = io_weight
+                if runtimeContext.scratch_outdir:
+                    # Jobs of a batch would share the scratch volume
+                    job.batchable = False
+                if memory_tmpdir:
+                    job.builder.resources, job.memory_tmpdir_megabytes = memory_tmpdir_resources(job.builder.resources)
+                    # Jobs of a batch would share the tmpfs
+                    job.batchable = False
+                job.tool_document = self.tool
+                job.step_name = step_name
+                job.step_path = runtimeContext.step_path
+                if Speculator.is_enabled():
+                    Speculator.add(step_name)
+                job.fuse_downstream = self.fuse_downstream
+                job.fused_upstream = self.fused_upstream
+                if UsageHistory.is_right_sizing():
+                    job.builder.resources = UsageHistory.right_size(job.usage_history_key(), job.builder.resources)
+            yield job
+
 
 def calrissian_make_tool(spec, loadingContext):
     """
@@ -0,0 +1,442 @@
+import os
+import tempfile
+from datetime import datetime, timezone
+from unittest import TestCase
+from unittest.mock import Mock, patch, call
+
+from calrissian.batch import scale_resources, job_script, batch_pod_body, indexed_job_body, mount_conflicts, read_status
+from calrissian.batch import JobBatch, IndexedJobBatch, JobBatcher, BATCH_STATUS_ROOT, BATCH_STATUS_FILENAME
+from calrissian.batch import INDEXED_JOB_BACKEND, INDEXED_JOB_RETRIES, COMPLETION_INDEX_ANNOTATION
+from calrissian.concurrency import ConcurrencyLimits
+from calrissian.executor import JobResourceQueue, Resources
+from calrissian.job import CalrissianCommandLineJob
+
+
+def make_pod(name, index, args='echo hello > out.txt', init_command=None):
+    pod = {
+        'metadata': {'name': name, 'labels': {'app': 'calrissian'}},
+        'apiVersion': 'v1',
+        'kind': 'Pod',
+        'spec': {
+            'initContainers': [],
+            'containers': [{
+                'name': '{}-container'.format(name),
+                'image': 'debian:stable',
+                'command': ['/bin/sh', '-c'],
+                'args': [args],
+                'env': [{'name': 'HOME', 'value': '/out{}'.format(index)}],
+                'resources': {'requests': {'cpu': '1', 'memory': '512Mi'}, 'limits': {'cpu': '0.5'}},
+                'volumeMounts': [
+                    {'name': 'claim1', 'mountPath': '/out{}'.format(index), 'subPath': 'out{}'.format(index),
+                     'readOnly': False},
+                    {'name': 'tmpdir', 'mountPath': '/tmp'},
+                    {'name': 'claim1', 'mountPath': '{}/{}'.format(BATCH_STATUS_ROOT, index),
+                     'subPath': 'status{}'.format(index), 'readOnly': False},
+                ],
+                'workingDir': '/out{}'.format(index),
+            }],
+            'restartPolicy': 'Never',
+            'volumes': [
+                {'name': 'claim1', 'persistentVolumeClaim': {'claimName': 'claim1', 'readOnly': False}},
+                {'name': 'tmpdir', 'emptyDir': {}},
+            ],
+            'nodeSelector': {},
+        }
+    }
+    if init_command:
+        pod['spec']['initContainers'].append({'name': 'init', 'command': ['/bin/sh', '-c', init_command]})
+    return pod
+
+
+def make_job(name='step1', resources=None, tool_document=None, image='debian:stable', cuda=False):
+    job = Mock(spec=CalrissianCommandLineJob)
+    job.name = name
+    job.batchable = True
+    job.fuse_downstream = False
+    job.fused_upstream = False
+    job.timelimit = None
+    job.reference_cache_entries = []
+    job.tool_document = tool_document or {'id': 'tool1'}
+    job.builder = Mock(resources=resources or {'cores': 1, 'ram': 512})
+    job.volume_builder = Mock()
+    job._get_container_image.return_value = image
+    job.get_requirement.return_value = ({'cudaDeviceCountMin': 1}, True) if cuda else (None, False)
+    return job
+
+
+class ScaleResourcesTestCase(TestCase):
+
+    def test_scales_cpu_and_memory(self):
+        scaled = scale_resources({'requests': {'cpu': '1', 'memory': '512Mi'}, 'limits': {'cpu': '0.5'}}, 3)
+        self.assertEqual(scaled, {'requests': {'cpu': '3', 'memory': '1536Mi'}, 'limits': {'cpu': '1.5'}})
+
+    def test_keeps_other_resources(self):
+        resources = {'limits': {'nvidia.com/gpu': '1'}}
+        self.assertEqual(scale_resources(resources, 2), resources)
+
+
+class JobScriptTestCase(TestCase):
+
+    def test_script(self):
+        script = job_script(make_pod('pod1', 0, init_command='mkdir -p logs;'), '/status/0')
+        self.assertEqual(script.split('\n'), [
+            '(',
+            'set -e',
+            'export HOME=/out0',
+            'cd /out0',
+            'mkdir -p logs;',
+            'set +e',
+            'start=$(date +%s)',
+            'echo hello > out.txt',
+            'echo "$? $start $(date +%s)" > /status/0',
+            ')',
+        ])
+
+
+class BatchPodBodyTestCase(TestCase):
+
+    def setUp(self):
+        self.pods = [(make_pod('pod{}'.format(i), i), '/status/{}'.format(i)) for i in range(3)]
+
+    def test_combines_volumes(self):
+        body = batch_pod_body(self.pods, 1)
+        self.assertTrue(body['metadata']['name'].startswith('pod0-batch-'))
+        self.assertEqual([v['name'] for v in body['spec']['volumes']], ['claim1', 'tmpdir'])
+        volume_mounts = body['spec']['containers'][0]['volumeMounts']
+        self.assertEqual(sorted(m['mountPath'] for m in volume_mounts),
+                         sorted(['/out0', '/out1', '/out2', '/tmp'] +
+                                ['{}/{}'.format(BATCH_STATUS_ROOT, i) for i in range(3)]))
+        self.assertNotIn('env', body['spec']['containers'][0])
+        self.assertNotIn('initContainers', body['spec'])
+
+    def test_sequential(self):
+        body = batch_pod_body(self.pods, 1)
+        container = body['spec']['containers'][0]
+        self.assertEqual(container['resources'], {'requests': {'cpu': '1', 'memory': '512Mi'}, 'limits': {'cpu': '0.5'}})
+        self.assertEqual(container['args'], ['\n'.join(job_script(pod, path) for pod, path in self.pods)])
+
+    def test_parallel(self):
+        body = batch_pod_body(self.pods, 2)
+        container = body['spec']['containers'][0]
+        self.assertEqual(container['resources']['requests'], {'cpu': '2', 'memory': '1024Mi'})
+        scripts = [job_script(pod, path) + ' &' for pod, path in self.pods]
+        self.assertEqual(container['args'], ['\n'.join([scripts[0], scripts[1], 'wait', scripts[2], 'wait'])])
+
+
+class IndexedJobBodyTestCase(TestCase):
+
+    def test_indexed_job_body(self):
+        pods = [(make_pod('pod{}'.format(i), i), '/status/{}'.format(i)) for i in range(3)]
+        body = indexed_job_body(pods, 2)
+        self.assertEqual(body['kind'], 'Job')
+        self.assertTrue(body['metadata']['name'].startswith('calrissian-batch-'))
+        self.assertEqual(body['spec']['completionMode'], 'Indexed')
+        self.assertEqual((body['spec']['completions'], body['spec']['parallelism']), (3, 2))
+        self.assertEqual(body['spec']['backoffLimitPerIndex'], INDEXED_JOB_RETRIES)
+        self.assertEqual(body['spec']['template']['metadata'], {'labels': {'app': 'calrissian'}})
+        pod_spec = body['spec']['template']['spec']
+        self.assertEqual(pod_spec['restartPolicy'], 'Never')
+        self.assertEqual([v['name'] for v in pod_spec['volumes']], ['claim1', 'tmpdir'])
+        container = pod_spec['containers'][0]
+        # Each index runs in its own pod, with the resources of a single job
+        self.assertEqual(container['resources']['requests'], {'cpu': '1', 'memory': '512Mi'})
+        self.assertEqual(container['args'], ['\n'.join(
+            ['case "$JOB_COMPLETION_INDEX" in'] +
+            ['{})\n{}\n;;'.format(i, job_script(pod, path)) for i, (pod, path) in enumerate(pods)] +
+            ['esac'])])
+
+
+class MountConflictsTestCase(TestCase):
+
+    def test_mount_conflicts(self):
+        volume_mounts = make_pod('pod0', 0)['spec']['containers'][0]['volumeMounts']
+        self.assertFalse(mount_conflicts(make_pod('pod1', 1), volume_mounts))
+        conflicting = make_pod('pod1', 1)
+        conflicting['spec']['containers'][0]['volumeMounts'][0]['mountPath'] = '/out0'
+        self.assertTrue(mount_conflicts(conflicting, volume_mounts))
+
+
+class ReadStatusTestCase(TestCase):
+
+    def setUp(self):
+        self.status_path = os.path.join(tempfile.mkdtemp(), BATCH_STATUS_FILENAME)
+
+    def test_read_status(self):
+        with open(self.status_path, 'w') as f:
+            f.write('2 1600000000 1600000060\n')
+        self.assertEqual(read_status(self.status_path), (
+            2, datetime(2020, 9, 13, 12, 26, 40, tzinfo=timezone.utc), datetime(2020, 9, 13, 12, 27, 40, tzinfo=timezone.utc)))
+
+    def test_read_status_without_times(self):
+        with open(self.status_path, 'w') as f:
+            f.write('0  \n')
+        self.assertEqual(read_status(self.status_path), (0, None, None))
+
+    def test_read_missing_status(self):
+        self.assertEqual(read_status(self.status_path), (None, None, None))
+
+
+class BatchTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.runtime_context = Mock()
+        self.batcher = Mock()
+
+    def make_batch_job(self, index):
+        job = make_job('step{}'.format(index))
+        job.tmpdir = self.tmpdir
+        job.resume_from_journal.return_value = False
+        job.restore_from_step_cache.return_value = False
+        job.create_kubernetes_runtime.return_value = make_pod('pod{}'.format(index), index)
+        return job
+
+    def make_batch_result(self, exit_code=0):
+        return Mock(exit_code=exit_code, start_time='start', finish_time='finish', tool_log=[], node_selectors={})
+
+    def write_status(self, job, content):
+        status_dir = job.volume_builder.add_volume_binding.call_args[0][0]
+        with open(os.path.join(status_dir, BATCH_STATUS_FILENAME), 'w') as f:
+            f.write(content)
+
+
+@patch('calrissian.batch.KubernetesClient')
+class JobBatchTestCase(BatchTestCase):
+
+    def test_run(self, mock_client):
+        jobs = [self.make_batch_job(0), self.make_batch_job(1)]
+        batch = JobBatch(jobs, 'key', 1, self.batcher)
+
+        def wait_for_completion():
+            self.write_status(jobs[0], '0 1600000000 1600000010\n')
+            self.write_status(jobs[1], '3 1600000010 1600000030\n')
+            return self.make_batch_result(3)
+        mock_client.return_value.wait_for_completion.side_effect = wait_for_completion
+
+        batch.run(self.runtime_context)
+        for index, job in enumerate(jobs):
+            self.assertEqual(job.prepare_run.call_args, call(self.runtime_context, None))
+            self.assertEqual(job.volume_builder.add_volume_binding.call_args[0][1:],
+                             ('{}/{}'.format(BATCH_STATUS_ROOT, index), ))
+            self.assertEqual(job.volume_builder.add_volume_binding.call_args[1], {'writable': True})
+        body = mock_client.return_value.submit_pod.call_args[0][0]
+        self.assertTrue(body['metadata']['name'].startswith('pod0-batch-'))
+        results = [job.finish.call_args[0][0] for job in jobs]
+        self.assertEqual([r.exit_code for r in results], [0, 3])
+        self.assertEqual([r.cpus for r in results], ['1', '1'])
+        self.assertEqual([r.memory for r in results], ['512Mi', '512Mi'])
+        self.assertEqual((results[1].finish_time - results[1].start_time).total_seconds(), 20)
+        self.assertEqual(self.batcher.record.mock_calls, [call('key', 10), call('key', 20)])
+
+    def test_run_without_status(self, mock_client):
+        job = self.make_batch_job(0)
+        mock_client.return_value.wait_for_completion.return_value = self.make_batch_result(137)
+        JobBatch([job], 'key', 1, self.batcher).run(self.runtime_context)
+        result = job.finish.call_args[0][0]
+        self.assertEqual(result.exit_code, 137)
+        self.assertEqual((result.start_time, result.finish_time), ('start', 'finish'))
+        self.assertFalse(self.batcher.record.called)
+
+    def test_run_skips_resumed_and_cached_jobs(self, mock_client):
+        resumed, cached = self.make_batch_job(0), self.make_batch_job(1)
+        resumed.resume_from_journal.return_value = True
+        cached.restore_from_step_cache.return_value = True
+        JobBatch([resumed, cached], 'key', 1, self.batcher).run(self.runtime_context)
+        self.assertFalse(resumed.prepare_run.called)
+        self.assertFalse(cached.create_kubernetes_runtime.called)
+        self.assertFalse(mock_client.return_value.submit_pod.called)
+
+    def test_run_conflicting_job_in_own_pod(self, mock_client):
+        jobs = [self.make_batch_job(0), self.make_batch_job(1)]
+        jobs[1].create_kubernetes_runtime.return_value = make_pod('pod1', 1)
+        jobs[1].create_kubernetes_runtime.return_value['spec']['containers'][0]['volumeMounts'][0]['mountPath'] = '/out0'
+        mock_client.return_value.wait_for_completion.return_value = self.make_batch_result()
+        JobBatch(jobs, 'key', 1, self.batcher).run(self.runtime_context)
+        self.assertEqual(jobs[1].run_kubernetes_pod.call_args, call(jobs[1].create_kubernetes_runtime.return_value,
+                                                                    self.runtime_context))
+        self.assertEqual(jobs[1].finish.call_args, call(jobs[1].run_kubernetes_pod.return_value, self.runtime_context))
+        self.assertFalse(jobs[0].run_kubernetes_pod.called)
+        self.assertTrue(jobs[0].finish.called)
+
+    def test_run_job_with_reference_cache_in_own_pod(self, mock_client):
+        jobs = [self.make_batch_job(0), self.make_batch_job(1)]
+        jobs[1].reference_cache_entries = [('key', '/refs/genome.fa')]
+        mock_client.return_value.wait_for_completion.return_value = self.make_batch_result()
+        JobBatch(jobs, 'key', 1, self.batcher).run(self.runtime_context)
+        self.assertEqual(jobs[1].run_kubernetes_pod.call_args, call(jobs[1].create_kubernetes_runtime.return_value,
+                                                                    self.runtime_context))
+        self.assertFalse(jobs[0].run_kubernetes_pod.called)
+
+
+@patch('calrissian.batch.KubernetesClient')
+class IndexedJobBatchTestCase(BatchTestCase):
+
+    def make_job_pod(self, name, index):
+        pod = Mock(metadata=Mock(annotations={COMPLETION_INDEX_ANNOTATION: str(index)}))
+        pod.metadata.name = name
+        return pod
+
+    def tearDown(self):
+        IndexedJobBatch.job_names = []
+
+    def test_run(self, mock_client):
+        jobs = [self.make_batch_job(0), self.make_batch_job(1)]
+        k8s_job = Mock(status=Mock(succeeded=1, start_time='start', completion_time='finish'))
+
+        def wait_for_job(name):
+            self.assertEqual(IndexedJobBatch.job_names, [name])
+            self.write_status(jobs[0], '0 1600000000 1600000010\n')
+            return k8s_job
+        mock_client.return_value.wait_for_job.side_effect = wait_for_job
+        mock_client.return_value.list_pods_for_selector.return_value = [
+            self.make_job_pod('pod-0', 0), self.make_job_pod('pod-1-retried', 1), self.make_job_pod('pod-1', 1)]
+        mock_client.return_value.read_pod_log.side_effect = lambda name: [name]
+
+        IndexedJobBatch(jobs, 'key', 2, self.batcher).run(self.runtime_context)
+        body = mock_client.return_value.create_job.call_args[0][0]
+        name = body['metadata']['name']
+        self.assertEqual(body['spec']['parallelism'], 2)
+        self.assertEqual(mock_client.return_value.list_pods_for_selector.call_args, call('job-name={}'.format(name)))
+        self.assertEqual(mock_client.return_value.delete_job_name.call_args, call(name))
+        self.assertEqual(IndexedJobBatch.job_names, [])
+        results = [job.finish.call_args[0][0] for job in jobs]
+        # The pod of the second job failed without a status
+        self.assertEqual([r.exit_code for r in results], [0, 1])
+        self.assertEqual([r.tool_log for r in results], [['pod-0'], ['pod-1-retried', 'pod-1']])
+        self.assertEqual((results[1].start_time, results[1].finish_time), ('start', 'finish'))
+
+    def test_run_deletes_job_on_error(self, mock_client):
+        mock_client.return_value.wait_for_job.side_effect = Exception('Watch failed')
+        with self.assertRaisesRegex(Exception, 'Watch failed'):
+            IndexedJobBatch([self.make_batch_job(0)], 'key', 1, self.batcher).run(self.runtime_context)
+        self.assertTrue(mock_client.return_value.delete_job_name.called)
+        self.assertEqual(IndexedJobBatch.job_names, [])
+
+    def test_cleanup(self, mock_client):
+        IndexedJobBatch.job_names = ['job-1', 'job-2']
+        IndexedJobBatch.cleanup()
+        self.assertEqual(mock_client.return_value.delete_job_name.mock_calls, [call('job-1'), call('job-2')])
+        self.assertEqual(IndexedJobBatch.job_names, [])
+
+    def test_cleanup_without_jobs(self, mock_client):
+        IndexedJobBatch.cleanup()
+        self.assertFalse(mock_client.called)
+
+
+class JobBatcherTestCase(TestCase):
+
+    def setUp(self):
+        self.batcher = JobBatcher(max_size=3, target_seconds=60, parallelism=2)
+
+    def test_batch_key(self):
+        key = JobBatcher.batch_key(make_job())
+        self.assertEqual(JobBatcher.batch_key(make_job('step2')), key)
+        self.assertNotEqual(JobBatcher.batch_key(make_job(tool_document={'id': 'tool2'})), key)
+        self.assertNotEqual(JobBatcher.batch_key(make_job(image='python:3')), key)
+        self.assertNotEqual(JobBatcher.batch_key(make_job(resources={'cores': 2, 'ram': 512})), key)
+
+    def test_batch_key_of_unbatchable_jobs(self):
+        self.assertIsNone(JobBatcher.batch_key(Mock()))
+        self.assertIsNone(JobBatcher.batch_key(make_job(cuda=True)))
+        job = make_job()
+        job.batchable = False
+        self.assertIsNone(JobBatcher.batch_key(job))
+        job = make_job()
+        job.fused_upstream = True
+        self.assertIsNone(JobBatcher.batch_key(job))
+        job = make_job()
+        job.timelimit = 60
+        self.assertIsNone(JobBatcher.batch_key(job))
+        job = make_job()
+        job._get_container_image.side_effect = Exception('No image')
+        self.assertIsNone(JobBatcher.batch_key(job))
+
+    def test_batch_size(self):
+        self.assertEqual(self.batcher.batch_size('key'), 3)
+        self.batcher.record('key', 40)
+        self.batcher.record('key', 60)
+        self.assertEqual(self.batcher.batch_size('key'), 2)
+        self.batcher.record('key', 500)
+        self.assertEqual(self.batcher.batch_size('key'), 1)
+
+    def test_batch(self):
+        jrq = JobResourceQueue()
+        jobs = [make_job('step{}'.format(i)) for i in range(4)]
+        other = make_job('other', image='python:3')
+        for job in jobs + [other]:
+            jrq.enqueue(job)
+        self.batcher.batch(jrq, Resources(4096, 8))
+        batches = [job for job in jrq.jobs if isinstance(job, JobBatch)]
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0].jobs, jobs[:3])
+        self.assertEqual(batches[0].parallelism, 2)
+        self.assertEqual(jrq.jobs[batches[0]], Resources(1024, 2))
+        # Single jobs are left alone
+        self.assertIn(jobs[3], jrq.jobs)
+        self.assertIn(other, jrq.jobs)
+
+    def test_batch_within_concurrency_limit(self):
+        jrq = JobResourceQueue()
+        for i in range(3):
+            job = make_job('step{}'.format(i))
+            job.concurrency_group, job.concurrency_limit = 'tool1', 1
+            jrq.enqueue(job)
+        self.batcher.batch(jrq, Resources(4096, 8))
+        self.assertEqual(list(jrq.jobs)[0].parallelism, 1)
+
+    def test_batch_fits_total_resources(self):
+        jrq = JobResourceQueue()
+        for i in range(2):
+            jrq.enqueue(make_job('step{}'.format(i)))
+        self.batcher.batch(jrq, Resources(1000, 8))
+        batch = list(jrq.jobs)[0]
+        self.assertEqual(batch.parallelism, 1)
+        self.assertEqual(jrq.jobs[batch], Resources(512, 1))
+
+    def test_batch_indexed_jobs(self):
+        batcher = JobBatcher(max_size=3, backend=INDEXED_JOB_BACKEND)
+        jrq = JobResourceQueue()
+        for i in range(2):
+            jrq.enqueue(make_job('step{}'.format(i)))
+        batcher.batch(jrq, Resources(4096, 8))
+        batch = list(jrq.jobs)[0]
+        self.assertIsInstance(batch, IndexedJobBatch)
+        # Queued with the resources of a single pod, widened when dequeued
+        self.assertEqual(batch.parallelism, 1)
+        self.assertEqual(jrq.jobs[batch], Resources(512, 1))
+
+    def test_widen(self):
+        batch = IndexedJobBatch([make_job('step{}'.format(i)) for i in range(3)], 'key', 1, self.batcher)
+        rsc, spare = JobBatcher.widen(batch, Resources(512, 1), Resources(2048, 8), [])
+        self.assertEqual(batch.parallelism, 3)
+        self.assertEqual((rsc, spare), (Resources(1536, 3), Resources(1024, 6)))
+
+    def test_widen_to_spare_resources(self):
+        batch = IndexedJobBatch([make_job('step{}'.format(i)) for i in range(3)], 'key', 1, self.batcher)
+        rsc, spare = JobBatcher.widen(batch, Resources(512, 1), Resources(600, 8), [])
+        self.assertEqual(batch.parallelism, 2)
+        self.assertEqual((rsc, spare), (Resources(1024, 2), Resources(88, 7)))
+
+    def test_widen_within_concurrency_limit(self):
+        ConcurrencyLimits.reset()
+        self.addCleanup(ConcurrencyLimits.reset)
+        jobs = [make_job('step{}'.format(i)) for i in range(3)]
+        for job in jobs:
+            job.concurrency_group, job.concurrency_limit = 'tool1', 3
+        other = make_job('other')
+        other.concurrency_group, other.concurrency_limit = 'tool1', 3
+        batch = IndexedJobBatch(jobs, 'key', 1, self.batcher)
+        rsc, spare = JobBatcher.widen(batch, Resources(512, 1), Resources(4096, 8), [other])
+        self.assertEqual(batch.parallelism, 2)
+        self.assertEqual((rsc, spare), (Resources(1024, 2), Resources(3584, 7)))
+
+    def test_widen_keeps_pod_batches(self):
+        batch = JobBatch([make_job(), make_job()], 'key', 1, self.batcher)
+        self.assertEqual(JobBatcher.widen(batch, Resources(512, 1), Resources(4096, 8), []),
+                         (Resources(512, 1), Resources(4096, 8)))
+        self.assertEqual(batch.parallelism, 1)
+
+    def test_members(self):
+        jobs = [make_job(), make_job()]
+        self.assertEqual(JobBatcher.members(JobBatch(jobs, 'key', 1, self.batcher)), jobs)
+        self.assertEqual(JobBatcher.members(jobs[0]), [jobs[0]])
@@ -0,0 +1,173 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch, call
+
+from calrissian.cache import StepCache, normalize, file_fingerprint, directory_fingerprint, cache_key, copy_tree, tree_size
+
+
+class NormalizeTestCase(TestCase):
+
+    def test_replaces_placeholders(self):
+        placeholders = {'/AbCdEf': '$(runtime.outdir)'}
+        self.assertEqual(normalize(['ls', '/AbCdEf/out.txt'], placeholders), ['ls', '$(runtime.outdir)/out.txt'])
+
+    def test_replaces_staging_dirs(self):
+        value = '/var/lib/cwl/stg0e8f1f8e-4c5b-4d0a-9b5e-6f7e8d9c0a1b/input.txt'
+        self.assertEqual(normalize(value, {}), '/var/lib/cwl/stg/input.txt')
+
+    def test_normalizes_dicts(self):
+        placeholders = {'/AbCdEf': '$(runtime.outdir)'}
+        self.assertEqual(normalize({'HOME': '/AbCdEf', 'count': 3}, placeholders),
+                         {'HOME': '$(runtime.outdir)', 'count': 3})
+
+    def test_leaves_none(self):
+        self.assertIsNone(normalize(None, {'/AbCdEf': '$(runtime.outdir)'}))
+
+
+class FingerprintTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'file.txt')
+        with open(self.path, 'w') as f:
+            f.write('12345')
+        os.utime(self.path, (1000, 1000))
+
+    def test_file_fingerprint_mtime(self):
+        self.assertEqual(file_fingerprint(self.path), [5, 1000000])
+
+    def test_file_fingerprint_checksum(self):
+        self.assertEqual(file_fingerprint(self.path, 'sha1$abc'), [5, 'sha1$abc'])
+
+    def test_directory_fingerprint(self):
+        self.assertEqual(directory_fingerprint(self.tmpdir), [['file.txt', 5, 1000000]])
+
+    def test_cache_key_is_stable(self):
+        self.assertEqual(cache_key({'a': 1, 'b': [1, 2]}), cache_key({'b': [1, 2], 'a': 1}))
+        self.assertNotEqual(cache_key({'a': 1}), cache_key({'a': 2}))
+
+
+class CopyTreeTestCase(TestCase):
+
+    def test_copy_tree(self):
+        src = tempfile.mkdtemp()
+        os.makedirs(os.path.join(src, 'sub'))
+        with open(os.path.join(src, 'sub', 'file.txt'), 'w') as f:
+            f.write('12345')
+        os.utime(os.path.join(src, 'sub', 'file.txt'), (1000, 1000))
+        dst = os.path.join(tempfile.mkdtemp(), 'dst')
+        copy_tree(src, dst)
+        with open(os.path.join(dst, 'sub', 'file.txt')) as f:
+            self.assertEqual(f.read(), '12345')
+        self.assertEqual(tree_size(dst), 5)
+        self.assertEqual(os.path.getmtime(os.path.join(dst, 'sub', 'file.txt')), 1000)
+
+    def test_copy_tree_does_not_share_files(self):
+        src = tempfile.mkdtemp()
+        with open(os.path.join(src, 'file.txt'), 'w') as f:
+            f.write('12345')
+        dst = tempfile.mkdtemp()
+        copy_tree(src, dst)
+        # Rewritten in place by a downstream step
+        with open(os.path.join(dst, 'file.txt'), 'r+') as f:
+            f.write('67890')
+        with open(os.path.join(src, 'file.txt')) as f:
+            self.assertEqual(f.read(), '12345')
+
+
+@patch('calrissian.cache.Reporter')
+class StepCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.cache_dir = os.path.join(tempfile.mkdtemp(), 'cache')
+        StepCache.initialize(self.cache_dir)
+
+    def tearDown(self):
+        StepCache.directory = None
+        StepCache.max_bytes = None
+        StepCache.pinned = {}
+
+    def make_outdir(self, size):
+        outdir = tempfile.mkdtemp()
+        with open(os.path.join(outdir, 'output.txt'), 'w') as f:
+            f.write('x' * size)
+        return outdir
+
+    def test_initialize_creates_directory(self, mock_reporter):
+        self.assertTrue(StepCache.is_enabled())
+        self.assertTrue(os.path.isdir(self.cache_dir))
+
+    def test_miss(self, mock_reporter):
+        self.assertFalse(StepCache.restore('key1', tempfile.mkdtemp()))
+        self.assertEqual(mock_reporter.add_cache_event.call_args, call(StepCache.MISSES))
+
+    def test_store_then_hit(self, mock_reporter):
+        StepCache.store('key1', self.make_outdir(10), name='step1')
+        with open(os.path.join(self.cache_dir, 'key1.json')) as f:
+            self.assertEqual(json.load(f), {'name': 'step1', 'size': 10})
+        outdir = tempfile.mkdtemp()
+        self.assertTrue(StepCache.restore('key1', outdir))
+        self.assertTrue(os.path.exists(os.path.join(outdir, 'output.txt')))
+        self.assertEqual(mock_reporter.add_cache_event.mock_calls, [call(StepCache.STORES), call(StepCache.HITS)])
+
+    def test_restore_copies_pinned_entry_without_lock(self, mock_reporter):
+        StepCache.store('key1', self.make_outdir(10))
+
+        def copy_tree(src, dst):
+            self.assertFalse(StepCache.lock.locked())
+            self.assertEqual(StepCache.pinned, {'key1': 1})
+
+        with patch('calrissian.cache.copy_tree', side_effect=copy_tree) as mock_copy_tree:
+            self.assertTrue(StepCache.restore('key1', tempfile.mkdtemp()))
+        self.assertTrue(mock_copy_tree.called)
+        self.assertEqual(StepCache.pinned, {})
+
+    def test_restore_unpins_entry_on_error(self, mock_reporter):
+        StepCache.store('key1', self.make_outdir(10))
+        with patch('calrissian.cache.copy_tree', side_effect=OSError('No space left on device')):
+            with self.assertRaises(OSError):
+                StepCache.restore('key1', tempfile.mkdtemp())
+        self.assertEqual(StepCache.pinned, {})
+
+    def test_store_existing_entry_is_ignored(self, mock_reporter):
+        StepCache.store('key1', self.make_outdir(10))
+        StepCache.store('key1', self.make_outdir(20))
+        with open(os.path.join(self.cache_dir, 'key1.json')) as f:
+            self.assertEqual(json.load(f)['size'], 10)
+        self.assertEqual([n for n in os.listdir(self.cache_dir) if n.startswith('.')], [])
+
+    def test_evicts_least_recently_used(self, mock_reporter):
+        StepCache.max_bytes = 25
+        StepCache.store('key1', self.make_outdir(10))
+        StepCache.store('key2', self.make_outdir(10))
+        os.utime(os.path.join(self.cache_dir, 'key1.json'), (1000, 1000))
+        os.utime(os.path.join(self.cache_dir, 'key2.json'), (2000, 2000))
+        # Using key1 makes key2 the least recently used
+        StepCache.restore('key1', tempfile.mkdtemp())
+        StepCache.store('key3', self.make_outdir(10))
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'key1')))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'key2')))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'key2.json')))
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'key3')))
+        self.assertIn(call(StepCache.EVICTIONS), mock_reporter.add_cache_event.mock_calls)
+
+    def test_does_not_evict_pinned_entries(self, mock_reporter):
+        StepCache.max_bytes = 15
+        StepCache.store('key1', self.make_outdir(10))
+        os.utime(os.path.join(self.cache_dir, 'key1.json'), (1000, 1000))
+        # key1 is being restored
+        StepCache.pinned = {'key1': 1}
+        StepCache.store('key2', self.make_outdir(10))
+        # The newer entry is evicted instead
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'key1.json')))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'key2.json')))
+        StepCache.pinned = {}
+        StepCache.store('key3', self.make_outdir(10))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'key1.json')))
+
+    def test_no_eviction_without_limit(self, mock_reporter):
+        StepCache.store('key1', self.make_outdir(10))
+        StepCache.store('key2', self.make_outdir(10))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['key1', 'key1.json', 'key2', 'key2.json'])
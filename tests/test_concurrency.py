@@ -0,0 +1,57 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+from calrissian.concurrency import ConcurrencyLimits, concurrency_of, concurrency_slots
+
+
+def make_job(group='api', limit=2):
+    return Mock(concurrency_group=group, concurrency_limit=limit, jobs=None)
+
+
+def make_batch(jobs, parallelism):
+    return Mock(jobs=jobs, parallelism=parallelism)
+
+
+class ConcurrencyOfTestCase(TestCase):
+
+    def test_concurrency_of(self):
+        self.assertEqual(concurrency_of(make_job()), ('api', 2))
+        self.assertEqual(concurrency_of(make_job(group=None, limit=None)), (None, None))
+
+    def test_concurrency_of_batch(self):
+        self.assertEqual(concurrency_of(make_batch([make_job(), make_job()], 2)), ('api', 2))
+
+    def test_concurrency_slots(self):
+        self.assertEqual(concurrency_slots(make_job()), 1)
+        self.assertEqual(concurrency_slots(make_batch([make_job(), make_job(), make_job()], 2)), 2)
+
+
+class ConcurrencyLimitsTestCase(TestCase):
+
+    def setUp(self):
+        ConcurrencyLimits.reset()
+
+    def tearDown(self):
+        ConcurrencyLimits.reset()
+
+    def test_can_admit_without_limit(self):
+        self.assertTrue(ConcurrencyLimits.can_admit(make_job(group=None, limit=None), {}))
+
+    def test_can_admit_counts_admitted(self):
+        self.assertTrue(ConcurrencyLimits.can_admit(make_job(), {make_job(): None, make_job(group='db'): None}))
+        self.assertFalse(ConcurrencyLimits.can_admit(make_job(), {make_job(): None, make_job(): None}))
+
+    def test_started_and_finished(self):
+        job = make_job()
+        ConcurrencyLimits.started(job)
+        ConcurrencyLimits.started(make_job())
+        self.assertEqual(ConcurrencyLimits.running, {'api': 2})
+        self.assertFalse(ConcurrencyLimits.can_admit(make_job(), {}))
+        ConcurrencyLimits.finished(job)
+        self.assertEqual(ConcurrencyLimits.running, {'api': 1})
+        self.assertTrue(ConcurrencyLimits.can_admit(make_job(), {}))
+
+    def test_batch_counts_its_parallelism(self):
+        ConcurrencyLimits.started(make_batch([make_job(limit=3), make_job(limit=3)], 2))
+        self.assertEqual(ConcurrencyLimits.running, {'api': 2})
+        self.assertFalse(ConcurrencyLimits.can_admit(make_batch([make_job(limit=3), make_job(limit=3)], 2), {}))
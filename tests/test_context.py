@@ -1,5 +1,5 @@
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 from calrissian.context import CalrissianLoadingContext, CalrissianRuntimeContext
 
 
@@ -48,3 +48,22 @@ class CalrissianRuntimeContextTestCase(TestCase):
         serviceaccount = "podmanager"
         ctx = CalrissianRuntimeContext({'pod_serviceaccount':serviceaccount})
         self.assertEqual(ctx.pod_serviceaccount, serviceaccount)
+
+    def test_create_outdir_with_striper(self):
+        ctx = CalrissianRuntimeContext()
+        ctx.outdir_striper = Mock()
+        self.assertEqual(ctx.create_outdir(), ctx.outdir_striper.create_outdir.return_value)
+        # Copies of the context share the striper
+        self.assertEqual(ctx.copy().create_outdir(), ctx.outdir_striper.create_outdir.return_value)
+
+    def test_step_path_follows_copies_named_by_steps(self):
+        # As WorkflowJobStep.job names the contexts of a step and of a step of its sub-workflow
+        ctx = CalrissianRuntimeContext()
+        step_ctx = ctx.copy()
+        step_ctx.name = 'sub'
+        inner_ctx = step_ctx.copy()
+        inner_ctx.name = 'inner'
+        self.assertEqual(ctx.step_path, ())
+        self.assertEqual(step_ctx.step_path, ('sub',))
+        self.assertEqual(inner_ctx.step_path, ('sub', 'inner'))
+        self.assertEqual(inner_ctx.name, 'inner')
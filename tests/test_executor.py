@@ -1,15 +1,26 @@
 from concurrent.futures import Future, ThreadPoolExecutor
 import threading
+import time
 from unittest import TestCase
 from unittest.mock import patch, call, Mock, create_autospec
 
-from calrissian.executor import Resources, JobResourceQueue, ThreadPoolJobExecutor
+from calrissian.executor import Resources, ResourcePool, JobResourceQueue, ThreadPoolJobExecutor, expected_runtime
 from calrissian.executor import DuplicateJobException, OversizedJobException, InconsistentResourcesException
+from calrissian.overcommit import MemoryOvercommit
 from cwltool.errors import WorkflowException
 
 
-def make_mock_job(resources):
-    return Mock(builder=Mock(resources={'ram': resources.ram, 'cores': resources.cores}))
+def make_mock_job(resources, timelimit=None):
+    return Mock(builder=Mock(resources={'ram': resources.ram, 'cores': resources.cores}), timelimit=timelimit)
+
+
+class ExpectedRuntimeTestCase(TestCase):
+
+    def test_expected_runtime(self):
+        self.assertEqual(expected_runtime(make_mock_job(Resources(100, 1), timelimit=60)), 60)
+        self.assertIsNone(expected_runtime(make_mock_job(Resources(100, 1), timelimit=0)))
+        self.assertIsNone(expected_runtime(make_mock_job(Resources(100, 1))))
+        self.assertIsNone(expected_runtime(object()))
 
 
 class ResourcesTestCase(TestCase):
@@ -88,10 +99,30 @@ class ResourcesTestCase(TestCase):
         self.assertEqual(result.ram, 400)
         self.assertEqual(result.gpus, 1)
 
+    def test_from_dict_extended(self):
+        result = Resources.from_dict({'cores': 3, 'ram': 400, 'extended': {'ephemeral-storage': 2048}})
+        self.assertEqual(result.extended, {'ephemeral-storage': 2048})
+        self.assertEqual(result.to_dict()['extended'], {'ephemeral-storage': 2048})
+        self.assertNotIn('extended', self.resource11.to_dict())
+
     def test_min(self):
         result = Resources.min(self.resource21, self.resource12)
         self.assertEqual(result, self.resource11)
 
+    def test_extended_arithmetic(self):
+        storage = Resources(1, 1, 0, {'ephemeral-storage': 100})
+        fpga = Resources(1, 1, 0, {'example.com/fpga': 1})
+        self.assertEqual(storage + fpga, Resources(2, 2, 0, {'ephemeral-storage': 100, 'example.com/fpga': 1}))
+        self.assertEqual(storage - fpga, Resources(0, 0, 0, {'ephemeral-storage': 100, 'example.com/fpga': -1}))
+        self.assertEqual(storage.scale(2), Resources(2, 2, 0, {'ephemeral-storage': 200}))
+        # Missing extended resources amount to 0
+        self.assertEqual(Resources(1, 1, 0, {'example.com/fpga': 0}), Resources(1, 1, 0))
+        self.assertTrue((storage - fpga).is_negative())
+        self.assertTrue(fpga.exceeds(storage))
+        self.assertFalse(Resources(1, 1, 0, {'ephemeral-storage': 50}).exceeds(storage))
+        self.assertEqual(Resources.min(storage, Resources(2, 2, 0, {'ephemeral-storage': 50})),
+                         Resources(1, 1, 0, {'ephemeral-storage': 50}))
+
     def test_is_negative(self):
         self.assertFalse(self.resource11.is_negative())
         self.assertTrue(self.resource_neg.is_negative())
@@ -139,6 +170,24 @@ class JobResourceQueueTestCase(TestCase):
         runnable = self.jrq.dequeue(limit)
         self.assertEqual(runnable, self.jobs)
 
+    def test_dequeue_skips_jobs_over_concurrency_limit(self):
+        capped = [make_mock_job(Resources(100, 1)) for _ in range(3)]
+        for job in capped:
+            job.concurrency_group, job.concurrency_limit = 'api', 2
+        for job in capped + [self.job200_2]:
+            self.jrq.enqueue(job)
+        runnable = self.jrq.dequeue(Resources(1000, 10))
+        # The third capped job stays queued while the larger job behind it is admitted
+        self.assertEqual(len([job for job in runnable if job in capped]), 2)
+        self.assertIn(self.job200_2, runnable)
+        self.assertEqual(len(self.jrq.jobs), 1)
+
+    @patch('calrissian.executor.IOBudget')
+    def test_dequeue_skips_jobs_over_io_budget(self, mock_io_budget):
+        mock_io_budget.can_admit.side_effect = lambda job, admitted: job is not self.job100_4
+        self.queue_jobs()
+        self.assertEqual(self.jrq.dequeue(Resources(1000, 10)), {self.job200_2: Resources(200, 2)})
+
     def test_dequeue_none_fit_ram_too_small(self):
         limit = Resources(99, 10)
         self.queue_jobs()
@@ -211,6 +260,38 @@ class JobResourceQueueTestCase(TestCase):
         runnable = self.jrq.dequeue(limit)
         self.assertEqual(runnable, self.jobs)
 
+    def test_reservation(self):
+        releases = [(20, Resources(100, 1)), (10, Resources(100, 1))]
+        self.assertEqual(JobResourceQueue.reservation(Resources(250, 2), Resources(100, 1), releases),
+                         (20, Resources(50, 1)))
+        self.assertEqual(JobResourceQueue.reservation(Resources(500, 2), Resources(100, 1), releases), (None, None))
+
+    def make_backfill_jobs(self):
+        self.jrq.descending = True
+        big, short, long = make_mock_job(Resources(300, 2)), make_mock_job(Resources(100, 1), timelimit=50), \
+            make_mock_job(Resources(100, 1))
+        for job in [big, short, long]:
+            self.jrq.enqueue(job)
+        return big, short, long
+
+    def test_dequeue_backfills_jobs_finishing_before_reservation(self):
+        big, short, long = self.make_backfill_jobs()
+        # big can start at 100, leaving 50 RAM beside it: long would delay it
+        runnable = self.jrq.dequeue(Resources(200, 4), [(100, Resources(150, 2))], 0)
+        self.assertEqual(runnable, {short: Resources(100, 1)})
+        self.assertEqual(set(self.jrq.jobs), {big, long})
+
+    def test_dequeue_backfills_jobs_fitting_beside_reservation(self):
+        big, short, long = self.make_backfill_jobs()
+        runnable = self.jrq.dequeue(Resources(200, 4), [(100, Resources(250, 2))], 0)
+        self.assertEqual(runnable, {short: Resources(100, 1), long: Resources(100, 1)})
+
+    def test_dequeue_backfills_all_without_reservation(self):
+        big, short, long = self.make_backfill_jobs()
+        # No running job is expected to release enough resources for big
+        runnable = self.jrq.dequeue(Resources(200, 4), [], 0)
+        self.assertEqual(runnable, {short: Resources(100, 1), long: Resources(100, 1)})
+
     def test_is_empty(self):
         self.assertTrue(self.jrq.is_empty())
         self.queue_jobs()
@@ -219,6 +300,26 @@ class JobResourceQueueTestCase(TestCase):
         self.assertTrue(self.jrq.is_empty())
 
 
+class ResourcePoolTestCase(TestCase):
+
+    def setUp(self):
+        self.pool = ResourcePool('gpu', {'accelerator': 'nvidia', 'pool': 'gpu'}, Resources(8192, 8, 4))
+
+    def test_init(self):
+        self.assertEqual(self.pool.available_resources, Resources(8192, 8, 4))
+        self.assertEqual(self.pool.pending_resources, Resources.EMPTY)
+        self.assertTrue(self.pool.jrq.is_empty())
+
+    def test_matches(self):
+        self.assertTrue(self.pool.matches({'accelerator': 'nvidia', 'pool': 'gpu', 'zone': 'a'}))
+        self.assertFalse(self.pool.matches({'accelerator': 'nvidia'}))
+        self.assertFalse(ResourcePool('default', {}, Resources(1, 1)).matches({'accelerator': 'nvidia'}))
+
+    def test_fits(self):
+        self.assertTrue(self.pool.fits(Resources(8192, 1, 4)))
+        self.assertFalse(self.pool.fits(Resources(8193, 1)))
+
+
 class ThreadPoolJobExecutorTestCase(TestCase):
 
     def setUp(self):
@@ -257,6 +358,23 @@ class ThreadPoolJobExecutorTestCase(TestCase):
         self.assertEqual(result['ramMax'], 1000) # When ram max requested exceeds total, result should be total
         self.assertEqual(result['coresMax'], 1) # when cpu max requested is below total, result should be requested
 
+    def test_select_resources_ephemeral_storage(self):
+        request = {'ramMin': 500, 'ramMax': 1000, 'coresMin': 1, 'coresMax': 2, 'tmpdirMin': 1024, 'outdirMin': 2048}
+        self.assertNotIn('extended', self.executor.select_resources(request, Mock()))
+        executor = ThreadPoolJobExecutor(1000, 2, 0, total_extended={'ephemeral-storage': 10240})
+        result = executor.select_resources(request, Mock())
+        self.assertEqual(result['extended'], {'ephemeral-storage': 3072})
+        self.assertEqual(result['outdirSize'], 2048)
+        self.assertEqual(result['tmpdirSize'], 1024)
+        executor = ThreadPoolJobExecutor(1000, 2, 0, total_extended={'ephemeral-storage': 2048})
+        with self.assertRaisesRegex(WorkflowException, 'exceed total'):
+            executor.select_resources(request, Mock())
+
+    def test_raise_if_oversized_with_unlimited_extended_resource(self):
+        job = Mock(builder=Mock(resources={'ram': 100, 'cores': 1, 'extended': {'example.com/fpga': 1}}))
+        with self.assertRaises(OversizedJobException):
+            self.executor.raise_if_oversized(job)
+
     def test_requested_and_limit_resources(self):
         request = {
             'ramMin': 500,
@@ -288,6 +406,14 @@ class ThreadPoolJobExecutorTestCase(TestCase):
         with self.assertRaisesRegex(InconsistentResourcesException, 'Available resources are negative'):
             self.executor.allocate(resource, self.logger)
 
+    def test_allocate_overcommitted_ram(self):
+        MemoryOvercommit.initialize(1.5)
+        self.addCleanup(MemoryOvercommit.initialize, None)
+        self.executor.allocate(Resources(1400, 1), self.logger)
+        self.assertEqual(self.executor.available_resources, Resources(-400, 1, 2))
+        with self.assertRaisesRegex(InconsistentResourcesException, 'Available resources are negative'):
+            self.executor.allocate(Resources(200, 0), self.logger)
+
     def test_restore_over_total_raises(self):
         self.assertEqual(self.executor.available_resources, self.executor.total_resources)
         with self.assertRaisesRegex(InconsistentResourcesException, 'Available resources exceeds total'):
@@ -297,6 +423,81 @@ class ThreadPoolJobExecutorTestCase(TestCase):
         with self.assertRaisesRegex(InconsistentResourcesException, 'Available resources exceeds total'):
             self.executor.restore(Resources(0, 1), self.logger)
 
+    def test_reserve_resources(self):
+        runtime_context = Mock(workflow_eval_lock=threading.Lock())
+        self.executor.reserve_resources(Resources(200, 0, 0), runtime_context)
+        self.assertEqual(self.executor.available_resources, Resources(800, 2, 2))
+        self.assertEqual(self.executor.pending_resources, Resources.EMPTY)
+        self.executor.release_resources(Resources(200, 0, 0), runtime_context)
+        self.assertEqual(self.executor.available_resources, self.executor.total_resources)
+
+    @patch('calrissian.executor.time')
+    def test_reserve_resources_waits_for_available(self, mock_time):
+        runtime_context = Mock(workflow_eval_lock=threading.Lock())
+        self.executor.available_resources = Resources(100, 2, 2)
+
+        def restore(seconds):
+            self.assertEqual(self.executor.pending_resources, Resources(200, 0, 0))
+            self.executor.restore(Resources(500, 0, 0), self.logger)
+
+        mock_time.sleep.side_effect = restore
+        self.executor.reserve_resources(Resources(200, 0, 0), runtime_context)
+        self.assertEqual(mock_time.sleep.call_count, 1)
+        self.assertEqual(self.executor.available_resources, Resources(400, 2, 2))
+        self.assertEqual(self.executor.pending_resources, Resources.EMPTY)
+
+    @patch('calrissian.executor.time')
+    def test_reserve_resources_without_blocking(self, mock_time):
+        runtime_context = Mock(workflow_eval_lock=threading.Lock())
+        self.executor.available_resources = Resources(100, 2, 2)
+        self.assertFalse(self.executor.reserve_resources(Resources(200, 0, 0), runtime_context, block=False))
+        self.assertTrue(self.executor.reserve_resources(Resources(100, 0, 0), runtime_context, block=False))
+        self.assertEqual(self.executor.available_resources, Resources(0, 2, 2))
+        self.assertFalse(mock_time.sleep.called)
+
+    def test_reserve_resources_without_blocking_leaves_pending(self):
+        runtime_context = Mock(workflow_eval_lock=threading.Lock())
+        self.executor.available_resources = Resources(300, 2, 2)
+        # Held back for a job waiting to retry with more RAM
+        self.executor.pending_resources = Resources(200, 0, 0)
+        self.assertFalse(self.executor.reserve_resources(Resources(200, 0, 0), runtime_context, block=False))
+        self.assertTrue(self.executor.reserve_resources(Resources(100, 0, 0), runtime_context, block=False))
+        self.assertEqual(self.executor.available_resources, Resources(200, 2, 2))
+
+    @patch('calrissian.executor.RESERVE_POLL_SECONDS', 0.01)
+    def test_reserve_resources_returns_held_while_waiting(self):
+        # Two running jobs escalate at once, each needing what the other holds
+        runtime_context = Mock(workflow_eval_lock=threading.Lock())
+        self.executor.allocate(Resources(500, 0, 0), self.logger)
+        self.executor.allocate(Resources(500, 0, 0), self.logger)
+        escalations = [threading.Thread(target=self.executor.reserve_resources,
+                                        args=(Resources(500, 0, 0), runtime_context),
+                                        kwargs={'held': Resources(500, 0, 0)}) for _ in range(2)]
+        for escalation in escalations:
+            escalation.start()
+        # The first escalated job finishes, restoring its escalated request
+        for _ in range(500):
+            if not all(escalation.is_alive() for escalation in escalations):
+                break
+            time.sleep(0.01)
+        self.assertEqual(sum(escalation.is_alive() for escalation in escalations), 1)
+        self.assertEqual(self.executor.available_resources, Resources(0, 2, 2))
+        self.executor.release_resources(Resources(1000, 0, 0), runtime_context)
+        for escalation in escalations:
+            escalation.join(timeout=5)
+            self.assertFalse(escalation.is_alive())
+        self.assertEqual(self.executor.available_resources, Resources(0, 2, 2))
+        self.assertEqual(self.executor.pending_resources, Resources.EMPTY)
+
+    def test_reserve_resources_raises_if_held_and_additional_exceed_total(self):
+        with self.assertRaises(OversizedJobException):
+            self.executor.reserve_resources(Resources(600, 0, 0), Mock(workflow_eval_lock=threading.Lock()),
+                                            held=Resources(600, 0, 0))
+
+    def test_reserve_resources_raises_if_exceeds_total(self):
+        with self.assertRaises(OversizedJobException):
+            self.executor.reserve_resources(Resources(2000, 0, 0), Mock(workflow_eval_lock=threading.Lock()))
+
     @patch('calrissian.executor.wait')
     def test_raise_if_exception_queued_raises_and_waits(self, mock_wait):
         self.executor.exceptions.put(self.workflow_exception)
@@ -348,6 +549,92 @@ class ThreadPoolJobExecutorTestCase(TestCase):
         job = make_mock_job(rsc)
         self.executor.raise_if_oversized(job)
 
+    def add_pools(self):
+        self.gpu_pool = ResourcePool('gpu', {'pool': 'gpu'}, Resources(4000, 8, 4))
+        self.highmem_pool = ResourcePool('highmem', {'pool': 'highmem'}, Resources(16000, 4))
+        self.executor.pools = [self.gpu_pool, self.highmem_pool]
+
+    def test_route_without_pools(self):
+        job = make_mock_job(Resources(100, 1))
+        self.assertIs(self.executor.route(job, Mock()), self.executor.default_pool)
+
+    def test_route_by_node_selector(self):
+        self.add_pools()
+        job = make_mock_job(Resources(100, 1))
+        job.node_selector.return_value = {'pool': 'gpu', 'zone': 'a'}
+        self.assertIs(self.executor.route(job, Mock()), self.gpu_pool)
+
+    def test_route_by_capacity(self):
+        self.add_pools()
+        small, large = make_mock_job(Resources(100, 1)), make_mock_job(Resources(8000, 1))
+        for job in (small, large):
+            job.node_selector.return_value = {}
+        self.assertIs(self.executor.route(small, Mock()), self.executor.default_pool)
+        self.assertIs(self.executor.route(large, Mock()), self.highmem_pool)
+
+    def test_enqueue_in_pool(self):
+        self.add_pools()
+        job = make_mock_job(Resources(8000, 1))
+        job.node_selector.return_value = {'pool': 'highmem'}
+        self.executor.enqueue(job, Mock())
+        self.assertIn(job, self.highmem_pool.jrq.jobs)
+        self.assertTrue(self.executor.jrq.is_empty())
+        self.assertIs(job.resource_pool, self.highmem_pool)
+
+    def test_enqueue_raises_if_oversized_for_pool(self):
+        self.add_pools()
+        job = make_mock_job(Resources(8000, 1))
+        job.node_selector.return_value = {'pool': 'gpu'}
+        with self.assertRaisesRegex(OversizedJobException, 'exceed total'):
+            self.executor.enqueue(job, Mock())
+
+    def test_select_resources_in_larger_pool(self):
+        self.add_pools()
+        result = self.executor.select_resources({'ramMin': 8000, 'ramMax': 32000, 'coresMin': 1, 'coresMax': 1},
+                                                Mock())
+        self.assertEqual(result['ramMax'], 16000)
+
+    def test_enqueue_clamps_to_routed_pool(self):
+        self.add_pools()
+        resources = self.executor.select_resources({'ramMin': 500, 'ramMax': 12000, 'coresMin': 1, 'coresMax': 8},
+                                                   Mock())
+        # Not routed yet, the limits fit the largest pools
+        self.assertEqual((resources['ramMax'], resources['coresMax']), (12000, 8))
+        highmem_job, default_job = Mock(builder=Mock(resources=resources)), Mock(builder=Mock(resources=resources))
+        highmem_job.node_selector.return_value = {'pool': 'highmem'}
+        default_job.node_selector.return_value = {}
+        self.executor.enqueue(highmem_job, Mock())
+        self.executor.enqueue(default_job, Mock())
+        self.assertEqual((highmem_job.builder.resources['ramMax'], highmem_job.builder.resources['coresMax']),
+                         (12000, 4))
+        self.assertEqual((default_job.builder.resources['ramMax'], default_job.builder.resources['coresMax']),
+                         (1000, 2))
+
+    def test_select_resources_raises_with_totals_of_pools(self):
+        self.add_pools()
+        with self.assertRaisesRegex(WorkflowException, r'\[ram: 16000, cores: 4'):
+            self.executor.select_resources({'ramMin': 32000, 'ramMax': 32000, 'coresMin': 1, 'coresMax': 1}, Mock())
+
+    @patch('calrissian.executor.JobResourceQueue.dequeue')
+    @patch('calrissian.executor.ThreadPoolJobExecutor.allocate')
+    def test_start_queued_jobs_of_each_pool(self, mock_allocate, mock_dequeue):
+        self.add_pools()
+        mock_dequeue.return_value = {}
+        self.gpu_pool.available_resources = Resources(1000, 2, 1)
+        self.executor.start_queued_jobs(Mock(), self.logger, Mock(builder=Mock()))
+        self.assertEqual(mock_dequeue.call_args_list, [call(Resources(1000, 2, 2)), call(Resources(1000, 2, 1)),
+                                                       call(Resources(16000, 4))])
+
+    def test_allocate_and_restore_in_pool(self):
+        self.add_pools()
+        self.executor.allocate(Resources(3000, 2, 1), self.logger, self.gpu_pool)
+        self.assertEqual(self.gpu_pool.available_resources, Resources(1000, 6, 3))
+        self.assertEqual(self.executor.available_resources, Resources(1000, 2, 2))
+        self.executor.restore(Resources(3000, 2, 1), self.logger, self.gpu_pool)
+        self.assertEqual(self.gpu_pool.available_resources, self.gpu_pool.total_resources)
+        with self.assertRaises(InconsistentResourcesException):
+            self.executor.allocate(Resources(5000, 1), self.logger, self.gpu_pool)
+
     @patch('calrissian.executor.ThreadPoolJobExecutor.restore')
     def test_job_done_callback_extracts_future_exception(self, mock_restore):
         future = Future()
@@ -355,7 +642,7 @@ class ThreadPoolJobExecutorTestCase(TestCase):
         rsc = Mock()
         self.executor.job_done_callback(rsc, self.logger, future)
         self.assertEqual(self.workflow_exception, self.executor.exceptions.get())
-        self.assertEqual(mock_restore.call_args, call(rsc, self.logger))
+        self.assertEqual(mock_restore.call_args, call(rsc, self.logger, None))
 
     @patch('calrissian.executor.ThreadPoolJobExecutor.restore')
     def test_job_done_callback_bails_out_if_canceled(self, mock_restore):
@@ -364,7 +651,7 @@ class ThreadPoolJobExecutorTestCase(TestCase):
         self.assertTrue(future.cancelled())
         rsc = Mock()
         self.executor.job_done_callback(rsc, self.logger, future)
-        self.assertEqual(mock_restore.call_args, call(rsc, self.logger))
+        self.assertEqual(mock_restore.call_args, call(rsc, self.logger, None))
         self.assertTrue(self.executor.exceptions.empty())
 
     @patch('calrissian.executor.ThreadPoolJobExecutor.restore')
@@ -389,8 +676,8 @@ class ThreadPoolJobExecutorTestCase(TestCase):
 
         # allocates resources
         self.assertEqual(mock_allocate.call_args_list, [
-            call(job_resources[0], self.logger),
-            call(job_resources[1], self.logger)
+            call(job_resources[0], self.logger, self.executor.default_pool),
+            call(job_resources[1], self.logger, self.executor.default_pool)
         ])
         # connects builder and output_dirs
         self.assertTrue(all([j.builder == mock_runtime_context.builder for j in mock_runnable_jobs]))
@@ -403,6 +690,125 @@ class ThreadPoolJobExecutorTestCase(TestCase):
         # returns set of submitted futures
         self.assertIn(mock_future, result)
 
+    @patch('calrissian.executor.IOBudget')
+    @patch('calrissian.executor.ConcurrencyLimits')
+    @patch('calrissian.executor.JobResourceQueue.dequeue')
+    @patch('calrissian.executor.ThreadPoolJobExecutor.allocate')
+    def test_start_queued_jobs_counts_started_jobs(self, mock_allocate, mock_dequeue, mock_concurrency_limits,
+                                                   mock_io_budget):
+        mock_job = make_mock_job(Resources(100, 1))
+        mock_dequeue.return_value = {mock_job: Resources(100, 1)}
+        self.executor.start_queued_jobs(Mock(), self.logger, Mock(builder=Mock()))
+        self.assertEqual(mock_concurrency_limits.started.call_args, call(mock_job))
+        self.assertEqual(mock_io_budget.started.call_args, call(mock_job))
+
+    @patch('calrissian.executor.time')
+    @patch('calrissian.executor.JobResourceQueue.dequeue')
+    @patch('calrissian.executor.ThreadPoolJobExecutor.allocate')
+    def test_start_queued_jobs_with_backfill(self, mock_allocate, mock_dequeue, mock_time):
+        mock_time.monotonic.return_value = 1000
+        running_future = Mock()
+        pool = self.executor.default_pool
+        self.executor.running = {running_future: (Mock(), Resources(100, 1), 1060, pool),
+                                 Mock(): (Mock(), Resources(100, 1), None, pool)}
+        job = make_mock_job(Resources(200, 2), timelimit=30)
+        mock_dequeue.return_value = {job: Resources(200, 2)}
+        self.executor.backfill = True
+        pool_executor = Mock()
+        self.executor.start_queued_jobs(pool_executor, self.logger, Mock(builder=Mock()))
+        # Only running jobs with a time limit are expected to release their resources
+        self.assertEqual(mock_dequeue.call_args,
+                         call(self.executor.available_resources, [(1060, Resources(100, 1))], 1000))
+        self.assertEqual(self.executor.running[pool_executor.submit.return_value], (job, Resources(200, 2), 1030, pool))
+
+    @patch('calrissian.executor.JobResourceQueue.dequeue')
+    @patch('calrissian.executor.ThreadPoolJobExecutor.allocate')
+    def test_start_queued_jobs_with_memory_overcommit(self, mock_allocate, mock_dequeue):
+        MemoryOvercommit.initialize(1.5, measured=True)
+        self.addCleanup(MemoryOvercommit.initialize, None)
+        running_job = Mock()
+        running_job.observed_ram_megabytes.return_value = 400
+        self.executor.running = {Mock(): (running_job, Resources(800, 1), None, self.executor.default_pool)}
+        self.executor.available_resources = Resources(200, 1, 2)
+        mock_dequeue.return_value = {}
+        self.executor.start_queued_jobs(Mock(), self.logger, Mock(builder=Mock()))
+        # The RAM requested but unused by the running job, with headroom, is admitted again
+        self.assertEqual(mock_dequeue.call_args, call(Resources(500, 1, 2)))
+
+    @patch('calrissian.executor.ThreadPoolJobExecutor.restore')
+    def test_job_done_callback_forgets_running_future(self, mock_restore):
+        future = Future()
+        future.set_result(None)
+        self.executor.running = {future: (Mock(), Resources(1, 1), None, self.executor.default_pool)}
+        self.executor.job_done_callback(Resources(1, 1), self.logger, future)
+        self.assertEqual(self.executor.running, {})
+
+    @patch('calrissian.executor.IOBudget')
+    @patch('calrissian.executor.ConcurrencyLimits')
+    @patch('calrissian.executor.ThreadPoolJobExecutor.restore')
+    def test_job_done_callback_counts_finished_job(self, mock_restore, mock_concurrency_limits, mock_io_budget):
+        future, mock_job = Future(), Mock()
+        future.set_result(None)
+        self.executor.running = {future: (mock_job, Resources(1, 1), None, self.executor.default_pool)}
+        self.executor.job_done_callback(Resources(1, 1), self.logger, future)
+        self.assertEqual(mock_concurrency_limits.finished.call_args, call(mock_job))
+        self.assertEqual(mock_io_budget.finished.call_args, call(mock_job))
+
+    @patch('calrissian.executor.ThreadPoolJobExecutor.restore')
+    def test_job_done_callback_releases_job_from_queue(self, mock_restore):
+        future, mock_job = Future(), Mock()
+        future.set_result(None)
+        self.executor.jrq = Mock()
+        self.executor.running = {future: (mock_job, Resources(1, 1), None, self.executor.default_pool)}
+        self.executor.job_done_callback(Resources(1, 1), self.logger, future)
+        self.assertEqual(self.executor.jrq.release.call_args, call(mock_job, Resources(1, 1)))
+
+    @patch('calrissian.executor.JobResourceQueue.dequeue')
+    @patch('calrissian.executor.ThreadPoolJobExecutor.allocate')
+    def test_start_queued_jobs_with_batcher(self, mock_allocate, mock_dequeue):
+        mock_batch, mock_members = Mock(), [Mock(), Mock()]
+        mock_dequeue.return_value = {mock_batch: Resources(200, 2)}
+        self.executor.batcher = Mock()
+        self.executor.batcher.members.return_value = mock_members
+        self.executor.batcher.widen.return_value = (Resources(200, 2), Resources.EMPTY)
+        pool_executor = Mock()
+        mock_runtime_context = Mock(builder=Mock())
+        self.executor.start_queued_jobs(pool_executor, self.logger, mock_runtime_context)
+        # batches the queue before dequeuing
+        self.assertEqual(self.executor.batcher.batch.call_args, call(self.executor.jrq, self.executor.total_resources))
+        # connects builder and output_dirs of the batched jobs
+        self.assertEqual(self.executor.batcher.members.call_args, call(mock_batch))
+        self.assertTrue(all([j.builder == mock_runtime_context.builder for j in mock_members]))
+        self.assertEqual(self.executor.output_dirs, {j.outdir for j in mock_members})
+        # submits the batch
+        self.assertEqual(pool_executor.submit.call_args, call(mock_batch.run, mock_runtime_context))
+
+    @patch('calrissian.executor.JobResourceQueue.resize')
+    @patch('calrissian.executor.JobResourceQueue.dequeue')
+    @patch('calrissian.executor.ThreadPoolJobExecutor.allocate')
+    def test_start_queued_jobs_widens_batches(self, mock_allocate, mock_dequeue, mock_resize):
+        mock_batch, mock_job = Mock(), Mock()
+        mock_dequeue.return_value = {mock_batch: Resources(200, 1), mock_job: Resources(100, 1)}
+        self.executor.batcher = Mock()
+        self.executor.batcher.members.side_effect = lambda job: [job]
+        self.executor.batcher.widen.side_effect = [(Resources(600, 3), Resources(100, 0)),
+                                                   (Resources(100, 1), Resources(100, 0))]
+        self.executor.start_queued_jobs(Mock(), self.logger, Mock(builder=Mock()))
+        # widened with the resources left by the dequeued jobs
+        self.assertEqual(self.executor.batcher.widen.call_args_list[0],
+                         call(mock_batch, Resources(200, 1), Resources(700, 0, 2), [mock_job]))
+        self.assertEqual(self.executor.batcher.widen.call_args_list[1],
+                         call(mock_job, Resources(100, 1), Resources(100, 0), [mock_batch]))
+        self.assertEqual(mock_resize.call_args_list, [call(mock_batch, Resources(200, 1), Resources(600, 3))])
+        self.assertEqual(mock_allocate.call_args_list[0][0][0], Resources(600, 3))
+
+    @patch('calrissian.executor.JobResourceQueue.dequeue')
+    def test_start_queued_jobs_holds_back_pending_resources(self, mock_dequeue):
+        mock_dequeue.return_value = {}
+        self.executor.pending_resources = Resources(300, 0, 0)
+        self.executor.start_queued_jobs(Mock(), self.logger, Mock(builder=Mock()))
+        self.assertEqual(mock_dequeue.call_args, call(Resources(700, 2, 2)))
+
     @patch('calrissian.executor.wait')
     @patch('calrissian.executor.FIRST_COMPLETED')
     def test_wait_for_completion(self, mock_first_completed, mock_wait):
@@ -529,3 +935,13 @@ class ThreadPoolJobExecutorQueueingTestCase(ThreadPoolJobExecutorTestCase):
                          call(mock_job_iterator, self.logger, self.mock_runtime_context, mock_context_executor))
         self.assertEqual(mock_drain_queue.call_args,
                          call(self.logger, self.mock_runtime_context, mock_context_executor, mock_enqueued_futures))
+
+    @patch('calrissian.executor.ThreadPoolExecutor', autospec=True)
+    @patch('calrissian.executor.ThreadPoolJobExecutor.enqueue_jobs_from_iterator')
+    @patch('calrissian.executor.ThreadPoolJobExecutor.drain_queue')
+    def test_run_jobs_calls_start_hooks(self, mock_drain_queue, mock_enqueue_jobs, mock_executor):
+        mock_hook = Mock()
+        mock_process = Mock()
+        self.executor.add_start_hook(mock_hook)
+        self.executor.run_jobs(mock_process, Mock(), self.logger, self.mock_runtime_context)
+        self.assertEqual(mock_hook.call_args, call(mock_process, self.mock_runtime_context))
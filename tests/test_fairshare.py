@@ -0,0 +1,181 @@
+import tempfile
+from itertools import takewhile
+from unittest import TestCase
+from unittest.mock import patch, call, Mock
+
+from cwltool.load_tool import load_tool
+
+from calrissian.concurrency import ConcurrencyLimits
+from calrissian.context import CalrissianLoadingContext, CalrissianRuntimeContext
+from calrissian.executor import Resources
+from calrissian.job import CalrissianCommandLineJob
+from calrissian.fairshare import FairShareQueue, fair_share_path
+
+
+def make_job(step_path, index=1, ram=100, cores=1, weight=1.0, concurrency_limit=None):
+    """
+    :param step_path: names of the steps of the job, from the outermost workflow, separated by slashes
+    """
+    step_path = tuple(step_path.split('/'))
+    step_name = step_path[-1]
+    job = Mock(builder=Mock(resources={'ram': ram, 'cores': cores}), timelimit=None, fair_share_weight=weight,
+               concurrency_group=step_name if concurrency_limit else None, concurrency_limit=concurrency_limit,
+               jobs=None, step_name=step_name, step_path=step_path)
+    # Named like cwltool names the jobs of a scatter
+    job.name = step_name if index == 1 else '{}_{}'.format(step_name, index)
+    return job
+
+
+class FairSharePathTestCase(TestCase):
+
+    def test_fair_share_path(self):
+        self.assertEqual(fair_share_path(make_job('crop', 12)), ('crop',))
+        self.assertEqual(fair_share_path(make_job('main/branch_a/crop', 3)), ('main', 'branch_a', 'crop'))
+
+    def test_fair_share_path_without_step_path(self):
+        job = make_job('crop')
+        job.step_path = ()
+        self.assertEqual(fair_share_path(job), ('crop',))
+
+    def test_fair_share_path_of_steps_ending_in_digits(self):
+        self.assertEqual(fair_share_path(make_job('align_1', 2)), ('align_1',))
+        self.assertEqual(fair_share_path(make_job('align_2')), ('align_2',))
+        self.assertEqual(fair_share_path(make_job('step_2021')), ('step_2021',))
+
+    def test_fair_share_path_of_batch(self):
+        batch = Mock(jobs=[make_job('crop', 3), make_job('crop', 4)])
+        batch.name = 'crop_3-batch'
+        self.assertEqual(fair_share_path(batch), ('crop',))
+
+    @patch('calrissian.job.KubernetesVolumeBuilder')
+    @patch('calrissian.job.KubernetesClient')
+    def test_fair_share_path_of_nested_workflow(self, mock_client, mock_volume_builder):
+        echo = {
+            'class': 'CommandLineTool',
+            'baseCommand': 'echo',
+            'inputs': {'msg': {'type': 'string', 'inputBinding': {'position': 1}}},
+            'outputs': [],
+        }
+        workflow = {
+            'id': '_:main',
+            'cwlVersion': 'v1.2',
+            'class': 'Workflow',
+            'requirements': {'SubworkflowFeatureRequirement': {}},
+            'inputs': {'msg': 'string'},
+            'outputs': [],
+            'steps': {
+                'top': {'run': echo, 'in': {'msg': 'msg'}, 'out': []},
+                'sub': {
+                    'in': {'msg': 'msg'},
+                    'out': [],
+                    'run': {
+                        'class': 'Workflow',
+                        'inputs': {'msg': 'string'},
+                        'outputs': [],
+                        'steps': {'inner': {'run': echo, 'in': {'msg': 'msg'}, 'out': []}},
+                    },
+                },
+            },
+        }
+        tool = load_tool(workflow, CalrissianLoadingContext())
+        runtime_context = CalrissianRuntimeContext({
+            'outdir': tempfile.mkdtemp(),
+            'tmpdir_prefix': tempfile.mkdtemp(),
+            'find_default_container': lambda tool: 'debian',
+        })
+        # Until the workflow waits for the jobs to run
+        jobs = takewhile(lambda job: job is not None, tool.job({'msg': 'hello'}, Mock(), runtime_context))
+        paths = [fair_share_path(job) for job in jobs if isinstance(job, CalrissianCommandLineJob)]
+        self.assertEqual(sorted(paths), [('sub', 'inner'), ('top',)])
+
+
+@patch('calrissian.fairshare.Reporter')
+class FairShareQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.queue = FairShareQueue(Resources(1000, 10))
+
+    def enqueue(self, jobs):
+        for job in jobs:
+            self.queue.enqueue(job)
+
+    def test_cost(self, mock_reporter):
+        self.assertEqual(self.queue.cost(Resources(500, 1)), 0.5)
+        self.assertEqual(self.queue.cost(Resources(100, 5)), 0.5)
+        self.assertEqual(self.queue.cost(Resources(100, 1, 1)), 0.1)
+
+    def test_sorted_jobs_interleaves_steps(self, mock_reporter):
+        scatter = [make_job('scatter', i) for i in range(1, 6)]
+        other = [make_job('other', i) for i in range(1, 3)]
+        self.enqueue(scatter + other)
+        names = [job.name for job, _ in self.queue.sorted_jobs()]
+        self.assertEqual(names[:4], ['other', 'scatter', 'other_2', 'scatter_2'])
+
+    def test_dequeue_shares_resources(self, mock_reporter):
+        scatter = [make_job('scatter', i) for i in range(1, 11)]
+        other = [make_job('other', i) for i in range(1, 11)]
+        self.enqueue(scatter + other)
+        runnable = self.queue.dequeue(Resources(1000, 4))
+        self.assertEqual(sorted(job.name for job in runnable), ['other', 'other_2', 'scatter', 'scatter_2'])
+        self.assertAlmostEqual(self.queue.usage[('scatter',)], 0.2)
+
+    def test_dequeue_by_weight(self, mock_reporter):
+        heavy = [make_job('heavy', i, weight=3) for i in range(1, 11)]
+        light = [make_job('light', i) for i in range(1, 11)]
+        self.enqueue(heavy + light)
+        runnable = self.queue.dequeue(Resources(1000, 4))
+        self.assertEqual(len([job for job in runnable if job in heavy]), 3)
+
+    def test_dequeue_hierarchically(self, mock_reporter):
+        # The scatter of branch a competes with the steps of branch b as a whole
+        branch_a = [make_job('main/a/scatter', i) for i in range(1, 11)]
+        branch_b = [make_job('main/b/{}'.format(step)) for step in ['x', 'y', 'z', 'w']]
+        self.enqueue(branch_a + branch_b)
+        runnable = self.queue.dequeue(Resources(1000, 4))
+        self.assertEqual(len([job for job in runnable if job in branch_a]), 2)
+
+    def test_dequeue_within_concurrency_limit(self, mock_reporter):
+        ConcurrencyLimits.reset()
+        self.addCleanup(ConcurrencyLimits.reset)
+        limited = [make_job('limited', i, concurrency_limit=2) for i in range(1, 6)]
+        other = [make_job('other', i, ram=400) for i in range(1, 3)]
+        self.enqueue(limited + other)
+        runnable = self.queue.dequeue(Resources(1000, 10))
+        self.assertEqual(sorted(job.name for job in runnable), ['limited', 'limited_2', 'other', 'other_2'])
+        for job in runnable:
+            ConcurrencyLimits.started(job)
+        # Capped until a limited job finishes
+        self.assertEqual(self.queue.dequeue(Resources(1000, 10)), {})
+        ConcurrencyLimits.finished(limited[0])
+        self.assertEqual(list(self.queue.dequeue(Resources(1000, 10))), [limited[2]])
+
+    def test_sorted_jobs_puts_capped_steps_last(self, mock_reporter):
+        ConcurrencyLimits.reset()
+        self.addCleanup(ConcurrencyLimits.reset)
+        limited = [make_job('limited', i, concurrency_limit=1) for i in range(1, 4)]
+        other = [make_job('other', i) for i in range(1, 4)]
+        self.enqueue(limited + other)
+        names = [job.name for job, _ in self.queue.sorted_jobs()]
+        self.assertEqual(names, ['limited', 'other', 'other_2', 'other_3', 'limited_2', 'limited_3'])
+
+    def test_dequeue_reports_queue_wait(self, mock_reporter):
+        self.enqueue([make_job('crop')])
+        self.queue.enqueued_at = {job: 0 for job in self.queue.jobs}
+        with patch('calrissian.fairshare.time') as mock_time:
+            mock_time.monotonic.return_value = 30
+            self.queue.dequeue(Resources(1000, 10))
+        self.assertEqual(mock_reporter.add_queue_wait.call_args, call('crop', 30))
+
+    def test_release(self, mock_reporter):
+        job = make_job('crop')
+        self.enqueue([job])
+        self.queue.dequeue(Resources(1000, 10))
+        self.queue.release(job, Resources(100, 1))
+        self.assertEqual(self.queue.usage, {('crop',): 0.0})
+
+    def test_resize(self, mock_reporter):
+        job = make_job('crop')
+        self.enqueue([job])
+        self.queue.dequeue(Resources(1000, 10))
+        self.queue.resize(job, Resources(100, 1), Resources(300, 3))
+        self.assertAlmostEqual(self.queue.usage[('crop',)], 0.3)
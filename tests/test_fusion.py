@@ -0,0 +1,107 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+from cwltool.command_line_tool import CommandLineTool
+from cwltool.workflow import Workflow
+
+from calrissian.fusion import upstream_steps, compatible_tools, fuse_linear_chains, start_step_fusion
+
+
+def make_tool(image='debian:stable', resources=None):
+    tool = Mock(spec=CommandLineTool)
+    requirements = {
+        'DockerRequirement': {'class': 'DockerRequirement', 'dockerPull': image},
+        'ResourceRequirement': resources,
+    }
+    tool.get_requirement.side_effect = lambda name: (requirements.get(name), True)
+    tool.fuse_downstream = False
+    tool.fused_upstream = False
+    return tool
+
+
+def make_step(step_id, sources, tool=None, scatter=False):
+    inputs = [{'id': '{}/in{}'.format(step_id, i), 'source': source} for i, source in enumerate(sources)]
+    step_tool = {'inputs': inputs}
+    if scatter:
+        step_tool['scatter'] = inputs[0]['id']
+    step = Mock(id=step_id, tool=step_tool, embedded_tool=tool or make_tool())
+    return step
+
+
+def make_workflow(*steps):
+    workflow = Mock(spec=Workflow)
+    workflow.steps = list(steps)
+    return workflow
+
+
+class UpstreamStepsTestCase(TestCase):
+
+    def test_upstream_steps(self):
+        step = make_step('#main/sort', ['#main/rev/output', ['#main/input', '#main/other/output']])
+        self.assertEqual(upstream_steps(step, {'#main/rev', '#main/sort', '#main/other'}),
+                         {'#main/rev', '#main/other'})
+
+
+class CompatibleToolsTestCase(TestCase):
+
+    def test_compatible_tools(self):
+        self.assertTrue(compatible_tools(make_tool(), make_tool()))
+        self.assertFalse(compatible_tools(make_tool(), make_tool(image='python:3')))
+        self.assertFalse(compatible_tools(make_tool(), make_tool(resources={'coresMin': 2})))
+        self.assertFalse(compatible_tools(make_tool(), Mock()))
+
+
+class FuseLinearChainsTestCase(TestCase):
+
+    def test_fuses_linear_chain(self):
+        rev = make_step('#main/rev', ['#main/input'])
+        sort = make_step('#main/sort', ['#main/rev/output', '#main/reverse'])
+        self.assertEqual(fuse_linear_chains(make_workflow(rev, sort)), [('#main/rev', '#main/sort')])
+        self.assertTrue(rev.embedded_tool.fuse_downstream)
+        self.assertFalse(rev.embedded_tool.fused_upstream)
+        self.assertTrue(sort.embedded_tool.fused_upstream)
+
+    def test_fuses_longer_chain(self):
+        steps = [make_step('#main/a', ['#main/input']), make_step('#main/b', ['#main/a/output']),
+                 make_step('#main/c', ['#main/b/output'])]
+        self.assertEqual(sorted(fuse_linear_chains(make_workflow(*steps))),
+                         [('#main/a', '#main/b'), ('#main/b', '#main/c')])
+        self.assertTrue(steps[1].embedded_tool.fuse_downstream and steps[1].embedded_tool.fused_upstream)
+
+    def test_does_not_fuse_fan_out(self):
+        steps = [make_step('#main/a', ['#main/input']), make_step('#main/b', ['#main/a/output']),
+                 make_step('#main/c', ['#main/a/output'])]
+        self.assertEqual(fuse_linear_chains(make_workflow(*steps)), [])
+
+    def test_does_not_fuse_fan_in(self):
+        steps = [make_step('#main/a', ['#main/input']), make_step('#main/b', ['#main/input']),
+                 make_step('#main/c', ['#main/a/output', '#main/b/output'])]
+        self.assertEqual(fuse_linear_chains(make_workflow(*steps)), [])
+
+    def test_does_not_fuse_scatter(self):
+        steps = [make_step('#main/a', ['#main/input']), make_step('#main/b', ['#main/a/output'], scatter=True)]
+        self.assertEqual(fuse_linear_chains(make_workflow(*steps)), [])
+
+    def test_does_not_fuse_incompatible_tools(self):
+        steps = [make_step('#main/a', ['#main/input']),
+                 make_step('#main/b', ['#main/a/output'], tool=make_tool(image='python:3'))]
+        self.assertEqual(fuse_linear_chains(make_workflow(*steps)), [])
+        self.assertFalse(steps[0].embedded_tool.fuse_downstream)
+
+    def test_fuses_nested_workflows(self):
+        subworkflow = make_workflow(make_step('#sub/a', ['#sub/input']), make_step('#sub/b', ['#sub/a/output']))
+        workflow = make_workflow(make_step('#main/sub', ['#main/input'], tool=subworkflow))
+        self.assertEqual(fuse_linear_chains(workflow), [('#sub/a', '#sub/b')])
+
+    def test_ignores_tools(self):
+        self.assertEqual(fuse_linear_chains(make_tool()), [])
+
+
+class StartStepFusionTestCase(TestCase):
+
+    def test_marks_chains(self):
+        rev = make_step('#main/rev', ['#main/input'])
+        sort = make_step('#main/sort', ['#main/rev/output'])
+        start_step_fusion(make_workflow(rev, sort), Mock())
+        self.assertTrue(rev.embedded_tool.fuse_downstream)
+        self.assertTrue(sort.embedded_tool.fused_upstream)
@@ -0,0 +1,57 @@
+from fractions import Fraction
+from unittest import TestCase
+from unittest.mock import Mock
+
+from cwltool.errors import WorkflowException
+
+from calrissian.executor import Resources
+from calrissian.gpu import mig_resource, slice_replicas, check_gpu_share, gpu_share_resources, GPU_REPLICAS
+
+
+class GPUShareTestCase(TestCase):
+
+    def test_mig_resource(self):
+        self.assertEqual(mig_resource('1g.5gb'), 'nvidia.com/mig-1g.5gb')
+        self.assertEqual(mig_resource('nvidia.com/mig-3g.20gb'), 'nvidia.com/mig-3g.20gb')
+
+    def test_slice_replicas(self):
+        self.assertEqual(slice_replicas(0.25, 4), 1)
+        self.assertEqual(slice_replicas(0.3, 4), 2)
+        self.assertEqual(slice_replicas(0.3, 10), 3)
+        self.assertEqual(slice_replicas(0.25, 1), 1)
+
+    def test_gpu_share_resources(self):
+        resources = {'cores': 1, 'ram': 1024, 'gpus': 1}
+        shared = gpu_share_resources(resources, {'share': 0.1}, 10)
+        self.assertEqual(shared, {'cores': 1, 'ram': 1024, 'gpus': Fraction(1, 10), 'cudaDeviceCountMax': Fraction(1, 10),
+                                  GPU_REPLICAS: 1})
+        self.assertEqual(resources['gpus'], 1)
+        # The shares of ten jobs add up to a whole GPU
+        total = Resources.EMPTY
+        for _ in range(10):
+            total += Resources.from_dict(shared)
+        self.assertEqual(total, Resources(10240, 10, 1))
+
+    def test_gpu_share_resources_mig(self):
+        shared = gpu_share_resources({'cores': 1, 'ram': 1024, 'gpus': 1, 'extended': {'ephemeral-storage': 10}},
+                                     {'migProfile': '1g.5gb', 'migCount': 2}, 1)
+        self.assertEqual(shared['gpus'], 0)
+        self.assertEqual(shared[GPU_REPLICAS], 0)
+        self.assertEqual(shared['extended'], {'ephemeral-storage': 10, 'nvidia.com/mig-1g.5gb': 2})
+
+    def test_check_gpu_share(self):
+        check_gpu_share({'share': 0.5}, Mock(resource_pools=None, max_gpus='2'))
+        check_gpu_share({'migProfile': '1g.5gb'}, Mock(resource_pools=None, max_resource=['nvidia.com/mig-1g.5gb=7']))
+        check_gpu_share({'share': 0.5}, Mock(resource_pools='pools.yaml', max_gpus=None))
+
+    def test_check_gpu_share_without_max_gpus(self):
+        with self.assertRaisesRegex(WorkflowException, '--max-gpus'):
+            check_gpu_share({'share': 0.5}, Mock(resource_pools=None, max_gpus=None))
+
+    def test_check_gpu_share_without_max_mig_resource(self):
+        with self.assertRaisesRegex(WorkflowException, '--max-resource nvidia.com/mig-1g.5gb='):
+            check_gpu_share({'migProfile': '1g.5gb'}, Mock(resource_pools=None, max_gpus='2', max_resource=None))
+
+    def test_gpu_share_resources_raises(self):
+        with self.assertRaisesRegex(WorkflowException, 'more than 0'):
+            gpu_share_resources({}, {'share': 0}, 4)
@@ -0,0 +1,92 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from calrissian.history import UsageHistory, percentile, clamp
+
+
+class PercentileTestCase(TestCase):
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3]
+        self.assertEqual(percentile(values, 100), 5)
+        self.assertEqual(percentile(values, 80), 4)
+        self.assertEqual(percentile(values, 50), 3)
+        self.assertEqual(percentile(values, 0), 1)
+
+    def test_clamp(self):
+        self.assertEqual(clamp(5, 1, 10), 5)
+        self.assertEqual(clamp(0, 1, 10), 1)
+        self.assertEqual(clamp(20, 1, 10), 10)
+
+
+class UsageHistoryTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'history', 'usage.sqlite')
+        UsageHistory.initialize(self.path, right_sizing=True, percentile=100)
+
+    def tearDown(self):
+        UsageHistory.path = None
+        UsageHistory.right_sizing = False
+        self.tmpdir.cleanup()
+
+    def record_runs(self, tool, peaks):
+        for peak_cpus, peak_ram_megabytes in peaks:
+            UsageHistory.record(tool, 'step', peak_cpus, peak_ram_megabytes)
+
+    def test_initialize(self):
+        self.assertTrue(os.path.isfile(self.path))
+        self.assertTrue(UsageHistory.is_enabled())
+        self.assertTrue(UsageHistory.is_right_sizing())
+        UsageHistory.right_sizing = False
+        self.assertFalse(UsageHistory.is_right_sizing())
+
+    def test_observations(self):
+        self.record_runs('tool.cwl@debian', [(0.5, 100), (1.5, 200)])
+        self.record_runs('other.cwl@debian', [(2, 300)])
+        self.assertEqual(sorted(UsageHistory.observations('tool.cwl@debian')), [(0.5, 100), (1.5, 200)])
+
+    def test_observations_persist(self):
+        self.record_runs('tool.cwl@debian', [(0.5, 100)])
+        UsageHistory.initialize(self.path)
+        self.assertEqual(UsageHistory.observations('tool.cwl@debian'), [(0.5, 100)])
+
+    @patch('calrissian.history.HISTORY_WINDOW', 2)
+    def test_observations_of_recent_runs(self):
+        self.record_runs('tool.cwl@debian', [(4, 400), (1, 100), (2, 200)])
+        self.assertEqual(sorted(UsageHistory.observations('tool.cwl@debian')), [(1, 100), (2, 200)])
+
+    def test_right_size(self):
+        self.record_runs('tool.cwl@debian', [(0.5, 100), (1.0, 500), (0.2, 200)])
+        resources = {'cores': 1, 'ram': 256, 'coresMax': 8, 'ramMax': 16384}
+        right_sized = UsageHistory.right_size('tool.cwl@debian', resources)
+        self.assertEqual(right_sized, {'cores': 1.2, 'ram': 600, 'coresMax': 8, 'ramMax': 16384})
+        # The resources of the job are left unchanged
+        self.assertEqual(resources['ram'], 256)
+
+    def test_right_size_within_max(self):
+        self.record_runs('tool.cwl@debian', [(0.01, 1), (4.0, 4096), (3.0, 1024)])
+        right_sized = UsageHistory.right_size('tool.cwl@debian', {'cores': 2, 'ram': 2048,
+                                                                  'coresMax': 2, 'ramMax': 3072})
+        self.assertEqual(right_sized['cores'], 2)
+        self.assertEqual(right_sized['ram'], 3072)
+
+    def test_right_size_within_min(self):
+        self.record_runs('tool.cwl@debian', [(0.01, 1), (0.01, 1), (0.01, 1)])
+        right_sized = UsageHistory.right_size('tool.cwl@debian', {'cores': 2, 'ram': 2048,
+                                                                  'coresMax': 4, 'ramMax': 4096})
+        self.assertEqual(right_sized['cores'], 2)
+        self.assertEqual(right_sized['ram'], 2048)
+
+    def test_right_size_needs_observations(self):
+        self.record_runs('tool.cwl@debian', [(0.5, 100), (1.0, 500)])
+        resources = {'cores': 8, 'ram': 16384}
+        self.assertEqual(UsageHistory.right_size('tool.cwl@debian', resources), resources)
+
+    def test_right_size_without_cpu_samples(self):
+        self.record_runs('tool.cwl@debian', [(None, 100), (None, 100), (None, 100)])
+        right_sized = UsageHistory.right_size('tool.cwl@debian', {'cores': 8, 'ram': 64, 'ramMax': 16384})
+        self.assertEqual(right_sized, {'cores': 8, 'ram': 120, 'ramMax': 16384})
@@ -0,0 +1,85 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from calrissian.iobudget import IOBudget, io_weight_of
+
+
+def make_job(io_weight=2):
+    return Mock(io_weight=io_weight, jobs=None)
+
+
+class IOWeightOfTestCase(TestCase):
+
+    def test_io_weight_of(self):
+        self.assertEqual(io_weight_of(make_job()), 2)
+        self.assertEqual(io_weight_of(Mock(jobs=None)), 0)
+
+    def test_io_weight_of_batch(self):
+        self.assertEqual(io_weight_of(Mock(jobs=[make_job(), make_job(), make_job()], parallelism=2)), 4)
+
+
+class IOBudgetTestCase(TestCase):
+
+    def setUp(self):
+        IOBudget.initialize(4)
+
+    def tearDown(self):
+        IOBudget.initialize(None)
+
+    def test_can_admit_when_disabled(self):
+        IOBudget.initialize(None)
+        self.assertTrue(IOBudget.can_admit(make_job(8), {make_job(8): None}))
+
+    def test_can_admit_without_weight(self):
+        IOBudget.started(make_job(4))
+        self.assertTrue(IOBudget.can_admit(make_job(0), {}))
+
+    def test_can_admit_within_budget(self):
+        IOBudget.started(make_job(2))
+        self.assertTrue(IOBudget.can_admit(make_job(2), {}))
+        self.assertFalse(IOBudget.can_admit(make_job(2), {make_job(1): None}))
+
+    def test_can_admit_heavier_job_alone(self):
+        self.assertTrue(IOBudget.can_admit(make_job(8), {}))
+        self.assertFalse(IOBudget.can_admit(make_job(8), {make_job(1): None}))
+
+    def test_has_room(self):
+        IOBudget.started(make_job(2))
+        self.assertTrue(IOBudget.has_room(make_job(1), [make_job(1)]))
+        self.assertFalse(IOBudget.has_room(make_job(2), [make_job(1)]))
+        # Without holding the job back
+        self.assertEqual(IOBudget.held, {})
+
+    def test_has_room_for_heavier_job_alone(self):
+        self.assertFalse(IOBudget.has_room(make_job(8), []))
+
+    def test_started_and_finished(self):
+        job = make_job(3)
+        IOBudget.started(job)
+        IOBudget.started(make_job(1))
+        self.assertEqual(IOBudget.in_use, 4)
+        IOBudget.finished(job)
+        self.assertEqual(IOBudget.in_use, 1)
+        self.assertEqual(IOBudget.peak_in_use, 4)
+
+    @patch('calrissian.iobudget.time')
+    def test_reports_io_wait(self, mock_time):
+        IOBudget.started(make_job(4))
+        held = [make_job(2), make_job(2)]
+        mock_time.monotonic.return_value = 100
+        for job in held:
+            self.assertFalse(IOBudget.can_admit(job, {}))
+        mock_time.monotonic.return_value = 110
+        # Held back again, still waiting since the first time
+        self.assertFalse(IOBudget.can_admit(held[0], {}))
+        IOBudget.in_use = 0
+        IOBudget.started(held[0])
+        mock_time.monotonic.return_value = 130
+        IOBudget.started(held[1])
+        self.assertEqual(IOBudget.to_dict(), {
+            'budget': 4,
+            'peak_weight': 4,
+            'held_tasks': 2,
+            'total_io_wait_seconds': 40.0,
+            'max_io_wait_seconds': 30.0,
+        })
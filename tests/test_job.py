@@ -1,15 +1,23 @@
 import os
+import tempfile
+import subprocess
 from unittest import TestCase, skip
 from unittest.mock import Mock, patch, call, create_autospec
 from calrissian.job import k8s_safe_name, KubernetesVolumeBuilder, VolumeBuilderException, KubernetesPodBuilder, random_tag, read_yaml
 from calrissian.job import CalrissianCommandLineJob, KubernetesPodVolumeInspector, CalrissianCommandLineJobException, total_size, quoted_arg_list
-from calrissian.job import INIT_IMAGE_ENV_VARIABLE, DEFAULT_INIT_IMAGE
+from calrissian.job import INIT_IMAGE_ENV_VARIABLE, DEFAULT_INIT_IMAGE, outputs_exist, is_pinned_by_digest
 from cwltool.errors import UnsupportedRequirement
+from cwltool.pathmapper import MapperEnt
 from calrissian.context import CalrissianRuntimeContext
-from calrissian.k8s import CompletionResult
+from calrissian.k8s import CompletionResult, PodDisruptedException, CalrissianJobException
+from calrissian.executor import Resources, ResourcePool
+from calrissian.journal import Journal
+from calrissian.pool import RUNNER_OUTDIR, RUNNER_STAGEDIR
 import threading
 from collections import OrderedDict
 
+PINNED_IMAGE = 'debian@sha256:' + '0123456789abcdef' * 4
+
 class SafeNameTestCase(TestCase):
 
     def setUp(self):
@@ -137,6 +145,14 @@ class KubernetesVolumeBuilderTestCase(TestCase):
         self.assertIsNotNone(self.volume_builder.find_persistent_volume('/prefix/1f'))
         self.assertIsNone(self.volume_builder.find_persistent_volume('/notfound'))
 
+    def test_finds_persistent_volume_of_longest_prefix(self):
+        self.volume_builder.add_persistent_volume_entry('/out10', None, 'claim10', False)
+        self.volume_builder.add_persistent_volume_entry('/out1', None, 'claim1', False)
+        self.volume_builder.add_persistent_volume_entry('/', None, 'root-claim', False)
+        self.assertEqual(self.volume_builder.find_persistent_volume('/out10/abc')['volume']['name'], 'claim10')
+        self.assertEqual(self.volume_builder.find_persistent_volume('/out1/abc')['volume']['name'], 'claim1')
+        self.assertEqual(self.volume_builder.find_persistent_volume('/data/abc')['volume']['name'], 'root-claim')
+
     def test_calculates_subpath(self):
         subpath = KubernetesVolumeBuilder.calculate_subpath('/prefix/1/foo', '/prefix/1', None)
         self.assertEqual('foo', subpath)
@@ -157,6 +173,7 @@ class KubernetesVolumeBuilderTestCase(TestCase):
         self.assertEqual(0, len(self.volume_builder.volume_mounts))
         self.volume_builder.add_volume_binding('/prefix/1/input1', '/input1-target', True)
         self.assertEqual({'name': 'claim1', 'mountPath': '/input1-target', 'readOnly': False, 'subPath': 'input1'}, self.volume_builder.volume_mounts[0])
+        self.assertEqual([('/prefix/1/input1', '/input1-target')], self.volume_builder.volume_bindings)
 
     def test_add_ro_volume_binding(self):
         # read-only
@@ -178,6 +195,21 @@ class KubernetesVolumeBuilderTestCase(TestCase):
         self.volume_builder.add_emptydir_volume('empty-volume')
         self.assertIn('empty-volume', self.volume_builder.emptydir_volume_names)
 
+    def test_add_hostpath_volume_binding(self):
+        self.volume_builder.add_hostpath_volume('reference-cache', '/mnt/reference-cache')
+        self.volume_builder.add_hostpath_volume_binding('reference-cache', '/refs/genome.fa', 'abc/data')
+        self.assertEqual(self.volume_builder.volumes, [
+            {'name': 'reference-cache', 'hostPath': {'path': '/mnt/reference-cache', 'type': 'DirectoryOrCreate'}}])
+        self.assertEqual(self.volume_builder.volume_mounts, [
+            {'name': 'reference-cache', 'mountPath': '/refs/genome.fa', 'subPath': 'abc/data', 'readOnly': True}])
+        with self.assertRaisesRegex(VolumeBuilderException, 'Could not find a hostPath volume'):
+            self.volume_builder.add_hostpath_volume_binding('other', '/refs/other.fa', 'def/data')
+
+    def test_add_emptydir_volume_in_memory(self):
+        self.volume_builder.add_emptydir_volume('tmpdir', medium='Memory', size_megabytes=2048)
+        self.assertEqual(self.volume_builder.volumes,
+                         [{'name': 'tmpdir', 'emptyDir': {'medium': 'Memory', 'sizeLimit': '2048Mi'}}])
+
     def test_add_emptydir_volume_binding(self):
         self.volume_builder.add_emptydir_volume('empty-volume')
         self.volume_builder.add_emptydir_volume_binding('empty-volume', '/path/to/empty')
@@ -322,6 +354,26 @@ class KubernetesPodBuilderTestCase(TestCase):
     def test_container_args_with_redirects(self):
         self.assertEqual(['cat > stdout.txt 2> stderr.txt < stdin.txt'], self.pod_builder.container_args())
 
+    def test_container_args_with_copy_back(self):
+        self.builder.outdir = '/out'
+        self.pod_builder.copy_back_dir = '/calrissian/copy-back'
+        self.assertEqual(['command -v tar > /dev/null || '
+                          '{ echo \'calrissian: --scratch-outdir requires tar in the image of the step\' >&2; exit 127; }; '
+                          '( cat > stdout.txt 2> stderr.txt < stdin.txt ); status=$?; '
+                          'tar -C /out -cf - . | tar -C /calrissian/copy-back -xf - || [ $status -ne 0 ] || status=1; '
+                          'exit $status'], self.pod_builder.container_args())
+
+    def test_copy_back_fails_without_tar(self):
+        self.builder.outdir = tempfile.mkdtemp()
+        self.pod_builder.copy_back_dir = tempfile.mkdtemp()
+        script = self.pod_builder.with_copy_back('touch ran')
+        # A PATH without tar
+        result = subprocess.run(['/bin/sh', '-c', script], cwd=self.builder.outdir, capture_output=True, text=True,
+                                env={'PATH': tempfile.mkdtemp()})
+        self.assertEqual(result.returncode, 127)
+        self.assertIn('requires tar in the image', result.stderr)
+        self.assertFalse(os.path.exists(os.path.join(self.builder.outdir, 'ran')))
+
     def test_container_environment(self):
         environment = self.pod_builder.container_environment()
         self.assertEqual(len(self.environment), len(environment))
@@ -401,6 +453,26 @@ class KubernetesPodBuilderTestCase(TestCase):
         }
         self.assertEqual(expected, resources)
 
+    def test_container_resources_extended(self):
+        self.pod_builder.resources = {'cores': 2, 'ram': 256,
+                                      'extended': {'ephemeral-storage': 3072.0, 'hugepages-2Mi': 512.0,
+                                                   'example.com/fpga': 1.0}}
+        resources = self.pod_builder.container_resources()
+        expected = {
+            'requests': {
+                'cpu': '2',
+                'memory': '256Mi',
+                'ephemeral-storage': '3072Mi',
+                'hugepages-2Mi': '512Mi',
+                'example.com/fpga': '1'
+            },
+            'limits': {
+                'hugepages-2Mi': '512Mi',
+                'example.com/fpga': '1'
+            }
+        }
+        self.assertEqual(expected, resources)
+
     def test_gpu_hints(self):
         self.pod_builder.resources = {'cores': 2, 'ram': 256 }
         self.pod_builder.requirements = [OrderedDict([("class", "cwltool:CUDARequirement"), ("cudaVersionMin", '10.0'), ("cudaComputeCapability", '3.0'), ("cudaDeviceCountMin", 1), ("cudaDeviceCountMax", 1)])]
@@ -451,6 +523,30 @@ class KubernetesPodBuilderTestCase(TestCase):
         self.pod_builder.labels = {'key1': 123}
         self.assertEqual(self.pod_builder.pod_labels(), {"calrissian-network": "disabled", 'key1':'123'})
         
+    def test_gpu_share_resources(self):
+        self.pod_builder.resources = {'cores': 2, 'ram': 256, 'gpus': 0.25, 'gpuReplicas': 2}
+        # The GPUShare replaces the whole GPUs of the CUDARequirement
+        self.pod_builder.requirements = [OrderedDict([("class", "cwltool:CUDARequirement"), ("cudaDeviceCountMin", 1), ("cudaDeviceCountMax", 1)])]
+        resources = self.pod_builder.container_resources()
+        self.assertEqual(resources, {
+            'requests': {'cpu': '2', 'memory': '256Mi', 'nvidia.com/gpu': '2'},
+            'limits': {'nvidia.com/gpu': '2'}
+        })
+
+    def test_mig_resources(self):
+        self.pod_builder.resources = {'cores': 2, 'ram': 256, 'gpus': 0, 'gpuReplicas': 0,
+                                      'extended': {'nvidia.com/mig-1g.5gb': 1}}
+        resources = self.pod_builder.container_resources()
+        self.assertEqual(resources, {
+            'requests': {'cpu': '2', 'memory': '256Mi', 'nvidia.com/mig-1g.5gb': '1'},
+            'limits': {'nvidia.com/mig-1g.5gb': '1'}
+        })
+
+    def test_gpu_share_nodeselectors(self):
+        self.pod_builder.resources = {'cores': 2, 'ram': 256, 'gpus': 0, 'gpuReplicas': 0}
+        self.pod_builder.gpu_nodeselectors = {'gpu': "true"}
+        self.assertEqual(self.pod_builder.select_pod_nodeselectors(), {'gpu': "true"})
+
     def test_string_nodeselectors(self):
         self.pod_builder.nodeselectors = {'cachelevel': 2}
         self.assertEqual(self.pod_builder.select_pod_nodeselectors(), {'cachelevel':'2'})
@@ -503,6 +599,17 @@ class KubernetesPodBuilderTestCase(TestCase):
         self.assertEqual(container['command'], ['/bin/sh','-c','mkdir -p out/to; mkdir -p err/to;'])
         self.assertEqual(container['volumeMounts'], self.pod_builder.volume_mounts)
 
+    def test_init_containers_with_reference_cache(self):
+        self.pod_builder.stdout = None
+        self.pod_builder.stderr = None
+        volume_mounts = [{'name': 'reference-cache', 'mountPath': '/calrissian/reference-cache'}]
+        self.pod_builder.reference_cache = ('<script>', volume_mounts)
+        init_containers = self.pod_builder.init_containers()
+        self.assertEqual(len(init_containers), 1)
+        self.assertEqual(init_containers[0]['name'], 'podname-cache')
+        self.assertEqual(init_containers[0]['command'], ['/bin/sh', '-c', '<script>'])
+        self.assertEqual(init_containers[0]['volumeMounts'], volume_mounts)
+
     @patch('calrissian.job.os.environ.get')
     def test_init_container_name_default(self, mock_environ_get):
         mock_environ_get.return_value = 'custom-init:1.0'
@@ -566,13 +673,18 @@ class KubernetesPodBuilderTestCase(TestCase):
         }
         self.assertEqual(expected, self.pod_builder.build())
 
+    def test_build_with_active_deadline_seconds(self):
+        self.assertNotIn('activeDeadlineSeconds', self.pod_builder.build()['spec'])
+        self.pod_builder.active_deadline_seconds = 600
+        self.assertEqual(self.pod_builder.build()['spec']['activeDeadlineSeconds'], 600)
+
 
 @patch('calrissian.job.KubernetesClient')
 @patch('calrissian.job.KubernetesVolumeBuilder')
 class CalrissianCommandLineJobTestCase(TestCase):
 
     def setUp(self):
-        self.builder = Mock(outdir='/out')
+        self.builder = Mock(outdir='/out', resources={})
         self.joborder = Mock()
         self.make_path_mapper = Mock()
         self.requirements = [{'class': 'DockerRequirement', 'dockerPull': 'dockerimage:1.0'}]
@@ -591,7 +703,9 @@ class CalrissianCommandLineJobTestCase(TestCase):
 
     def make_completion_result(self, exit_code):
         return create_autospec(CompletionResult, pod_name=self.name, exit_code=exit_code, cpus='1', memory='1', start_time=Mock(),
-                        finish_time=Mock(), pod_log='logs/', node_selectors={})
+                        finish_time=Mock(), pod_log='logs/', node_selectors={}, reason=None,
+                        peak_cpus=None, peak_ram_megabytes=None, mean_cpus=None, mean_ram_megabytes=None,
+                        extended_resources={})
 
     def test_constructor_calculates_persistent_volume_entries(self, mock_volume_builder, mock_client):
         self.make_job()
@@ -742,7 +856,7 @@ class CalrissianCommandLineJobTestCase(TestCase):
         job = self.make_job()
         job.outdir = '/outdir'
         job.tmpdir = '/tmpdir'
-        mock_runtime_context = Mock(tmpdir_prefix='TP', pod_serviceaccount=None)
+        mock_runtime_context = Mock(tmpdir_prefix='TP', pod_serviceaccount=None, scratch_outdir=False)
         built = job.create_kubernetes_runtime(mock_runtime_context)
         # Adds volume binding for outdir
         self.assertEqual(mock_add_volume_binding.call_args, call('/real/outdir', '/out', True))
@@ -770,12 +884,64 @@ class CalrissianCommandLineJobTestCase(TestCase):
             job.get_pod_additional_spec(mock_runtime_context),
             mock_read_yaml.return_value,
             mock_read_yaml.return_value,
+            copy_back_dir=None,
+            reference_cache=None,
         ))
         # calls builder.build
         # returns that
         self.assertTrue(mock_pod_builder.return_value.build.called)
         self.assertEqual(built, mock_pod_builder.return_value.build.return_value)
 
+    @patch('calrissian.job.KubernetesPodBuilder')
+    @patch('calrissian.job.read_yaml')
+    def test_create_kubernetes_runtime_with_memory_tmpdir(self, mock_read_yaml, mock_pod_builder, mock_volume_builder,
+                                                          mock_client):
+        job = self.make_job()
+        job.outdir = '/outdir'
+        job.memory_tmpdir_megabytes = 2048
+        mock_pod_builder.return_value.build.return_value = '<built pod>'
+        job.create_kubernetes_runtime(Mock(tmpdir_prefix='TP', pod_serviceaccount=None, scratch_outdir=False))
+        add_emptydir_volume = mock_volume_builder.return_value.add_emptydir_volume
+        self.assertEqual(add_emptydir_volume.call_args, call('tmpdir', medium='Memory', size_megabytes=2048))
+        self.assertEqual(mock_volume_builder.return_value.add_emptydir_volume_binding.call_args, call('tmpdir', '/tmp'))
+
+    def test_uses_scratch_outdir(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.generatemapper = None
+        job.pathmapper = {'input.txt': MapperEnt('/data/input.txt', '/var/lib/cwl/stg1/input.txt', 'File', True)}
+        self.assertFalse(job.uses_scratch_outdir(Mock(scratch_outdir=False)))
+        self.assertTrue(job.uses_scratch_outdir(Mock(scratch_outdir=True)))
+        # Inputs staged into the outdir stay on the shared volume
+        job.generatemapper = {'conf': MapperEnt('/data/conf', '/out/conf', 'WritableFile', True)}
+        self.assertFalse(job.uses_scratch_outdir(Mock(scratch_outdir=True)))
+
+    def test_add_scratch_outdir_volume(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.outdir = '/calrissian/out'
+        job.volume_builder = KubernetesVolumeBuilder()
+        job.volume_builder.add_persistent_volume_entry('/calrissian', None, 'claim1', False)
+        job.add_scratch_outdir_volume(Mock(scratch_storage_class=None))
+        self.assertIn({'name': 'scratch-outdir', 'emptyDir': {}}, job.volume_builder.volumes)
+        self.assertEqual(job.volume_builder.volume_mounts, [
+            {'name': 'scratch-outdir', 'mountPath': '/out'},
+            {'name': 'claim1', 'mountPath': '/calrissian/copy-back', 'subPath': 'out', 'readOnly': False},
+        ])
+        self.assertEqual(job.copy_back_dir, '/calrissian/copy-back')
+
+    def test_add_scratch_outdir_ephemeral_volume(self, mock_volume_builder, mock_client):
+        self.builder.resources = {'outdirSize': 2048}
+        job = self.make_job()
+        job.outdir = '/calrissian/out'
+        job.volume_builder = KubernetesVolumeBuilder()
+        job.volume_builder.add_persistent_volume_entry('/calrissian', None, 'claim1', False)
+        job.add_scratch_outdir_volume(Mock(scratch_storage_class='local-nvme'))
+        volume = job.volume_builder.volumes[-1]
+        self.assertEqual(volume['name'], 'scratch-outdir')
+        self.assertEqual(volume['ephemeral']['volumeClaimTemplate']['spec']['storageClassName'], 'local-nvme')
+        self.assertEqual(volume['ephemeral']['volumeClaimTemplate']['spec']['resources'],
+                         {'requests': {'storage': '2048Mi'}})
+        self.assertEqual(job.volume_builder.ephemeral_volume_names, ['scratch-outdir'])
+
     def test_execute_kubernetes_pod(self, mock_volume_builder, mock_client):
         job = self.make_job()
         k8s_pod = Mock()
@@ -792,6 +958,57 @@ class CalrissianCommandLineJobTestCase(TestCase):
         # It should add the volume binding with writable=False
         self.assertEqual(mock_add_volume_binding.call_args, call('/resolved', '/target', False))
 
+    @patch('calrissian.job.ReferenceCache')
+    def test_add_file_or_directory_volume_from_reference_cache(self, mock_reference_cache, mock_volume_builder,
+                                                               mock_client):
+        mock_reference_cache.caches.return_value = True
+        mock_reference_cache.directory = '/mnt/reference-cache'
+        mock_reference_cache.entry_key.return_value = 'abc'
+        self.joborder = {'genome': {'class': 'File', 'location': 'file:///calrissian/refs/genome.fa',
+                                    'checksum': 'sha1$123'}}
+        job = self.make_job()
+        job.builder.job = self.joborder
+        job.volume_builder = KubernetesVolumeBuilder()
+        volume = MapperEnt('/calrissian/refs/genome.fa', '/var/lib/cwl/stg1/genome.fa', 'File', True)
+        job.add_file_or_directory_volume([], volume, None)
+        self.assertEqual(mock_reference_cache.entry_key.call_args, call('/calrissian/refs/genome.fa', 'sha1$123'))
+        self.assertEqual(job.volume_builder.volume_mounts, [
+            {'name': 'reference-cache', 'mountPath': '/var/lib/cwl/stg1/genome.fa', 'subPath': 'abc/data',
+             'readOnly': True}])
+        self.assertEqual(job.reference_cache_entries, [('abc', '/calrissian/refs/genome.fa')])
+        # Directories are mounted from the shared volume
+        job.volume_builder.add_persistent_volume_entry('/calrissian', None, 'claim1', False)
+        job.add_file_or_directory_volume([], MapperEnt('/calrissian/refs/index', '/index', 'Directory', True), None)
+        self.assertEqual(job.volume_builder.volume_bindings, [('/calrissian/refs/index', '/index')])
+
+    @patch('calrissian.job.ReferenceCache')
+    @patch('calrissian.job.os.path.getsize')
+    def test_add_reference_cache_init(self, mock_getsize, mock_reference_cache, mock_volume_builder, mock_client):
+        mock_getsize.return_value = 2048
+        mock_reference_cache.max_bytes = 1024 * 1024
+        job = self.make_job()
+        job.tmpdir = tempfile.mkdtemp(dir='/tmp')
+        job.volume_builder = KubernetesVolumeBuilder()
+        job.volume_builder.add_persistent_volume_entry('/', None, 'claim1', False)
+        job.reference_cache_entries = [('abc', '/calrissian/refs/genome.fa'), ('abc', '/calrissian/refs/genome.fa')]
+        job.add_reference_cache_init()
+        script, volume_mounts = job.reference_cache
+        self.assertEqual(script.count('cp '), 1)
+        self.assertEqual([mount['mountPath'] for mount in volume_mounts],
+                         ['/calrissian/reference-cache', '/calrissian/reference-stats', '/calrissian/reference-sources/0'])
+        self.assertEqual(volume_mounts[2]['subPath'], 'calrissian/refs/genome.fa')
+        self.assertTrue(volume_mounts[2]['readOnly'])
+        self.assertTrue(job.reference_cache_stats_dir.startswith(job.tmpdir))
+
+    @patch('calrissian.job.ReferenceCache')
+    @patch('calrissian.job.Reporter')
+    def test_finish_records_reference_cache_stats(self, mock_reporter, mock_reference_cache, mock_volume_builder,
+                                                  mock_client):
+        job = self.make_job()
+        job.reference_cache_stats_dir = '/tmp/stats'
+        job.finish(self.make_completion_result(0), self.runtime_context)
+        self.assertEqual(mock_reference_cache.record.call_args, call(job.name, '/tmp/stats'))
+
     def test_ignores_add_file_or_directory_volume_with_under_colon(self, mock_volume_builder, mock_client):
         mock_add_volume_binding = mock_volume_builder.return_value.add_volume_binding
         job = self.make_job()
@@ -879,6 +1096,279 @@ class CalrissianCommandLineJobTestCase(TestCase):
         self.assertTrue(job.wait_for_kubernetes_pod.called)
         self.assertEqual(job.finish.call_args, call(job.wait_for_kubernetes_pod.return_value, self.runtime_context))
 
+    def test_run_in_runner_pool_does_not_submit(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.make_tmpdir = Mock()
+        job.populate_env_vars = Mock()
+        job._setup = Mock()
+        job.create_kubernetes_runtime = Mock()
+        job.execute_in_runner_pool = Mock(return_value=self.make_completion_result(0))
+        job.execute_kubernetes_pod = Mock()
+        job.record_submission = Mock()
+        job.wait_for_kubernetes_pod = Mock()
+        job.finish = Mock()
+
+        job.run(self.runtime_context)
+        self.assertEqual(job.execute_in_runner_pool.call_args, call(job.create_kubernetes_runtime.return_value))
+        self.assertFalse(job.execute_kubernetes_pod.called)
+        self.assertFalse(job.record_submission.called)
+        self.assertFalse(job.wait_for_kubernetes_pod.called)
+        self.assertEqual(job.finish.call_args, call(job.execute_in_runner_pool.return_value, self.runtime_context))
+
+    @patch('calrissian.job.RunnerPool')
+    def test_can_run_in_runner_pool(self, mock_runner_pool, mock_volume_builder, mock_client):
+        mock_runner_pool.is_enabled.return_value = True
+        job = self.make_job()
+        job.volume_builder = KubernetesVolumeBuilder()
+        job.volume_builder.add_emptydir_volume('tmpdir')
+        job.volume_builder.volume_bindings = [('/calrissian/out', RUNNER_OUTDIR),
+                                              ('/calrissian/input.txt', RUNNER_STAGEDIR + '/stg1/input.txt')]
+        self.assertTrue(job.can_run_in_runner_pool())
+        job.volume_builder.volume_bindings.append(('/calrissian/input.txt', '/input.txt'))
+        self.assertFalse(job.can_run_in_runner_pool())
+
+    @patch('calrissian.job.RunnerPool')
+    def test_cannot_run_in_runner_pool_with_env_from(self, mock_runner_pool, mock_volume_builder, mock_client):
+        mock_runner_pool.is_enabled.return_value = True
+        job = self.make_job()
+        job.volume_builder = KubernetesVolumeBuilder()
+        pod = {'spec': {'containers': [{'env': [{'name': 'HOME', 'value': RUNNER_OUTDIR}],
+                                        'envFrom': [{'secretRef': {'name': 'secret1'}}]}]}}
+        self.assertFalse(job.can_run_in_runner_pool(pod))
+        self.assertIsNone(job.execute_in_runner_pool(pod))
+        self.assertFalse(mock_runner_pool.execute.called)
+
+    @patch('calrissian.job.RunnerPool')
+    def test_cannot_run_in_runner_pool_with_scratch_outdir(self, mock_runner_pool, mock_volume_builder, mock_client):
+        mock_runner_pool.is_enabled.return_value = True
+        job = self.make_job()
+        job.volume_builder = KubernetesVolumeBuilder()
+        job.volume_builder.add_ephemeral_volume('scratch-outdir', 'local-nvme', 1024)
+        self.assertFalse(job.can_run_in_runner_pool())
+
+    @patch('calrissian.job.RunnerPool')
+    def test_cannot_run_in_runner_pool_with_memory_tmpdir(self, mock_runner_pool, mock_volume_builder, mock_client):
+        mock_runner_pool.is_enabled.return_value = True
+        job = self.make_job()
+        job.volume_builder = KubernetesVolumeBuilder()
+        job.memory_tmpdir_megabytes = 1024
+        self.assertFalse(job.can_run_in_runner_pool())
+
+    @patch('calrissian.job.RunnerPool')
+    def test_cannot_run_in_runner_pool_with_reference_cache(self, mock_runner_pool, mock_volume_builder, mock_client):
+        mock_runner_pool.is_enabled.return_value = True
+        job = self.make_job()
+        job.volume_builder = KubernetesVolumeBuilder()
+        job.reference_cache_entries = [('abc', '/calrissian/refs/genome.fa')]
+        self.assertFalse(job.can_run_in_runner_pool())
+
+    @patch('calrissian.job.RunnerPool')
+    def test_cannot_run_in_runner_pool_with_timelimit(self, mock_runner_pool, mock_volume_builder, mock_client):
+        mock_runner_pool.is_enabled.return_value = True
+        job = self.make_job()
+        job.volume_builder = KubernetesVolumeBuilder()
+        job.timelimit = 600
+        self.assertFalse(job.can_run_in_runner_pool())
+
+    @patch('calrissian.job.RunnerPool')
+    def test_cannot_run_in_runner_pool_with_other_volumes(self, mock_runner_pool, mock_volume_builder, mock_client):
+        mock_runner_pool.is_enabled.return_value = True
+        job = self.make_job()
+        job.volume_builder = KubernetesVolumeBuilder()
+        job.volume_builder.add_configmap_volume('script', 'dask-script')
+        self.assertFalse(job.can_run_in_runner_pool())
+
+    def test_cannot_run_in_disabled_runner_pool(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        self.assertFalse(job.can_run_in_runner_pool())
+        self.assertIsNone(job.execute_in_runner_pool(Mock()))
+
+    @patch('calrissian.job.RunnerPool')
+    def test_execute_in_runner_pool(self, mock_runner_pool, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.can_run_in_runner_pool = Mock(return_value=True)
+        mock_pod = Mock()
+        self.assertEqual(job.execute_in_runner_pool(mock_pod), mock_runner_pool.execute.return_value)
+        self.assertEqual(mock_runner_pool.execute.call_args,
+                         call(mock_pod, job.volume_builder.volume_bindings,
+                              job.volume_builder.persistent_volume_entries.values.return_value,
+                              input_paths=None, hold_outdir=None))
+
+    @patch('calrissian.job.RunnerPool')
+    def test_execute_fused_steps_in_runner_pool(self, mock_runner_pool, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.can_run_in_runner_pool = Mock(return_value=True)
+        job.fuse_downstream = True
+        job.fused_upstream = True
+        job.outdir = '/calrissian/tmpout/out2'
+        job.pathmapper = Mock()
+        job.pathmapper.items.return_value = [('file:///calrissian/tmpout/out1/rev.txt',
+                                              Mock(resolved='/calrissian/tmpout/out1/rev.txt'))]
+        job.execute_in_runner_pool(Mock())
+        self.assertEqual(mock_runner_pool.execute.call_args[1],
+                         {'input_paths': ['/calrissian/tmpout/out1/rev.txt'], 'hold_outdir': '/calrissian/tmpout/out2'})
+
+    @patch('calrissian.retry.RetryParameters')
+    def test_submit_resubmits_disrupted_pod(self, mock_retry_parameters, mock_volume_builder, mock_client):
+        mock_retry_parameters.MULTIPLIER, mock_retry_parameters.MIN, mock_retry_parameters.MAX = 0, 0, 0
+        job = self.make_job()
+        job.execute_kubernetes_pod = Mock()
+        job.record_submission = Mock()
+        job.build_kubernetes_pod = Mock()
+        job.wait_for_kubernetes_pod = Mock(side_effect=[PodDisruptedException('Evicted'), Mock(exit_code=0)])
+        self.runtime_context.max_pod_resubmissions = 2
+        mock_pod = Mock()
+
+        completion_result = job.submit_kubernetes_pod(mock_pod, self.runtime_context)
+        self.assertEqual(completion_result.exit_code, 0)
+        self.assertEqual(job.execute_kubernetes_pod.call_args_list,
+                         [call(mock_pod), call(job.build_kubernetes_pod.return_value)])
+        self.assertEqual(job.record_submission.call_args, call(job.build_kubernetes_pod.return_value))
+
+    @patch('calrissian.job.Speculator')
+    def test_submit_waits_with_speculator(self, mock_speculator, mock_volume_builder, mock_client):
+        mock_speculator.is_enabled.return_value = True
+        job = self.make_job()
+        job.execute_kubernetes_pod = Mock()
+        job.record_submission = Mock()
+        job.wait_for_kubernetes_pod = Mock()
+        mock_pod = Mock()
+        self.assertEqual(job.submit_kubernetes_pod(mock_pod, self.runtime_context),
+                         mock_speculator.wait.return_value)
+        self.assertEqual(mock_speculator.wait.call_args, call(job, mock_pod, self.runtime_context))
+        self.assertFalse(job.wait_for_kubernetes_pod.called)
+
+    @patch('calrissian.retry.RetryParameters')
+    def test_submit_gives_up_after_max_resubmissions(self, mock_retry_parameters, mock_volume_builder, mock_client):
+        mock_retry_parameters.MULTIPLIER, mock_retry_parameters.MIN, mock_retry_parameters.MAX = 0, 0, 0
+        job = self.make_job()
+        job.execute_kubernetes_pod = Mock()
+        job.record_submission = Mock()
+        job.build_kubernetes_pod = Mock()
+        job.wait_for_kubernetes_pod = Mock(side_effect=PodDisruptedException('NodeLost'))
+        self.runtime_context.max_pod_resubmissions = 1
+
+        with self.assertRaisesRegex(PodDisruptedException, 'NodeLost'):
+            job.submit_kubernetes_pod(Mock(), self.runtime_context)
+        self.assertEqual(job.execute_kubernetes_pod.call_count, 2)
+
+    @patch('calrissian.retry.RetryParameters')
+    def test_submit_does_not_resubmit_pod_deleted_on_cleanup(self, mock_retry_parameters, mock_volume_builder,
+                                                             mock_client):
+        mock_retry_parameters.MULTIPLIER, mock_retry_parameters.MIN, mock_retry_parameters.MAX = 0, 0, 0
+        job = self.make_job()
+        job.execute_kubernetes_pod = Mock()
+        job.record_submission = Mock()
+        job.build_kubernetes_pod = Mock()
+        job.wait_for_kubernetes_pod = Mock(side_effect=CalrissianJobException('Pod was deleted by the controller'))
+        self.runtime_context.max_pod_resubmissions = 2
+
+        with self.assertRaisesRegex(CalrissianJobException, 'deleted by the controller'):
+            job.submit_kubernetes_pod(Mock(), self.runtime_context)
+        self.assertEqual(job.execute_kubernetes_pod.call_count, 1)
+        self.assertFalse(job.build_kubernetes_pod.called)
+
+    def test_escalated_ram(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        self.runtime_context.oom_retry_factor = 2.0
+        self.runtime_context.max_ram = '3G'
+        job.builder.resources = {'ram': 1024, 'ramMax': 1024}
+        self.assertEqual(job.escalated_ram(self.runtime_context), 2048)
+        job.builder.resources = {'ram': 2048, 'ramMax': 2048}
+        self.assertEqual(job.escalated_ram(self.runtime_context), 3000)
+        job.builder.resources = {'ram': 1024, 'ramMax': 1536}
+        self.assertEqual(job.escalated_ram(self.runtime_context), 1536)
+        job.builder.resources = {'ram': 3000, 'ramMax': 3000}
+        self.assertIsNone(job.escalated_ram(self.runtime_context))
+
+    @patch('calrissian.job.Reporter')
+    def test_retry_oom_killed(self, mock_reporter, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.builder.resources = {'ram': 1024, 'ramMax': 1024}
+        job.report = Mock()
+        job.build_kubernetes_pod = Mock()
+        oom_killed = Mock(exit_code=137, reason='OOMKilled')
+        succeeded = Mock(exit_code=0, reason='Completed')
+        job.run_kubernetes_pod = Mock(side_effect=[oom_killed, succeeded])
+        self.runtime_context.oom_retry_factor = 1.5
+        self.runtime_context.oom_max_retries = 2
+        self.runtime_context.max_ram = '4G'
+        self.runtime_context.reserve_resources = Mock()
+
+        pod, completion_result = job.retry_oom_killed(Mock(), oom_killed, self.runtime_context)
+        self.assertEqual(pod, job.build_kubernetes_pod.return_value)
+        self.assertEqual(completion_result, succeeded)
+        self.assertEqual(job.builder.resources, {'ram': 2304, 'ramMax': 2304})
+        self.assertEqual(job.run_kubernetes_pod.call_count, 2)
+        self.assertEqual(self.runtime_context.reserve_resources.call_args_list,
+                         [call(Resources(ram=512), self.runtime_context, pool=None, held=Resources(ram=1024)),
+                          call(Resources(ram=768), self.runtime_context, pool=None, held=Resources(ram=1536))])
+        self.assertEqual(job.escalated_resources, Resources(ram=1280))
+        self.assertEqual(job.report.call_count, 2)
+        self.assertEqual(mock_reporter.add_memory_escalation.call_args_list[1],
+                         call({'name': job.name, 'attempt': 2, 'from_ram_megabytes': 1536, 'to_ram_megabytes': 2304}))
+
+    @patch('calrissian.job.Reporter')
+    def test_retry_oom_killed_stops_after_max_retries(self, mock_reporter, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.builder.resources = {'ram': 1024, 'ramMax': 1024}
+        job.report = Mock()
+        job.build_kubernetes_pod = Mock()
+        oom_killed = Mock(exit_code=137, reason='OOMKilled')
+        job.run_kubernetes_pod = Mock(return_value=oom_killed)
+        self.runtime_context.oom_retry_factor = 2.0
+        self.runtime_context.oom_max_retries = 1
+        self.runtime_context.max_ram = '8G'
+        self.runtime_context.reserve_resources = Mock()
+
+        _, completion_result = job.retry_oom_killed(Mock(), oom_killed, self.runtime_context)
+        self.assertEqual(completion_result, oom_killed)
+        self.assertEqual(job.run_kubernetes_pod.call_count, 1)
+
+    def test_retry_oom_killed_disabled(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.run_kubernetes_pod = Mock()
+        mock_pod = Mock()
+        oom_killed = Mock(exit_code=137, reason='OOMKilled')
+        self.assertEqual(job.retry_oom_killed(mock_pod, oom_killed, self.runtime_context), (mock_pod, oom_killed))
+        self.runtime_context.oom_retry_factor = 2.0
+        self.assertEqual(job.retry_oom_killed(None, oom_killed, self.runtime_context), (None, oom_killed))
+        self.assertFalse(job.run_kubernetes_pod.called)
+
+    def test_run_releases_escalated_resources(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.prepare_run = Mock()
+        job.create_kubernetes_runtime = Mock()
+        job.run_kubernetes_pod = Mock(return_value=self.make_completion_result(0))
+        job.retry_oom_killed = Mock(return_value=(Mock(), self.make_completion_result(0)))
+        job.escalated_resources = Resources(ram=512)
+        job.finish = Mock(side_effect=ValueError)
+        self.runtime_context.release_resources = Mock()
+
+        with self.assertRaises(ValueError):
+            job.run(self.runtime_context)
+        self.assertEqual(self.runtime_context.release_resources.call_args,
+                         call(Resources(ram=512), self.runtime_context, pool=None))
+        self.assertEqual(job.escalated_resources, Resources.EMPTY)
+
+    def test_run_reattached_does_not_submit(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.make_tmpdir = Mock()
+        job.populate_env_vars = Mock()
+        job._setup = Mock()
+        job.reattach_kubernetes_pod = Mock(return_value=True)
+        job.create_kubernetes_runtime = Mock()
+        job.execute_kubernetes_pod = Mock()
+        job.record_submission = Mock()
+        job.wait_for_kubernetes_pod = Mock()
+        job.finish = Mock()
+
+        job.run(self.runtime_context)
+        self.assertFalse(job.create_kubernetes_runtime.called)
+        self.assertFalse(job.execute_kubernetes_pod.called)
+        self.assertFalse(job.record_submission.called)
+        self.assertEqual(job.finish.call_args, call(job.wait_for_kubernetes_pod.return_value, self.runtime_context))
+
     @patch('calrissian.job.KubernetesPodBuilder')
     def test_run_uses_tmpdir_lock(self, mock_pod_builder, mock_volume_builder, mock_client):
         mock_make_tmpdir = Mock()
@@ -942,11 +1432,278 @@ class CalrissianCommandLineJobTestCase(TestCase):
         self.assertEqual(labels, expected_labels)
         self.assertEqual(mock_read_yaml.call_args, call('labels.yaml'))
 
+    def test_get_pod_additional_spec_with_timelimit(self, mock_volume_builder, mock_client):
+        mock_runtime_context = Mock(pod_priority_class=None, env_from_secret=None, env_from_configmap=None)
+        job = self.make_job()
+        self.assertEqual(job.get_pod_additional_spec(mock_runtime_context), {})
+        job.timelimit = 600
+        self.assertEqual(job.get_pod_additional_spec(mock_runtime_context), {'active_deadline_seconds': 600})
+
     def test_get_pod_labels_empty(self, mock_volume_builder, mock_client):
         mock_runtime_context = Mock(pod_labels=None)
         job = self.make_job()
         labels = job.get_pod_labels(mock_runtime_context)
         self.assertEqual(labels, {})
+
+    @patch('calrissian.job.Journal')
+    def test_get_pod_labels_adds_run_id_with_journal(self, mock_journal, mock_volume_builder, mock_client):
+        mock_journal.is_enabled.return_value = True
+        mock_journal.run_id = 'abc123'
+        mock_runtime_context = Mock(pod_labels=None)
+        job = self.make_job()
+        labels = job.get_pod_labels(mock_runtime_context)
+        self.assertEqual(labels, {'calrissian-run-id': 'abc123'})
+
+    @patch('calrissian.job.job_identity')
+    @patch('calrissian.job.Journal')
+    def test_record_submission(self, mock_journal, mock_job_identity, mock_volume_builder, mock_client):
+        mock_journal.is_enabled.return_value = True
+        job = self.make_job()
+        job.outdir = '/calrissian/out'
+        job.record_submission({'metadata': {'name': 'test-clj-pod-abc'}})
+        self.assertEqual(mock_journal.record.call_args,
+                         call(mock_journal.SUBMITTED, mock_job_identity.return_value, name='test-clj',
+                              pod='test-clj-pod-abc', outdir='/calrissian/out', builder_outdir='/out'))
+
+    @patch('calrissian.job.Journal')
+    def test_record_submission_without_journal(self, mock_journal, mock_volume_builder, mock_client):
+        mock_journal.is_enabled.return_value = False
+        job = self.make_job()
+        job.record_submission({'metadata': {'name': 'test-clj-pod-abc'}})
+        self.assertFalse(mock_journal.record.called)
+
+    @patch('calrissian.job.job_identity')
+    @patch('calrissian.job.Journal')
+    def test_record_completion(self, mock_journal, mock_job_identity, mock_volume_builder, mock_client):
+        mock_journal.is_enabled.return_value = True
+        job = self.make_job()
+        job.record_completion({'out': 1}, 'success', 0)
+        self.assertEqual(mock_journal.record.call_args,
+                         call(mock_journal.COMPLETED, mock_job_identity.return_value, name='test-clj',
+                              outputs={'out': 1}, status='success', exit_code=0))
+
+    @patch('calrissian.job.Reporter')
+    def test_finish_records_completion(self, mock_reporter, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.record_completion = Mock()
+        job.finish(self.make_completion_result(0), self.runtime_context)
+        self.assertEqual(job.record_completion.call_args, call(job.collect_outputs.return_value, 'success', 0))
+
+    def test_resume_without_journal(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        self.assertFalse(job.resume_from_journal(self.runtime_context))
+        self.assertFalse(job.output_callback.called)
+
+    @patch('calrissian.job.outputs_exist')
+    @patch('calrissian.job.job_identity')
+    @patch('calrissian.job.Journal')
+    def test_resume_calls_output_callback(self, mock_journal, mock_job_identity, mock_outputs_exist, mock_volume_builder, mock_client):
+        mock_journal.is_enabled.return_value = True
+        mock_journal.claim.return_value = {'key': 'test-clj:123', 'outputs': {'out': 1}, 'status': 'success', 'exit_code': 0}
+        mock_outputs_exist.return_value = True
+        job = self.make_job()
+        self.assertTrue(job.resume_from_journal(self.runtime_context))
+        self.assertEqual(mock_journal.claim.call_args, call(mock_journal.COMPLETED, mock_job_identity.return_value))
+        job.output_callback.assert_called_with({'out': 1}, 'success')
+        self.assertTrue(mock_journal.record.called)
+
+    @patch('calrissian.job.outputs_exist')
+    @patch('calrissian.job.job_identity')
+    @patch('calrissian.job.Journal')
+    def test_resume_runs_failed_job(self, mock_journal, mock_job_identity, mock_outputs_exist, mock_volume_builder, mock_client):
+        mock_journal.is_enabled.return_value = True
+        mock_journal.claim.return_value = {'key': 'test-clj:123', 'outputs': {}, 'status': 'permanentFail', 'exit_code': 1}
+        mock_outputs_exist.return_value = True
+        job = self.make_job()
+        self.assertFalse(job.resume_from_journal(self.runtime_context))
+        self.assertFalse(job.output_callback.called)
+
+    @patch('calrissian.job.outputs_exist')
+    @patch('calrissian.job.job_identity')
+    @patch('calrissian.job.Journal')
+    def test_resume_runs_job_with_missing_outputs(self, mock_journal, mock_job_identity, mock_outputs_exist, mock_volume_builder, mock_client):
+        mock_journal.is_enabled.return_value = True
+        mock_journal.claim.return_value = {'key': 'test-clj:123', 'outputs': {'out': 1}, 'status': 'success', 'exit_code': 0}
+        mock_outputs_exist.return_value = False
+        job = self.make_job()
+        self.assertFalse(job.resume_from_journal(self.runtime_context))
+        self.assertFalse(job.output_callback.called)
+
+    def test_run_resumed_does_not_setup(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.resume_from_journal = Mock(return_value=True)
+        job.make_tmpdir = Mock()
+        job._setup = Mock()
+        job.create_kubernetes_runtime = Mock()
+        job.run(self.runtime_context)
+        self.assertFalse(job.make_tmpdir.called)
+        self.assertFalse(job._setup.called)
+        self.assertFalse(job.create_kubernetes_runtime.called)
+
+    def test_restore_from_step_cache_disabled(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        self.assertFalse(job.restore_from_step_cache(self.runtime_context))
+        self.assertIsNone(job.step_cache_key)
+
+    @patch('calrissian.job.StepCache')
+    def test_restore_from_step_cache_hit(self, mock_step_cache, mock_volume_builder, mock_client):
+        mock_step_cache.restore.return_value = True
+        self.requirements = [{'class': 'DockerRequirement', 'dockerPull': PINNED_IMAGE}]
+        job = self.make_job()
+        job.compute_step_cache_key = Mock(return_value='abc')
+        job.cleanup = Mock()
+        self.assertTrue(job.restore_from_step_cache(self.runtime_context))
+        self.assertEqual(mock_step_cache.restore.call_args, call('abc', job.outdir))
+        self.assertEqual(job.collect_outputs.call_args, call(job.outdir, 0))
+        job.output_callback.assert_called_with(job.collect_outputs.return_value, 'success')
+        self.assertTrue(job.cleanup.called)
+
+    @patch('calrissian.job.StepCache')
+    def test_restore_from_step_cache_miss(self, mock_step_cache, mock_volume_builder, mock_client):
+        mock_step_cache.restore.return_value = False
+        self.requirements = [{'class': 'DockerRequirement', 'dockerPull': PINNED_IMAGE}]
+        job = self.make_job()
+        job.compute_step_cache_key = Mock(return_value='abc')
+        self.assertFalse(job.restore_from_step_cache(self.runtime_context))
+        self.assertEqual(job.step_cache_key, 'abc')
+        self.assertFalse(job.output_callback.called)
+
+    @patch('calrissian.job.StepCache')
+    def test_restore_from_step_cache_skips_unpinned_image(self, mock_step_cache, mock_volume_builder, mock_client):
+        job = self.make_job()
+        self.assertFalse(job.restore_from_step_cache(self.runtime_context))
+        self.assertIsNone(job.step_cache_key)
+        self.assertFalse(mock_step_cache.restore.called)
+
+    def test_is_pinned_by_digest(self, mock_volume_builder, mock_client):
+        self.assertTrue(is_pinned_by_digest(PINNED_IMAGE))
+        self.assertTrue(is_pinned_by_digest('registry:5000/debian:stable@sha256:' + 'a' * 64))
+        self.assertFalse(is_pinned_by_digest('dockerimage:1.0'))
+        self.assertFalse(is_pinned_by_digest('registry:5000/debian'))
+
+    @patch('calrissian.job.StepCache')
+    def test_restore_from_step_cache_respects_work_reuse(self, mock_step_cache, mock_volume_builder, mock_client):
+        self.requirements.append({'class': 'WorkReuse', 'enableReuse': False})
+        job = self.make_job()
+        self.assertFalse(job.restore_from_step_cache(self.runtime_context))
+        self.assertFalse(mock_step_cache.restore.called)
+
+    @patch('calrissian.job.StepCache')
+    @patch('calrissian.job.Reporter')
+    def test_finish_stores_in_step_cache(self, mock_reporter, mock_step_cache, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.step_cache_key = 'abc'
+        job.finish(self.make_completion_result(0), self.runtime_context)
+        self.assertEqual(mock_step_cache.store.call_args, call('abc', job.outdir, name='test-clj', image='dockerimage:1.0'))
+
+    @patch('calrissian.job.StepCache')
+    @patch('calrissian.job.Reporter')
+    def test_finish_does_not_store_failures(self, mock_reporter, mock_step_cache, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.step_cache_key = 'abc'
+        job.finish(self.make_completion_result(1), self.runtime_context)
+        self.assertFalse(mock_step_cache.store.called)
+
+    def test_usage_history_key(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.tool_document = {'id': 'file:///workflows/tools/crop.cwl'}
+        self.assertEqual(job.usage_history_key(), 'crop.cwl@dockerimage:1.0')
+        job.tool_document = None
+        self.assertEqual(job.usage_history_key(), 'test-clj@dockerimage:1.0')
+
+    @patch('calrissian.job.UsageMonitor')
+    def test_observed_ram_megabytes(self, mock_usage_monitor, mock_volume_builder, mock_client):
+        job = self.make_job()
+        job.client.pod = None
+        self.assertIsNone(job.observed_ram_megabytes())
+        job.client.pod = Mock()
+        job.client.pod.metadata.name = 'test-clj-pod-123'
+        self.assertEqual(job.observed_ram_megabytes(), mock_usage_monitor.peak_ram_megabytes.return_value)
+        self.assertEqual(mock_usage_monitor.peak_ram_megabytes.call_args, call('test-clj-pod-123'))
+
+    @patch('calrissian.job.UsageMonitor')
+    def test_wait_samples_usage_when_enabled(self, mock_usage_monitor, mock_volume_builder, mock_client):
+        mock_usage_monitor.is_enabled.return_value = True
+        job = self.make_job()
+        job.wait_for_kubernetes_pod()
+        self.assertEqual(mock_client.return_value.wait_for_completion.call_args, call(sample_usage=True))
+
+    @patch('calrissian.job.UsageHistory')
+    @patch('calrissian.job.Reporter')
+    def test_finish_records_usage(self, mock_reporter, mock_usage_history, mock_volume_builder, mock_client):
+        mock_usage_history.is_enabled.return_value = True
+        job = self.make_job()
+        job.tool_document = {'id': 'crop.cwl'}
+        completion_result = self.make_completion_result(0)
+        completion_result.peak_cpus, completion_result.peak_ram_megabytes = 0.5, 300
+        job.finish(completion_result, self.runtime_context)
+        self.assertEqual(mock_usage_history.record.call_args, call('crop.cwl@dockerimage:1.0', 'test-clj', 0.5, 300))
+
+    @patch('calrissian.job.UsageHistory')
+    @patch('calrissian.job.Reporter')
+    def test_finish_does_not_record_unsampled_or_failed_usage(self, mock_reporter, mock_usage_history,
+                                                              mock_volume_builder, mock_client):
+        mock_usage_history.is_enabled.return_value = True
+        completion_result = self.make_completion_result(0)
+        completion_result.peak_cpus, completion_result.peak_ram_megabytes = None, None
+        self.make_job().finish(completion_result, self.runtime_context)
+        completion_result = self.make_completion_result(1)
+        completion_result.peak_cpus, completion_result.peak_ram_megabytes = 0.5, 300
+        self.make_job().finish(completion_result, self.runtime_context)
+        self.assertFalse(mock_usage_history.record.called)
+
+    def test_compute_step_cache_key_ignores_outdir(self, mock_volume_builder, mock_client):
+        def key_for(outdir):
+            self.builder = Mock(outdir=outdir, files=[])
+            job = self.make_job()
+            job.command_line = ['cat', '{}/input.txt'.format(outdir)]
+            job.environment = {'HOME': outdir}
+            job.pathmapper = {}
+            job.tool_document = {'id': 'tool'}
+            return job.compute_step_cache_key()
+        self.assertEqual(key_for('/AbCdEf'), key_for('/GhIjKl'))
+
+    def test_reattach_without_journal(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        self.assertFalse(job.reattach_kubernetes_pod())
+        self.assertFalse(mock_client.return_value.reattach_pod.called)
+
+    @patch('calrissian.job.job_identity')
+    @patch('calrissian.job.Journal')
+    def test_reattach_adopts_outdir(self, mock_journal, mock_job_identity, mock_volume_builder, mock_client):
+        mock_journal.is_enabled.return_value = True
+        mock_journal.claim.return_value = {'key': 'test-clj:123', 'pod': 'test-clj-pod-abc',
+                                           'outdir': '/calrissian/old', 'builder_outdir': '/oldout'}
+        mock_client.return_value.reattach_pod.return_value = True
+        job = self.make_job()
+        self.assertTrue(job.reattach_kubernetes_pod())
+        self.assertEqual(mock_journal.claim.call_args, call(mock_journal.SUBMITTED, mock_job_identity.return_value))
+        self.assertEqual(mock_client.return_value.reattach_pod.call_args, call('test-clj-pod-abc'))
+        self.assertEqual(job.outdir, '/calrissian/old')
+        self.assertEqual(job.builder.outdir, '/oldout')
+        self.assertTrue(mock_journal.record.called)
+
+    @patch('calrissian.job.job_identity')
+    @patch('calrissian.job.Journal')
+    def test_reattach_when_pod_gone(self, mock_journal, mock_job_identity, mock_volume_builder, mock_client):
+        mock_journal.is_enabled.return_value = True
+        mock_journal.claim.return_value = {'key': 'test-clj:123', 'pod': 'test-clj-pod-abc',
+                                           'outdir': '/calrissian/old', 'builder_outdir': '/oldout'}
+        mock_client.return_value.reattach_pod.return_value = False
+        job = self.make_job()
+        outdir = job.outdir
+        self.assertFalse(job.reattach_kubernetes_pod())
+        self.assertEqual(job.outdir, outdir)
+        self.assertEqual(job.builder.outdir, '/out')
+
+    @patch('calrissian.job.job_identity')
+    @patch('calrissian.job.Journal')
+    def test_reattach_when_not_submitted(self, mock_journal, mock_job_identity, mock_volume_builder, mock_client):
+        mock_journal.is_enabled.return_value = True
+        mock_journal.claim.return_value = None
+        job = self.make_job()
+        self.assertFalse(job.reattach_kubernetes_pod())
+        self.assertFalse(mock_client.return_value.reattach_pod.called)
         
     @patch('calrissian.job.read_yaml')
     def test_get_pod_nodeselectors(self, mock_read_yaml, mock_volume_builder, mock_client):
@@ -964,6 +1721,23 @@ class CalrissianCommandLineJobTestCase(TestCase):
         nodeselectors = job.get_pod_nodeselectors(mock_runtime_context)
         self.assertEqual(nodeselectors, {})
 
+    @patch('calrissian.job.read_yaml')
+    def test_node_selector(self, mock_read_yaml, mock_volume_builder, mock_client):
+        mock_read_yaml.side_effect = lambda path: {'pool': path}
+        mock_runtime_context = Mock(pod_nodeselectors='cpu', pod_gpu_nodeselectors='gpu')
+        job = self.make_job()
+        self.assertEqual(job.node_selector(mock_runtime_context), {'pool': 'cpu'})
+        self.requirements.append({'class': 'http://commonwl.org/cwltool#CUDARequirement', 'cudaDeviceCountMin': 1})
+        job = self.make_job()
+        self.assertEqual(job.node_selector(mock_runtime_context), {'pool': 'gpu'})
+
+    def test_get_resource_pool_nodeselectors(self, mock_volume_builder, mock_client):
+        job = self.make_job()
+        self.assertEqual(job.get_resource_pool_nodeselectors({'disktype': 'ssd'}), {'disktype': 'ssd'})
+        job.resource_pool = ResourcePool('highmem', {'pool': 'highmem'}, Resources(65536, 8))
+        self.assertEqual(job.get_resource_pool_nodeselectors({'disktype': 'ssd'}),
+                         {'disktype': 'ssd', 'pool': 'highmem'})
+
     @patch('calrissian.job.read_yaml')
     def test_get_pod_env_vars(self, mock_read_yaml, mock_volume_builder, mock_client):
         expected_env_vars = {'HTTP_PROXY':'1.2.3.4:3853'}
@@ -997,6 +1771,36 @@ class CalrissianCommandLineJobTestCase(TestCase):
         self.assertEqual(mock_add_volume_binding.call_args, call('source','target',True))
 
 
+class OutputsExistTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.existing = os.path.join(self.tmpdir, 'exists.txt')
+        with open(self.existing, 'w') as f:
+            f.write('data')
+
+    def test_existing_outputs(self):
+        outputs = {
+            'file': {'class': 'File', 'location': 'file://' + self.existing},
+            'dir': {'class': 'Directory', 'location': 'file://' + self.tmpdir},
+            'count': 3,
+        }
+        self.assertTrue(outputs_exist(outputs))
+
+    def test_missing_output(self):
+        outputs = {
+            'files': [
+                {'class': 'File', 'location': 'file://' + self.existing},
+                {'class': 'File', 'location': 'file://' + os.path.join(self.tmpdir, 'missing.txt')},
+            ]
+        }
+        self.assertFalse(outputs_exist(outputs))
+
+    def test_ignores_non_local_locations(self):
+        outputs = {'file': {'class': 'File', 'location': 's3://bucket/file.txt'}}
+        self.assertTrue(outputs_exist(outputs))
+
+
 class TotalSizeTestCase(TestCase):
 
     def make_file(self, size=None, path=None):
@@ -0,0 +1,137 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock
+
+from calrissian.journal import Journal, job_identity, read_journal
+
+
+class JobIdentityTestCase(TestCase):
+
+    def make_job(self, name, inputs):
+        job = Mock(builder=Mock(job=inputs))
+        # name is a Mock constructor argument, so it must be set afterwards
+        job.name = name
+        return job
+
+    def test_same_name_and_inputs_same_identity(self):
+        job1 = self.make_job('step1', {'count': 3, 'message': 'hello'})
+        job2 = self.make_job('step1', {'message': 'hello', 'count': 3})
+        self.assertEqual(job_identity(job1), job_identity(job2))
+
+    def test_identity_starts_with_name(self):
+        job = self.make_job('step1', {})
+        self.assertTrue(job_identity(job).startswith('step1:'))
+
+    def test_different_inputs_different_identity(self):
+        job1 = self.make_job('step1', {'count': 3})
+        job2 = self.make_job('step1', {'count': 4})
+        self.assertNotEqual(job_identity(job1), job_identity(job2))
+
+    def test_different_names_different_identity(self):
+        job1 = self.make_job('step1', {'count': 3})
+        job2 = self.make_job('step1_2', {'count': 3})
+        self.assertNotEqual(job_identity(job1), job_identity(job2))
+
+    def test_ignores_staging_paths(self):
+        job1 = self.make_job('step1', {'file': {'class': 'File', 'location': 'file:///data/a.txt',
+                                                'path': '/var/lib/cwl/stgabc/a.txt', 'dirname': '/var/lib/cwl/stgabc'}})
+        job2 = self.make_job('step1', {'file': {'class': 'File', 'location': 'file:///data/a.txt',
+                                                'path': '/var/lib/cwl/stgdef/a.txt', 'dirname': '/var/lib/cwl/stgdef'}})
+        self.assertEqual(job_identity(job1), job_identity(job2))
+
+    def test_depends_on_location(self):
+        job1 = self.make_job('step1', {'files': [{'class': 'File', 'location': 'file:///data/a.txt'}]})
+        job2 = self.make_job('step1', {'files': [{'class': 'File', 'location': 'file:///data/b.txt'}]})
+        self.assertNotEqual(job_identity(job1), job_identity(job2))
+
+
+class JournalTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'journal.jsonl')
+
+    def tearDown(self):
+        Journal.path = None
+        Journal.run_id = None
+        Journal.replayed = {}
+
+    def test_disabled_by_default(self):
+        self.assertFalse(Journal.is_enabled())
+
+    def test_record_does_nothing_when_disabled(self):
+        Journal.record(Journal.SUBMITTED, 'key1', pod='pod1')
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_initialize_records_run_id(self):
+        Journal.initialize(self.path)
+        self.assertTrue(Journal.is_enabled())
+        self.assertIsNotNone(Journal.run_id)
+        self.assertEqual(read_journal(self.path), [{'event': 'run', 'key': Journal.run_id}])
+
+    def test_record_appends(self):
+        Journal.initialize(self.path)
+        Journal.record(Journal.SUBMITTED, 'key1', pod='pod1')
+        Journal.record(Journal.SUBMITTED, 'key2', pod='pod2')
+        entries = read_journal(self.path)
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(entries[1], {'event': 'submitted', 'key': 'key1', 'pod': 'pod1'})
+        self.assertEqual(entries[2], {'event': 'submitted', 'key': 'key2', 'pod': 'pod2'})
+
+    def test_new_run_without_replay(self):
+        Journal.initialize(self.path)
+        first_run_id = Journal.run_id
+        Journal.record(Journal.SUBMITTED, 'key1', pod='pod1')
+        Journal.initialize(self.path)
+        self.assertNotEqual(Journal.run_id, first_run_id)
+        self.assertEqual(Journal.replayed_entries(Journal.SUBMITTED), [])
+
+    def test_replay_reuses_run_id_and_loads_entries(self):
+        Journal.initialize(self.path)
+        run_id = Journal.run_id
+        Journal.record(Journal.SUBMITTED, 'key1', pod='pod1')
+        Journal.record(Journal.SUBMITTED, 'key1', pod='pod1-again')
+        Journal.initialize(self.path, replay=[Journal.SUBMITTED])
+        self.assertEqual(Journal.run_id, run_id)
+        self.assertEqual(Journal.replayed_entries(Journal.SUBMITTED),
+                         [{'event': 'submitted', 'key': 'key1', 'pod': 'pod1-again'}])
+
+    def test_replay_only_latest_run(self):
+        Journal.initialize(self.path)
+        Journal.record(Journal.SUBMITTED, 'key1', pod='pod1')
+        Journal.initialize(self.path)
+        run_id = Journal.run_id
+        Journal.record(Journal.SUBMITTED, 'key2', pod='pod2')
+        Journal.initialize(self.path, replay=[Journal.SUBMITTED])
+        self.assertEqual(Journal.run_id, run_id)
+        self.assertEqual([e['key'] for e in Journal.replayed_entries(Journal.SUBMITTED)], ['key2'])
+
+    def test_replay_missing_file_starts_run(self):
+        Journal.initialize(self.path, replay=[Journal.SUBMITTED])
+        self.assertIsNotNone(Journal.run_id)
+        self.assertEqual(Journal.replayed_entries(Journal.SUBMITTED), [])
+
+    def test_replay_only_requested_events(self):
+        Journal.initialize(self.path)
+        Journal.record(Journal.SUBMITTED, 'key1', pod='pod1')
+        Journal.record(Journal.COMPLETED, 'key1', outputs={}, status='success')
+        Journal.initialize(self.path, replay=[Journal.COMPLETED])
+        self.assertEqual(Journal.replayed_entries(Journal.SUBMITTED), [])
+        self.assertEqual(Journal.replayed_entries(Journal.COMPLETED),
+                         [{'event': 'completed', 'key': 'key1', 'outputs': {}, 'status': 'success'}])
+
+    def test_claim_removes_entry(self):
+        Journal.initialize(self.path)
+        Journal.record(Journal.SUBMITTED, 'key1', pod='pod1')
+        Journal.initialize(self.path, replay=[Journal.SUBMITTED])
+        self.assertEqual(Journal.claim(Journal.SUBMITTED, 'key1')['pod'], 'pod1')
+        self.assertIsNone(Journal.claim(Journal.SUBMITTED, 'key1'))
+        self.assertIsNone(Journal.claim(Journal.SUBMITTED, 'key2'))
+
+    def test_read_journal_skips_truncated_line(self):
+        with open(self.path, 'w') as f:
+            f.write(json.dumps({'event': 'run', 'key': 'abc'}) + '\n')
+            f.write('{"event": "submi')
+        self.assertEqual(read_journal(self.path), [{'event': 'run', 'key': 'abc'}])
@@ -5,7 +5,7 @@ from kubernetes.client.rest import ApiException
 from kubernetes.config.config_exception import ConfigException
 from calrissian.executor import IncompleteStatusException
 from calrissian.k8s import load_config_get_namespace, KubernetesClient, CalrissianJobException, PodMonitor
-from calrissian.k8s import CompletionResult, read_file
+from calrissian.k8s import CompletionResult, PodDisruptedException, PodUsage, UsageMonitor, read_file
 
 
 class ReadFileTestCase(TestCase):
@@ -52,6 +52,108 @@ class KubernetesClientTestCase(TestCase):
         self.assertIsNone(kc.pod)
         self.assertIsNone(kc.completion_result)
 
+    def test_reattach_pod(self, mock_get_namespace, mock_client):
+        mock_pod = Mock()
+        mock_client.CoreV1Api.return_value.list_namespaced_pod.return_value = Mock(items=[mock_pod])
+        kc = KubernetesClient()
+        self.assertTrue(kc.reattach_pod('pod-123'))
+        self.assertEqual(kc.pod, mock_pod)
+        self.assertEqual(mock_client.CoreV1Api.return_value.list_namespaced_pod.call_args,
+                         call(mock_get_namespace.return_value, field_selector='metadata.name=pod-123'))
+
+    def test_reattach_pod_gone(self, mock_get_namespace, mock_client):
+        mock_client.CoreV1Api.return_value.list_namespaced_pod.return_value = Mock(items=[])
+        kc = KubernetesClient()
+        self.assertFalse(kc.reattach_pod('pod-123'))
+        self.assertIsNone(kc.pod)
+
+    def test_list_pods_for_run(self, mock_get_namespace, mock_client):
+        mock_list = mock_client.CoreV1Api.return_value.list_namespaced_pod
+        kc = KubernetesClient()
+        pods = kc.list_pods_for_run('abc123')
+        self.assertEqual(pods, mock_list.return_value.items)
+        self.assertEqual(mock_list.call_args,
+                         call(mock_get_namespace.return_value, label_selector='calrissian-run-id=abc123'))
+
+    def test_list_pods_for_selector(self, mock_get_namespace, mock_client):
+        mock_list = mock_client.CoreV1Api.return_value.list_namespaced_pod
+        kc = KubernetesClient()
+        self.assertEqual(kc.list_pods_for_selector('app=test'), mock_list.return_value.items)
+        self.assertEqual(mock_list.call_args, call(kc.namespace, label_selector='app=test'))
+
+    def test_create_daemonset(self, mock_get_namespace, mock_client):
+        mock_create = mock_client.AppsV1Api.return_value.create_namespaced_daemon_set
+        kc = KubernetesClient()
+        mock_body = Mock()
+        self.assertEqual(kc.create_daemonset(mock_body), mock_create.return_value)
+        self.assertEqual(mock_create.call_args, call(kc.namespace, mock_body))
+
+    def test_read_daemonset(self, mock_get_namespace, mock_client):
+        mock_read = mock_client.AppsV1Api.return_value.read_namespaced_daemon_set
+        kc = KubernetesClient()
+        self.assertEqual(kc.read_daemonset('ds-123'), mock_read.return_value)
+        self.assertEqual(mock_read.call_args, call('ds-123', kc.namespace))
+
+    def test_delete_daemonset_name(self, mock_get_namespace, mock_client):
+        mock_delete = mock_client.AppsV1Api.return_value.delete_namespaced_daemon_set
+        kc = KubernetesClient()
+        kc.delete_daemonset_name('ds-123')
+        self.assertEqual(mock_delete.call_args, call('ds-123', kc.namespace, propagation_policy='Foreground'))
+
+    def test_delete_daemonset_name_ignores_404(self, mock_get_namespace, mock_client):
+        mock_client.AppsV1Api.return_value.delete_namespaced_daemon_set.side_effect = ApiException(status=404)
+        kc = KubernetesClient()
+        kc.delete_daemonset_name('ds-123')
+
+    def test_create_job(self, mock_get_namespace, mock_client):
+        mock_create = mock_client.BatchV1Api.return_value.create_namespaced_job
+        kc = KubernetesClient()
+        mock_body = Mock()
+        self.assertEqual(kc.create_job(mock_body), mock_create.return_value)
+        self.assertEqual(mock_create.call_args, call(kc.namespace, mock_body))
+
+    def test_job_is_finished(self, mock_get_namespace, mock_client):
+        def make_job(*conditions):
+            return Mock(status=Mock(conditions=[Mock(type=t, status=s) for t, s in conditions]))
+        self.assertFalse(KubernetesClient.job_is_finished(make_job()))
+        self.assertFalse(KubernetesClient.job_is_finished(make_job(('Complete', 'False'))))
+        self.assertTrue(KubernetesClient.job_is_finished(make_job(('Suspended', 'False'), ('Complete', 'True'))))
+        self.assertTrue(KubernetesClient.job_is_finished(make_job(('Failed', 'True'))))
+
+    @patch('calrissian.k8s.watch', autospec=True)
+    def test_wait_for_job(self, mock_watch, mock_get_namespace, mock_client):
+        running = Mock(status=Mock(conditions=None))
+        finished = Mock(status=Mock(conditions=[Mock(type='Complete', status='True')]))
+        # The first watch times out
+        mock_watch.Watch.return_value.stream.side_effect = [
+            [{'object': running}],
+            [{'object': running}, {'object': finished}],
+        ]
+        kc = KubernetesClient()
+        self.assertEqual(kc.wait_for_job('job-123'), finished)
+        self.assertEqual(mock_watch.Watch.return_value.stream.call_args,
+                         call(kc.batch_api_instance.list_namespaced_job, kc.namespace,
+                              field_selector='metadata.name=job-123'))
+        self.assertTrue(mock_watch.Watch.return_value.stop.called)
+
+    def test_read_pod_log(self, mock_get_namespace, mock_client):
+        mock_read = mock_client.CoreV1Api.return_value.read_namespaced_pod_log
+        mock_read.return_value = 'line 1\nline 2\n'
+        kc = KubernetesClient()
+        self.assertEqual([entry['entry'] for entry in kc.read_pod_log('pod-123')], ['line 1', 'line 2'])
+        self.assertEqual(mock_read.call_args, call('pod-123', kc.namespace))
+
+    def test_delete_job_name(self, mock_get_namespace, mock_client):
+        mock_delete = mock_client.BatchV1Api.return_value.delete_namespaced_job
+        kc = KubernetesClient()
+        kc.delete_job_name('job-123')
+        self.assertEqual(mock_delete.call_args, call('job-123', kc.namespace, propagation_policy='Foreground'))
+
+    def test_delete_job_name_ignores_404(self, mock_get_namespace, mock_client):
+        mock_client.BatchV1Api.return_value.delete_namespaced_job.side_effect = ApiException(status=404)
+        kc = KubernetesClient()
+        kc.delete_job_name('job-123')
+
     @patch('calrissian.k8s.PodMonitor')
     def test_submit_pod(self, mock_podmonitor, mock_get_namespace, mock_client):
         mock_get_namespace.return_value = 'namespace'
@@ -96,6 +198,54 @@ class KubernetesClientTestCase(TestCase):
         self.assertEqual(mock_stream.call_args, call(kc.core_api_instance.list_namespaced_pod, kc.namespace,
                                                      field_selector='metadata.name=test123'))
     @patch('calrissian.k8s.watch', autospec=True)
+    def test_wait_for_running(self, mock_watch, mock_get_namespace, mock_client):
+        mock_waiting_pod = self.make_mock_pod('test123')
+        mock_waiting_pod.status.container_statuses[0].state = Mock(running=None, waiting=Mock(), terminated=None)
+        mock_running_pod = self.make_mock_pod('test123')
+        mock_running_pod.status.container_statuses[0].state = Mock(running=Mock(), waiting=None, terminated=None)
+        self.setup_mock_watch(mock_watch, [mock_waiting_pod, mock_running_pod])
+        kc = KubernetesClient()
+        kc._set_pod(mock_running_pod)
+        kc.wait_for_running()
+        self.assertEqual(mock_watch.Watch.return_value.stream.call_args,
+                         call(kc.core_api_instance.list_namespaced_pod, kc.namespace,
+                              field_selector='metadata.name=test123'))
+        self.assertTrue(mock_watch.Watch.return_value.stop.called)
+
+    @patch('calrissian.k8s.watch', autospec=True)
+    def test_wait_for_running_raises_when_terminated(self, mock_watch, mock_get_namespace, mock_client):
+        mock_pod = self.make_mock_pod('test123')
+        mock_pod.status.container_statuses[0].state = Mock(running=None, waiting=None, terminated=Mock(exit_code=1))
+        self.setup_mock_watch(mock_watch, [mock_pod])
+        kc = KubernetesClient()
+        kc._set_pod(mock_pod)
+        with self.assertRaisesRegex(CalrissianJobException, 'is not running'):
+            kc.wait_for_running()
+
+    @patch('calrissian.k8s.stream')
+    def test_exec_in_pod(self, mock_stream, mock_get_namespace, mock_client):
+        mock_resp = mock_stream.return_value
+        mock_resp.is_open.side_effect = [True, False]
+        mock_resp.peek_stdout.return_value = True
+        mock_resp.read_stdout.return_value = 'line 1\nline 2\n'
+        mock_resp.peek_stderr.return_value = False
+        mock_resp.returncode = 3
+        mock_pod = self.make_mock_pod('test123')
+        mock_pod.spec.containers = [Mock(resources=Mock(requests={'cpu': '1', 'memory': '1Gi'}))]
+        kc = KubernetesClient()
+        kc._set_pod(mock_pod)
+        completion_result = kc.exec_in_pod(['/bin/sh', '-c', 'true'])
+        self.assertEqual(mock_stream.call_args,
+                         call(kc.core_api_instance.connect_get_namespaced_pod_exec, 'test123', kc.namespace,
+                              command=['/bin/sh', '-c', 'true'], stderr=True, stdin=False, stdout=True, tty=False,
+                              _preload_content=False))
+        self.assertEqual(completion_result.exit_code, 3)
+        self.assertEqual(completion_result.cpus, '1')
+        self.assertEqual(completion_result.memory, '1Gi')
+        self.assertEqual([entry['entry'] for entry in completion_result.tool_log], ['line 1', 'line 2'])
+        self.assertTrue(mock_resp.close.called)
+
+    @patch('calrissian.k8s.watch', autospec=True)
     def test_wait_calls_watch_pod_with_imcomplete_status(self, mock_watch, mock_get_namespace, mock_client):
         self.setup_mock_watch(mock_watch)
         mock_pod = self.make_mock_pod('test123')
@@ -107,7 +257,7 @@ class KubernetesClientTestCase(TestCase):
 
     @patch('calrissian.k8s.watch', autospec=True)
     def test_wait_skips_pod_when_status_is_none(self, mock_watch, mock_get_namespace, mock_client):
-        mock_pod = Mock(status=Mock(container_statuses=None))
+        mock_pod = Mock(status=Mock(container_statuses=None, reason=None, conditions=None))
         self.setup_mock_watch(mock_watch, [mock_pod])
         kc = KubernetesClient()
         kc._set_pod(Mock())
@@ -130,6 +280,48 @@ class KubernetesClientTestCase(TestCase):
         self.assertFalse(mock_client.CoreV1Api.return_value.delete_namespaced_pod.called)
         self.assertIsNotNone(kc.pod)
 
+    @patch('calrissian.k8s.watch', autospec=True)
+    @patch('calrissian.k8s.UsageMonitor')
+    @patch('calrissian.k8s.KubernetesClient.follow_logs')
+    @patch('calrissian.k8s.KubernetesClient._extract_cpu_memory_requests')
+    def test_wait_samples_usage_while_running(self, mock_cpu_memory, mock_follow_logs, mock_usage_monitor, mock_watch,
+                                              mock_get_namespace, mock_client):
+        running_pod, terminated_pod = create_autospec(V1Pod), create_autospec(V1Pod)
+        running_pod.metadata.name = terminated_pod.metadata.name = 'pod-123'
+        running_pod.status.container_statuses[0].state = Mock(running=True, waiting=None, terminated=None)
+        terminated_pod.status.container_statuses[0].state = Mock(running=None, waiting=None,
+                                                                 terminated=Mock(exit_code=0))
+        mock_cpu_memory.return_value = ('1', '1Mi')
+        usage = PodUsage()
+        usage.add({'timestamp': 't1', 'containers': [{'usage': {'cpu': '500m', 'memory': '300M'}}]})
+        usage.add({'timestamp': 't2', 'containers': [{'usage': {'cpu': '1500m', 'memory': '100M'}}]})
+        mock_usage_monitor.remove.return_value = usage
+        self.setup_mock_watch(mock_watch, [running_pod, terminated_pod])
+        kc = KubernetesClient()
+        kc._set_pod(Mock())
+        completion_result = kc.wait_for_completion(sample_usage=True)
+        self.assertEqual(mock_usage_monitor.add.call_args, call('pod-123', kc.namespace))
+        self.assertTrue(mock_follow_logs.called)
+        self.assertEqual(mock_usage_monitor.remove.call_args_list[0], call('pod-123'))
+        self.assertAlmostEqual(completion_result.peak_cpus, 1.5)
+        self.assertAlmostEqual(completion_result.mean_cpus, 1)
+        self.assertAlmostEqual(completion_result.peak_ram_megabytes, 300)
+        self.assertAlmostEqual(completion_result.mean_ram_megabytes, 200)
+
+    @patch('calrissian.k8s.watch', autospec=True)
+    @patch('calrissian.k8s.UsageMonitor')
+    @patch('calrissian.k8s.KubernetesClient.follow_logs')
+    def test_wait_does_not_sample_usage_by_default(self, mock_follow_logs, mock_usage_monitor, mock_watch,
+                                                   mock_get_namespace, mock_client):
+        mock_pod = create_autospec(V1Pod)
+        mock_pod.status.container_statuses[0].state = Mock(running=True, waiting=None, terminated=None)
+        self.setup_mock_watch(mock_watch, [mock_pod])
+        kc = KubernetesClient()
+        kc._set_pod(Mock())
+        with self.assertRaises(IncompleteStatusException):
+            kc.wait_for_completion()
+        self.assertFalse(mock_usage_monitor.add.called)
+
     @patch('calrissian.k8s.watch', autospec=True)
     @patch('calrissian.k8s.KubernetesClient.follow_logs')
     def test_wait_follows_logs_pod_when_state_is_running(self, mock_follow_logs, mock_watch, mock_get_namespace, mock_client):
@@ -147,18 +339,22 @@ class KubernetesClientTestCase(TestCase):
 
     @patch('calrissian.k8s.watch', autospec=True)
     @patch('calrissian.k8s.PodMonitor')
+    @patch('calrissian.k8s.MemoryOvercommit')
     @patch('calrissian.k8s.KubernetesClient._extract_cpu_memory_requests')
-    def test_wait_finishes_when_pod_state_is_terminated(self, mock_cpu_memory,
+    def test_wait_finishes_when_pod_state_is_terminated(self, mock_cpu_memory, mock_memory_overcommit,
                                                         mock_podmonitor, mock_watch, mock_get_namespace,
                                                         mock_client):
         mock_pod = create_autospec(V1Pod)
-        mock_pod.status.container_statuses[0].state = Mock(running=None, waiting=None, terminated=Mock(exit_code=123))
+        mock_pod.status.container_statuses[0].state = Mock(running=None, waiting=None,
+                                                           terminated=Mock(exit_code=123, reason='OOMKilled'))
         mock_cpu_memory.return_value = ('1', '1Mi')
         self.setup_mock_watch(mock_watch, [mock_pod])
         kc = KubernetesClient()
         kc._set_pod(Mock())
         completion_result = kc.wait_for_completion()
         self.assertEqual(completion_result.exit_code, 123)
+        self.assertEqual(completion_result.reason, 'OOMKilled')
+        self.assertEqual(mock_memory_overcommit.observe.call_args, call('OOMKilled'))
         self.assertTrue(mock_watch.Watch.return_value.stop.called)
         self.assertTrue(mock_client.CoreV1Api.return_value.delete_namespaced_pod.called)
         self.assertIsNone(kc.pod)
@@ -186,6 +382,151 @@ class KubernetesClientTestCase(TestCase):
         self.assertFalse(mock_client.CoreV1Api.return_value.delete_namespaced_pod.called)
         self.assertIsNone(kc.pod)
 
+    @patch('calrissian.k8s.watch', autospec=True)
+    @patch('calrissian.k8s.PodMonitor')
+    @patch('calrissian.k8s.KubernetesClient._extract_cpu_memory_requests')
+    def test_wait_finishes_when_pod_exceeds_deadline(self, mock_cpu_memory, mock_podmonitor, mock_watch,
+                                                     mock_get_namespace, mock_client):
+        mock_pod = create_autospec(V1Pod)
+        mock_pod.status.reason = 'DeadlineExceeded'
+        mock_pod.status.container_statuses[0].state = Mock(running=None, waiting=None,
+                                                           terminated=Mock(exit_code=137, reason='Error'))
+        mock_cpu_memory.return_value = ('1', '1Mi')
+        self.setup_mock_watch(mock_watch, [mock_pod])
+        kc = KubernetesClient()
+        kc._set_pod(Mock())
+        completion_result = kc.wait_for_completion()
+        self.assertEqual(completion_result.exit_code, 137)
+        self.assertEqual(completion_result.reason, 'DeadlineExceeded')
+        self.assertTrue(mock_client.CoreV1Api.return_value.delete_namespaced_pod.called)
+        self.assertIsNone(kc.pod)
+
+    @patch('calrissian.k8s.watch', autospec=True)
+    @patch('calrissian.k8s.PodMonitor')
+    @patch('calrissian.k8s.KubernetesClient._extract_cpu_memory_requests')
+    def test_wait_finishes_when_pod_exceeds_deadline_while_waiting(self, mock_cpu_memory, mock_podmonitor, mock_watch,
+                                                                   mock_get_namespace, mock_client):
+        mock_pod = create_autospec(V1Pod)
+        mock_pod.status.reason = 'DeadlineExceeded'
+        mock_pod.status.start_time = None
+        mock_pod.status.container_statuses[0].state = Mock(running=None, waiting=Mock(reason='ImagePullBackOff'),
+                                                           terminated=None)
+        mock_cpu_memory.return_value = ('1', '1Mi')
+        self.setup_mock_watch(mock_watch, [mock_pod])
+        kc = KubernetesClient()
+        kc._set_pod(Mock())
+        completion_result = kc.wait_for_completion()
+        self.assertEqual(completion_result.exit_code, 137)
+        self.assertEqual(completion_result.reason, 'DeadlineExceeded')
+        self.assertEqual(completion_result.start_time, completion_result.finish_time)
+        self.assertTrue(mock_watch.Watch.return_value.stop.called)
+        self.assertTrue(mock_client.CoreV1Api.return_value.delete_namespaced_pod.called)
+        self.assertIsNone(kc.pod)
+
+    @patch('calrissian.k8s.watch', autospec=True)
+    @patch('calrissian.k8s.PodMonitor')
+    def test_wait_raises_when_pod_is_evicted(self, mock_podmonitor, mock_watch, mock_get_namespace, mock_client):
+        mock_pod = create_autospec(V1Pod)
+        mock_pod.metadata.name = 'evicted-pod'
+        mock_pod.status.reason = 'Evicted'
+        mock_pod.status.container_statuses[0].state = Mock(running=None, waiting=None, terminated=Mock(exit_code=137))
+        self.setup_mock_watch(mock_watch, [mock_pod])
+        kc = KubernetesClient()
+        kc._set_pod(Mock())
+        with self.assertRaisesRegex(PodDisruptedException, 'Evicted'):
+            kc.wait_for_completion()
+        self.assertTrue(mock_watch.Watch.return_value.stop.called)
+        self.assertEqual(mock_client.CoreV1Api.return_value.delete_namespaced_pod.call_args,
+                         call('evicted-pod', kc.namespace))
+        self.assertTrue(mock_podmonitor.return_value.__enter__.return_value.remove.called)
+        self.assertIsNone(kc.pod)
+
+    @patch('calrissian.k8s.watch', autospec=True)
+    @patch('calrissian.k8s.PodMonitor')
+    def test_wait_raises_when_pod_is_deleted(self, mock_podmonitor, mock_watch, mock_get_namespace, mock_client):
+        mock_pod = create_autospec(V1Pod)
+        mock_podmonitor.deletion_requested.return_value = False
+        mock_watch.Watch.return_value.stream.return_value = [{'type': 'DELETED', 'object': mock_pod}]
+        kc = KubernetesClient()
+        kc._set_pod(Mock())
+        with self.assertRaises(PodDisruptedException):
+            kc.wait_for_completion()
+        self.assertFalse(mock_client.CoreV1Api.return_value.delete_namespaced_pod.called)
+
+    @patch('calrissian.k8s.watch', autospec=True)
+    @patch('calrissian.k8s.PodMonitor')
+    def test_wait_does_not_resubmit_pod_deleted_on_cleanup(self, mock_podmonitor, mock_watch, mock_get_namespace,
+                                                           mock_client):
+        mock_pod = create_autospec(V1Pod)
+        mock_pod.metadata.name = 'cleanup-pod'
+        mock_podmonitor.deletion_requested.return_value = True
+        mock_watch.Watch.return_value.stream.return_value = [{'type': 'DELETED', 'object': mock_pod}]
+        kc = KubernetesClient()
+        kc._set_pod(Mock())
+        with self.assertRaisesRegex(CalrissianJobException, 'cleanup-pod was deleted by the controller') as context:
+            kc.wait_for_completion()
+        self.assertNotIsInstance(context.exception, PodDisruptedException)
+        self.assertEqual(mock_podmonitor.deletion_requested.call_args, call('cleanup-pod'))
+        self.assertTrue(mock_watch.Watch.return_value.stop.called)
+        self.assertIsNone(kc.pod)
+
+    @patch('calrissian.k8s.watch', autospec=True)
+    @patch('calrissian.k8s.PodMonitor')
+    @patch('calrissian.k8s.MemoryOvercommit')
+    def test_wait_backs_off_memory_overcommit_when_pod_is_evicted(self, mock_memory_overcommit, mock_podmonitor,
+                                                                   mock_watch, mock_get_namespace, mock_client):
+        mock_pod = create_autospec(V1Pod)
+        mock_pod.status.reason = 'Evicted'
+        mock_watch.Watch.return_value.stream.return_value = [{'type': 'MODIFIED', 'object': mock_pod}]
+        kc = KubernetesClient()
+        kc._set_pod(Mock())
+        with self.assertRaises(PodDisruptedException):
+            kc.wait_for_completion()
+        self.assertEqual(mock_memory_overcommit.observe.call_args, call('Evicted'))
+
+    @patch('calrissian.k8s.watch', autospec=True)
+    @patch('calrissian.k8s.PodMonitor')
+    @patch('calrissian.k8s.MemoryOvercommit')
+    def test_wait_leaves_memory_overcommit_when_pod_is_deleted(self, mock_memory_overcommit, mock_podmonitor,
+                                                                mock_watch, mock_get_namespace, mock_client):
+        mock_podmonitor.deletion_requested.return_value = False
+        mock_watch.Watch.return_value.stream.return_value = [{'type': 'DELETED', 'object': create_autospec(V1Pod)}]
+        kc = KubernetesClient()
+        kc._set_pod(Mock())
+        with self.assertRaises(PodDisruptedException):
+            kc.wait_for_completion()
+        self.assertFalse(mock_memory_overcommit.observe.called)
+
+    def test_extract_extended_requests(self, mock_get_namespace, mock_client):
+        container = Mock()
+        container.resources.requests = {'cpu': '1', 'memory': '1Mi', 'ephemeral-storage': '2Gi'}
+        self.assertEqual(KubernetesClient()._extract_extended_requests(container), {'ephemeral-storage': '2Gi'})
+        container.resources.requests = None
+        self.assertEqual(KubernetesClient()._extract_extended_requests(container), {})
+
+    def test_pod_disruption_reason(self, mock_get_namespace, mock_client):
+        mock_pod = create_autospec(V1Pod)
+        mock_pod.status.reason = None
+        mock_pod.status.conditions = [Mock(type='Ready', status='False')]
+        self.assertIsNone(KubernetesClient.pod_disruption_reason({'type': 'MODIFIED', 'object': mock_pod}))
+        mock_pod.status.conditions.append(Mock(type='DisruptionTarget', status='True', reason='PreemptionByScheduler'))
+        self.assertEqual(KubernetesClient.pod_disruption_reason({'type': 'MODIFIED', 'object': mock_pod}),
+                         'PreemptionByScheduler')
+        mock_pod.status.reason = 'NodeLost'
+        self.assertEqual(KubernetesClient.pod_disruption_reason({'type': 'MODIFIED', 'object': mock_pod}), 'NodeLost')
+        self.assertEqual(KubernetesClient.pod_disruption_reason({'type': 'DELETED', 'object': mock_pod}), 'Deleted')
+        PodMonitor.deleted_names = {mock_pod.metadata.name}
+        self.addCleanup(setattr, PodMonitor, 'deleted_names', set())
+        self.assertIsNone(KubernetesClient.pod_disruption_reason({'type': 'DELETED', 'object': mock_pod}))
+        # Pods killed by their deadline are not resubmitted
+        mock_pod.status.reason = 'DeadlineExceeded'
+        self.assertIsNone(KubernetesClient.pod_disruption_reason({'type': 'MODIFIED', 'object': mock_pod}))
+        # Nor pods terminated for other reasons
+        mock_pod.status.conditions = []
+        for reason in ['Terminated', 'Shutdown']:
+            mock_pod.status.reason = reason
+            self.assertIsNone(KubernetesClient.pod_disruption_reason({'type': 'MODIFIED', 'object': mock_pod}))
+
     @patch('calrissian.k8s.watch', autospec=True)
     def test_wait_raises_exception_when_state_is_unexpected(self, mock_watch, mock_get_namespace, mock_client):
         mock_pod = create_autospec(V1Pod)
@@ -344,6 +685,7 @@ class PodMonitorTestCase(TestCase):
 
     def setUp(self):
         PodMonitor.pod_names = []
+        PodMonitor.deleted_names = set()
 
     def test_add(self):
         pod = self.make_mock_pod('pod-123')
@@ -365,6 +707,17 @@ class PodMonitorTestCase(TestCase):
         PodMonitor.pod_names = ['cleanup-pod']
         PodMonitor.cleanup()
         self.assertEqual(mock_delete_pod_name.call_args, call('cleanup-pod'))
+        self.assertTrue(PodMonitor.deletion_requested('cleanup-pod'))
+
+    @patch('calrissian.k8s.KubernetesClient')
+    def test_recover(self, mock_client):
+        recorded = self.make_mock_pod('recorded-pod')
+        unrecorded = self.make_mock_pod('unrecorded-pod')
+        mock_client.return_value.list_pods_for_run.return_value = [recorded, unrecorded]
+        PodMonitor.recover('abc123', ['recorded-pod', 'gone-pod'])
+        self.assertEqual(mock_client.return_value.list_pods_for_run.call_args, call('abc123'))
+        self.assertEqual(PodMonitor.pod_names, ['recorded-pod'])
+        self.assertEqual(mock_client.return_value.delete_pod_name.mock_calls, [call('unrecorded-pod')])
 
     @patch('calrissian.k8s.PodMonitor')
     def test_delete_pods_calls_podmonitor(self, mock_pod_monitor):
@@ -390,6 +743,91 @@ class PodMonitorTestCase(TestCase):
         mock_log.warning.assert_called_with('PodMonitor pod-123 has already been removed')
 
 
+class PodUsageTestCase(TestCase):
+
+    def test_add(self):
+        usage = PodUsage()
+        self.assertIsNone(usage.mean_cpus())
+        usage.add({'timestamp': 't1', 'containers': [{'usage': {'cpu': '250000000n', 'memory': '100M'}},
+                                                     {'usage': {'cpu': '250m', 'memory': '100M'}}]})
+        usage.add({'timestamp': 't2', 'containers': [{'usage': {'cpu': '1', 'memory': '100M'}}]})
+        self.assertAlmostEqual(usage.peak_cpus, 1)
+        self.assertAlmostEqual(usage.mean_cpus(), 0.75)
+        self.assertAlmostEqual(usage.peak_ram_megabytes, 200)
+        self.assertAlmostEqual(usage.mean_ram_megabytes(), 150)
+
+    def test_add_counts_each_scrape_once(self):
+        usage = PodUsage()
+        for _ in range(3):
+            usage.add({'timestamp': 't1', 'containers': [{'usage': {'cpu': '1', 'memory': '100M'}}]})
+        usage.add({'timestamp': 't2', 'containers': []})
+        self.assertEqual(usage.samples, 1)
+
+
+class UsageMonitorTestCase(TestCase):
+
+    def setUp(self):
+        UsageMonitor.initialize()
+
+    def tearDown(self):
+        UsageMonitor.interval = None
+        UsageMonitor.usages = {}
+
+    def test_initialize_bounds_interval(self):
+        self.assertTrue(UsageMonitor.is_enabled())
+        UsageMonitor.initialize(0.1)
+        self.assertEqual(UsageMonitor.interval, 5)
+
+    @patch('calrissian.k8s.threading')
+    def test_add_and_remove(self, mock_threading):
+        usage = UsageMonitor.add('pod-123', 'namespace')
+        UsageMonitor.add('pod-456', 'namespace')
+        # A single thread samples all the pods
+        self.assertEqual(mock_threading.Thread.call_count, 1)
+        self.assertTrue(mock_threading.Thread.return_value.start.called)
+        self.assertEqual(UsageMonitor.remove('pod-123'), usage)
+        self.assertIsNone(UsageMonitor.remove('pod-123'))
+        UsageMonitor.thread = None
+
+    def test_peak_ram_megabytes(self):
+        usage = PodUsage()
+        UsageMonitor.usages = {'pod-123': usage}
+        self.assertIsNone(UsageMonitor.peak_ram_megabytes('pod-123'))
+        usage.add({'timestamp': 't1', 'containers': [{'usage': {'cpu': '500m', 'memory': '300M'}}]})
+        self.assertAlmostEqual(UsageMonitor.peak_ram_megabytes('pod-123'), 300)
+        self.assertIsNone(UsageMonitor.peak_ram_megabytes('pod-456'))
+
+    def test_sample(self):
+        usage = PodUsage()
+        UsageMonitor.usages = {'pod-123': usage}
+        api = Mock()
+        api.list_namespaced_custom_object.return_value = {'items': [
+            {'metadata': {'name': 'pod-123'}, 'timestamp': 't1', 'containers': [{'usage': {'cpu': '1', 'memory': '1M'}}]},
+            {'metadata': {'name': 'other-pod'}, 'timestamp': 't1', 'containers': [{'usage': {'cpu': '2', 'memory': '1M'}}]},
+        ]}
+        UsageMonitor.sample(api, 'namespace')
+        self.assertEqual(api.list_namespaced_custom_object.call_args,
+                         call('metrics.k8s.io', 'v1beta1', 'namespace', 'pods'))
+        self.assertEqual(usage.peak_cpus, 1)
+
+    def test_sample_without_metrics(self):
+        api = Mock()
+        api.list_namespaced_custom_object.side_effect = ApiException(status=404)
+        UsageMonitor.sample(api, 'namespace')
+
+    @patch('calrissian.k8s.client')
+    @patch('calrissian.k8s.time')
+    @patch('calrissian.k8s.UsageMonitor.sample')
+    def test_run_stops_without_pods(self, mock_sample, mock_time, mock_client):
+        UsageMonitor.usages = {'pod-123': PodUsage()}
+        UsageMonitor.thread = Mock()
+        mock_sample.side_effect = lambda api, namespace: UsageMonitor.usages.clear()
+        UsageMonitor.run('namespace')
+        self.assertEqual(mock_sample.call_args, call(mock_client.CustomObjectsApi.return_value, 'namespace'))
+        self.assertEqual(mock_time.sleep.call_args_list, [call(15), call(15)])
+        self.assertIsNone(UsageMonitor.thread)
+
+
 class CompletionResultTestCase(TestCase):
 
     def setUp(self):
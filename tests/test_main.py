@@ -1,12 +1,22 @@
+import argparse
 from unittest import TestCase
 from unittest.mock import patch, call, Mock
 from calrissian.main import main, add_arguments, parse_arguments
 from calrissian.main import handle_sigterm, install_signal_handler, install_tees, flush_tees
-from calrissian.main import activate_logging, get_log_level, print_version
+from calrissian.main import activate_logging, get_log_level, print_version, initialize_journal, parse_max_resources
+from calrissian.main import parse_resource_pools, add_custom_schema
+from calrissian.executor import Resources
+from calrissian.fairshare import FairShareQueue
+from calrissian.prepull import start_image_prepull
+from calrissian.pool import RUNNER_OUTDIR, RUNNER_STAGEDIR
+from calrissian.fusion import start_step_fusion
 import logging
+import os
+import tempfile
 
 class CalrissianMainTestCase(TestCase):
 
+    @patch('calrissian.main.parse_resource_pools')
     @patch('calrissian.main.cwlmain')
     @patch('calrissian.main.arg_parser')
     @patch('calrissian.main.ThreadPoolJobExecutor', autospec=True)
@@ -15,6 +25,16 @@ class CalrissianMainTestCase(TestCase):
     @patch('calrissian.main.version')
     @patch('calrissian.main.parse_arguments')
     @patch('calrissian.main.add_arguments')
+    @patch('calrissian.main.Reporter')
+    @patch('calrissian.main.ReferenceCache')
+    @patch('calrissian.main.IOBudget')
+    @patch('calrissian.main.MemoryOvercommit')
+    @patch('calrissian.main.UsageMonitor')
+    @patch('calrissian.main.UsageHistory')
+    @patch('calrissian.main.Speculator')
+    @patch('calrissian.main.JobBatcher')
+    @patch('calrissian.main.RunnerPool')
+    @patch('calrissian.main.ImagePrePuller')
     @patch('calrissian.main.PodMonitor')
     @patch('calrissian.main.install_signal_handler')
     @patch('calrissian.main.write_report')
@@ -30,12 +50,33 @@ class CalrissianMainTestCase(TestCase):
                                                   mock_memory_parser, mock_cpu_parser,
                                                   mock_initialize_reporter, mock_write_report,
                                                   mock_install_signal_handler, mock_pod_monitor,
-                                                  mock_add_arguments, mock_parse_arguments, mock_version,
+                                                  mock_image_prepuller, mock_runner_pool, mock_job_batcher, mock_speculator, mock_usage_history, mock_usage_monitor, mock_memory_overcommit, mock_io_budget, mock_reference_cache, mock_reporter, mock_add_arguments, mock_parse_arguments, mock_version,
                                                   mock_runtime_context, mock_loading_context, mock_executor,
-                                                  mock_arg_parser, mock_cwlmain):
+                                                  mock_arg_parser, mock_cwlmain, mock_parse_resource_pools):
         mock_exit_code = Mock()
         mock_cwlmain.return_value = mock_exit_code  # not called before main
         mock_parse_arguments.return_value.dask_gateway_url = None  # No custom schema callback
+        mock_parse_arguments.return_value.journal = None
+        mock_parse_arguments.return_value.step_cache = None
+        mock_parse_arguments.return_value.prepull_images = True
+        mock_parse_arguments.return_value.warm_pool_ttl = 30
+        mock_parse_arguments.return_value.batch_max_size = 20
+        mock_parse_arguments.return_value.fuse_steps = True
+        mock_parse_arguments.return_value.speculation_factor = 2.0
+        mock_parse_arguments.return_value.usage_history = 'usage.sqlite'
+        mock_parse_arguments.return_value.usage_sample_seconds = None
+        mock_parse_arguments.return_value.memory_overcommit = 1.5
+        mock_parse_arguments.return_value.io_budget = 16.0
+        mock_parse_arguments.return_value.stripe_outdir_prefix = ['/out1/', '/out2/']
+        mock_parse_arguments.return_value.stripe_placement = 'least-used'
+        mock_parse_arguments.return_value.reference_cache_dir = '/mnt/reference-cache'
+        mock_parse_arguments.return_value.reference_cache_prefix = ['/calrissian/refs']
+        mock_parse_arguments.return_value.max_resource = ['ephemeral-storage=100Gi']
+        mock_parse_arguments.return_value.resource_pools = 'pools.yaml'
+        mock_pool = Mock(total_resources=Resources(1024, 2))
+        mock_pool.name = 'gpu'
+        mock_executor.return_value.all_pools.return_value = [mock_pool]
+        mock_parse_arguments.return_value.fair_share = True
         result = main()
         self.assertTrue(mock_arg_parser.called)
         self.assertEqual(mock_add_arguments.call_args, call(mock_arg_parser.return_value))
@@ -45,18 +86,60 @@ class CalrissianMainTestCase(TestCase):
         self.assertEqual(mock_memory_parser.parse_to_megabytes.call_args, call(mock_parse_arguments.return_value.max_ram))
         self.assertEqual(mock_cpu_parser.parse.call_args, call(mock_parse_arguments.return_value.max_cores))
         self.assertEqual(mock_executor.call_args,
-                         call(mock_memory_parser.parse_to_megabytes.return_value, mock_cpu_parser.parse.return_value, 1))
+                         call(mock_memory_parser.parse_to_megabytes.return_value, mock_cpu_parser.parse.return_value, 1,
+                              total_extended={'ephemeral-storage': 102400.0}))
         self.assertTrue(mock_runtime_context.called)
         self.assertEqual(mock_cwlmain.call_args, call(args=mock_parse_arguments.return_value,
                                                       executor=mock_executor.return_value,
                                                       loadingContext=mock_loading_context.return_value,
                                                       runtimeContext=mock_runtime_context.return_value,
                                                       versionfunc=mock_version,
-                                                      custom_schema_callback=None))
+                                                      custom_schema_callback=add_custom_schema))
         self.assertEqual(mock_runtime_context.return_value.select_resources,
                          mock_executor.return_value.select_resources)
+        self.assertEqual(mock_runtime_context.return_value.reserve_resources,
+                         mock_executor.return_value.reserve_resources)
+        self.assertEqual(mock_runtime_context.return_value.release_resources,
+                         mock_executor.return_value.release_resources)
         self.assertEqual(result, mock_exit_code)
         self.assertTrue(mock_pod_monitor.cleanup.called)  # called after main()
+        self.assertEqual(mock_executor.return_value.add_start_hook.mock_calls,
+                         [call(start_step_fusion), call(start_image_prepull)])
+        self.assertTrue(mock_image_prepuller.cleanup.called)
+        self.assertEqual(mock_runner_pool.initialize.call_args, call(30))
+        self.assertEqual(mock_runtime_context.return_value.docker_outdir, RUNNER_OUTDIR)
+        self.assertEqual(mock_runtime_context.return_value.docker_stagedir, RUNNER_STAGEDIR)
+        self.assertTrue(mock_runner_pool.cleanup.called)
+        self.assertEqual(mock_job_batcher.call_args, call(20, mock_parse_arguments.return_value.batch_target_seconds,
+                                                          mock_parse_arguments.return_value.batch_parallelism,
+                                                          mock_parse_arguments.return_value.batch_backend,
+                                                          not mock_parse_arguments.return_value.batch_shared_backoff_limit))
+        self.assertEqual(mock_executor.return_value.batcher, mock_job_batcher.return_value)
+        self.assertEqual(mock_executor.return_value.backfill, mock_parse_arguments.return_value.backfill)
+        self.assertEqual(mock_speculator.initialize.call_args,
+                         call(2.0, mock_parse_arguments.return_value.speculation_quantile))
+        # The usage history samples usage at the default interval
+        self.assertEqual(mock_usage_monitor.initialize.call_args, call(15))
+        self.assertEqual(mock_usage_history.initialize.call_args,
+                         call('usage.sqlite', mock_parse_arguments.return_value.right_size,
+                              mock_parse_arguments.return_value.right_size_percentile))
+        self.assertEqual(mock_memory_overcommit.initialize.call_args,
+                         call(1.5, mock_usage_monitor.is_enabled.return_value))
+        self.assertEqual(mock_reporter.set_memory_overcommit.call_args, call(mock_memory_overcommit.to_dict.return_value))
+        self.assertEqual(mock_io_budget.initialize.call_args, call(16.0))
+        self.assertEqual(mock_runtime_context.return_value.outdir_striper.prefixes, ['/out1/', '/out2/'])
+        self.assertEqual(mock_runtime_context.return_value.outdir_striper.placement, 'least-used')
+        self.assertEqual(mock_reporter.set_io_budget.call_args, call(mock_io_budget.to_dict.return_value))
+        self.assertEqual(mock_reference_cache.initialize.call_args,
+                         call('/mnt/reference-cache', ['/calrissian/refs'], mock_memory_parser.parse.return_value))
+        self.assertEqual(mock_memory_parser.parse.call_args,
+                         call(mock_parse_arguments.return_value.reference_cache_size))
+        self.assertIsInstance(mock_pool.jrq, FairShareQueue)
+        self.assertEqual(mock_pool.jrq.total_resources, Resources(1024, 2))
+        self.assertEqual(mock_parse_resource_pools.call_args, call('pools.yaml'))
+        self.assertEqual(mock_executor.return_value.pools, mock_parse_resource_pools.return_value)
+        self.assertEqual(mock_reporter.set_resource_pools.call_args,
+                         call({'gpu': {'cores': 2, 'ram': 1024, 'gpus': 0}}))
         self.assertTrue(mock_write_report.called)
         self.assertEqual(mock_initialize_reporter.call_args, call(mock_memory_parser.parse_to_megabytes.return_value, mock_cpu_parser.parse.return_value))
         self.assertEqual(mock_install_tees.call_args, call(mock_parse_arguments.return_value.stdout, mock_parse_arguments.return_value.stderr))
@@ -65,7 +148,15 @@ class CalrissianMainTestCase(TestCase):
     def test_add_arguments(self):
         mock_parser = Mock()
         add_arguments(mock_parser)
-        self.assertEqual(mock_parser.add_argument.call_count, 20)
+        self.assertEqual(mock_parser.add_argument.call_count, 57)
+
+    def test_retries_are_opt_in(self):
+        parser = argparse.ArgumentParser()
+        add_arguments(parser)
+        parsed = parser.parse_args([])
+        self.assertEqual(parsed.max_pod_resubmissions, 0)
+        self.assertIsNone(parsed.oom_retry_factor)
+        self.assertIsNone(parsed.speculation_factor)
 
     @patch('calrissian.main.sys')
     def test_parse_arguments_exits_without_ram_or_cores(self, mock_sys):
@@ -99,14 +190,43 @@ class CalrissianMainTestCase(TestCase):
         self.assertTrue(mock_print_version.called)
         self.assertEqual(mock_sys.exit.call_args, call(0))
 
+    @patch('calrissian.main.PodMonitor')
+    @patch('calrissian.main.Journal')
+    def test_initialize_journal(self, mock_journal, mock_pod_monitor):
+        initialize_journal('journal.jsonl', False, False)
+        self.assertEqual(mock_journal.initialize.call_args, call('journal.jsonl', replay=[]))
+        self.assertFalse(mock_pod_monitor.recover.called)
+
+    @patch('calrissian.main.PodMonitor')
+    @patch('calrissian.main.Journal')
+    def test_initialize_journal_resume(self, mock_journal, mock_pod_monitor):
+        initialize_journal('journal.jsonl', False, True)
+        self.assertEqual(mock_journal.initialize.call_args, call('journal.jsonl', replay=[mock_journal.COMPLETED]))
+        self.assertFalse(mock_pod_monitor.recover.called)
+
+    @patch('calrissian.main.PodMonitor')
+    @patch('calrissian.main.Journal')
+    def test_initialize_journal_reattach_recovers_pods(self, mock_journal, mock_pod_monitor):
+        mock_journal.replayed_entries.return_value = [{'pod': 'pod1'}, {'pod': 'pod2'}]
+        initialize_journal('journal.jsonl', True, False)
+        self.assertEqual(mock_journal.initialize.call_args,
+                         call('journal.jsonl', replay=[mock_journal.SUBMITTED, mock_journal.COMPLETED]))
+        self.assertEqual(mock_journal.replayed_entries.call_args, call(mock_journal.SUBMITTED))
+        self.assertEqual(mock_pod_monitor.recover.call_args, call(mock_journal.run_id, ['pod1', 'pod2']))
+
     @patch('calrissian.main.sys')
+    @patch('calrissian.main.IndexedJobBatch')
+    @patch('calrissian.main.ImagePrePuller')
     @patch('calrissian.main.PodMonitor')
-    def test_handle_sigterm_exits_with_signal(self, mock_pod_monitor, mock_sys):
+    def test_handle_sigterm_exits_with_signal(self, mock_pod_monitor, mock_image_prepuller, mock_indexed_job_batch,
+                                              mock_sys):
         frame = Mock()
         signum = 15
         handle_sigterm(signum, frame)
         self.assertEqual(mock_sys.exit.call_args, call(signum))
         self.assertTrue(mock_pod_monitor.cleanup.called)
+        self.assertTrue(mock_indexed_job_batch.cleanup.called)
+        self.assertTrue(mock_image_prepuller.cleanup.called)
 
     @patch('calrissian.main.signal')
     @patch('calrissian.main.handle_sigterm')
@@ -154,16 +274,48 @@ class CalrissianMainTestCase(TestCase):
         self.assertTrue(mock_sys.stdout.flush.called)
         self.assertTrue(mock_sys.stderr.flush.called)
 
+    def test_parse_max_resources(self):
+        self.assertEqual(parse_max_resources(None), {})
+        self.assertEqual(parse_max_resources(['ephemeral-storage=10Gi', 'example.com/fpga = 2']),
+                         {'ephemeral-storage': 10240, 'example.com/fpga': 2})
+        with self.assertRaisesRegex(ValueError, 'expected NAME=QUANTITY'):
+            parse_max_resources(['ephemeral-storage'])
+
+    def test_parse_resource_pools(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'pools.yaml')
+            with open(filename, 'w') as f:
+                f.write('gpu:\n'
+                        '  nodeSelector: {pool: gpu}\n'
+                        '  maxRam: 64G\n'
+                        '  maxCores: 16\n'
+                        '  maxGpus: 4\n'
+                        '  maxResources: {ephemeral-storage: 100Gi}\n')
+            pools = parse_resource_pools(filename)
+        self.assertEqual(len(pools), 1)
+        self.assertEqual(pools[0].name, 'gpu')
+        self.assertEqual(pools[0].node_selector, {'pool': 'gpu'})
+        self.assertEqual(pools[0].total_resources, Resources(64000, 16, 4, {'ephemeral-storage': 102400}))
+
+    @patch('calrissian.main.read_yaml')
+    def test_parse_resource_pools_raises(self, mock_read_yaml):
+        mock_read_yaml.return_value = {'highmem': {'maxRam': '512Gi'}}
+        with self.assertRaisesRegex(ValueError, 'has no nodeSelector'):
+            parse_resource_pools('pools.yaml')
+        mock_read_yaml.return_value = {'default': {'nodeSelector': {'pool': 'cpu'}}}
+        with self.assertRaisesRegex(ValueError, 'is reserved'):
+            parse_resource_pools('pools.yaml')
+
     @patch('calrissian.main.logging')
     def test_activate_logging(self, mock_logging):
         mock_level = Mock()
         activate_logging(mock_level)
-        self.assertEqual(mock_logging.getLogger.call_count, 14) #
-        #  setLevel should be called 7 times
-        self.assertEqual([call(mock_level)] * 7, mock_logging.getLogger.return_value.setLevel.mock_calls)
-        # addHandler should be called 7 times
+        self.assertEqual(mock_logging.getLogger.call_count, 42) #
+        #  setLevel should be called 11 times
+        self.assertEqual([call(mock_level)] * 21, mock_logging.getLogger.return_value.setLevel.mock_calls)
+        # addHandler should be called 11 times
         mock_streamhandler = mock_logging.StreamHandler.return_value
-        self.assertEqual([call(mock_streamhandler)] * 7, mock_logging.getLogger.return_value.addHandler.mock_calls)
+        self.assertEqual([call(mock_streamhandler)] * 21, mock_logging.getLogger.return_value.addHandler.mock_calls)
 
     def test_get_log_level(self):
         args_quiet = Mock(quiet=True, verbose=False, debug=False)
@@ -0,0 +1,74 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+from calrissian.executor import Resources
+from calrissian.overcommit import MemoryOvercommit
+
+
+def make_running_job(observed_ram_megabytes):
+    job = Mock()
+    job.observed_ram_megabytes.return_value = observed_ram_megabytes
+    return job
+
+
+class MemoryOvercommitTestCase(TestCase):
+
+    def setUp(self):
+        MemoryOvercommit.initialize(2.0)
+
+    def tearDown(self):
+        MemoryOvercommit.initialize(None)
+
+    def test_is_enabled(self):
+        self.assertTrue(MemoryOvercommit.is_enabled())
+        MemoryOvercommit.initialize(None)
+        self.assertFalse(MemoryOvercommit.is_enabled())
+
+    def test_allowance(self):
+        self.assertEqual(MemoryOvercommit.allowance(1000, []), 1000)
+
+    def test_measured_allowance(self):
+        MemoryOvercommit.initialize(2.0, measured=True)
+        running = [
+            (make_running_job(200), Resources(500, 1)),
+            # Uses more than requested, so it has no unused RAM
+            (make_running_job(600), Resources(500, 1)),
+            # Not sampled yet, so it counts at its request
+            (make_running_job(None), Resources(500, 1)),
+        ]
+        self.assertEqual(MemoryOvercommit.allowance(1000, running), 250)
+
+    def test_measured_allowance_within_ratio(self):
+        MemoryOvercommit.initialize(1.1, measured=True)
+        self.assertAlmostEqual(MemoryOvercommit.allowance(1000, [(make_running_job(100), Resources(1000, 1))]), 100)
+
+    def test_observe_backs_off_on_memory_shortage(self):
+        MemoryOvercommit.observe('OOMKilled')
+        self.assertEqual(MemoryOvercommit.ratio, 1.5)
+        MemoryOvercommit.observe('Evicted')
+        self.assertEqual(MemoryOvercommit.ratio, 1.25)
+        self.assertEqual(MemoryOvercommit.backoffs, 2)
+
+    def test_observe_recovers_up_to_max_ratio(self):
+        MemoryOvercommit.observe('OOMKilled')
+        MemoryOvercommit.observe('Completed')
+        self.assertAlmostEqual(MemoryOvercommit.ratio, 1.55)
+        for _ in range(20):
+            MemoryOvercommit.observe(None)
+        self.assertEqual(MemoryOvercommit.ratio, 2.0)
+
+    def test_observe_when_disabled(self):
+        MemoryOvercommit.initialize(None)
+        MemoryOvercommit.observe('OOMKilled')
+        self.assertIsNone(MemoryOvercommit.ratio)
+
+    def test_record_admission(self):
+        MemoryOvercommit.record_admission(1500, 1000)
+        MemoryOvercommit.record_admission(1200, 1000)
+        self.assertEqual(MemoryOvercommit.to_dict(), {
+            'max_ratio': 2.0,
+            'ratio': 2.0,
+            'admission_ratio': 1.2,
+            'peak_admission_ratio': 1.5,
+            'backoffs': 0,
+        })
@@ -0,0 +1,277 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch, call
+
+from calrissian.pool import runner_pod_body, runner_script, exports_environment, RunnerPod, RunnerPool
+from calrissian.pool import RUNNER_ROOT, RUNNER_OUTDIR, RUNNER_STAGEDIR, RUNNER_LABEL, RUNNER_VOLUME_NAME
+
+
+def make_pod():
+    return {
+        'metadata': {'name': 'step1-pod-abcdefgh', 'labels': {'app': 'calrissian'}},
+        'apiVersion': 'v1',
+        'kind': 'Pod',
+        'spec': {
+            'initContainers': [{
+                'name': 'step1-init',
+                'image': 'alpine:3.10',
+                'command': ['/bin/sh', '-c', 'mkdir -p logs;'],
+            }],
+            'containers': [{
+                'name': 'step1-container',
+                'image': 'debian:stable',
+                'command': ['/bin/sh', '-c'],
+                'args': ['echo hello > logs/out.txt'],
+                'env': [{'name': 'HOME', 'value': RUNNER_OUTDIR}, {'name': 'MESSAGE', 'value': 'hello world'}],
+                'resources': {'requests': {'cpu': '1', 'memory': '1024Mi'}},
+                'volumeMounts': [{'name': 'claim1', 'mountPath': RUNNER_OUTDIR, 'subPath': 'out', 'readOnly': False}],
+                'workingDir': RUNNER_OUTDIR,
+            }],
+            'restartPolicy': 'Never',
+            'volumes': [{'name': 'claim1', 'persistentVolumeClaim': {'claimName': 'claim1', 'readOnly': False}}],
+            'securityContext': {'runAsUser': 1000},
+            'nodeSelector': {},
+        }
+    }
+
+
+PERSISTENT_VOLUME_ENTRIES = [
+    {'prefix': '/calrissian', 'subPath': None,
+     'volume': {'name': 'claim1', 'persistentVolumeClaim': {'claimName': 'claim1', 'readOnly': False}}},
+    {'prefix': '/calrissian/input-data', 'subPath': 'data',
+     'volume': {'name': 'claim1', 'persistentVolumeClaim': {'claimName': 'claim1', 'readOnly': True}}},
+]
+
+
+class ExportsEnvironmentTestCase(TestCase):
+
+    def test_exports_values(self):
+        self.assertTrue(exports_environment(make_pod()))
+
+    def test_does_not_export_value_from(self):
+        pod = make_pod()
+        pod['spec']['containers'][0]['env'].append(
+            {'name': 'TOKEN', 'valueFrom': {'secretKeyRef': {'name': 'secret1', 'key': 'token'}}})
+        self.assertFalse(exports_environment(pod))
+
+    def test_does_not_export_env_from(self):
+        pod = make_pod()
+        pod['spec']['containers'][0]['envFrom'] = [{'secretRef': {'name': 'secret1'}}]
+        self.assertFalse(exports_environment(pod))
+
+
+class RunnerPodBodyTestCase(TestCase):
+
+    def test_keeps_scheduling_and_resources(self):
+        body = runner_pod_body(make_pod(), PERSISTENT_VOLUME_ENTRIES)
+        self.assertNotIn('name', body['metadata'])
+        self.assertEqual(body['metadata']['labels'], {'app': 'calrissian', RUNNER_LABEL: 'true'})
+        self.assertEqual(body['spec']['securityContext'], {'runAsUser': 1000})
+        container = body['spec']['containers'][0]
+        self.assertEqual(container['image'], 'debian:stable')
+        self.assertEqual(container['resources'], {'requests': {'cpu': '1', 'memory': '1024Mi'}})
+
+    def test_replaces_job_specifics(self):
+        body = runner_pod_body(make_pod(), PERSISTENT_VOLUME_ENTRIES)
+        self.assertNotIn('initContainers', body['spec'])
+        container = body['spec']['containers'][0]
+        self.assertNotIn('env', container)
+        self.assertNotIn('args', container)
+        self.assertEqual(container['workingDir'], RUNNER_ROOT)
+
+    def test_mounts_shared_volumes(self):
+        body = runner_pod_body(make_pod(), PERSISTENT_VOLUME_ENTRIES)
+        self.assertEqual([v['name'] for v in body['spec']['volumes']], [RUNNER_VOLUME_NAME, 'tmpdir', 'claim1'])
+        volume_mounts = body['spec']['containers'][0]['volumeMounts']
+        self.assertIn({'name': RUNNER_VOLUME_NAME, 'mountPath': RUNNER_ROOT}, volume_mounts)
+        self.assertIn({'name': 'claim1', 'mountPath': '/calrissian', 'subPath': None, 'readOnly': False}, volume_mounts)
+        self.assertIn({'name': 'claim1', 'mountPath': '/calrissian/input-data', 'subPath': 'data', 'readOnly': True},
+                      volume_mounts)
+
+    def test_same_body_for_different_jobs(self):
+        other_pod = make_pod()
+        other_pod['metadata']['name'] = 'step2-pod-ijklmnop'
+        other_pod['spec']['containers'][0]['args'] = ['cat input.txt']
+        other_pod['spec']['containers'][0]['env'] = []
+        self.assertEqual(runner_pod_body(make_pod(), PERSISTENT_VOLUME_ENTRIES),
+                         runner_pod_body(other_pod, PERSISTENT_VOLUME_ENTRIES))
+
+
+class RunnerScriptTestCase(TestCase):
+
+    def test_script(self):
+        bindings = [
+            ('/calrissian/input-data/in put.txt', RUNNER_STAGEDIR + '/stg1/in put.txt'),
+            ('/calrissian/out', RUNNER_OUTDIR),
+        ]
+        script = runner_script(make_pod(), bindings)
+        self.assertEqual(script.split('\n'), [
+            'set -e',
+            'rm -rf {}/* /tmp/* /tmp/.[!.]*'.format(RUNNER_ROOT),
+            'mkdir -p {} && ln -sfn /calrissian/out {}'.format(RUNNER_ROOT, RUNNER_OUTDIR),
+            "mkdir -p {}/stg1 && ln -sfn '/calrissian/input-data/in put.txt' '{}/stg1/in put.txt'".format(
+                RUNNER_STAGEDIR, RUNNER_STAGEDIR),
+            'export HOME={}'.format(RUNNER_OUTDIR),
+            "export MESSAGE='hello world'",
+            'cd {}'.format(RUNNER_OUTDIR),
+            'mkdir -p logs;',
+            'set +e',
+            'echo hello > logs/out.txt',
+        ])
+
+
+@patch('calrissian.pool.KubernetesClient')
+class RunnerPodTestCase(TestCase):
+
+    def test_name(self, mock_client):
+        runner = RunnerPod('key', runner_pod_body(make_pod(), []))
+        self.assertTrue(runner.name.startswith('calrissian-runner-'))
+
+    def test_start(self, mock_client):
+        runner = RunnerPod('key', runner_pod_body(make_pod(), []))
+        runner.start()
+        self.assertEqual(mock_client.return_value.submit_pod.call_args, call(runner.body))
+        self.assertTrue(mock_client.return_value.wait_for_running.called)
+
+    def test_execute(self, mock_client):
+        runner = RunnerPod('key', runner_pod_body(make_pod(), []))
+        self.assertEqual(runner.execute('true'), mock_client.return_value.exec_in_pod.return_value)
+        self.assertEqual(mock_client.return_value.exec_in_pod.call_args, call(['/bin/sh', '-c', 'true']))
+
+    @patch('calrissian.pool.PodMonitor')
+    def test_delete(self, mock_podmonitor, mock_client):
+        runner = RunnerPod('key', runner_pod_body(make_pod(), []))
+        runner.delete()
+        self.assertEqual(mock_client.return_value.delete_pod_name.call_args, call(runner.name))
+        self.assertEqual(mock_podmonitor.return_value.__enter__.return_value.remove.call_args,
+                         call(mock_client.return_value.pod))
+
+    @patch('calrissian.pool.PodMonitor')
+    def test_delete_not_submitted(self, mock_podmonitor, mock_client):
+        mock_client.return_value.pod = None
+        RunnerPod('key', runner_pod_body(make_pod(), [])).delete()
+        self.assertFalse(mock_client.return_value.delete_pod_name.called)
+
+
+@patch('calrissian.pool.RunnerPod')
+class RunnerPoolTestCase(TestCase):
+
+    def setUp(self):
+        RunnerPool.ttl = 30
+        RunnerPool.idle = {}
+        RunnerPool.held = {}
+
+    def tearDown(self):
+        RunnerPool.ttl = None
+        RunnerPool.idle = {}
+        RunnerPool.held = {}
+
+    def test_acquire_starts_runner(self, mock_runner_pod):
+        runner = RunnerPool.acquire({'spec': {}})
+        self.assertEqual(runner, mock_runner_pod.return_value)
+        self.assertTrue(runner.start.called)
+
+    def test_acquire_reuses_released_runner(self, mock_runner_pod):
+        runner = RunnerPool.acquire({'spec': {}})
+        runner.key = mock_runner_pod.call_args[0][0]
+        RunnerPool.release(runner)
+        mock_runner_pod.reset_mock()
+        self.assertEqual(RunnerPool.acquire({'spec': {}}), runner)
+        self.assertFalse(mock_runner_pod.called)
+
+    def test_acquire_does_not_reuse_other_key(self, mock_runner_pod):
+        runner = Mock(key='other')
+        RunnerPool.release(runner)
+        RunnerPool.acquire({'spec': {}})
+        self.assertTrue(mock_runner_pod.called)
+        self.assertEqual(RunnerPool.idle, {'other': [runner]})
+
+    def test_acquire_discards_runner_failing_to_start(self, mock_runner_pod):
+        mock_runner_pod.return_value.start.side_effect = Exception('Unschedulable')
+        with self.assertRaisesRegex(Exception, 'Unschedulable'):
+            RunnerPool.acquire({'spec': {}})
+        self.assertTrue(mock_runner_pod.return_value.delete.called)
+
+    def test_evict_expired(self, mock_runner_pod):
+        expired, recent = Mock(key='key', last_used=100), Mock(key='key', last_used=150)
+        RunnerPool.idle = {'key': [expired, recent]}
+        RunnerPool.evict_expired(now=140)
+        self.assertEqual(RunnerPool.idle, {'key': [recent]})
+        self.assertTrue(expired.delete.called)
+        self.assertFalse(recent.delete.called)
+
+    def test_evict_expired_held(self, mock_runner_pod):
+        expired = Mock(key='key', last_used=100)
+        RunnerPool.held = {'/calrissian/out1': expired}
+        RunnerPool.evict_expired(now=140)
+        self.assertEqual(RunnerPool.held, {})
+        self.assertTrue(expired.delete.called)
+
+    def test_claim_held_runner(self, mock_runner_pod):
+        runner = Mock(key='key')
+        RunnerPool.hold('/calrissian/out1', runner)
+        self.assertIsNone(RunnerPool.claim(['/calrissian/out10/rev.txt'], 'key'))
+        self.assertEqual(RunnerPool.claim(['/calrissian/input.txt', '/calrissian/out1/rev.txt'], 'key'), runner)
+        self.assertEqual(RunnerPool.held, {})
+
+    def test_claim_discards_other_key(self, mock_runner_pod):
+        runner = Mock(key='other')
+        RunnerPool.hold('/calrissian/out1', runner)
+        self.assertIsNone(RunnerPool.claim(['/calrissian/out1/rev.txt'], 'key'))
+        self.assertTrue(runner.delete.called)
+        self.assertEqual(RunnerPool.held, {})
+
+    @patch('calrissian.pool.runner_script')
+    def test_execute_fused_steps(self, mock_runner_script, mock_runner_pod):
+        mock_runner_pod.return_value.execute.return_value = Mock(exit_code=0)
+        RunnerPool.execute(make_pod(), [], [], hold_outdir='/calrissian/out1')
+        runner = mock_runner_pod.return_value
+        self.assertEqual(RunnerPool.held, {'/calrissian/out1': runner})
+        runner.key = mock_runner_pod.call_args[0][0]
+        RunnerPool.execute(make_pod(), [], [], input_paths=['/calrissian/out1/rev.txt'])
+        # The fused step ran in the held runner, which then returned to the pool
+        self.assertEqual(mock_runner_pod.call_count, 1)
+        self.assertEqual(runner.execute.call_count, 2)
+        self.assertEqual(RunnerPool.held, {})
+        self.assertEqual(RunnerPool.idle, {runner.key: [runner]})
+
+    @patch('calrissian.pool.runner_script')
+    def test_execute_does_not_hold_after_failure(self, mock_runner_script, mock_runner_pod):
+        mock_runner_pod.return_value.execute.return_value = Mock(exit_code=1)
+        RunnerPool.execute(make_pod(), [], [], hold_outdir='/calrissian/out1')
+        self.assertEqual(RunnerPool.held, {})
+
+    @patch('calrissian.pool.runner_script')
+    @patch('calrissian.pool.runner_pod_body')
+    def test_execute(self, mock_runner_pod_body, mock_runner_script, mock_runner_pod):
+        mock_pod, mock_bindings, mock_entries = Mock(), Mock(), Mock()
+        mock_runner_pod_body.return_value = {'spec': {}}
+        completion_result = RunnerPool.execute(mock_pod, mock_bindings, mock_entries)
+        runner = mock_runner_pod.return_value
+        self.assertEqual(completion_result, runner.execute.return_value)
+        self.assertEqual(mock_runner_pod_body.call_args, call(mock_pod, mock_entries))
+        self.assertEqual(mock_runner_script.call_args, call(mock_pod, mock_bindings))
+        self.assertEqual(runner.execute.call_args, call(mock_runner_script.return_value))
+        self.assertEqual(RunnerPool.idle, {runner.key: [runner]})
+
+    @patch('calrissian.pool.runner_script')
+    def test_execute_falls_back_when_runner_fails(self, mock_runner_script, mock_runner_pod):
+        runner = mock_runner_pod.return_value
+        runner.execute.side_effect = Exception('Pod deleted')
+        self.assertIsNone(RunnerPool.execute(make_pod(), [], []))
+        self.assertTrue(runner.delete.called)
+        self.assertEqual(RunnerPool.idle, {})
+
+    def test_execute_falls_back_when_runner_does_not_start(self, mock_runner_pod):
+        mock_runner_pod.return_value.start.side_effect = Exception('Unschedulable')
+        self.assertIsNone(RunnerPool.execute(make_pod(), [], []))
+
+    def test_cleanup(self, mock_runner_pod):
+        runner, held = Mock(key='key'), Mock(key='key')
+        RunnerPool.idle = {'key': [runner]}
+        RunnerPool.held = {'/calrissian/out1': held}
+        RunnerPool.cleanup()
+        self.assertTrue(runner.delete.called)
+        self.assertTrue(held.delete.called)
+        self.assertEqual(RunnerPool.held, {})
+        self.assertFalse(RunnerPool.is_enabled())
+        self.assertEqual(RunnerPool.idle, {})
@@ -0,0 +1,256 @@
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import Mock, patch, call
+
+from cwltool.command_line_tool import CommandLineTool, ExpressionTool
+from cwltool.workflow import Workflow
+
+from calrissian.gpu import GPU_SHARE_REQUIREMENT
+from calrissian.prepull import collect_images, is_gpu_tool, started_at, ImagePrePuller, start_image_prepull
+from calrissian.prepull import PREPULL_LABEL
+
+
+def make_tool(docker_requirement=None, gpu_requirement=None):
+    requirements = {'DockerRequirement': docker_requirement}
+    if gpu_requirement:
+        requirements[gpu_requirement] = {'class': gpu_requirement}
+    tool = Mock(spec=CommandLineTool)
+    tool.get_requirement.side_effect = lambda name: (requirements.get(name), True)
+    return tool
+
+
+def make_workflow(*tools):
+    workflow = Mock(spec=Workflow)
+    workflow.steps = [Mock(embedded_tool=tool) for tool in tools]
+    return workflow
+
+
+def make_container_status(name, waiting_reason=None, seconds_ago=None):
+    state = Mock(waiting=None, running=None, terminated=None)
+    if waiting_reason:
+        state.waiting = Mock(reason=waiting_reason)
+    if seconds_ago is not None:
+        state.running = Mock(started_at=datetime.now(timezone.utc) - timedelta(seconds=seconds_ago))
+    status = Mock(state=state, last_state=None)
+    # name is a Mock constructor argument, so it must be set afterwards
+    status.name = name
+    return status
+
+
+def make_pod(node_name, statuses, seconds_ago=10):
+    start_time = datetime.now(timezone.utc) - timedelta(seconds=seconds_ago)
+    pod = Mock(status=Mock(start_time=start_time, container_statuses=statuses))
+    pod.spec.node_name = node_name
+    return pod
+
+
+class CollectImagesTestCase(TestCase):
+
+    def test_collects_docker_pull(self):
+        tool = make_tool({'class': 'DockerRequirement', 'dockerPull': 'debian:stable'})
+        self.assertEqual(collect_images(tool), {'debian:stable'})
+
+    def test_uses_default_container(self):
+        self.assertEqual(collect_images(make_tool(), 'alpine:3'), {'alpine:3'})
+        self.assertEqual(collect_images(make_tool()), set())
+
+    def test_walks_nested_workflows(self):
+        subworkflow = make_workflow(make_tool({'dockerPull': 'python:3'}), make_tool({'dockerPull': 'debian:stable'}))
+        workflow = make_workflow(make_tool({'dockerPull': 'debian:stable'}), Mock(spec=ExpressionTool), subworkflow)
+        self.assertEqual(collect_images(workflow), {'debian:stable', 'python:3'})
+
+    def test_collects_images_of_gpu_tools(self):
+        workflow = make_workflow(make_tool({'dockerPull': 'debian:stable'}),
+                                 make_tool({'dockerPull': 'cuda:12'}, 'http://commonwl.org/cwltool#CUDARequirement'),
+                                 make_tool({'dockerPull': 'torch:2'}, GPU_SHARE_REQUIREMENT))
+        self.assertEqual(collect_images(workflow, gpu=True), {'cuda:12', 'torch:2'})
+        self.assertEqual(collect_images(workflow, gpu=False), {'debian:stable'})
+        self.assertEqual(len(collect_images(workflow)), 3)
+
+    def test_is_gpu_tool(self):
+        self.assertFalse(is_gpu_tool(make_tool({'dockerPull': 'debian:stable'})))
+        self.assertTrue(is_gpu_tool(make_tool(gpu_requirement=GPU_SHARE_REQUIREMENT)))
+
+
+class StartedAtTestCase(TestCase):
+
+    def test_started_at(self):
+        status = make_container_status('prepull-0', seconds_ago=5)
+        self.assertEqual(started_at(status), status.state.running.started_at)
+
+    def test_started_at_of_restarted_container(self):
+        status = make_container_status('prepull-0', 'CrashLoopBackOff')
+        first = datetime.now(timezone.utc) - timedelta(seconds=5)
+        status.last_state = Mock(running=None, terminated=Mock(started_at=first))
+        self.assertEqual(started_at(status), first)
+
+    def test_not_started(self):
+        self.assertIsNone(started_at(make_container_status('prepull-0', 'ContainerCreating')))
+
+
+class ImagePrePullerTestCase(TestCase):
+
+    def setUp(self):
+        self.prepuller = ImagePrePuller(['debian:stable', 'python:3'])
+
+    def tearDown(self):
+        ImagePrePuller.daemonset_names = []
+
+    def test_build(self):
+        body = self.prepuller.build()
+        labels = {PREPULL_LABEL: self.prepuller.name}
+        self.assertEqual(body['kind'], 'DaemonSet')
+        self.assertEqual(body['metadata'], {'name': self.prepuller.name, 'labels': labels})
+        self.assertEqual(body['spec']['selector'], {'matchLabels': labels})
+        self.assertEqual(body['spec']['template']['metadata'], {'labels': labels})
+        containers = body['spec']['template']['spec']['containers']
+        self.assertEqual([(c['name'], c['image']) for c in containers],
+                         [('prepull-0', 'debian:stable'), ('prepull-1', 'python:3')])
+        self.assertNotIn('nodeSelector', body['spec']['template']['spec'])
+        self.assertNotIn('serviceAccountName', body['spec']['template']['spec'])
+
+    def test_build_with_nodeselectors_and_serviceaccount(self):
+        prepuller = ImagePrePuller(['debian:stable'], {'disktype': 'ssd', 'zone': 1}, 'runner')
+        pod_spec = prepuller.build()['spec']['template']['spec']
+        self.assertEqual(pod_spec['nodeSelector'], {'disktype': 'ssd', 'zone': '1'})
+        self.assertEqual(pod_spec['serviceAccountName'], 'runner')
+
+    def test_observe(self):
+        pod = make_pod('node1', [
+            make_container_status('prepull-0', 'CrashLoopBackOff'),
+            make_container_status('prepull-1', 'ContainerCreating'),
+        ])
+        self.prepuller.observe(pod)
+        self.assertEqual(list(self.prepuller.pulls.keys()), [('node1', 'debian:stable')])
+        pull = self.prepuller.pulls[('node1', 'debian:stable')]
+        self.assertEqual(pull['status'], 'pulled')
+        self.assertGreaterEqual(pull['elapsed_seconds'], 10)
+
+    def test_observe_times_each_container(self):
+        pod = make_pod('node1', [
+            make_container_status('prepull-0', seconds_ago=25),
+            make_container_status('prepull-1', seconds_ago=5),
+        ], seconds_ago=30)
+        self.prepuller.observe(pod)
+        self.assertAlmostEqual(self.prepuller.pulls[('node1', 'debian:stable')]['elapsed_seconds'], 5, places=1)
+        self.assertAlmostEqual(self.prepuller.pulls[('node1', 'python:3')]['elapsed_seconds'], 20, places=1)
+
+    def test_observe_waits_for_previous_pulls(self):
+        pod = make_pod('node1', [
+            make_container_status('prepull-0', 'ContainerCreating'),
+            make_container_status('prepull-1', 'ImagePullBackOff'),
+        ])
+        self.prepuller.observe(pod)
+        self.assertEqual(self.prepuller.pulls, {})
+
+    def test_observe_failed_pull(self):
+        pod = make_pod('node1', [make_container_status('prepull-0', seconds_ago=5),
+                                 make_container_status('prepull-1', 'ImagePullBackOff')])
+        self.prepuller.observe(pod)
+        self.assertEqual(self.prepuller.pulls[('node1', 'python:3')]['status'], 'failed')
+
+    def test_observe_keeps_first_result(self):
+        pod = make_pod('node1', [make_container_status('prepull-0')], seconds_ago=10)
+        self.prepuller.observe(pod)
+        pod.status.start_time -= timedelta(seconds=100)
+        self.prepuller.observe(pod)
+        self.assertLess(self.prepuller.pulls[('node1', 'debian:stable')]['elapsed_seconds'], 100)
+
+    def test_observe_ignores_unscheduled_pod(self):
+        pod = make_pod(None, [make_container_status('prepull-0')])
+        self.prepuller.observe(pod)
+        self.assertEqual(self.prepuller.pulls, {})
+
+    def test_is_done(self):
+        daemonset = Mock(status=Mock(observed_generation=1, desired_number_scheduled=2))
+        self.prepuller.pulls = {('node1', 'debian:stable'): {}, ('node1', 'python:3'): {}}
+        self.assertFalse(self.prepuller.is_done(daemonset))
+        self.prepuller.pulls.update({('node2', 'debian:stable'): {}, ('node2', 'python:3'): {}})
+        self.assertTrue(self.prepuller.is_done(daemonset))
+
+    def test_is_not_done_until_observed(self):
+        daemonset = Mock(status=Mock(observed_generation=None, desired_number_scheduled=0))
+        self.assertFalse(self.prepuller.is_done(daemonset))
+
+    @patch('calrissian.prepull.Reporter')
+    @patch('calrissian.prepull.KubernetesClient')
+    def test_run(self, mock_client, mock_reporter):
+        pod = make_pod('node1', [make_container_status('prepull-0'), make_container_status('prepull-1')])
+        mock_client.return_value.list_pods_for_selector.return_value = [pod]
+        mock_client.return_value.read_daemonset.return_value = Mock(
+            status=Mock(observed_generation=1, desired_number_scheduled=1))
+        self.prepuller.run()
+        self.assertEqual(mock_client.return_value.create_daemonset.call_args, call(self.prepuller.build()))
+        self.assertEqual(mock_client.return_value.list_pods_for_selector.call_args,
+                         call('{}={}'.format(PREPULL_LABEL, self.prepuller.name)))
+        self.assertEqual(mock_client.return_value.delete_daemonset_name.call_args, call(self.prepuller.name))
+        self.assertEqual(ImagePrePuller.daemonset_names, [])
+        self.assertEqual(mock_reporter.add_image_pull.call_count, 2)
+
+    @patch('calrissian.prepull.time')
+    @patch('calrissian.prepull.Reporter')
+    @patch('calrissian.prepull.KubernetesClient')
+    def test_run_times_out(self, mock_client, mock_reporter, mock_time):
+        mock_time.monotonic.side_effect = [0, 1, 1000]
+        mock_client.return_value.list_pods_for_selector.return_value = []
+        mock_client.return_value.read_daemonset.return_value = Mock(
+            status=Mock(observed_generation=1, desired_number_scheduled=1))
+        self.prepuller.run()
+        self.assertEqual(mock_time.sleep.call_count, 1)
+        self.assertEqual(mock_client.return_value.delete_daemonset_name.call_args, call(self.prepuller.name))
+        self.assertFalse(mock_reporter.add_image_pull.called)
+
+    @patch('calrissian.prepull.KubernetesClient')
+    def test_cleanup(self, mock_client):
+        ImagePrePuller.daemonset_names = ['ds-1', 'ds-2']
+        ImagePrePuller.cleanup()
+        self.assertEqual(mock_client.return_value.delete_daemonset_name.mock_calls, [call('ds-1'), call('ds-2')])
+        self.assertEqual(ImagePrePuller.daemonset_names, [])
+
+    @patch('calrissian.prepull.KubernetesClient')
+    def test_cleanup_without_daemonsets(self, mock_client):
+        ImagePrePuller.cleanup()
+        self.assertFalse(mock_client.called)
+
+
+class StartImagePrepullTestCase(TestCase):
+
+    @patch('calrissian.prepull.ImagePrePuller')
+    def test_starts_prepuller(self, mock_prepuller):
+        tool = make_tool({'dockerPull': 'debian:stable'})
+        runtime_context = Mock(default_container=None, pod_nodeselectors=None, pod_gpu_nodeselectors=None,
+                               pod_serviceaccount='runner')
+        start_image_prepull(tool, runtime_context)
+        self.assertEqual(mock_prepuller.call_args_list, [call(['debian:stable'], None, 'runner')])
+        self.assertTrue(mock_prepuller.return_value.start.called)
+
+    @patch('calrissian.prepull.read_yaml')
+    @patch('calrissian.prepull.ImagePrePuller')
+    def test_starts_prepuller_per_nodeselectors(self, mock_prepuller, mock_read_yaml):
+        mock_read_yaml.side_effect = lambda path: {'pool': path.split('.')[0]}
+        workflow = make_workflow(make_tool({'dockerPull': 'debian:stable'}),
+                                 make_tool({'dockerPull': 'cuda:12'}, 'http://commonwl.org/cwltool#CUDARequirement'))
+        runtime_context = Mock(default_container=None, pod_nodeselectors='cpu.yaml',
+                               pod_gpu_nodeselectors='gpu.yaml', pod_serviceaccount=None)
+        start_image_prepull(workflow, runtime_context)
+        self.assertEqual(mock_prepuller.call_args_list, [
+            call(['debian:stable'], {'pool': 'cpu'}, None),
+            call(['cuda:12'], {'pool': 'gpu'}, None),
+        ])
+        self.assertEqual(mock_prepuller.return_value.start.call_count, 2)
+
+    @patch('calrissian.prepull.read_yaml')
+    @patch('calrissian.prepull.ImagePrePuller')
+    def test_reads_nodeselectors(self, mock_prepuller, mock_read_yaml):
+        tool = make_tool()
+        runtime_context = Mock(default_container='alpine:3', pod_nodeselectors='nodeselectors.yaml',
+                               pod_gpu_nodeselectors=None, pod_serviceaccount=None)
+        start_image_prepull(tool, runtime_context)
+        self.assertEqual(mock_read_yaml.call_args, call('nodeselectors.yaml'))
+        self.assertEqual(mock_prepuller.call_args, call(['alpine:3'], mock_read_yaml.return_value, None))
+
+    @patch('calrissian.prepull.ImagePrePuller')
+    def test_no_images(self, mock_prepuller):
+        runtime_context = Mock(default_container=None, pod_nodeselectors=None, pod_gpu_nodeselectors=None)
+        start_image_prepull(make_tool(), runtime_context)
+        self.assertFalse(mock_prepuller.called)
@@ -0,0 +1,79 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch, call
+
+from calrissian.refcache import ReferenceCache, fill_script, read_stats
+
+
+class FillScriptTestCase(TestCase):
+
+    def test_fill_script(self):
+        script = fill_script([('k1', '/calrissian/reference-sources/0', 2048),
+                              ('k2', '/calrissian/reference-sources/1', 4096)], 1024 * 1024)
+        self.assertIn('stats=/calrissian/reference-stats/stats', script)
+        # Evicts to fit the entries under the limit, in KiB, keeping those of the pod
+        self.assertIn('[ $((used + 6)) -gt 1024 ] || break', script)
+        self.assertIn('case " k1 k2 " in', script)
+        self.assertIn('cp /calrissian/reference-sources/0 "$cache/k1.partial/data"', script)
+        self.assertIn('echo "hits 4096" >> "$stats"', script)
+        self.assertIn(') 9>"$cache/k2.lock"', script)
+
+
+class ReadStatsTestCase(TestCase):
+
+    def test_read_stats(self):
+        path = os.path.join(tempfile.mkdtemp(), 'stats')
+        with open(path, 'w') as f:
+            f.write('evictions 1024\nhits 2048\nhits 4096\nmisses 512\n')
+        self.assertEqual(read_stats(path), {'evictions': 1, 'evictions_bytes': 1024, 'hits': 2, 'hits_bytes': 6144,
+                                            'misses': 1, 'misses_bytes': 512})
+
+
+class ReferenceCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'refs', 'genome.fa')
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('ACGT')
+
+    def tearDown(self):
+        ReferenceCache.directory = None
+        ReferenceCache.prefixes = []
+        ReferenceCache.max_bytes = None
+
+    def test_disabled_by_default(self):
+        self.assertFalse(ReferenceCache.is_enabled())
+        self.assertFalse(ReferenceCache.caches(self.path))
+
+    def test_caches_files_under_prefixes(self):
+        ReferenceCache.initialize('/mnt/reference-cache', [os.path.join(self.tmpdir, 'refs')], 1024.0)
+        self.assertEqual(ReferenceCache.max_bytes, 1024)
+        self.assertTrue(ReferenceCache.caches(self.path))
+        self.assertFalse(ReferenceCache.caches(os.path.dirname(self.path)))
+        self.assertFalse(ReferenceCache.caches(os.path.join(self.tmpdir, 'refs2', 'genome.fa')))
+
+    def test_entry_key(self):
+        key = ReferenceCache.entry_key(self.path)
+        self.assertEqual(ReferenceCache.entry_key(self.path), key)
+        os.utime(self.path, (1000, 1000))
+        self.assertNotEqual(ReferenceCache.entry_key(self.path), key)
+        # Copies of a file with the same checksum share an entry
+        copy = os.path.join(self.tmpdir, 'copy.fa')
+        with open(copy, 'w') as f:
+            f.write('ACGT')
+        self.assertEqual(ReferenceCache.entry_key(self.path, 'sha1$abc'), ReferenceCache.entry_key(copy, 'sha1$abc'))
+
+    @patch('calrissian.refcache.Reporter')
+    def test_record(self, mock_reporter):
+        with open(os.path.join(self.tmpdir, 'stats'), 'w') as f:
+            f.write('hits 2048\n')
+        ReferenceCache.record('step1', self.tmpdir)
+        self.assertEqual(mock_reporter.add_reference_cache_stats.call_args, call({'hits': 1, 'hits_bytes': 2048}))
+
+    @patch('calrissian.refcache.Reporter')
+    def test_record_without_stats(self, mock_reporter):
+        ReferenceCache.record('step1', self.tmpdir)
+        self.assertFalse(mock_reporter.add_reference_cache_stats.called)
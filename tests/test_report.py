@@ -1,7 +1,7 @@
 from unittest import TestCase
 from calrissian.report import TimedReport, TimedResourceReport, TimelineReport
 from calrissian.report import Event, MaxParallelCountProcessor, MaxParallelCPUsProcessor, MaxParallelRAMProcessor
-from calrissian.report import MemoryParser, CPUParser, Reporter
+from calrissian.report import MemoryParser, CPUParser, Reporter, parse_resource_quantity, format_resource_quantity
 from calrissian.report import initialize_reporter, write_report, default_serializer, sum_ignore_none
 from calrissian.k8s import CompletionResult
 from freezegun import freeze_time
@@ -114,6 +114,30 @@ class TimedResourceReportTestCase(TestCase):
         self.assertEqual(report.name, 'test-job')
         self.assertEqual(report.disk_megabytes, 10)
         self.assertEqual(report.exit_code, 0)
+        self.assertIsNone(report.peak_cpus)
+        self.assertIsNone(report.used_cpu_hours())
+
+    def test_create_with_sampled_usage(self):
+        completion_result = CompletionResult(0, '4', '3G', TIME_1000, TIME_1100, [], {}, peak_cpus=2.5,
+                                             peak_ram_megabytes=1500, mean_cpus=1.5, mean_ram_megabytes=1000)
+        report = TimedResourceReport.create('test-job', completion_result, 0)
+        self.assertEqual(report.peak_cpus, 2.5)
+        self.assertEqual(report.peak_ram_megabytes, 1500)
+        self.assertEqual(report.used_cpu_hours(), 1.5)
+        self.assertEqual(report.used_ram_megabyte_hours(), 1000)
+        report_dict = report.to_dict()
+        self.assertEqual(report_dict['mean_cpus'], 1.5)
+        self.assertEqual(report_dict['peak_ram_megabytes'], 1500)
+        self.assertEqual(report_dict['used_cpu_hours'], 1.5)
+        self.assertEqual(report_dict['used_ram_megabyte_hours'], 1000)
+        self.assertNotIn('extended_resource_hours', report_dict)
+
+    def test_create_with_extended_resources(self):
+        completion_result = CompletionResult(0, '4', '3G', TIME_1000, TIME_1100, [], {},
+                                             extended_resources={'ephemeral-storage': '2Gi', 'nvidia.com/gpu': '1'})
+        report = TimedResourceReport.create('test-job', completion_result, 0)
+        self.assertEqual(report.extended_resources, {'ephemeral-storage': 2048, 'nvidia.com/gpu': 1})
+        self.assertEqual(report.to_dict()['extended_resource_hours'], {'ephemeral-storage': 2048, 'nvidia.com/gpu': 1})
 
 
     def test_to_dict(self):
@@ -256,6 +280,111 @@ class TimelineReportTestCase(TestCase):
         self.assertEqual(report_dict['finish_time'], TIME_1100)
         self.assertEqual(report_dict['cores_allowed'], 4)
         self.assertEqual(report_dict['ram_mb_allowed'], 4096)
+        self.assertNotIn('step_cache', report_dict)
+        self.assertNotIn('reference_cache', report_dict)
+        self.assertNotIn('image_pulls', report_dict)
+        self.assertNotIn('memory_escalations', report_dict)
+        self.assertNotIn('memory_overcommit', report_dict)
+        self.assertNotIn('total_used_cpu_hours', report_dict)
+        self.assertNotIn('used_cpu_hours', report_dict['children'][0])
+        self.assertNotIn('total_extended_resource_hours', report_dict)
+        self.assertNotIn('resource_pools', report_dict)
+        self.assertNotIn('total_gpu_hours', report_dict)
+
+    def test_to_dict_with_extended_resources(self):
+        self.report.add_report(TimedResourceReport(start_time=TIME_1000, finish_time=TIME_1100, cpus=4,
+                                                   extended_resources={'ephemeral-storage': 1024}))
+        self.report.add_report(TimedResourceReport(start_time=TIME_1000, finish_time=TIME_1030, cpus=4,
+                                                   extended_resources={'ephemeral-storage': 2048,
+                                                                       'example.com/fpga': 2}))
+        report_dict = self.report.to_dict()
+        self.assertEqual(report_dict['total_extended_resource_hours'],
+                         {'ephemeral-storage': 2048, 'example.com/fpga': 1})
+
+    def test_to_dict_with_gpus(self):
+        self.report.add_report(TimedResourceReport(start_time=TIME_1000, finish_time=TIME_1100, cpus=1, gpus=0.25))
+        self.report.add_report(TimedResourceReport(start_time=TIME_1000, finish_time=TIME_1030, cpus=1, gpus=1))
+        self.report.add_report(TimedResourceReport(start_time=TIME_1000, finish_time=TIME_1030, cpus=1))
+        report_dict = self.report.to_dict()
+        self.assertEqual(report_dict['total_gpu_hours'], 0.75)
+        self.assertEqual(report_dict['children'][0]['gpu_hours'], 0.25)
+        self.assertNotIn('gpu_hours', report_dict['children'][2])
+
+    def test_to_dict_with_sampled_usage(self):
+        self.report.add_report(TimedResourceReport(start_time=TIME_1000, finish_time=TIME_1100, cpus=4,
+                                                   mean_cpus=0.5, mean_ram_megabytes=100))
+        self.report.add_report(TimedResourceReport(start_time=TIME_1000, finish_time=TIME_1030, cpus=4,
+                                                   mean_cpus=1, mean_ram_megabytes=300))
+        self.report.add_report(TimedResourceReport(start_time=TIME_1000, finish_time=TIME_1030, cpus=4))
+        report_dict = self.report.to_dict()
+        self.assertEqual(report_dict['total_cpu_hours'], 8)
+        self.assertEqual(report_dict['total_used_cpu_hours'], 1)
+        self.assertEqual(report_dict['total_used_ram_megabyte_hours'], 250)
+
+    def test_add_image_pull(self):
+        image_pull = {'image': 'debian:stable', 'node': 'node1', 'status': 'pulled', 'elapsed_seconds': 4.5}
+        self.report.add_image_pull(image_pull)
+        self.assertEqual(self.report.to_dict()['image_pulls'], [image_pull])
+
+    def test_add_memory_escalation(self):
+        escalation = {'name': 'step', 'attempt': 1, 'from_ram_megabytes': 1024, 'to_ram_megabytes': 2048}
+        self.report.add_memory_escalation(escalation)
+        self.assertEqual(self.report.to_dict()['memory_escalations'], [escalation])
+
+    def test_set_memory_overcommit(self):
+        memory_overcommit = {'max_ratio': 1.5, 'ratio': 1.25, 'admission_ratio': 1.1, 'peak_admission_ratio': 1.4,
+                             'backoffs': 1}
+        self.report.set_memory_overcommit(memory_overcommit)
+        self.assertEqual(self.report.to_dict()['memory_overcommit'], memory_overcommit)
+
+    def test_set_io_budget(self):
+        io_budget = {'budget': 16, 'peak_weight': 16, 'held_tasks': 3, 'total_io_wait_seconds': 90.0,
+                     'max_io_wait_seconds': 45.0}
+        self.report.set_io_budget(io_budget)
+        self.assertEqual(self.report.to_dict()['io_budget'], io_budget)
+
+    def test_add_queue_wait(self):
+        self.report.add_queue_wait('main/crop', 10)
+        self.report.add_queue_wait('main/crop', 30)
+        self.assertEqual(self.report.to_dict()['queue_waits'], {
+            'main/crop': {'tasks': 2, 'total_wait_seconds': 40.0, 'max_wait_seconds': 30.0}
+        })
+
+    def test_to_dict_with_resource_pools(self):
+        self.report.add_report(TimedResourceReport(start_time=TIME_1000, finish_time=TIME_1100, cpus=2,
+                                                   ram_megabytes=1024))
+        self.report.add_report(TimedResourceReport(start_time=TIME_1000, finish_time=TIME_1030, cpus=1,
+                                                   ram_megabytes=8192, resource_pool='highmem'))
+        self.report.set_resource_pools({'default': {'cores': 4, 'ram': 4096, 'gpus': 0},
+                                        'highmem': {'cores': 2, 'ram': 32768, 'gpus': 0}})
+        report_dict = self.report.to_dict()
+        self.assertEqual(report_dict['resource_pools']['default'], {
+            'cores_allowed': 4,
+            'ram_mb_allowed': 4096,
+            'total_tasks': 1,
+            'total_cpu_hours': 2,
+            'total_ram_megabyte_hours': 1024,
+            'max_parallel_cpus': 2,
+            'max_parallel_ram_megabytes': 1024,
+            'cpu_utilization': 0.5,
+            'ram_utilization': 0.25,
+        })
+        self.assertEqual(report_dict['resource_pools']['highmem']['total_cpu_hours'], 0.5)
+        self.assertEqual(report_dict['resource_pools']['highmem']['ram_utilization'], 0.125)
+        self.assertEqual(report_dict['children'][1]['resource_pool'], 'highmem')
+
+    def test_add_reference_cache_stats(self):
+        self.report.add_reference_cache_stats({'misses': 1, 'misses_bytes': 2048})
+        self.report.add_reference_cache_stats({'hits': 2, 'hits_bytes': 4096, 'misses': 1, 'misses_bytes': 1024})
+        self.assertEqual(self.report.to_dict()['reference_cache'],
+                         {'hits': 2, 'hits_bytes': 4096, 'misses': 2, 'misses_bytes': 3072})
+
+    def test_add_cache_event(self):
+        self.report.add_cache_event('hits')
+        self.report.add_cache_event('hits')
+        self.report.add_cache_event('misses')
+        report_dict = self.report.to_dict()
+        self.assertEqual(report_dict['step_cache'], {'hits': 2, 'misses': 1})
 
 
 class EventTestCase(TestCase):
@@ -390,12 +519,28 @@ class MemoryParserTestCase(TestCase):
         self.assertIn(MemoryParser.url, str(context.exception))
 
 
+class ResourceQuantityTestCase(TestCase):
+
+    def test_parse_resource_quantity(self):
+        self.assertEqual(parse_resource_quantity('ephemeral-storage', '10Gi'), 10240)
+        self.assertEqual(parse_resource_quantity('hugepages-2Mi', '512Mi'), 512)
+        self.assertEqual(parse_resource_quantity('example.com/fpga', '2'), 2)
+        self.assertEqual(parse_resource_quantity('example.com/fpga', 1), 1)
+
+    def test_format_resource_quantity(self):
+        self.assertEqual(format_resource_quantity('ephemeral-storage', 10240.0), '10240Mi')
+        self.assertEqual(format_resource_quantity('ephemeral-storage', 1.5), '1.5Mi')
+        self.assertEqual(format_resource_quantity('example.com/fpga', 2.0), '2')
+
+
 class CPUParserTestCase(TestCase):
 
     def test_parse(self):
         self.assertEqual(CPUParser.parse('6'), 6)
         self.assertEqual(CPUParser.parse('300m'), 0.3)
         self.assertEqual(CPUParser.parse('0.1'), 0.1)
+        self.assertAlmostEqual(CPUParser.parse('250000000n'), 0.25)
+        self.assertAlmostEqual(CPUParser.parse('1500u'), 0.0015)
 
     def test_raises_when_not_string(self):
         with self.assertRaises(ValueError) as context:
@@ -426,6 +571,26 @@ class ReporterTestCase(TestCase):
         Reporter.add_report(mock_report)
         self.assertIn(mock_report, Reporter.get_report().children)
 
+    def test_add_image_pull(self):
+        Reporter.add_image_pull({'image': 'debian:stable'})
+        self.assertEqual(Reporter.get_report().image_pulls, [{'image': 'debian:stable'}])
+
+    def test_add_memory_escalation(self):
+        Reporter.add_memory_escalation({'name': 'step'})
+        self.assertEqual(Reporter.get_report().memory_escalations, [{'name': 'step'}])
+
+    def test_set_memory_overcommit(self):
+        Reporter.set_memory_overcommit({'ratio': 1.5})
+        self.assertEqual(Reporter.get_report().memory_overcommit, {'ratio': 1.5})
+
+    def test_set_resource_pools(self):
+        Reporter.set_resource_pools({'gpu': {'cores': 8, 'ram': 65536, 'gpus': 4}})
+        self.assertEqual(Reporter.get_report().resource_pools, {'gpu': {'cores': 8, 'ram': 65536, 'gpus': 4}})
+
+    def test_add_cache_event(self):
+        Reporter.add_cache_event('hits')
+        self.assertEqual(Reporter.get_report().step_cache, {'hits': 1})
+
     def test_get_report(self):
         mock_timeline_report = Mock()
         Reporter.timeline_report = mock_timeline_report
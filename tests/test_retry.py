@@ -1,4 +1,4 @@
-from calrissian.retry import retry_exponential_if_exception_type
+from calrissian.retry import retry_exponential_if_exception_type, retrying_exponential_if_exception_type
 from unittest import TestCase
 from unittest.mock import Mock, patch
 
@@ -252,3 +252,24 @@ class RetryTestCase(TestCase):
             wrapped()
 
         self.assertEqual(self.mock.call_count, mock_retry_parameters.ATTEMPTS)
+
+    @patch('calrissian.retry.RetryParameters')
+    def test_retrying_runs_attempts_until_success(self, mock_retry_parameters):
+        self.setup_mock_retry_parameters(mock_retry_parameters)
+        self.mock.side_effect = [ValueError('value error'), 'result']
+        for attempt in retrying_exponential_if_exception_type(ValueError, 3, self.logger):
+            with attempt:
+                result = self.mock(attempt.retry_state.attempt_number)
+        self.assertEqual(result, 'result')
+        self.assertEqual(self.mock.call_count, 2)
+        self.assertEqual(self.mock.call_args[0], (2,))
+
+    @patch('calrissian.retry.RetryParameters')
+    def test_retrying_gives_up_after_attempts(self, mock_retry_parameters):
+        self.setup_mock_retry_parameters(mock_retry_parameters)
+        self.mock.side_effect = ValueError('value error')
+        with self.assertRaisesRegex(ValueError, 'value error'):
+            for attempt in retrying_exponential_if_exception_type(ValueError, 2, self.logger):
+                with attempt:
+                    self.mock()
+        self.assertEqual(self.mock.call_count, 2)
@@ -0,0 +1,201 @@
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import Mock, patch, call
+
+from calrissian.executor import Resources
+from calrissian.job import KubernetesVolumeBuilder
+from calrissian.k8s import PodDisruptedException
+from calrissian.speculation import sibling_group, avoid_node, Speculator
+
+
+class SiblingGroupTestCase(TestCase):
+
+    def test_sibling_group(self):
+        job = Mock(step_name='crop')
+        job.name = 'crop_12'
+        self.assertEqual(sibling_group(job), 'crop')
+        # Steps ending in digits are not merged
+        job = Mock(step_name='align_2')
+        job.name = 'align_2'
+        self.assertEqual(sibling_group(job), 'align_2')
+
+    def test_sibling_group_without_step_name(self):
+        job = Mock(step_name=None)
+        job.name = 'crop_12'
+        self.assertEqual(sibling_group(job), 'crop_12')
+
+
+class AvoidNodeTestCase(TestCase):
+
+    def test_avoid_node(self):
+        pod = {'spec': {}}
+        avoid_node(pod, 'slow-node')
+        terms = pod['spec']['affinity']['nodeAffinity']['requiredDuringSchedulingIgnoredDuringExecution']
+        self.assertEqual(terms['nodeSelectorTerms'],
+                         [{'matchFields': [{'key': 'metadata.name', 'operator': 'NotIn', 'values': ['slow-node']}]}])
+
+
+class SpeculatorTestCase(TestCase):
+
+    def setUp(self):
+        Speculator.initialize(2.0, 0.9)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.runtime_context = Mock()
+        self.runtime_context.reserve_resources.return_value = True
+
+    def tearDown(self):
+        Speculator.initialize(None)
+        self.tmpdir.cleanup()
+
+    def make_job(self):
+        job = Mock(generatemapper=None, resource_pool=None, step_name='crop', copy_back_dir=None)
+        job.name = 'crop_3'
+        job.builder.resources = {'ram': 512, 'cores': 1}
+        job.builder.outdir = '/out'
+        job.outdir = os.path.join(self.tmpdir.name, 'outdir')
+        os.makedirs(job.outdir)
+        job.volume_builder = KubernetesVolumeBuilder()
+        job.volume_builder.add_persistent_volume_entry(self.tmpdir.name, None, 'calrissian-wdir', False)
+        job.client.get_pod_for_name.return_value.spec.node_name = 'slow-node'
+        job.build_kubernetes_pod.return_value = {
+            'metadata': {'name': 'crop-3-pod-abcdefgh'},
+            'spec': {'containers': [{'volumeMounts': [
+                {'name': 'calrissian-wdir', 'mountPath': '/out', 'subPath': 'outdir'},
+                {'name': 'calrissian-wdir', 'mountPath': '/in', 'subPath': 'input'},
+            ]}]}
+        }
+        return job
+
+    def finish_siblings(self, count, seconds):
+        for _ in range(count):
+            Speculator.add('crop')
+            Speculator.finish('crop', seconds)
+
+    def test_is_enabled(self):
+        self.assertTrue(Speculator.is_enabled())
+        Speculator.initialize(None)
+        self.assertFalse(Speculator.is_enabled())
+
+    def test_is_straggler(self):
+        self.finish_siblings(9, 10)
+        Speculator.add('crop')
+        self.assertTrue(Speculator.is_straggler('crop', 25))
+        self.assertFalse(Speculator.is_straggler('crop', 15))
+
+    def test_is_not_straggler_until_most_siblings_finished(self):
+        self.finish_siblings(8, 10)
+        for _ in range(2):
+            Speculator.add('crop')
+        self.assertFalse(Speculator.is_straggler('crop', 100))
+
+    def test_is_not_straggler_until_most_of_scatter_finished(self):
+        # Siblings made but still queued count
+        self.finish_siblings(9, 10)
+        for _ in range(11):
+            Speculator.add('crop')
+        self.assertFalse(Speculator.is_straggler('crop', 100))
+
+    def test_is_not_straggler_with_few_siblings(self):
+        self.finish_siblings(3, 10)
+        Speculator.add('crop')
+        self.assertFalse(Speculator.is_straggler('crop', 100))
+
+    def test_can_speculate(self):
+        job = self.make_job()
+        self.assertTrue(Speculator.can_speculate(job))
+        job.generatemapper = Mock()
+        self.assertFalse(Speculator.can_speculate(job))
+
+    @patch('calrissian.speculation.KubernetesClient')
+    def test_speculate(self, mock_client):
+        job = self.make_job()
+        client, outdir = Speculator.speculate(job, {'metadata': {'name': 'crop-3-pod-original'}}, Resources(512, 1),
+                                              self.runtime_context)
+        self.assertEqual(client, mock_client.return_value)
+        self.assertTrue(os.path.isdir(outdir))
+        self.assertEqual(os.path.dirname(outdir), self.tmpdir.name)
+        self.assertEqual(self.runtime_context.reserve_resources.call_args,
+                         call(Resources(512, 1), self.runtime_context, block=False, pool=None))
+        self.assertEqual(job.client.get_pod_for_name.call_args, call('crop-3-pod-original'))
+        duplicate = mock_client.return_value.submit_pod.call_args[0][0]
+        volume_mounts = duplicate['spec']['containers'][0]['volumeMounts']
+        self.assertEqual(volume_mounts[0]['subPath'], os.path.basename(outdir))
+        self.assertEqual(volume_mounts[1]['subPath'], 'input')
+        self.assertIn('affinity', duplicate['spec'])
+        # The pod spec built for the job is left unchanged
+        self.assertEqual(job.build_kubernetes_pod.return_value['spec']['containers'][0]['volumeMounts'][0]['subPath'],
+                         'outdir')
+
+    @patch('calrissian.speculation.KubernetesClient')
+    def test_speculate_with_scratch_outdir(self, mock_client):
+        job = self.make_job()
+        job.copy_back_dir = '/calrissian/copy-back'
+        job.build_kubernetes_pod.return_value['spec']['containers'][0]['volumeMounts'] = [
+            {'name': 'scratch-outdir', 'mountPath': '/out'},
+            {'name': 'calrissian-wdir', 'mountPath': '/calrissian/copy-back', 'subPath': 'outdir'},
+        ]
+        _, outdir = Speculator.speculate(job, {'metadata': {'name': 'crop-3-pod-original'}}, Resources(512, 1),
+                                         self.runtime_context)
+        duplicate = mock_client.return_value.submit_pod.call_args[0][0]
+        volume_mounts = duplicate['spec']['containers'][0]['volumeMounts']
+        # The duplicate copies its results back to its own outdir, the scratch volume is left alone
+        self.assertEqual(volume_mounts[0], {'name': 'scratch-outdir', 'mountPath': '/out'})
+        self.assertEqual(volume_mounts[1]['subPath'], os.path.basename(outdir))
+
+    @patch('calrissian.speculation.KubernetesClient')
+    def test_speculate_without_resources(self, mock_client):
+        self.runtime_context.reserve_resources.return_value = False
+        self.assertIsNone(Speculator.speculate(self.make_job(), Mock(), Resources(512, 1), self.runtime_context))
+        self.assertFalse(mock_client.called)
+
+    @patch('calrissian.speculation.KubernetesClient')
+    def test_speculate_releases_resources_on_failure(self, mock_client):
+        mock_client.return_value.submit_pod.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            Speculator.speculate(self.make_job(), {'metadata': {'name': 'pod'}}, Resources(512, 1),
+                                 self.runtime_context)
+        self.assertEqual(self.runtime_context.release_resources.call_args,
+                         call(Resources(512, 1), self.runtime_context, pool=None))
+
+    def test_wait_without_straggling(self):
+        job = self.make_job()
+        self.assertEqual(Speculator.wait(job, Mock(), self.runtime_context), job.wait_for_kubernetes_pod.return_value)
+        self.assertEqual(len(Speculator.runtimes['crop']), 1)
+        self.assertFalse(self.runtime_context.reserve_resources.called)
+
+    def test_wait_raises_when_pod_fails(self):
+        job = self.make_job()
+        job.wait_for_kubernetes_pod.side_effect = PodDisruptedException('Evicted')
+        with self.assertRaises(PodDisruptedException):
+            Speculator.wait(job, Mock(), self.runtime_context)
+
+    @patch('calrissian.speculation.SPECULATION_CHECK_SECONDS', 0.01)
+    @patch('calrissian.speculation.Speculator.is_straggler', return_value=True)
+    @patch('calrissian.speculation.Speculator.speculate')
+    def test_wait_adopts_outdir_of_winning_duplicate(self, mock_speculate, mock_is_straggler):
+        job = self.make_job()
+        original_outdir = job.outdir
+        speculative_outdir = os.path.join(self.tmpdir.name, 'outdir-speculative')
+        os.makedirs(speculative_outdir)
+        deleted = threading.Event()
+        job.client.delete_pod_name.side_effect = lambda name: deleted.set()
+
+        def wait_for_original():
+            deleted.wait(5)
+            raise PodDisruptedException('Deleted')
+
+        job.wait_for_kubernetes_pod.side_effect = wait_for_original
+        duplicate_client = Mock()
+        mock_speculate.return_value = (duplicate_client, speculative_outdir)
+
+        result = Speculator.wait(job, Mock(), self.runtime_context)
+        self.assertEqual(result, duplicate_client.wait_for_completion.return_value)
+        self.assertTrue(deleted.is_set())
+        self.assertEqual(job.client.delete_pod_name.call_args, call(job.client.pod.metadata.name))
+        self.assertEqual(job.outdir, speculative_outdir)
+        self.assertFalse(os.path.exists(original_outdir))
+        self.assertEqual(self.runtime_context.release_resources.call_args,
+                         call(Resources(512, 1), self.runtime_context, pool=None))
+        self.assertEqual(mock_speculate.call_count, 1)
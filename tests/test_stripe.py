@@ -0,0 +1,44 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from calrissian.stripe import OutdirStriper, LEAST_USED
+
+
+class OutdirStriperTestCase(TestCase):
+
+    def test_round_robin(self):
+        striper = OutdirStriper(['/out1/', '/out2/', '/out3/'])
+        self.assertEqual([striper.next_prefix() for _ in range(4)], ['/out1/', '/out2/', '/out3/', '/out1/'])
+        self.assertEqual(striper.placed, {'/out1/': 2, '/out2/': 1, '/out3/': 1})
+
+    def test_unknown_placement(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown outdir placement'):
+            OutdirStriper(['/out1/'], 'random')
+
+    @patch('calrissian.stripe.OutdirStriper.used_percent')
+    def test_least_used(self, mock_used_percent):
+        used = {'/out1/': 80, '/out2/': 40, '/out3/': 40}
+        mock_used_percent.side_effect = lambda prefix: used[prefix]
+        striper = OutdirStriper(['/out1/', '/out2/', '/out3/'], LEAST_USED)
+        # Volumes used alike are taken in turn
+        self.assertEqual([striper.next_prefix() for _ in range(4)], ['/out2/', '/out3/', '/out2/', '/out3/'])
+        used['/out1/'] = 10
+        self.assertEqual(striper.next_prefix(), '/out1/')
+
+    @patch('calrissian.stripe.shutil')
+    def test_used_percent(self, mock_shutil):
+        mock_shutil.disk_usage.return_value.used = 250
+        mock_shutil.disk_usage.return_value.total = 1000
+        self.assertEqual(OutdirStriper.used_percent('/out1/run-'), 25)
+        mock_shutil.disk_usage.assert_called_with('/out1')
+
+    def test_create_outdir(self):
+        with tempfile.TemporaryDirectory() as out1, tempfile.TemporaryDirectory() as out2:
+            striper = OutdirStriper([os.path.join(out1, 'run-'), os.path.join(out2, 'run-')])
+            outdirs = [striper.create_outdir() for _ in range(2)]
+            self.assertEqual(os.path.dirname(outdirs[0]), out1)
+            self.assertEqual(os.path.dirname(outdirs[1]), out2)
+            self.assertTrue(all(os.path.basename(outdir).startswith('run-') for outdir in outdirs))
+            self.assertTrue(all(os.path.isdir(outdir) for outdir in outdirs))
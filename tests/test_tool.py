@@ -1,7 +1,10 @@
 from unittest import TestCase
 from unittest.mock import Mock, patch, call
+from cwltool.errors import WorkflowException
 from calrissian.dask import CalrissianCommandLineDaskJob
-from calrissian.tool import CalrissianCommandLineTool, calrissian_make_tool, CalrissianCommandLineToolException
+from calrissian.job import CalrissianCommandLineJob
+from calrissian.tool import CalrissianCommandLineTool, calrissian_make_tool, CalrissianCommandLineToolException, \
+    memory_tmpdir_resources
 from calrissian.context import CalrissianLoadingContext
 from calrissian.main import add_custom_schema
 
@@ -37,6 +40,211 @@ class CalrissianCommandLineToolTestCase(TestCase):
         runner = tool.make_job_runner(Mock())
         self.assertEqual(runner, mock_command_line_job)
 
+    @patch('calrissian.tool.CommandLineTool.job')
+    def test_job_sets_tool_document(self, mock_job):
+        mock_calrissian_job = Mock(spec=CalrissianCommandLineJob)
+        mock_job.return_value = iter([None, mock_calrissian_job])
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        runtime_context = Mock(memory_tmpdir=False, step_path=('main', 'crop'))
+        runtime_context.name = 'crop'
+        jobs = list(tool.job({}, Mock(), runtime_context))
+        self.assertEqual(jobs, [None, mock_calrissian_job])
+        self.assertEqual(mock_calrissian_job.tool_document, tool.tool)
+        self.assertEqual(mock_calrissian_job.step_name, 'crop')
+        self.assertEqual(mock_calrissian_job.step_path, ('main', 'crop'))
+        self.assertFalse(mock_calrissian_job.fuse_downstream)
+        self.assertFalse(mock_calrissian_job.fused_upstream)
+
+    @patch('calrissian.tool.CommandLineTool.job')
+    def test_job_sets_fusion(self, mock_job):
+        mock_calrissian_job = Mock(spec=CalrissianCommandLineJob)
+        mock_job.return_value = iter([mock_calrissian_job])
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        tool.fuse_downstream = True
+        list(tool.job({}, Mock(), Mock(memory_tmpdir=False)))
+        self.assertTrue(mock_calrissian_job.fuse_downstream)
+        self.assertFalse(mock_calrissian_job.fused_upstream)
+
+    @patch('calrissian.tool.UsageHistory')
+    @patch('calrissian.tool.CommandLineTool.job')
+    def test_job_right_sizes_resources(self, mock_job, mock_usage_history):
+        mock_calrissian_job = Mock(spec=CalrissianCommandLineJob)
+        mock_calrissian_job.builder = Mock(resources={'cores': 4, 'ram': 8192})
+        mock_job.return_value = iter([mock_calrissian_job])
+        mock_usage_history.is_right_sizing.return_value = True
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        list(tool.job({}, Mock(), Mock()))
+        self.assertEqual(mock_usage_history.right_size.call_args,
+                         call(mock_calrissian_job.usage_history_key.return_value, {'cores': 4, 'ram': 8192}))
+        self.assertEqual(mock_calrissian_job.builder.resources, mock_usage_history.right_size.return_value)
+
+    @patch('calrissian.tool.CommandLineTool.job')
+    def test_job_adds_extended_resources(self, mock_job):
+        mock_calrissian_job = Mock(spec=CalrissianCommandLineJob)
+        mock_calrissian_job.builder = Mock(resources={'cores': 4, 'ram': 8192,
+                                                      'extended': {'ephemeral-storage': 2048}})
+        mock_job.return_value = iter([mock_calrissian_job])
+        self.toolpath_object['hints'] = [{
+            'class': 'https://calrissian-cwl.github.io/schema#ExtendedResources',
+            'resources': {'hugepages-2Mi': '1Gi', 'example.com/fpga': 1}
+        }]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        list(tool.job({}, Mock(), Mock()))
+        self.assertEqual(mock_calrissian_job.builder.resources['extended'],
+                         {'ephemeral-storage': 2048, 'hugepages-2Mi': 1024, 'example.com/fpga': 1})
+
+    @patch('calrissian.tool.CommandLineTool.job')
+    def test_job_shares_gpu(self, mock_job):
+        mock_calrissian_job = Mock(spec=CalrissianCommandLineJob)
+        mock_calrissian_job.builder = Mock(resources={'cores': 1, 'ram': 1024, 'gpus': 1})
+        mock_job.return_value = iter([mock_calrissian_job])
+        self.toolpath_object['hints'] = [{
+            'class': 'https://calrissian-cwl.github.io/schema#GPUShare',
+            'share': 0.25
+        }]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        list(tool.job({}, Mock(), Mock(gpu_slices=8)))
+        self.assertEqual(mock_calrissian_job.builder.resources['gpus'], 0.25)
+        self.assertEqual(mock_calrissian_job.builder.resources['gpuReplicas'], 2)
+
+    @patch('calrissian.tool.CommandLineTool.job')
+    def test_job_shares_gpu_without_max_gpus(self, mock_job):
+        mock_job.return_value = iter([Mock(spec=CalrissianCommandLineJob)])
+        self.toolpath_object['hints'] = [{
+            'class': 'https://calrissian-cwl.github.io/schema#GPUShare',
+            'share': 0.25
+        }]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        with self.assertRaisesRegex(WorkflowException, '--max-gpus'):
+            list(tool.job({}, Mock(), Mock(gpu_slices=8, max_gpus=None, resource_pools=None)))
+        self.assertFalse(mock_job.called)
+
+    @patch('calrissian.tool.Speculator')
+    @patch('calrissian.tool.CommandLineTool.job')
+    def test_job_counts_siblings_for_speculation(self, mock_job, mock_speculator):
+        mock_job.return_value = iter([Mock(spec=CalrissianCommandLineJob), Mock(spec=CalrissianCommandLineJob)])
+        mock_speculator.is_enabled.return_value = True
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        runtime_context = Mock(memory_tmpdir=False)
+        runtime_context.name = 'crop'
+        list(tool.job({}, Mock(), runtime_context))
+        self.assertEqual(mock_speculator.add.call_args_list, [call('crop'), call('crop')])
+
+    @patch('calrissian.tool.CommandLineTool.job')
+    def test_job_sets_fair_share(self, mock_job):
+        mock_calrissian_job = Mock(spec=CalrissianCommandLineJob)
+        mock_calrissian_job.builder = Mock(resources={'cores': 1, 'ram': 1024})
+        mock_job.return_value = iter([mock_calrissian_job])
+        self.toolpath_object['hints'] = [{
+            'class': 'https://calrissian-cwl.github.io/schema#FairShare',
+            'weight': 2
+        }]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        list(tool.job({}, Mock(), Mock()))
+        self.assertEqual(mock_calrissian_job.fair_share_weight, 2)
+
+    @patch('calrissian.tool.CommandLineTool.job')
+    def test_job_sets_concurrency(self, mock_job):
+        mock_calrissian_job = Mock(spec=CalrissianCommandLineJob)
+        mock_calrissian_job.builder = Mock(resources={'cores': 1, 'ram': 1024})
+        mock_job.return_value = iter([mock_calrissian_job])
+        self.toolpath_object['hints'] = [{
+            'class': 'https://calrissian-cwl.github.io/schema#Concurrency',
+            'maxConcurrency': 4
+        }]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        list(tool.job({}, Mock(), Mock()))
+        self.assertEqual(mock_calrissian_job.concurrency_group, '1')
+        self.assertEqual(mock_calrissian_job.concurrency_limit, 4)
+
+    def test_concurrency_group(self):
+        self.toolpath_object['hints'] = [{
+            'class': 'https://calrissian-cwl.github.io/schema#Concurrency',
+            'maxConcurrency': 2,
+            'group': 'geocoding-api'
+        }]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        self.assertEqual(tool.concurrency(), ('geocoding-api', 2))
+
+    @patch('calrissian.tool.CommandLineTool.job')
+    def test_job_sets_io_weight(self, mock_job):
+        mock_calrissian_job = Mock(spec=CalrissianCommandLineJob)
+        mock_calrissian_job.builder = Mock(resources={'cores': 1, 'ram': 1024})
+        mock_job.return_value = iter([mock_calrissian_job])
+        self.toolpath_object['hints'] = [{
+            'class': 'https://calrissian-cwl.github.io/schema#IOClass',
+            'ioClass': 'heavy'
+        }]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        list(tool.job({}, Mock(), Mock()))
+        self.assertEqual(mock_calrissian_job.io_weight, 4)
+
+    @patch('calrissian.tool.CommandLineTool.job')
+    def test_job_with_scratch_outdir_is_not_batchable(self, mock_job):
+        mock_calrissian_job = Mock(spec=CalrissianCommandLineJob)
+        mock_calrissian_job.builder = Mock(resources={'cores': 1, 'ram': 1024})
+        mock_job.return_value = iter([mock_calrissian_job])
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        list(tool.job({}, Mock(), Mock(scratch_outdir=True, memory_tmpdir=False)))
+        self.assertFalse(mock_calrissian_job.batchable)
+
+    @patch('calrissian.tool.CommandLineTool.job')
+    def test_job_with_memory_tmpdir(self, mock_job):
+        mock_calrissian_job = Mock(spec=CalrissianCommandLineJob)
+        mock_calrissian_job.builder = Mock(resources={'cores': 1, 'ram': 1024, 'ramMax': 2048, 'tmpdirSize': 512})
+        mock_job.return_value = iter([mock_calrissian_job])
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        list(tool.job({}, Mock(), Mock(scratch_outdir=False, memory_tmpdir=True)))
+        self.assertEqual(mock_calrissian_job.builder.resources['ram'], 1536)
+        self.assertEqual(mock_calrissian_job.builder.resources['ramMax'], 2560)
+        self.assertEqual(mock_calrissian_job.memory_tmpdir_megabytes, 512)
+        self.assertFalse(mock_calrissian_job.batchable)
+
+    def test_memory_tmpdir(self):
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        self.assertFalse(tool.memory_tmpdir(Mock(memory_tmpdir=False)))
+        self.assertTrue(tool.memory_tmpdir(Mock(memory_tmpdir=True)))
+        self.toolpath_object['hints'] = [{'class': 'https://calrissian-cwl.github.io/schema#MemoryTmpdir'}]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        self.assertTrue(tool.memory_tmpdir(Mock(memory_tmpdir=False)))
+        # Tools opt out of --memory-tmpdir
+        self.toolpath_object['hints'] = [{'class': 'https://calrissian-cwl.github.io/schema#MemoryTmpdir',
+                                          'enabled': False}]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        self.assertFalse(tool.memory_tmpdir(Mock(memory_tmpdir=True)))
+
+    def test_memory_tmpdir_resources(self):
+        resources = {'cores': 1, 'ram': 1024, 'ramMax': 1024, 'tmpdirSize': 1024,
+                     'extended': {'ephemeral-storage': 3072}}
+        moved, size_megabytes = memory_tmpdir_resources(resources)
+        self.assertEqual(size_megabytes, 1024)
+        self.assertEqual(moved, {'cores': 1, 'ram': 2048, 'ramMax': 2048, 'tmpdirSize': 1024,
+                                 'extended': {'ephemeral-storage': 2048}})
+        self.assertEqual(resources['ram'], 1024)
+
+    def test_io_weight(self):
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        self.assertEqual(tool.io_weight(), 0)
+        self.toolpath_object['hints'] = [{'class': 'https://calrissian-cwl.github.io/schema#IOClass', 'weight': 3}]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        self.assertEqual(tool.io_weight(), 3)
+
+    def test_io_weight_of_unknown_class(self):
+        self.toolpath_object['hints'] = [{'class': 'https://calrissian-cwl.github.io/schema#IOClass',
+                                          'ioClass': 'extreme'}]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        with self.assertRaisesRegex(WorkflowException, 'must be one of light, medium, heavy'):
+            tool.io_weight()
+
+    def test_concurrency_must_be_positive(self):
+        self.toolpath_object['hints'] = [{
+            'class': 'https://calrissian-cwl.github.io/schema#Concurrency',
+            'maxConcurrency': 0
+        }]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        with self.assertRaisesRegex(WorkflowException, 'at least 1'):
+            tool.concurrency()
+
     def test_fails_use_container_false(self):
         tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
         runtimeContext = Mock(use_container=False)
@@ -92,6 +300,19 @@ class CalrissianCommandLineToolTestCase(TestCase):
 
         self.assertEqual(runner, CalrissianCommandLineDaskJob)
     
+    def test_supports_calrissian_requirements(self):
+        add_custom_schema()
+        self.toolpath_object['requirements'] = [
+            {'class': 'https://calrissian-cwl.github.io/schema#GPUShare', 'share': 0.5},
+            {'class': 'https://calrissian-cwl.github.io/schema#ExtendedResources',
+             'resources': {'example.com/fpga': 1}},
+            {'class': 'https://calrissian-cwl.github.io/schema#FairShare', 'weight': 2},
+        ]
+        tool = CalrissianCommandLineTool(self.toolpath_object, self.loadingContext)
+        self.assertEqual(tool.gpu_share(), {'class': 'https://calrissian-cwl.github.io/schema#GPUShare',
+                                            'share': 0.5})
+        self.assertEqual(tool.extended_resources(), {'example.com/fpga': 1})
+
     def test_uses_dask_hints(self):
         # Set up the tool with a Dask requirement
         self.toolpath_object['hints'] = [